@@ -7,7 +7,12 @@ import torch
 
 from mattergen.common.data.chemgraph import ChemGraph
 from mattergen.common.data.types import PropertySourceId
-from mattergen.denoiser import GemNetTDenoiser, get_chemgraph_from_denoiser_output
+from mattergen.denoiser import (
+    GemNetTDenoiser,
+    conditioning_inputs,
+    get_chemgraph_from_denoiser_output,
+)
+from mattergen.diffusion.inference_options import cached_conditioning
 from mattergen.property_embeddings import (
     ZerosEmbedding,
     get_property_embeddings,
@@ -64,30 +69,18 @@ class GemNetTAdapter(GemNetTDenoiser):
         t_enc = self.noise_level_encoding(t).to(lattice.device)
         z_per_crystal = t_enc
 
-        # shape = (Nbatch, sum(hidden_dim of all properties in condition_on_adapt))
-        conditions_base_model: torch.Tensor = get_property_embeddings(
-            property_embeddings=self.property_embeddings, batch=x
+        # evaluate the conditions, once per batch during sampling
+        conditions_base_model, conditions_adapt_dict, conditions_adapt_mask_dict = (
+            cached_conditioning(
+                key=(self, "conditions"),
+                inputs=conditioning_inputs(x, self.cond_fields_model_was_trained_on),
+                compute=lambda: self._conditions(x),
+            )
         )
 
         if len(conditions_base_model) > 0:
             z_per_crystal = torch.cat([z_per_crystal, conditions_base_model], dim=-1)
 
-        # compose into a dict
-        conditions_adapt_dict = {}
-        conditions_adapt_mask_dict = {}
-        for cond_field, property_embedding in self.property_embeddings_adapt.items():
-            conditions_adapt_dict[cond_field] = property_embedding.forward(batch=x)
-            try:
-                conditions_adapt_mask_dict[cond_field] = get_use_unconditional_embedding(
-                    batch=x, cond_field=cond_field
-                )
-            except KeyError:
-                # no values have been provided for the conditional field,
-                # interpret this as the user wanting an unconditional score
-                conditions_adapt_mask_dict[cond_field] = torch.ones_like(
-                    x["num_atoms"], dtype=torch.bool
-                ).reshape(-1, 1)
-
         output = self.gemnet(
             z=z_per_crystal,
             frac_coords=frac_coords,
@@ -116,6 +109,35 @@ class GemNetTAdapter(GemNetTDenoiser):
             x_input=x,
         )
 
+    def _conditions(
+        self, x: ChemGraph
+    ) -> tuple[torch.Tensor, dict[str, torch.Tensor], dict[str, torch.Tensor]]:
+        """
+        Embeddings of the conditions of the base model, and embeddings and unconditional masks of the
+        conditions of the adapter.
+        """
+        # shape = (Nbatch, sum(hidden_dim of all properties in condition_on_adapt))
+        conditions_base_model: torch.Tensor = get_property_embeddings(
+            property_embeddings=self.property_embeddings, batch=x
+        )
+
+        # compose into a dict
+        conditions_adapt_dict = {}
+        conditions_adapt_mask_dict = {}
+        for cond_field, property_embedding in self.property_embeddings_adapt.items():
+            conditions_adapt_dict[cond_field] = property_embedding.forward(batch=x)
+            try:
+                conditions_adapt_mask_dict[cond_field] = get_use_unconditional_embedding(
+                    batch=x, cond_field=cond_field
+                )
+            except KeyError:
+                # no values have been provided for the conditional field,
+                # interpret this as the user wanting an unconditional score
+                conditions_adapt_mask_dict[cond_field] = torch.ones_like(
+                    x["num_atoms"], dtype=torch.bool
+                ).reshape(-1, 1)
+        return conditions_base_model, conditions_adapt_dict, conditions_adapt_mask_dict
+
     @property
     def cond_fields_model_was_trained_on(self) -> list[PropertySourceId]:
         """
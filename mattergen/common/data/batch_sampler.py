@@ -0,0 +1,92 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+from typing import Iterator, Sequence
+
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+
+
+class AtomBudgetBatchSampler(Sampler[list[int]]):
+    """Batch sampler that packs crystals into batches with a bounded total number of atoms.
+
+    The number of edges and triplets in the radius graphs built by the denoiser scales with the number of atoms
+    (the number of neighbors per atom is capped), so bounding the number of atoms per batch bounds the peak memory
+    and evens out the time per batch.
+
+    Indices are processed in windows of `window_size` crystals. Within a window, crystals are sorted by their number of atoms
+    and greedily packed into batches, such that crystals of similar size end up in the same batch.
+
+    Args:
+        num_atoms: number of atoms of each crystal in the dataset.
+        max_atoms_per_batch: maximum total number of atoms in a batch. A crystal with more atoms gets a batch of its own.
+        max_batch_size: maximum number of crystals in a batch. If None, only the atom budget limits the batch size.
+        window_size: number of crystals sorted together. If None, all crystals are sorted together.
+        shuffle: whether to shuffle the crystals before splitting them into windows, and the order of the batches.
+        generator: random number generator used for shuffling.
+    """
+
+    def __init__(
+        self,
+        num_atoms: Sequence[int] | np.ndarray | torch.Tensor,
+        max_atoms_per_batch: int,
+        max_batch_size: int | None = None,
+        window_size: int | None = None,
+        shuffle: bool = False,
+        generator: torch.Generator | None = None,
+    ):
+        assert max_atoms_per_batch > 0, "max_atoms_per_batch must be positive."
+        assert max_batch_size is None or max_batch_size > 0, "max_batch_size must be positive."
+        assert window_size is None or window_size > 0, "window_size must be positive."
+        self.num_atoms = np.asarray(num_atoms, dtype=np.int64).reshape(-1)
+        self.max_atoms_per_batch = max_atoms_per_batch
+        self.max_batch_size = max_batch_size
+        self.window_size = window_size
+        self.shuffle = shuffle
+        self.generator = generator
+        # Batches for the next call to __iter__, so that __len__ is consistent with it when shuffling.
+        self._next_batches: list[list[int]] | None = None
+
+    def _make_batches(self) -> list[list[int]]:
+        num_crystals = len(self.num_atoms)
+        if self.shuffle:
+            order = torch.randperm(num_crystals, generator=self.generator).numpy()
+        else:
+            order = np.arange(num_crystals)
+        window_size = self.window_size or max(num_crystals, 1)
+
+        batches: list[list[int]] = []
+        for start in range(0, num_crystals, window_size):
+            window = order[start : start + window_size]
+            window = window[np.argsort(self.num_atoms[window], kind="stable")]
+            batch: list[int] = []
+            batch_atoms = 0
+            for ix in window.tolist():
+                n = int(self.num_atoms[ix])
+                if batch and (
+                    batch_atoms + n > self.max_atoms_per_batch
+                    or (self.max_batch_size is not None and len(batch) == self.max_batch_size)
+                ):
+                    batches.append(batch)
+                    batch, batch_atoms = [], 0
+                batch.append(ix)
+                batch_atoms += n
+            if batch:
+                batches.append(batch)
+
+        if self.shuffle:
+            batches = [
+                batches[i] for i in torch.randperm(len(batches), generator=self.generator).tolist()
+            ]
+        return batches
+
+    def __iter__(self) -> Iterator[list[int]]:
+        batches = self._next_batches if self._next_batches is not None else self._make_batches()
+        self._next_batches = None
+        yield from batches
+
+    def __len__(self) -> int:
+        if self._next_batches is None:
+            self._next_batches = self._make_batches()
+        return len(self._next_batches)
@@ -1,12 +1,19 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT License.
 
+import csv
+import json
+from collections import Counter
 from functools import partial
+from pathlib import Path
 from typing import Callable, Iterable, Sequence
 
+import numpy as np
 import torch
+from pymatgen.core.structure import Structure
 from torch.utils.data import DataLoader, Dataset
 
+from mattergen.common.data.batch_sampler import AtomBudgetBatchSampler
 from mattergen.common.data.chemgraph import ChemGraph
 from mattergen.common.data.collate import collate
 from mattergen.common.data.dataset import NumAtomsCrystalDataset
@@ -18,6 +25,10 @@ from mattergen.diffusion.data.batched_data import BatchedData
 
 ConditionLoader = Iterable[tuple[BatchedData, dict[str, torch.Tensor]] | None]
 
+# Name of the field that holds the row of a condition table that a sample is conditioned on. PyG offsets
+# fields named `*index*` by the number of nodes when batching, so this is not called `condition_index`.
+CONDITION_ROW = "condition_row"
+
 
 def _collate_fn(
     batch: Sequence[ChemGraph],
@@ -26,6 +37,30 @@ def _collate_fn(
     return collate_fn(batch), None
 
 
+def _get_data_loader(
+    dataset: Dataset,
+    num_atoms: Sequence[int],
+    batch_size: int,
+    shuffle: bool,
+    max_atoms_per_batch: int | None,
+    window_size: int | None,
+) -> DataLoader:
+    collate_fn = partial(_collate_fn, collate_fn=collate)
+    if max_atoms_per_batch is None:
+        return DataLoader(dataset, batch_size=batch_size, collate_fn=collate_fn, shuffle=shuffle)
+    return DataLoader(
+        dataset,
+        batch_sampler=AtomBudgetBatchSampler(
+            num_atoms=num_atoms,
+            max_atoms_per_batch=max_atoms_per_batch,
+            max_batch_size=batch_size,
+            window_size=window_size,
+            shuffle=shuffle,
+        ),
+        collate_fn=collate_fn,
+    )
+
+
 def get_number_of_atoms_condition_loader(
     num_atoms_distribution: str,
     num_samples: int,
@@ -33,7 +68,17 @@ def get_number_of_atoms_condition_loader(
     shuffle: bool = True,
     transforms: list[Transform] | None = None,
     properties: TargetProperty | None = None,
+    max_atoms_per_batch: int | None = None,
+    window_size: int | None = 4096,
 ) -> ConditionLoader:
+    """
+    Returns a dataloader over conditions with a number of atoms drawn from the given distribution.
+
+    If `max_atoms_per_batch` is given, crystals of similar size are packed into batches with at most
+    `max_atoms_per_batch` atoms and at most `batch_size` crystals each (see `AtomBudgetBatchSampler`),
+    so that peak memory does not depend on which sizes happen to be drawn together. Crystals are then sorted by size
+    within windows of `window_size` crystals.
+    """
     transforms = transforms or []
     if properties is not None:
         for k, v in properties.items():
@@ -46,11 +91,95 @@ def get_number_of_atoms_condition_loader(
         num_samples=num_samples,
         transforms=transforms,
     )
-    return DataLoader(
+    return _get_data_loader(
         dataset,
+        num_atoms=dataset.num_atoms,
         batch_size=batch_size,
-        collate_fn=partial(_collate_fn, collate_fn=collate),
         shuffle=shuffle,
+        max_atoms_per_batch=max_atoms_per_batch,
+        window_size=window_size,
+    )
+
+
+def load_condition_table(path: str | Path) -> list[TargetProperty]:
+    """
+    Loads a condition table, i.e., a list of the properties to condition on, one dictionary per row.
+    The table is either a .json file with a list of dictionaries, or a .csv file with one column per property,
+    e.g., `dft_bulk_modulus,chemical_system` and rows like `100.0,Li-O`. Numeric values in a .csv file are read as floats.
+    """
+    path = Path(path)
+    if path.suffix == ".json":
+        with open(path) as f:
+            conditions = json.load(f)
+    elif path.suffix == ".csv":
+        with open(path, newline="") as f:
+            conditions = [
+                {k: _parse_csv_value(v) for k, v in row.items()} for row in csv.DictReader(f)
+            ]
+    else:
+        raise ValueError(f"Unsupported condition table format: {path}. Use a .json or .csv file.")
+    _check_condition_table(conditions)
+    return conditions
+
+
+def _parse_csv_value(value: str) -> float | str:
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+
+def _check_condition_table(conditions: Sequence[TargetProperty]) -> None:
+    if len(conditions) == 0:
+        raise ValueError("The condition table is empty.")
+    # Samples of different rows are batched together, so they need to have the same fields.
+    keys = set(conditions[0].keys())
+    for ix, row in enumerate(conditions):
+        if set(row.keys()) != keys:
+            raise ValueError(
+                f"All rows of the condition table must set the same properties, but row {ix} sets "
+                f"{sorted(row.keys())} and row 0 sets {sorted(keys)}."
+            )
+        if any(v is None or v == "" for v in row.values()):
+            raise ValueError(f"Row {ix} of the condition table has missing values: {row}.")
+
+
+def get_condition_table_loader(
+    num_atoms_distribution: str,
+    conditions: Sequence[TargetProperty],
+    num_samples_per_condition: int,
+    batch_size: int,
+    shuffle: bool = True,
+    max_atoms_per_batch: int | None = None,
+    window_size: int | None = 4096,
+) -> ConditionLoader:
+    """
+    Returns a dataloader over `num_samples_per_condition` conditions for each row of a condition table (see
+    `load_condition_table`), with a number of atoms drawn from the given distribution.
+
+    Unlike `get_number_of_atoms_condition_loader`, the samples of a batch can have different properties, so that a grid of
+    target values fills whole batches. Each sample has a `condition_row` field with the row of its properties.
+    """
+    _check_condition_table(conditions)
+    assert num_samples_per_condition > 0, "Generate at least one structure per condition."
+    assert (
+        num_atoms_distribution in NUM_ATOMS_DISTRIBUTIONS
+    ), f"Invalid num_atoms_distribution: {num_atoms_distribution}"
+    dataset = NumAtomsCrystalDataset.from_num_atoms_distribution(
+        num_atoms_distribution=NUM_ATOMS_DISTRIBUTIONS[num_atoms_distribution],
+        num_samples=len(conditions) * num_samples_per_condition,
+    )
+    return _get_data_loader(
+        ConditionTableDataset(
+            dataset,
+            conditions=conditions,
+            condition_rows=np.repeat(np.arange(len(conditions)), num_samples_per_condition),
+        ),
+        num_atoms=dataset.num_atoms,
+        batch_size=batch_size,
+        shuffle=shuffle,
+        max_atoms_per_batch=max_atoms_per_batch,
+        window_size=window_size,
     )
 
 
@@ -58,12 +187,15 @@ def get_composition_data_loader(
     target_compositions_dict: list[dict[str, float]],
     num_structures_to_generate_per_composition: int,
     batch_size: int,
+    max_atoms_per_batch: int | None = None,
+    window_size: int | None = None,
 ) -> ConditionLoader:
     """
     Given a list of target compositions, generate a dataset of chemgraphs
     where each chemgraph contains atoms corresponding to the target composition
     without positions or cell information.
     Returns a torch dataloader equipped with the correct collate function containing such dataset.
+    If `max_atoms_per_batch` is given, batches are packed up to this number of atoms, as in `get_number_of_atoms_condition_loader`.
     """
 
     dataset_ = []
@@ -75,11 +207,57 @@ def get_composition_data_loader(
 
     dataset = ChemGraphlistDataset(dataset_)
 
-    return DataLoader(
+    return _get_data_loader(
         dataset,
+        num_atoms=[int(chemgraph.num_atoms) for chemgraph in dataset_],
         batch_size=batch_size,
-        collate_fn=partial(_collate_fn, collate_fn=collate),
         shuffle=False,
+        max_atoms_per_batch=max_atoms_per_batch,
+        window_size=window_size,
+    )
+
+
+def get_structure_condition_loader(
+    structures: Sequence[Structure],
+    fixed_atom_types: bool = False,
+    properties: TargetProperty | None = None,
+    conditions: Sequence[TargetProperty] | None = None,
+) -> ConditionLoader:
+    """
+    Returns a dataloader with one batch per structure, holding the conditions that the structure was generated from:
+    its number of atoms, the given properties and, if `fixed_atom_types` (crystal structure prediction), its atom types
+    in the order of its sites. If the structures were generated from a condition table `conditions`, their properties are
+    taken from the row in their `condition_row` property instead.
+    """
+    if fixed_atom_types:
+        # Atoms are grouped by element, in the order of the composition the structure was generated for.
+        dataset: Dataset = ChemGraphlistDataset(
+            [
+                create_chem_graph_from_composition(
+                    dict(Counter(site.specie.symbol for site in structure))
+                )
+                for structure in structures
+            ]
+        )
+    else:
+        transforms: list[Transform] = [SetProperty(k, v) for k, v in (properties or {}).items()]
+        dataset = NumAtomsCrystalDataset(
+            num_atoms=np.array([len(structure) for structure in structures]),
+            transforms=transforms,
+        )
+        if conditions is not None:
+            dataset = ConditionTableDataset(
+                dataset,
+                conditions=conditions,
+                condition_rows=[structure.properties[CONDITION_ROW] for structure in structures],
+            )
+    return _get_data_loader(
+        dataset,
+        num_atoms=[len(structure) for structure in structures],
+        batch_size=1,
+        shuffle=False,
+        max_atoms_per_batch=None,
+        window_size=None,
     )
 
 
@@ -93,3 +271,29 @@ class ChemGraphlistDataset(Dataset):
 
     def __getitem__(self, index: int) -> ChemGraph:
         return self.data[index]
+
+
+class ConditionTableDataset(Dataset):
+    """Sets the properties of row `condition_rows[index]` of `conditions` on sample `index` of `dataset`."""
+
+    def __init__(
+        self,
+        dataset: Dataset,
+        conditions: Sequence[TargetProperty],
+        condition_rows: Sequence[int],
+    ) -> None:
+        super().__init__()
+        assert len(condition_rows) == len(dataset)  # type: ignore
+        self.dataset = dataset
+        self.condition_rows = [int(ix) for ix in condition_rows]
+        self.transforms = [[SetProperty(k, v) for k, v in row.items()] for row in conditions]
+
+    def __len__(self) -> int:
+        return len(self.condition_rows)
+
+    def __getitem__(self, index: int) -> ChemGraph:
+        condition_row = self.condition_rows[index]
+        data = self.dataset[index]
+        for t in self.transforms[condition_row]:
+            data = t(data)
+        return data.replace(**{CONDITION_ROW: torch.tensor(condition_row)})
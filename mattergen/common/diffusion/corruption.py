@@ -4,6 +4,7 @@
 import torch
 from omegaconf import DictConfig
 
+from mattergen.diffusion import per_sample_rng
 from mattergen.diffusion.corruption.corruption import B, BatchedData, maybe_expand
 from mattergen.diffusion.corruption.sde_lib import SDE as DiffSDE
 from mattergen.diffusion.corruption.sde_lib import VESDE as DiffVESDE
@@ -171,7 +172,7 @@ class LatticeVPSDE(VPSDE):
         conditioning_data: BatchedData | None = None,
         batch_idx: B = None,
     ) -> torch.Tensor:
-        x_sample = torch.randn(*shape)
+        x_sample = per_sample_rng.randn(shape, batch_idx)
         x_sample = make_noise_symmetric_preserve_variance(x_sample)
         assert conditioning_data is not None
         limit_info = conditioning_data[self.limit_info_key]
@@ -266,7 +267,9 @@ class NumAtomsVarianceAdjustedWrappedVESDE(WrappedVESDE):
         # prior sample is randn() * sigma_max, so we need additionally multiply by std_scale to get the correct variance.
         # We call VESDE.prior_sampling (a "grandparent" function) because the super() prior_sampling already does the wrapping,
         # which means we couldn't do the variance adjustment here anymore otherwise.
-        prior_sample = DiffVESDE.prior_sampling(self, shape=shape).to(num_atoms.device)
+        prior_sample = DiffVESDE.prior_sampling(self, shape=shape, batch_idx=batch_idx).to(
+            num_atoms.device
+        )
         return self.wrap(prior_sample * maybe_expand(std_scale, batch_idx, like=prior_sample))
 
     def sde(
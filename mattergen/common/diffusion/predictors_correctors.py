@@ -5,10 +5,11 @@ import torch
 
 from mattergen.common.diffusion import corruption as sde_lib
 from mattergen.common.utils.data_utils import compute_lattice_polar_decomposition
+from mattergen.diffusion import per_sample_rng
 from mattergen.diffusion.corruption.corruption import Corruption, maybe_expand
 from mattergen.diffusion.data.batched_data import BatchedData
 from mattergen.diffusion.sampling import predictors_correctors as pc
-from mattergen.diffusion.sampling.predictors import AncestralSamplingPredictor
+from mattergen.diffusion.sampling.predictors import AncestralSamplingPredictor, DDIMPredictor
 
 SampleAndMean = tuple[torch.Tensor, torch.Tensor]
 
@@ -42,7 +43,9 @@ class LatticeAncestralSamplingPredictor(AncestralSamplingPredictor):
         # => mean_coeff = 1 - x_coeff = 1 - 1/(1-beta)
         mean_coeff = 1 - x_coeff
         # Sample random noise.
-        z = sde_lib.make_noise_symmetric_preserve_variance(torch.randn_like(x_coeff))
+        z = sde_lib.make_noise_symmetric_preserve_variance(
+            per_sample_rng.randn_like(x_coeff, batch_idx)
+        )
         assert hasattr(self.corruption, "get_limit_mean")  # mypy
         mean = (
             x_coeff * x
@@ -53,6 +56,25 @@ class LatticeAncestralSamplingPredictor(AncestralSamplingPredictor):
         return sample, mean
 
 
+class LatticeDDIMPredictor(DDIMPredictor):
+    """DDIM / probability flow predictor for the LatticeVPSDE, whose prior is centered at the limit mean."""
+
+    @classmethod
+    def is_compatible(cls, corruption: Corruption) -> bool:
+        _super = super()
+        assert hasattr(_super, "is_compatible")
+        return _super.is_compatible(corruption) or isinstance(corruption, sde_lib.LatticeVPSDE)
+
+    def _get_limit_mean(self, x: torch.Tensor, batch: BatchedData | None) -> torch.Tensor | float:
+        assert hasattr(self.corruption, "get_limit_mean")  # mypy
+        return self.corruption.get_limit_mean(x=x, batch=batch)
+
+    def _sample_noise(self, like: torch.Tensor, batch_idx: torch.LongTensor) -> torch.Tensor:
+        return sde_lib.make_noise_symmetric_preserve_variance(
+            per_sample_rng.randn_like(like, batch_idx)
+        )
+
+
 # create a langevin corrector that accepts LatticeVPSDE
 class LatticeLangevinDiffCorrector(pc.LangevinCorrector):
     @classmethod
@@ -73,22 +95,18 @@ class LatticeLangevinDiffCorrector(pc.LangevinCorrector):
         assert isinstance(self.corruption, sde_lib.LatticeVPSDE)
         alpha = self.get_alpha(t, dt=dt)
         snr = self.snr
-        noise = torch.randn_like(x)
+        noise = per_sample_rng.randn_like(x, batch_idx)
         noise = sde_lib.make_noise_symmetric_preserve_variance(noise)
 
-        # [batch_size, ] or [num_atoms, ] if batch_idx is not None
-        grad_norm_square = torch.square(score).reshape(score.shape[0], -1).sum(dim=1)
-        noise_norm_square = torch.square(noise).reshape(noise.shape[0], -1).sum(dim=1)
-        # Average over items, leading to scalars.
-        grad_norm = grad_norm_square.sqrt().mean()
-        noise_norm = noise_norm_square.sqrt().mean()
+        # Each row of the lattice belongs to its own sample.
+        grad_norm, noise_norm = self.score_and_noise_norms(score, noise, batch_idx=None)
 
         # If gradient is zero (i.e., we are sampling from an improper distribution that's flat over the whole of R^n)
         # the step_size blows up. Clip step_size to avoid this.
         # The EGNN reports zero scores when there are no edges between nodes.
         step_size = (snr * noise_norm / grad_norm) ** 2 * 2 * alpha
         step_size = torch.minimum(step_size, self.max_step_size)
-        step_size[grad_norm == 0, :] = self.max_step_size
+        step_size = torch.where(grad_norm == 0, self.max_step_size, step_size)
         step_size = maybe_expand(step_size, batch_idx, score)
         mean = x + step_size * score
         x = mean + torch.sqrt(step_size * 2) * noise
@@ -0,0 +1,94 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+from dataclasses import dataclass
+from functools import lru_cache
+
+import torch
+from pymatgen.core.periodic_table import Element
+
+from mattergen.common.data.chemgraph import ChemGraph
+from mattergen.common.utils.globals import MAX_ATOMIC_NUM
+
+# Converts amu / Angstrom**3 to g / cm**3.
+_AMU_PER_CUBIC_ANGSTROM_TO_G_PER_CM3 = 1.66053906660
+
+
+@dataclass(frozen=True)
+class CrystalScreen:
+    """Screen for `PredictorCorrector` that drops crystals that are bound to be invalid.
+
+    A crystal fails the screen if any of the enabled checks fails on the estimate of the denoised crystal.
+    Atom types that are not real elements (e.g., the mask token of the atom type diffusion) are ignored by the checks.
+
+    Args:
+        min_interatomic_distance: minimum distance between atoms (in Angstrom), taking periodic images into account.
+            The default is the cutoff of `structure_validity`. Crystals with a volume below 0.1 Angstrom**3 fail this check, too.
+        density_range: (minimum, maximum) density in g/cm**3.
+        max_num_elements: maximum number of different elements.
+    """
+
+    min_interatomic_distance: float | None = 0.5
+    density_range: tuple[float, float] | None = None
+    max_num_elements: int | None = None
+
+    def __call__(self, x0: ChemGraph) -> torch.Tensor:
+        keep = torch.ones(x0.get_batch_size(), dtype=torch.bool, device=x0.pos.device)
+        cell = x0.cell.to(torch.float32)
+        volume = torch.linalg.det(cell).abs()
+        batch_idx = x0.get_batch_idx("pos")
+        assert batch_idx is not None
+        atomic_numbers = x0.atomic_numbers
+        is_element = (atomic_numbers >= 1) & (atomic_numbers <= MAX_ATOMIC_NUM)
+
+        if self.min_interatomic_distance is not None:
+            keep &= volume >= 0.1
+            keep &= _min_interatomic_distances(x0.pos, cell, x0.num_atoms) >= (
+                self.min_interatomic_distance
+            )
+        if self.density_range is not None:
+            masses = _atomic_masses(str(atomic_numbers.device))[
+                torch.where(is_element, atomic_numbers, 0)
+            ]
+            mass = torch.zeros_like(volume).index_add_(0, batch_idx, masses)
+            density = mass / volume.clamp(min=1e-8) * _AMU_PER_CUBIC_ANGSTROM_TO_G_PER_CM3
+            keep &= (density >= self.density_range[0]) & (density <= self.density_range[1])
+        if self.max_num_elements is not None:
+            present = torch.zeros(
+                (len(keep), MAX_ATOMIC_NUM + 1), dtype=torch.bool, device=keep.device
+            )
+            present[batch_idx[is_element], atomic_numbers[is_element]] = True
+            keep &= present.sum(dim=1) <= self.max_num_elements
+        return keep
+
+
+@lru_cache
+def _atomic_masses(device: str) -> torch.Tensor:
+    """Atomic masses in amu, indexed by atomic number. Index 0 has mass 0."""
+    return torch.tensor(
+        [0.0] + [float(Element.from_Z(z).atomic_mass) for z in range(1, MAX_ATOMIC_NUM + 1)],
+        device=device,
+    )
+
+
+def _min_interatomic_distances(
+    frac_coords: torch.Tensor, cell: torch.Tensor, num_atoms: torch.Tensor
+) -> torch.Tensor:
+    """Smallest distance between two different atoms of each crystal (or inf for crystals with one atom),
+    over the periodic images in the neighboring unit cells."""
+    offsets = torch.cartesian_prod(*[torch.arange(-1, 2, device=frac_coords.device)] * 3).to(
+        frac_coords.dtype
+    )
+    distances = []
+    for frac, lattice in zip(frac_coords.split(num_atoms.tolist()), cell):
+        n = len(frac)
+        if n < 2:
+            distances.append(torch.tensor(float("inf"), device=frac.device))
+            continue
+        delta = (frac[:, None, :] - frac[None, :, :]).remainder(1.0)
+        # shape (n, n, 27, 3)
+        cart = (delta[:, :, None, :] + offsets) @ lattice.to(frac.dtype)
+        d = cart.norm(dim=-1).min(dim=-1).values
+        d = d.masked_fill(torch.eye(n, dtype=torch.bool, device=d.device), float("inf"))
+        distances.append(d.min())
+    return torch.stack(distances).to(cell.dtype)
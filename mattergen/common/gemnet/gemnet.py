@@ -6,17 +6,22 @@ Adapted from https://github.com/FAIR-Chem/fairchem/blob/main/src/fairchem/core/m
 """
 
 from dataclasses import dataclass
+from functools import partial
 from typing import Optional, Tuple
 
 # import numpy as np
 import torch
 import torch.nn as nn
 from torch_scatter import scatter
-from torch_sparse import SparseTensor
 
 from mattergen.common.gemnet.layers.atom_update_block import OutputBlock
 from mattergen.common.gemnet.layers.base_layers import Dense
-from mattergen.common.gemnet.layers.efficient import EfficientInteractionDownProjection
+from mattergen.common.gemnet.layers.efficient import (
+    EfficientInteractionDownProjection,
+    TripletChunk,
+    map_edge_chunks,
+    split_triplets_into_chunks,
+)
 from mattergen.common.gemnet.layers.embedding_block import EdgeEmbedding
 from mattergen.common.gemnet.layers.interaction_block import InteractionBlockTripletsOnly
 from mattergen.common.gemnet.layers.radial_basis import RadialBasis
@@ -25,17 +30,25 @@ from mattergen.common.gemnet.layers.spherical_basis import CircularBasisLayer
 from mattergen.common.gemnet.utils import (
     inner_product_normalized,
     mask_neighbors,
-    ragged_range,
     repeat_blocks,
+    symmetric_edge_triplets,
 )
 from mattergen.common.utils.data_utils import (
+    RadiusGraphAlgorithm,
     frac_to_cart_coords_with_lattice,
     get_pbc_distances,
     lattice_params_to_matrix_torch,
     radius_graph_pbc,
 )
-from mattergen.common.utils.globals import MODELS_PROJECT_ROOT, get_device, get_pyg_device
+from mattergen.common.utils.globals import MODELS_PROJECT_ROOT
 from mattergen.common.utils.lattice_score import edge_score_to_lattice_score_frac_symmetric
+from mattergen.common.utils.neighbor_list_cache import VerletNeighborList
+from mattergen.diffusion.inference_options import (
+    CompiledFunction,
+    autocast,
+    current_inference_cache,
+    current_inference_options,
+)
 
 
 @dataclass(frozen=True)
@@ -46,6 +59,30 @@ class ModelOutput:
     stress: Optional[torch.Tensor] = None
 
 
+@dataclass(frozen=True)
+class _GraphTopology:
+    # Interaction graph with symmetric edges, see GemNetT.reorder_symmetric_edges
+    edge_index: torch.Tensor
+    cell_offsets: torch.Tensor
+    neighbors: torch.Tensor
+    # Which edges of the input graph are kept and how they and their counter-edges are ordered
+    mask: torch.Tensor
+    edge_reorder_idx: torch.Tensor
+    # Indices for symmetric message passing and triplets, see symmetric_edge_triplets
+    id_swap: torch.Tensor
+    id3_ba: torch.Tensor
+    id3_ca: torch.Tensor
+    id3_ragged_idx: torch.Tensor
+
+
+@dataclass
+class _ReusedGraph:
+    # Neighbor list that a GemNet keeps across calls, see mattergen.diffusion.inference_options
+    neighbor_list: VerletNeighborList
+    # Topology of the interaction graph that was last built from the neighbor list
+    topology: _GraphTopology | None = None
+
+
 class RBFBasedLatticeUpdateBlock(torch.nn.Module):
     # Lattice update block that mimics GemNet's edge processing, e.g., uses radial basis functions.
     def __init__(
@@ -106,9 +143,27 @@ class RBFBasedLatticeUpdateBlockFrac(RBFBasedLatticeUpdateBlock):
         normalize_score: bool = True,
     ) -> torch.Tensor:
         edge_scores = self.compute_score_per_edge(edge_emb=edge_emb, rbf=rbf)
+        return self.edge_scores_to_lattice_update(
+            edge_scores=edge_scores,
+            edge_index=edge_index,
+            distance_vec=distance_vec,
+            batch=batch,
+            normalize_score=normalize_score,
+        )
+
+    def edge_scores_to_lattice_update(
+        self,
+        edge_scores: torch.Tensor,  # [Num_edges, num_heads]
+        edge_index: torch.Tensor,  # [2, Num_edges]
+        distance_vec: torch.Tensor,  # [Num_edges, 3]
+        batch: torch.Tensor,  # [Num_atoms, ]
+        normalize_score: bool = True,
+    ) -> torch.Tensor:
+        # The lattice update is linear in the edge scores, so the scores of several blocks can be summed
+        # before they are converted.
         if normalize_score:
             num_edges = scatter(torch.ones_like(distance_vec[:, 0]), batch[edge_index[0]])
-            edge_scores /= num_edges[batch[edge_index[0]], None]
+            edge_scores = edge_scores / num_edges[batch[edge_index[0]], None]
         outs = []
         for i in range(self.num_out):
             lattice_update = edge_score_to_lattice_score_frac_symmetric(
@@ -163,6 +218,9 @@ class GemNetT(torch.nn.Module):
             Number of residual blocks in the atom embedding blocks.
         cutoff: float
             Embedding cutoff for interactomic directions in Angstrom.
+        radius_graph_algorithm: str
+            How to find the neighbors within the cutoff if otf_graph, "all_pairs" or "cell_list". Both give the same
+            graph, but "cell_list" scales linearly with the number of atoms per crystal, see RadiusGraphAlgorithm.
         rbf: dict
             Name and hyperparameters of the radial basis function.
         envelope: dict
@@ -208,6 +266,7 @@ class GemNetT(torch.nn.Module):
         activation: str = "swish",
         max_cell_images_per_dim: int = 5,
         encoder_mode: bool = False,  #
+        radius_graph_algorithm: RadiusGraphAlgorithm = "all_pairs",
         **kwargs,
     ):
         super().__init__()
@@ -226,6 +285,8 @@ class GemNetT(torch.nn.Module):
 
         self.max_cell_images_per_dim = max_cell_images_per_dim
 
+        self.radius_graph_algorithm = radius_graph_algorithm
+
         self.otf_graph = otf_graph
 
         self.regress_stress = regress_stress
@@ -360,53 +421,8 @@ class GemNetT(torch.nn.Module):
             (self.mlp_rbf_h, self.num_blocks),
             (self.mlp_rbf_out, self.num_blocks + 1),
         ]
-
-    def get_triplets(
-        self, edge_index: torch.Tensor, num_atoms: int
-    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
-        """
-        Get all b->a for each edge c->a.
-        It is possible that b=c, as long as the edges are distinct.
-
-        Returns
-        -------
-        id3_ba: torch.Tensor, shape (num_triplets,)
-            Indices of input edge b->a of each triplet b->a<-c
-        id3_ca: torch.Tensor, shape (num_triplets,)
-            Indices of output edge c->a of each triplet b->a<-c
-        id3_ragged_idx: torch.Tensor, shape (num_triplets,)
-            Indices enumerating the copies of id3_ca for creating a padded matrix
-        """
-        idx_s, idx_t = edge_index  # c->a (source=c, target=a)
-
-        value = torch.arange(idx_s.size(0), device=idx_s.device, dtype=idx_s.dtype)
-        # Possibly contains multiple copies of the same edge (for periodic interactions)
-        pyg_device = get_pyg_device() if idx_s.device != torch.device("cpu") else idx_s.device
-        torch_device = get_device() if idx_s.device != torch.device("cpu") else idx_s.device
-        adj = SparseTensor(
-            row=idx_t.to(pyg_device),
-            col=idx_s.to(pyg_device),
-            value=value.to(pyg_device),
-            sparse_sizes=(num_atoms.to(pyg_device), num_atoms.to(pyg_device)),
-        )
-        adj_edges = adj[idx_t.to(pyg_device)].to(torch_device)
-
-        # Edge indices (b->a, c->a) for triplets.
-        id3_ba = adj_edges.storage.value().to(torch_device)
-        id3_ca = adj_edges.storage.row().to(torch_device)
-
-        # Remove self-loop triplets
-        # Compare edge indices, not atom indices to correctly handle periodic interactions
-        mask = id3_ba != id3_ca
-        id3_ba = id3_ba[mask]
-        id3_ca = id3_ca[mask]
-
-        # Get indices to reshape the neighbor indices b->a into a dense matrix.
-        # id3_ca has to be sorted for this to work.
-        num_triplets = torch.bincount(id3_ca, minlength=idx_s.size(0))
-        id3_ragged_idx = ragged_range(num_triplets)
-
-        return id3_ba, id3_ca, id3_ragged_idx
+        # Used instead of self._interaction_blocks, compiled if the inference options say so.
+        self._compiled_interaction_blocks = CompiledFunction(self._interaction_blocks)
 
     def select_symmetric_edges(self, tensor, mask, reorder_idx, inverse_neg):
         # Mask out counter-edges
@@ -418,26 +434,20 @@ class GemNetT(torch.nn.Module):
         tensor_ordered = tensor_cat[reorder_idx]
         return tensor_ordered
 
-    def reorder_symmetric_edges(
+    def _symmetric_edge_order(
         self,
         edge_index: torch.Tensor,
         cell_offsets: torch.Tensor,
         neighbors: torch.Tensor,
-        edge_dist: torch.Tensor,
-        edge_vector: torch.Tensor,
-    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
         """
-        Reorder edges to make finding counter-directional edges easier.
+        Which edges `reorder_symmetric_edges` keeps and how it orders them and their counter-edges. Only depends on the
+        topology of the graph.
 
-        Some edges are only present in one direction in the data,
-        since every atom has a maximum number of neighbors. Since we only use i->j
-        edges here, we lose some j->i edges and add others by
-        making it symmetric.
-        We could fix this by merging edge_index with its counter-edges,
-        including the cell_offsets, and then running torch.unique.
-        But this does not seem worth it.
+        returns:
+            mask of the kept edges, index to reorder the kept edges and their counter-edges, the reordered edge_index
+            and the number of reordered edges per image.
         """
-
         # Generate mask
         mask_sep_atoms = edge_index[0] < edge_index[1]
         # Distinguish edges between the same (periodic) atom by ordering the cells
@@ -480,6 +490,30 @@ class GemNetT(torch.nn.Module):
 
         # Reorder everything so the edges of every image are consecutive
         edge_index_new = edge_index_cat[:, edge_reorder_idx]
+        return mask, edge_reorder_idx, edge_index_new, neighbors_new
+
+    def reorder_symmetric_edges(
+        self,
+        edge_index: torch.Tensor,
+        cell_offsets: torch.Tensor,
+        neighbors: torch.Tensor,
+        edge_dist: torch.Tensor,
+        edge_vector: torch.Tensor,
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        Reorder edges to make finding counter-directional edges easier.
+
+        Some edges are only present in one direction in the data,
+        since every atom has a maximum number of neighbors. Since we only use i->j
+        edges here, we lose some j->i edges and add others by
+        making it symmetric.
+        We could fix this by merging edge_index with its counter-edges,
+        including the cell_offsets, and then running torch.unique.
+        But this does not seem worth it.
+        """
+        mask, edge_reorder_idx, edge_index_new, neighbors_new = self._symmetric_edge_order(
+            edge_index, cell_offsets, neighbors
+        )
         cell_offsets_new = self.select_symmetric_edges(cell_offsets, mask, edge_reorder_idx, True)
         edge_dist_new = self.select_symmetric_edges(edge_dist, mask, edge_reorder_idx, False)
         edge_vector_new = self.select_symmetric_edges(edge_vector, mask, edge_reorder_idx, True)
@@ -531,7 +565,12 @@ class GemNetT(torch.nn.Module):
         torch.Tensor,
         torch.Tensor,
     ]:
-        if self.otf_graph:
+        reused_graph = self._reused_graph()
+        if reused_graph is not None:
+            edge_index, to_jimages, num_bonds = reused_graph.neighbor_list(
+                cart_coords, lattice, num_atoms
+            )
+        elif self.otf_graph:
             edge_index, to_jimages, num_bonds = radius_graph_pbc(
                 cart_coords=cart_coords,
                 lattice=lattice,
@@ -539,6 +578,7 @@ class GemNetT(torch.nn.Module):
                 radius=self.cutoff,
                 max_num_neighbors_threshold=self.max_neighbors,
                 max_cell_images_per_dim=self.max_cell_images_per_dim,
+                algorithm=self.radius_graph_algorithm,
             )
 
         # Switch the indices, so the second one becomes the target index,
@@ -561,44 +601,198 @@ class GemNetT(torch.nn.Module):
         # But we want to use col as idx_t for efficient aggregation.
         V_st = -out["distance_vec"] / D_st[:, None]
 
-        (
-            edge_index,
-            cell_offsets,
-            neighbors,
+        if (
+            reused_graph is not None
+            and reused_graph.topology is not None
+            and not reused_graph.neighbor_list.graph_changed
+        ):
+            topology = reused_graph.topology
+        else:
+            topology = self._graph_topology(edge_index, to_jimages, num_bonds, num_atoms)
+            if reused_graph is not None:
+                reused_graph.topology = topology
+        D_st = self.select_symmetric_edges(D_st, topology.mask, topology.edge_reorder_idx, False)
+        V_st = self.select_symmetric_edges(V_st, topology.mask, topology.edge_reorder_idx, True)
+
+        return (
+            topology.edge_index,
+            topology.neighbors,
             D_st,
             V_st,
-        ) = self.reorder_symmetric_edges(edge_index, to_jimages, num_bonds, D_st, V_st)
+            topology.id_swap,
+            topology.id3_ba,
+            topology.id3_ca,
+            topology.id3_ragged_idx,
+            topology.cell_offsets,
+        )
 
-        # Indices for swapping c->a and a->c (for symmetric MP)
-        block_sizes = neighbors // 2
+    def _reused_graph(self) -> _ReusedGraph | None:
+        """The neighbor list that this model keeps across calls, if it builds its graph on the fly and is called
+        with a neighbor list skin and an inference cache."""
+        skin = current_inference_options().neighbor_list_skin
+        cache = current_inference_cache()
+        if skin is None or cache is None or not self.otf_graph:
+            return None
+        reused_graph = cache.neighbor_lists.get(self)
+        if reused_graph is None:
+            reused_graph = cache.neighbor_lists[self] = _ReusedGraph(
+                neighbor_list=VerletNeighborList(
+                    cutoff=self.cutoff,
+                    skin=skin,
+                    max_num_neighbors_threshold=self.max_neighbors,
+                    max_cell_images_per_dim=self.max_cell_images_per_dim,
+                    algorithm=self.radius_graph_algorithm,
+                )
+            )
+        return reused_graph
 
-        # Remove 0 sizes
-        block_sizes = torch.masked_select(block_sizes, block_sizes > 0)
-        id_swap = repeat_blocks(
-            block_sizes,
-            repeats=2,
-            continuous_indexing=False,
-            start_idx=block_sizes[0],
-            block_inc=block_sizes[:-1] + block_sizes[1:],
-            repeat_inc=-block_sizes,
+    def _graph_topology(
+        self,
+        edge_index: torch.Tensor,
+        cell_offsets: torch.Tensor,
+        neighbors: torch.Tensor,
+        num_atoms: torch.Tensor,
+    ) -> _GraphTopology:
+        """The symmetric edges of the interaction graph and its triplets, which only depend on its topology."""
+        mask, edge_reorder_idx, edge_index, neighbors_new = self._symmetric_edge_order(
+            edge_index, cell_offsets, neighbors
         )
+        cell_offsets = self.select_symmetric_edges(cell_offsets, mask, edge_reorder_idx, True)
 
-        id3_ba, id3_ca, id3_ragged_idx = self.get_triplets(
-            edge_index,
-            num_atoms=num_atoms.sum(),
+        id_swap, id3_ba, id3_ca, id3_ragged_idx = symmetric_edge_triplets(
+            edge_index, neighbors_new, num_atoms=int(num_atoms.sum())
+        )
+        return _GraphTopology(
+            edge_index=edge_index,
+            cell_offsets=cell_offsets,
+            neighbors=neighbors_new,
+            mask=mask,
+            edge_reorder_idx=edge_reorder_idx,
+            id_swap=id_swap,
+            id3_ba=id3_ba,
+            id3_ca=id3_ca,
+            id3_ragged_idx=id3_ragged_idx,
         )
 
-        return (
-            edge_index,
-            neighbors,
-            D_st,
-            V_st,
-            id_swap,
-            id3_ba,
-            id3_ca,
-            id3_ragged_idx,
-            cell_offsets,
+    def _circular_basis(
+        self,
+        D_st: torch.Tensor,
+        V_st: torch.Tensor,
+        id3_ba: torch.Tensor,
+        id3_ca: torch.Tensor,
+        id3_ragged_idx: torch.Tensor,
+    ) -> tuple[tuple[torch.Tensor, torch.Tensor], list[TripletChunk] | None]:
+        """
+        The circular basis of the triplets for the interaction blocks and, if the inference options set
+        `max_triplets_per_chunk`, the chunks in which the interaction and output blocks process the triplets and edges
+        (see `mattergen.diffusion.inference_options`). Chunked calls run in eager mode, since the number of chunks
+        varies between batches.
+        """
+        # Calculate triplet angles
+        cosφ_cab = inner_product_normalized(V_st[id3_ca], V_st[id3_ba])
+        rad_cbf3, cbf3 = self.cbf_basis3(D_st, cosφ_cab, id3_ca)
+        max_triplets = current_inference_options().max_triplets_per_chunk
+        if max_triplets is None:
+            # Padded to the maximum number of triplets per edge, whose data-dependent size is only computed here.
+            return self.mlp_cbf3(rad_cbf3, cbf3, id3_ca, id3_ragged_idx), None
+        # Padded one chunk at a time in the interaction blocks.
+        cbf3 = self.mlp_cbf3(rad_cbf3, cbf3, id3_ca, id3_ragged_idx, pad=False)
+        chunks = split_triplets_into_chunks(
+            id3_ca, num_edges=D_st.shape[0], max_triplets_per_chunk=max_triplets
         )
+        return cbf3, chunks
+
+    def _embed_edges(
+        self,
+        h: torch.Tensor,
+        rbf: torch.Tensor,
+        idx_s: torch.Tensor,
+        idx_t: torch.Tensor,
+        cosines: torch.Tensor,
+    ) -> torch.Tensor:
+        m = self.edge_emb(h, rbf, idx_s, idx_t)  # (nEdges, emb_size_edge)
+        m = torch.cat([m, cosines], dim=-1)
+        return self.angle_edge_emb(m)
+
+    def _interaction_blocks(
+        self,
+        z: torch.Tensor | None,
+        atomic_numbers: torch.Tensor,
+        batch: torch.Tensor,
+        rbf: torch.Tensor,
+        cbf3: tuple[torch.Tensor, torch.Tensor],
+        cosines: torch.Tensor,
+        edge_index: torch.Tensor,
+        id_swap: torch.Tensor,
+        id3_ba: torch.Tensor,
+        id3_ca: torch.Tensor,
+        id3_ragged_idx: torch.Tensor,
+        chunks: list[TripletChunk] | None = None,
+    ) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        Runs the embedding, interaction and output blocks on the interaction graph and its basis functions.
+        Only takes and returns tensors, so that it can be compiled, see `mattergen.diffusion.inference_options`,
+        except for the chunks of triplets of chunked message passing, which runs in eager mode (see
+        `_circular_basis`).
+
+        returns:
+            node embeddings: (N_atoms, emb_size_atom)
+            energy per atom: (N_atoms, num_targets)
+            force per edge: (N_edges, num_targets)
+            lattice score per edge: (N_edges, num_heads)
+        """
+        idx_s, idx_t = edge_index
+        # Embedding block
+        h = self.atom_emb(atomic_numbers)
+        # Merge z and atom embedding
+        if z is not None:
+            z_per_atom = z[batch]
+            h = torch.cat([h, z_per_atom], dim=1)
+            # Combine all embeddings
+            h = self.atom_latent_emb(h)
+        # (nAtoms, emb_size_atom)
+        m = map_edge_chunks(
+            partial(self._embed_edges, h), chunks, rbf, idx_s, idx_t, cosines
+        )  # (nEdges, emb_size_edge)
+
+        rbf3 = self.mlp_rbf3(rbf)
+
+        rbf_h = self.mlp_rbf_h(rbf)
+        rbf_out = self.mlp_rbf_out(rbf)
+
+        E_t, F_st = self.out_blocks[0](h, m, rbf_out, idx_t, chunks=chunks)
+        # Accumulate the outputs of all blocks in full precision.
+        E_t, F_st = E_t.float(), F_st.float()
+
+        rbf_lattice = self.mlp_rbf_lattice(rbf)
+        lattice_scores = map_edge_chunks(
+            self.lattice_out_blocks[0].compute_score_per_edge, chunks, m, rbf_lattice
+        ).float()
+        for i in range(self.num_blocks):
+            # Interaction block
+            h, m = self.int_blocks[i](
+                h=h,
+                m=m,
+                rbf3=rbf3,
+                cbf3=cbf3,
+                id3_ragged_idx=id3_ragged_idx,
+                id_swap=id_swap,
+                id3_ba=id3_ba,
+                id3_ca=id3_ca,
+                rbf_h=rbf_h,
+                idx_s=idx_s,
+                idx_t=idx_t,
+                chunks=chunks,
+            )  # (nAtoms, emb_size_atom), (nEdges, emb_size_edge)
+
+            E, F = self.out_blocks[i + 1](h, m, rbf_out, idx_t, chunks=chunks)
+            # (nAtoms, num_targets), (nEdges, num_targets)
+            F_st += F
+            E_t += E
+            lattice_scores += map_edge_chunks(
+                self.lattice_out_blocks[i + 1].compute_score_per_edge, chunks, m, rbf_lattice
+            )
+        return h.float(), E_t, F_st, lattice_scores
 
     def forward(
         self,
@@ -667,79 +861,42 @@ class GemNetT(torch.nn.Module):
         )
         idx_s, idx_t = edge_index
 
-        # Calculate triplet angles
-        cosφ_cab = inner_product_normalized(V_st[id3_ca], V_st[id3_ba])
-        rad_cbf3, cbf3 = self.cbf_basis3(D_st, cosφ_cab, id3_ca)
+        cbf3, chunks = self._circular_basis(D_st, V_st, id3_ba, id3_ca, id3_ragged_idx)
 
         rbf = self.radial_basis(D_st)
-
-        # Embedding block
-        h = self.atom_emb(atomic_numbers)
-        # Merge z and atom embedding
-        if z is not None:
-            z_per_atom = z[batch]
-            h = torch.cat([h, z_per_atom], dim=1)
-            # Combine all embeddings
-            h = self.atom_latent_emb(h)
-        # (nAtoms, emb_size_atom)
-        m = self.edge_emb(h, rbf, idx_s, idx_t)  # (nEdges, emb_size_edge)
         batch_edge = batch[edge_index[0]]
         cosines = torch.cosine_similarity(V_st[:, None], distorted_lattice[batch_edge], dim=-1)
-        m = torch.cat([m, cosines], dim=-1)
-        m = self.angle_edge_emb(m)
-
-        rbf3 = self.mlp_rbf3(rbf)
-        cbf3 = self.mlp_cbf3(rad_cbf3, cbf3, id3_ca, id3_ragged_idx)
-
-        rbf_h = self.mlp_rbf_h(rbf)
-        rbf_out = self.mlp_rbf_out(rbf)
-
-        E_t, F_st = self.out_blocks[0](h, m, rbf_out, idx_t)
-
         distance_vec = V_st * D_st[:, None]
 
-        lattice_update = None
-        rbf_lattice = self.mlp_rbf_lattice(rbf)
-        lattice_update = self.lattice_out_blocks[0](
-            edge_emb=m,
-            edge_index=edge_index,
-            distance_vec=distance_vec,
-            lattice=distorted_lattice,
-            batch=batch,
-            rbf=rbf_lattice,
-            normalize_score=True,
+        # With mixed-precision inference, the embeddings, dense layers and interaction blocks run in
+        # lower precision. The graph and basis functions above and the aggregation of the outputs below
+        # stay in full precision.
+        interaction_blocks = (
+            self._compiled_interaction_blocks if chunks is None else self._interaction_blocks
         )
-        F_fully_connected = torch.tensor(0.0, device=distorted_lattice.device)
-        for i in range(self.num_blocks):
-            # Interaction block
-            h, m = self.int_blocks[i](
-                h=h,
-                m=m,
-                rbf3=rbf3,
+        with autocast(pos.device):
+            h, E_t, F_st, lattice_scores = interaction_blocks(
+                z=z,
+                atomic_numbers=atomic_numbers,
+                batch=batch,
+                rbf=rbf,
                 cbf3=cbf3,
-                id3_ragged_idx=id3_ragged_idx,
+                cosines=cosines,
+                edge_index=edge_index,
                 id_swap=id_swap,
                 id3_ba=id3_ba,
                 id3_ca=id3_ca,
-                rbf_h=rbf_h,
-                idx_s=idx_s,
-                idx_t=idx_t,
-            )  # (nAtoms, emb_size_atom), (nEdges, emb_size_edge)
-
-            E, F = self.out_blocks[i + 1](h, m, rbf_out, idx_t)
-            # (nAtoms, num_targets), (nEdges, num_targets)
-            F_st += F
-            E_t += E
-            rbf_lattice = self.mlp_rbf_lattice(rbf)
-            lattice_update += self.lattice_out_blocks[i + 1](
-                edge_emb=m,
-                edge_index=edge_index,
-                distance_vec=distance_vec,
-                lattice=distorted_lattice,
-                batch=batch,
-                rbf=rbf_lattice,
-                normalize_score=True,
+                id3_ragged_idx=id3_ragged_idx,
+                chunks=chunks,
             )
+        lattice_update = self.lattice_out_blocks[0].edge_scores_to_lattice_update(
+            edge_scores=lattice_scores,
+            edge_index=edge_index,
+            distance_vec=distance_vec,
+            batch=batch,
+            normalize_score=True,
+        )
+        F_fully_connected = torch.tensor(0.0, device=distorted_lattice.device)
 
         nMolecules = torch.max(batch) + 1
 
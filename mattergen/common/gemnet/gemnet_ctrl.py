@@ -4,6 +4,7 @@
 
 # Adapted from https://github.com/FAIR-Chem/fairchem/blob/main/src/fairchem/core/models/gemnet/gemnet.py.
 
+from functools import partial
 from typing import Dict, List, Optional
 
 # import numpy as np
@@ -13,11 +14,12 @@ from torch_scatter import scatter
 
 from mattergen.common.data.types import PropertySourceId
 from mattergen.common.gemnet.gemnet import GemNetT, ModelOutput
-from mattergen.common.gemnet.utils import inner_product_normalized
+from mattergen.common.gemnet.layers.efficient import TripletChunk, map_edge_chunks
 from mattergen.common.utils.data_utils import (
     frac_to_cart_coords_with_lattice,
     lattice_params_to_matrix_torch,
 )
+from mattergen.diffusion.inference_options import autocast
 
 
 class GemNetTCtrl(GemNetT):
@@ -66,6 +68,90 @@ class GemNetTCtrl(GemNetT):
             self.cond_adapt_layers[cond] = torch.nn.ModuleList(adapt_layers)
             self.cond_mixin_layers[cond] = torch.nn.ModuleList(mixin_layers)
 
+    def _interaction_blocks(  # type: ignore[override]
+        self,
+        z: torch.Tensor | None,
+        atomic_numbers: torch.Tensor,
+        batch: torch.Tensor,
+        rbf: torch.Tensor,
+        cbf3: tuple[torch.Tensor, torch.Tensor],
+        cosines: torch.Tensor,
+        edge_index: torch.Tensor,
+        id_swap: torch.Tensor,
+        id3_ba: torch.Tensor,
+        id3_ca: torch.Tensor,
+        id3_ragged_idx: torch.Tensor,
+        cond_adapt_per_atom: Dict[PropertySourceId, torch.Tensor],
+        cond_adapt_mask_per_atom: Dict[PropertySourceId, torch.Tensor],
+        chunks: list[TripletChunk] | None = None,
+    ) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        As GemNetT._interaction_blocks, with the condition embeddings of each atom mixed into the atom
+        embeddings before each interaction block.
+        """
+        idx_s, idx_t = edge_index
+        # Embedding block
+        h = self.atom_emb(atomic_numbers)
+        # Merge z and atom embedding
+        if z is not None:
+            z_per_atom = z[batch]
+            h = torch.cat([h, z_per_atom], dim=1)
+            h = self.atom_latent_emb(h)
+        # (nAtoms, emb_size_atom)
+        m = map_edge_chunks(
+            partial(self._embed_edges, h), chunks, rbf, idx_s, idx_t, cosines
+        )  # (nEdges, emb_size_edge)
+
+        rbf3 = self.mlp_rbf3(rbf)
+
+        rbf_h = self.mlp_rbf_h(rbf)
+        rbf_out = self.mlp_rbf_out(rbf)
+
+        E_t, F_st = self.out_blocks[0](h, m, rbf_out, idx_t, chunks=chunks)
+        # Accumulate the outputs of all blocks in full precision.
+        E_t, F_st = E_t.float(), F_st.float()
+
+        rbf_lattice = self.mlp_rbf_lattice(rbf)
+        lattice_scores = map_edge_chunks(
+            self.lattice_out_blocks[0].compute_score_per_edge, chunks, m, rbf_lattice
+        ).float()
+
+        for i in range(self.num_blocks):
+            h_adapt = torch.zeros_like(h)
+            for cond in self.condition_on_adapt:
+                h_adapt_cond = self.cond_adapt_layers[cond][i](
+                    torch.cat([h, cond_adapt_per_atom[cond]], dim=-1)
+                )
+                h_adapt_cond = self.cond_mixin_layers[cond][i](h_adapt_cond)
+                # cond_adapt_mask_per_atom[cond] is 1.0 if we want to use conditional embedding and 0 for unconditional embedding
+                h_adapt += cond_adapt_mask_per_atom[cond] * h_adapt_cond
+            h = h + h_adapt
+
+            # Interaction block
+            h, m = self.int_blocks[i](
+                h=h,
+                m=m,
+                rbf3=rbf3,
+                cbf3=cbf3,
+                id3_ragged_idx=id3_ragged_idx,
+                id_swap=id_swap,
+                id3_ba=id3_ba,
+                id3_ca=id3_ca,
+                rbf_h=rbf_h,
+                idx_s=idx_s,
+                idx_t=idx_t,
+                chunks=chunks,
+            )  # (nAtoms, emb_size_atom), (nEdges, emb_size_edge)
+
+            E, F = self.out_blocks[i + 1](h, m, rbf_out, idx_t, chunks=chunks)
+            # (nAtoms, num_targets), (nEdges, num_targets)
+            F_st += F
+            E_t += E
+            lattice_scores += map_edge_chunks(
+                self.lattice_out_blocks[i + 1].compute_score_per_edge, chunks, m, rbf_lattice
+            )
+        return h.float(), E_t, F_st, lattice_scores
+
     def forward(
         self,
         z: torch.Tensor,
@@ -138,101 +224,54 @@ class GemNetTCtrl(GemNetT):
         )
         idx_s, idx_t = edge_index
 
-        # Calculate triplet angles
-        cosφ_cab = inner_product_normalized(V_st[id3_ca], V_st[id3_ba])
-        rad_cbf3, cbf3 = self.cbf_basis3(D_st, cosφ_cab, id3_ca)
+        cbf3, chunks = self._circular_basis(D_st, V_st, id3_ba, id3_ca, id3_ragged_idx)
 
         rbf = self.radial_basis(D_st)
-
-        # Embedding block
-        h = self.atom_emb(atomic_numbers)
-        # Merge z and atom embedding
-        if z is not None:
-            z_per_atom = z[batch]
-            h = torch.cat([h, z_per_atom], dim=1)
-            h = self.atom_latent_emb(h)
-        # (nAtoms, emb_size_atom)
-        m = self.edge_emb(h, rbf, idx_s, idx_t)  # (nEdges, emb_size_edge)
         batch_edge = batch[edge_index[0]]
         cosines = torch.cosine_similarity(V_st[:, None], distorted_lattice[batch_edge], dim=-1)
-        m = torch.cat([m, cosines], dim=-1)
-        m = self.angle_edge_emb(m)
-
-        rbf3 = self.mlp_rbf3(rbf)
-        cbf3 = self.mlp_cbf3(rad_cbf3, cbf3, id3_ca, id3_ragged_idx)
-
-        rbf_h = self.mlp_rbf_h(rbf)
-        rbf_out = self.mlp_rbf_out(rbf)
-
-        E_t, F_st = self.out_blocks[0](h, m, rbf_out, idx_t)
-
         distance_vec = V_st * D_st[:, None]
 
-        lattice_update = None
-        rbf_lattice = self.mlp_rbf_lattice(rbf)
-        lattice_update = self.lattice_out_blocks[0](
-            edge_emb=m,
-            edge_index=edge_index,
-            distance_vec=distance_vec,
-            lattice=distorted_lattice,
-            batch=batch,
-            rbf=rbf_lattice,
-            normalize_score=True,
-        )
-
         # currently only working for a single cond adapt property.
         # to extend to multi-properties,
         # use a ModuleDict for adapt layers and mixin layers.
         # use a dictionary to track the conditions?
 
+        cond_adapt_per_atom = {}
+        cond_adapt_mask_per_atom = {}
         if cond_adapt is not None and cond_adapt_mask is not None:
-            cond_adapt_per_atom = {}
-            cond_adapt_mask_per_atom = {}
             for cond in self.condition_on_adapt:
                 cond_adapt_per_atom[cond] = cond_adapt[cond][batch]
                 # 1 = use conditional embedding, 0 = use unconditional embedding
                 cond_adapt_mask_per_atom[cond] = 1.0 - cond_adapt_mask[cond][batch].float()
 
-        for i in range(self.num_blocks):
-            h_adapt = torch.zeros_like(h)
-            for cond in self.condition_on_adapt:
-                h_adapt_cond = self.cond_adapt_layers[cond][i](
-                    torch.cat([h, cond_adapt_per_atom[cond]], dim=-1)
-                )
-                h_adapt_cond = self.cond_mixin_layers[cond][i](h_adapt_cond)
-                # cond_adapt_mask_per_atom[cond] is 1.0 if we want to use conditional embedding and 0 for unconditional embedding
-                h_adapt += cond_adapt_mask_per_atom[cond] * h_adapt_cond
-            h = h + h_adapt
-
-            # Interaction block
-            h, m = self.int_blocks[i](
-                h=h,
-                m=m,
-                rbf3=rbf3,
+        # Mixed-precision inference as in GemNetT.forward.
+        interaction_blocks = (
+            self._compiled_interaction_blocks if chunks is None else self._interaction_blocks
+        )
+        with autocast(pos.device):
+            h, E_t, F_st, lattice_scores = interaction_blocks(
+                z=z,
+                atomic_numbers=atomic_numbers,
+                batch=batch,
+                rbf=rbf,
                 cbf3=cbf3,
-                id3_ragged_idx=id3_ragged_idx,
+                cosines=cosines,
+                edge_index=edge_index,
                 id_swap=id_swap,
                 id3_ba=id3_ba,
                 id3_ca=id3_ca,
-                rbf_h=rbf_h,
-                idx_s=idx_s,
-                idx_t=idx_t,
-            )  # (nAtoms, emb_size_atom), (nEdges, emb_size_edge)
-
-            E, F = self.out_blocks[i + 1](h, m, rbf_out, idx_t)
-            # (nAtoms, num_targets), (nEdges, num_targets)
-            F_st += F
-            E_t += E
-            rbf_lattice = self.mlp_rbf_lattice(rbf)
-            lattice_update += self.lattice_out_blocks[i + 1](
-                edge_emb=m,
-                edge_index=edge_index,
-                distance_vec=distance_vec,
-                lattice=distorted_lattice,
-                batch=batch,
-                rbf=rbf_lattice,
-                normalize_score=True,
+                id3_ragged_idx=id3_ragged_idx,
+                cond_adapt_per_atom=cond_adapt_per_atom,
+                cond_adapt_mask_per_atom=cond_adapt_mask_per_atom,
+                chunks=chunks,
             )
+        lattice_update = self.lattice_out_blocks[0].edge_scores_to_lattice_update(
+            edge_scores=lattice_scores,
+            edge_index=edge_index,
+            distance_vec=distance_vec,
+            batch=batch,
+            normalize_score=True,
+        )
 
         nMolecules = torch.max(batch) + 1
 
@@ -5,13 +5,17 @@ Licensed under the MIT License.
 Adapted from https://github.com/FAIR-Chem/fairchem/blob/main/src/fairchem/core/models/gemnet/layers/atom_update_block.py.
 """
 
-from typing import Tuple
+from typing import List, Optional, Tuple
 
 import torch
-from torch_scatter import scatter
 
 from mattergen.common.gemnet.initializers import he_orthogonal_init
 from mattergen.common.gemnet.layers.base_layers import Dense, ResidualLayer
+from mattergen.common.gemnet.layers.efficient import (
+    TripletChunk,
+    map_edge_chunks,
+    scatter_edge_chunks,
+)
 from mattergen.common.gemnet.layers.scaling import ScalingFactor
 
 
@@ -60,10 +64,24 @@ class AtomUpdateBlock(torch.nn.Module):
         mlp += res
         return torch.nn.ModuleList(mlp)
 
+    def _edge_messages(self, m: torch.Tensor, rbf: torch.Tensor) -> torch.Tensor:
+        mlp_rbf = self.dense_rbf(rbf)  # (nEdges, emb_size_edge)
+        return m * mlp_rbf
+
     def forward(
-        self, h: torch.Tensor, m: torch.Tensor, rbf: torch.Tensor, id_j: torch.Tensor
+        self,
+        h: torch.Tensor,
+        m: torch.Tensor,
+        rbf: torch.Tensor,
+        id_j: torch.Tensor,
+        chunks: Optional[List[TripletChunk]] = None,
     ) -> torch.Tensor:
         """
+        Arguments
+        ---------
+            chunks: list of TripletChunk, optional
+                Chunks of edges whose messages are computed and aggregated one at a time.
+
         Returns
         -------
             h: torch.Tensor, shape=(nAtoms, emb_size_atom)
@@ -71,10 +89,7 @@ class AtomUpdateBlock(torch.nn.Module):
         """
         nAtoms = h.shape[0]
 
-        mlp_rbf = self.dense_rbf(rbf)  # (nEdges, emb_size_edge)
-        x = m * mlp_rbf
-
-        x2 = scatter(x, id_j, dim=0, dim_size=nAtoms, reduce="sum")
+        x2 = scatter_edge_chunks(self._edge_messages, chunks, id_j, nAtoms, m, rbf)
         # (nAtoms, emb_size_edge)
         x = self.scale_sum(m, x2)
 
@@ -159,10 +174,31 @@ class OutputBlock(AtomUpdateBlock):
         else:
             raise UserWarning(f"Unknown output_init: {self.output_init}")
 
+    def _edge_forces(self, m: torch.Tensor, rbf: torch.Tensor) -> torch.Tensor:
+        x_F = m
+        for i, layer in enumerate(self.seq_forces):
+            x_F = layer(x_F)  # (nEdges, emb_size_edge)
+
+        rbf_emb_F = self.dense_rbf_F(rbf)  # (nEdges, emb_size_edge)
+        x_F_rbf = x_F * rbf_emb_F
+        x_F = self.scale_rbf_F(x_F, x_F_rbf)
+
+        return self.out_forces(x_F)  # (nEdges, num_targets)
+
     def forward(
-        self, h: torch.Tensor, m: torch.Tensor, rbf: torch.Tensor, id_j: torch.Tensor
+        self,
+        h: torch.Tensor,
+        m: torch.Tensor,
+        rbf: torch.Tensor,
+        id_j: torch.Tensor,
+        chunks: Optional[List[TripletChunk]] = None,
     ) -> Tuple[torch.Tensor, torch.Tensor]:
         """
+        Arguments
+        ---------
+            chunks: list of TripletChunk, optional
+                Chunks of edges that are processed one at a time.
+
         Returns
         -------
             (E, F): tuple
@@ -173,10 +209,7 @@ class OutputBlock(AtomUpdateBlock):
         nAtoms = h.shape[0]
 
         # -------------------------------------- Energy Prediction -------------------------------------- #
-        rbf_emb_E = self.dense_rbf(rbf)  # (nEdges, emb_size_edge)
-        x = m * rbf_emb_E
-
-        x_E = scatter(x, id_j, dim=0, dim_size=nAtoms, reduce="sum")
+        x_E = scatter_edge_chunks(self._edge_messages, chunks, id_j, nAtoms, m, rbf)
         # (nAtoms, emb_size_edge)
         x_E = self.scale_sum(m, x_E)
 
@@ -187,15 +220,7 @@ class OutputBlock(AtomUpdateBlock):
 
         # --------------------------------------- Force Prediction -------------------------------------- #
         if self.direct_forces:
-            x_F = m
-            for i, layer in enumerate(self.seq_forces):
-                x_F = layer(x_F)  # (nEdges, emb_size_edge)
-
-            rbf_emb_F = self.dense_rbf_F(rbf)  # (nEdges, emb_size_edge)
-            x_F_rbf = x_F * rbf_emb_F
-            x_F = self.scale_rbf_F(x_F, x_F_rbf)
-
-            x_F = self.out_forces(x_F)  # (nEdges, num_targets)
+            x_F = map_edge_chunks(self._edge_forces, chunks, m, rbf)  # (nEdges, num_targets)
         else:
             x_F = 0
         # ----------------------------------------------------------------------------------------------- #
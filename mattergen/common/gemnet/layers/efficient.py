@@ -5,13 +5,120 @@ Licensed under the MIT License.
 Adapted from https://github.com/FAIR-Chem/fairchem/blob/main/src/fairchem/core/models/gemnet/layers/efficient.py.
 """
 
+from dataclasses import dataclass
+from typing import Callable
 from warnings import warn
 
 import torch
+from torch_scatter import scatter
 
 from mattergen.common.gemnet.initializers import he_orthogonal_init
 
 
+@dataclass(frozen=True)
+class TripletChunk:
+    """Consecutive edges c->a and their triplets b->a<-c, which are consecutive as well since id3_ca is sorted."""
+
+    edge_start: int
+    edge_end: int
+    triplet_start: int
+    triplet_end: int
+    # Maximum number of triplets of any edge in the chunk, i.e., Kmax of its padded matrices.
+    max_triplets_per_edge: int
+
+    @property
+    def edges(self) -> slice:
+        return slice(self.edge_start, self.edge_end)
+
+
+def split_triplets_into_chunks(
+    id3_ca: torch.Tensor, num_edges: int, max_triplets_per_chunk: int
+) -> list[TripletChunk]:
+    """
+    Splits the edges into chunks of the same number of edges, such that the padded (nEdges, Kmax, ...) matrices of
+    the triplets of each chunk have at most `max_triplets_per_chunk` rows, unless a single edge has more triplets.
+    The dense layers of the edges are chunked the same way, see `map_edge_chunks`.
+    """
+    num_triplets = torch.bincount(id3_ca, minlength=num_edges)
+    Kmax = int(num_triplets.max()) if num_edges > 0 else 0
+    edges_per_chunk = max(1, max_triplets_per_chunk // max(Kmax, 1))
+    num_chunks = -(-num_edges // edges_per_chunk)
+    triplet_bounds = torch.cat([num_triplets.new_zeros(1), num_triplets.cumsum(0)])
+    edge_starts = list(range(0, num_edges, edges_per_chunk))
+    edge_ends = edge_starts[1:] + [num_edges]
+    chunk_Kmax = (
+        torch.nn.functional.pad(num_triplets, (0, num_chunks * edges_per_chunk - num_edges))
+        .view(num_chunks, edges_per_chunk)
+        .amax(dim=1)
+    )
+    return [
+        TripletChunk(edge_start, edge_end, triplet_start, triplet_end, Kmax_chunk)
+        for edge_start, edge_end, triplet_start, triplet_end, Kmax_chunk in zip(
+            edge_starts,
+            edge_ends,
+            triplet_bounds[edge_starts].tolist(),
+            triplet_bounds[edge_ends].tolist(),
+            chunk_Kmax.tolist(),
+        )
+    ]
+
+
+def map_edge_chunks(
+    fn: Callable[..., torch.Tensor],
+    chunks: list[TripletChunk] | None,
+    *edge_tensors: torch.Tensor,
+) -> torch.Tensor:
+    """
+    Same as `fn(*edge_tensors)` for a function that processes each edge on its own, but applied to one chunk of edges
+    at a time, so that the intermediate (nEdges, ...) tensors of `fn` only exist for one chunk at a time. The results
+    are written into a single output tensor. Without chunks, `fn` is applied to all edges at once.
+    """
+    if not chunks:
+        return fn(*edge_tensors)
+    out = None
+    for chunk in chunks:
+        out_chunk = fn(*(x[chunk.edges] for x in edge_tensors))
+        if out is None:
+            out = out_chunk.new_empty(chunks[-1].edge_end, *out_chunk.shape[1:])
+        out[chunk.edges] = out_chunk
+    assert out is not None
+    return out
+
+
+def scatter_edge_chunks(
+    fn: Callable[..., torch.Tensor],
+    chunks: list[TripletChunk] | None,
+    index: torch.Tensor,
+    dim_size: int,
+    *edge_tensors: torch.Tensor,
+) -> torch.Tensor:
+    """
+    Same as `scatter(fn(*edge_tensors), index, dim=0, dim_size=dim_size, reduce="sum")`, but one chunk of edges at a
+    time as in `map_edge_chunks`. The sums of the chunks are accumulated in full precision.
+    """
+    if not chunks:
+        return scatter(fn(*edge_tensors), index, dim=0, dim_size=dim_size, reduce="sum")
+    out = None
+    for chunk in chunks:
+        out_chunk = fn(*(x[chunk.edges] for x in edge_tensors))
+        dtype = out_chunk.dtype
+        out_chunk = scatter(
+            out_chunk.float(), index[chunk.edges], dim=0, dim_size=dim_size, reduce="sum"
+        )
+        out = out_chunk if out is None else out + out_chunk
+    assert out is not None
+    return out.to(dtype)
+
+
+def _padded(
+    x: torch.Tensor, id_reduce: torch.Tensor, id_ragged_idx: torch.Tensor, nEdges: int, Kmax: int
+) -> torch.Tensor:
+    # Zero padded dense matrix (nEdges, Kmax, ...) of the triplet values x
+    x2 = x.new_zeros(nEdges, Kmax, *x.shape[1:])
+    x2[id_reduce, id_ragged_idx] = x
+    return x2
+
+
 class EfficientInteractionDownProjection(torch.nn.Module):
     """
     Down projection in the efficient reformulation.
@@ -45,20 +152,23 @@ class EfficientInteractionDownProjection(torch.nn.Module):
         )
         he_orthogonal_init(self.weight)
 
-    def forward(self, rbf, sph, id_ca, id_ragged_idx):
+    def forward(self, rbf, sph, id_ca, id_ragged_idx, pad=True):
         """
 
         Arguments
         ---------
         rbf: torch.Tensor, shape=(1, nEdges, num_radial)
-        sph: torch.Tensor, shape=(nEdges, Kmax, num_spherical)
+        sph: torch.Tensor, shape=(nTriplets, num_spherical)
         id_ca
         id_ragged_idx
+        pad: bool
+            Whether to return sph as a zero padded dense matrix. Without padding, sph is returned as is for
+            EfficientInteractionBilinear.forward_chunked, which pads one chunk of edges at a time.
 
         Returns
         -------
         rbf_W1: torch.Tensor, shape=(nEdges, emb_size_interm, num_spherical)
-        sph: torch.Tensor, shape=(nEdges, Kmax, num_spherical)
+        sph: torch.Tensor, shape=(nEdges, num_spherical, Kmax)
             Kmax = maximum number of neighbors of the edges
         """
         num_edges = rbf.shape[1]
@@ -68,6 +178,8 @@ class EfficientInteractionDownProjection(torch.nn.Module):
         # (num_spherical, nEdges , emb_size_interm)
         rbf_W1 = rbf_W1.permute(1, 2, 0)
         # (nEdges, emb_size_interm, num_spherical)
+        if not pad:
+            return rbf_W1, sph
 
         # Zero padded dense matrix
         # maximum number of neighbors, catch empty id_ca with maximum
@@ -79,8 +191,7 @@ class EfficientInteractionDownProjection(torch.nn.Module):
                 torch.tensor(0).to(id_ragged_idx.device),
             )
 
-        sph2 = sph.new_zeros(num_edges, Kmax, self.num_spherical)
-        sph2[id_ca, id_ragged_idx] = sph
+        sph2 = _padded(sph, id_ca, id_ragged_idx, num_edges, Kmax)
 
         sph2 = torch.transpose(sph2, 1, 2)
         # (nEdges, num_spherical/emb_size_interm, Kmax)
@@ -144,7 +255,7 @@ class EfficientInteractionBilinear(torch.nn.Module):
                 Edge embeddings.
         """
         # num_spherical is actually num_spherical**2 for quadruplets
-        (rbf_W1, sph) = basis
+        rbf_W1, sph = basis
         # (nEdges, emb_size_interm, num_spherical), (nEdges, num_spherical, Kmax)
         nEdges = rbf_W1.shape[0]
 
@@ -154,15 +265,66 @@ class EfficientInteractionBilinear(torch.nn.Module):
             return torch.zeros((0, 0))
 
         # Create (zero-padded) dense matrix of the neighboring edge embeddings.
-        Kmax = torch.max(
-            torch.max(id_ragged_idx) + 1,
-            torch.tensor(0).to(id_ragged_idx.device),
-        )
-        # maximum number of neighbors, catch empty id_reduce_ji with maximum
-        m2 = m.new_zeros(nEdges, Kmax, self.emb_size)
-        m2[id_reduce, id_ragged_idx] = m
+        # The basis is already padded to the maximum number of neighbors, so that Kmax is known without a
+        # synchronizing reduction over id_ragged_idx, and is a dynamic dimension when compiled.
+        Kmax = sph.shape[2]
+        m2 = _padded(m, id_reduce, id_ragged_idx, nEdges, Kmax)
         # (num_quadruplets or num_triplets, emb_size) -> (nEdges, Kmax, emb_size)
+        return self._contract(rbf_W1, sph, m2)
+
+    def forward_chunked(
+        self,
+        basis,
+        m,
+        id_expand,
+        id_reduce,
+        id_ragged_idx,
+        chunks,
+    ):
+        """
+        Same as `forward(basis, m[id_expand], id_reduce, id_ragged_idx)` with the padded basis, but for one chunk of
+        edges at a time, so that the neighboring edge embeddings and the padded dense matrices only exist for one
+        chunk at a time.
+
+        Arguments
+        ---------
+        basis: rbf_W1 and the unpadded sph, see EfficientInteractionDownProjection with pad=False
+        m: edge embeddings, shape=(nEdges, emb_size)
+        id_expand: index of the neighboring edge b->a of each triplet
+        id_reduce
+        id_ragged_idx
+        chunks: list of TripletChunk, see split_triplets_into_chunks
+
+        Returns
+        -------
+            m_ca: torch.Tensor, shape=(nEdges, units_out)
+                Edge embeddings.
+        """
+        rbf_W1, sph = basis
+        # (nEdges, emb_size_interm, num_spherical), (nTriplets, num_spherical)
+        if rbf_W1.shape[0] == 0:
+            # shape=[0,0]
+            warn(f"Zero graph edges found in {self.__class__}")
+            return torch.zeros((0, 0))
+
+        m_ca = []
+        for chunk in chunks:
+            triplets = slice(chunk.triplet_start, chunk.triplet_end)
+            nEdges = chunk.edge_end - chunk.edge_start
+            id_reduce_chunk = id_reduce[triplets] - chunk.edge_start
+            id_ragged_idx_chunk = id_ragged_idx[triplets]
+            Kmax = chunk.max_triplets_per_edge
+            sph2 = _padded(sph[triplets], id_reduce_chunk, id_ragged_idx_chunk, nEdges, Kmax)
+            m2 = _padded(m[id_expand[triplets]], id_reduce_chunk, id_ragged_idx_chunk, nEdges, Kmax)
+            m_ca.append(
+                self._contract(
+                    rbf_W1[chunk.edge_start : chunk.edge_end], torch.transpose(sph2, 1, 2), m2
+                )
+            )
+        return torch.cat(m_ca)
 
+    def _contract(self, rbf_W1, sph, m2):
+        # (nEdges, emb_size_interm, num_spherical), (nEdges, num_spherical, Kmax), (nEdges, Kmax, emb_size)
         sum_k = torch.matmul(sph, m2)  # (nEdges, num_spherical, emb_size)
 
         # MatMul: mul + sum over num_spherical
@@ -6,14 +6,18 @@ Adapted from https://github.com/FAIR-Chem/fairchem/blob/main/src/fairchem/core/m
 """
 
 import math
+from functools import partial
 
 import torch
 
 from mattergen.common.gemnet.layers.atom_update_block import AtomUpdateBlock
 from mattergen.common.gemnet.layers.base_layers import Dense, ResidualLayer
-from mattergen.common.gemnet.layers.efficient import EfficientInteractionBilinear
+from mattergen.common.gemnet.layers.efficient import (
+    EfficientInteractionBilinear,
+    map_edge_chunks,
+)
 from mattergen.common.gemnet.layers.embedding_block import EdgeEmbedding
-from mattergen.common.gemnet.layers.scaling import ScalingFactor
+from mattergen.common.gemnet.layers.scaling import AutomaticFit, ScalingFactor
 
 
 class InteractionBlockTripletsOnly(torch.nn.Module):
@@ -153,8 +157,14 @@ class InteractionBlockTripletsOnly(torch.nn.Module):
         rbf_h,
         idx_s,
         idx_t,
+        chunks=None,
     ):
         """
+        Arguments
+        ---------
+            chunks: list of TripletChunk, optional
+                Chunks of triplets and edges to process one at a time, see TripletInteraction.
+
         Returns
         -------
             h: torch.Tensor, shape=(nEdges, emb_size_atom)
@@ -163,9 +173,6 @@ class InteractionBlockTripletsOnly(torch.nn.Module):
                 Edge embeddings (c->a).
         """
 
-        # Initial transformation
-        x_ca_skip = self.dense_ca(m)  # (nEdges, emb_size_edge)
-
         x3 = self.trip_interaction(
             m,
             rbf3,
@@ -174,8 +181,28 @@ class InteractionBlockTripletsOnly(torch.nn.Module):
             id_swap,
             id3_ba,
             id3_ca,
+            chunks=chunks,
         )
 
+        m = map_edge_chunks(self._update_edges, chunks, m, x3)  # (nEdges, emb_size_edge)
+
+        # ---------------------------------------- Update Atom Embeddings --------------------------------------- ##
+        h2 = self.atom_update(h, m, rbf_h, idx_t, chunks=chunks)
+
+        # Skip connection
+        h = h + h2  # (nAtoms, emb_size_atom)
+        h = h * self.skip_connection_factor
+
+        # ----------------------------- Update Edge Embeddings with Atom Embeddings ----------------------------- ##
+        m = map_edge_chunks(
+            partial(self._update_edges_with_atoms, h), chunks, m, idx_s, idx_t
+        )  # (nEdges, emb_size_edge)
+        return h, m
+
+    def _update_edges(self, m, x3):
+        # Initial transformation
+        x_ca_skip = self.dense_ca(m)  # (nEdges, emb_size_edge)
+
         # ----------------------------- Merge Embeddings after Triplet Interaction ------------------------------ ##
         x = x_ca_skip + x3  # (nEdges, emb_size_edge)
         x = x * self.inv_sqrt_2
@@ -192,15 +219,9 @@ class InteractionBlockTripletsOnly(torch.nn.Module):
         # Transformations after skip connection
         for i, layer in enumerate(self.layers_after_skip):
             m = layer(m)  # (nEdges, emb_size_edge)
+        return m
 
-        # ---------------------------------------- Update Atom Embeddings --------------------------------------- ##
-        h2 = self.atom_update(h, m, rbf_h, idx_t)
-
-        # Skip connection
-        h = h + h2  # (nAtoms, emb_size_atom)
-        h = h * self.skip_connection_factor
-
-        # ----------------------------- Update Edge Embeddings with Atom Embeddings ----------------------------- ##
+    def _update_edges_with_atoms(self, h, m, idx_s, idx_t):
         m2 = self.concat_layer(h, m, idx_s, idx_t)  # (nEdges, emb_size_edge)
 
         for i, layer in enumerate(self.residual_m):
@@ -209,7 +230,7 @@ class InteractionBlockTripletsOnly(torch.nn.Module):
         # Skip connection
         m = m + m2  # (nEdges, emb_size_edge)
         m = m * self.inv_sqrt_2
-        return h, m
+        return m
 
 
 class TripletInteraction(torch.nn.Module):
@@ -303,29 +324,33 @@ class TripletInteraction(torch.nn.Module):
         id_swap,
         id3_ba,
         id3_ca,
+        chunks=None,
     ):
         """
+        Arguments
+        ---------
+            chunks: list of TripletChunk, optional
+                If given, the triplets are processed one chunk at a time, with the unpadded circular basis cbf3 (see
+                EfficientInteractionBilinear.forward_chunked), and so are the dense layers of the edges.
+
         Returns
         -------
             m: torch.Tensor, shape=(nEdges, emb_size_edge)
                 Edge embeddings (c->a).
         """
 
-        # Dense transformation
-        x_ba = self.dense_ba(m)  # (nEdges, emb_size_edge)
-
-        # Transform via radial bessel basis
-        rbf_emb = self.mlp_rbf(rbf3)  # (nEdges, emb_size_edge)
-        x_ba2 = x_ba * rbf_emb
-        x_ba = self.scale_rbf(x_ba, x_ba2)
-
-        x_ba = self.down_projection(x_ba)  # (nEdges, emb_size_trip)
+        x_ba = map_edge_chunks(self._project_down, chunks, m, rbf3)  # (nEdges, emb_size_trip)
 
-        # Transform via circular spherical basis
-        x_ba = x_ba[id3_ba]
+        if chunks is None:
+            # Transform via circular spherical basis
+            x_ba = x_ba[id3_ba]
 
-        # Efficient bilinear layer
-        x = self.mlp_cbf(cbf3, x_ba, id3_ca, id3_ragged_idx)
+            # Efficient bilinear layer
+            x = self.mlp_cbf(cbf3, x_ba, id3_ca, id3_ragged_idx)
+        else:
+            x = self.mlp_cbf.forward_chunked(cbf3, x_ba, id3_ba, id3_ca, id3_ragged_idx, chunks)
+            # The reference for the scaling factor is only used to fit it.
+            x_ba = x_ba[id3_ba] if AutomaticFit.fitting_mode else x_ba
         # (nEdges, emb_size_quad)
         x = self.scale_cbf_sum(x_ba, x)
 
@@ -333,12 +358,28 @@ class TripletInteraction(torch.nn.Module):
         # rbf(d_ba)
         # cbf(d_ca, angle_cab)
 
+        # Swap to add to edge a->c and not c->a, before the up projection which is applied to each edge on its own
+        x_ac = x[id_swap]  # (nEdges, emb_size_quad)
+        x3 = map_edge_chunks(self._project_up, chunks, x, x_ac)  # (nEdges, emb_size_edge)
+        return x3
+
+    def _project_down(self, m, rbf3):
+        # Dense transformation
+        x_ba = self.dense_ba(m)  # (nEdges, emb_size_edge)
+
+        # Transform via radial bessel basis
+        rbf_emb = self.mlp_rbf(rbf3)  # (nEdges, emb_size_edge)
+        x_ba2 = x_ba * rbf_emb
+        x_ba = self.scale_rbf(x_ba, x_ba2)
+
+        return self.down_projection(x_ba)  # (nEdges, emb_size_trip)
+
+    def _project_up(self, x_ca, x_ac):
         # Up project embeddings
-        x_ca = self.up_projection_ca(x)  # (nEdges, emb_size_edge)
-        x_ac = self.up_projection_ac(x)  # (nEdges, emb_size_edge)
+        x_ca = self.up_projection_ca(x_ca)  # (nEdges, emb_size_edge)
+        x_ac = self.up_projection_ac(x_ac)  # (nEdges, emb_size_edge)
 
         # Merge interaction of c->a and a->c
-        x_ac = x_ac[id_swap]  # swap to add to edge a->c and not c->a
         x3 = x_ca + x_ac
         x3 = x3 * self.inv_sqrt_2
         return x3
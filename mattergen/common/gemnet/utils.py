@@ -224,6 +224,71 @@ def repeat_blocks(
     return res
 
 
+def symmetric_edge_triplets(
+    edge_index: torch.Tensor, neighbors: torch.Tensor, num_atoms: int
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+    """Indices for symmetric message passing and the triplets of a graph with symmetric edges.
+
+    The edges must be ordered as by `GemNetT.reorder_symmetric_edges`, i.e., the 2k edges of each image consist of k
+    edges followed by their counter-edges in the same order. All indices are built in one pass over the edges sorted
+    by target atom, which gives the same triplets, in the same order, as indexing a torch_sparse.SparseTensor
+    adjacency with the target atoms.
+
+    Parameters
+    ----------
+        edge_index: Tensor, shape = (2, nEdges)
+            Source and target atom of the edges.
+        neighbors: Tensor, shape = (nImages,)
+            Number of edges per image.
+        num_atoms: int
+            Total number of atoms.
+
+    Returns
+    -------
+        id_swap: Tensor, shape = (nEdges,)
+            Index of the counter-edge of each edge.
+        id3_ba: Tensor, shape = (nTriplets,)
+            Indices of input edge b->a of each triplet b->a<-c
+        id3_ca: Tensor, shape = (nTriplets,)
+            Indices of output edge c->a of each triplet b->a<-c
+        id3_ragged_idx: Tensor, shape = (nTriplets,)
+            Indices enumerating the copies of id3_ca for creating a padded matrix
+    """
+    idx_s, idx_t = edge_index
+    edge_ids = torch.arange(idx_s.size(0), device=idx_s.device)
+
+    # The counter-edge of the i-th of the 2k edges of an image is the (i + k)-th, and vice versa.
+    image_start = torch.repeat_interleave(neighbors.cumsum(0) - neighbors, neighbors)
+    half = torch.repeat_interleave(neighbors // 2, neighbors)
+    id_swap = edge_ids + torch.where(edge_ids - image_start < half, half, -half)
+
+    # Incoming edges of each atom in CSR format, sorted by source atom. Periodic copies of the same edge are in the
+    # order of the (unstable) sort of a torch_sparse.SparseTensor adjacency, such that the triplets are the same.
+    edges_by_target = torch.sort(idx_t * num_atoms + idx_s).indices
+    num_incoming = torch.bincount(idx_t, minlength=num_atoms)
+    target_start = num_incoming.cumsum(0) - num_incoming
+    # Position of each edge among the incoming edges of its target atom.
+    rank = torch.empty_like(edge_ids)
+    rank[edges_by_target] = edge_ids - target_start[idx_t[edges_by_target]]
+
+    # Each edge c->a forms a triplet with every other incoming edge b->a of atom a. The copies of id3_ca are enumerated
+    # by id3_ragged_idx, and the b->a of each copy is found in the CSR rows by skipping c->a itself.
+    num_triplets = num_incoming[idx_t] - 1
+    triplet_start = num_triplets.cumsum(0) - num_triplets
+    id3_ca = torch.repeat_interleave(edge_ids, num_triplets)
+    # index_select is considerably faster than advanced indexing for these long index tensors.
+    triplet_ids = torch.arange(id3_ca.size(0), device=idx_s.device)
+    id3_ragged_idx = triplet_ids - triplet_start.index_select(0, id3_ca)
+    position_ba = (
+        id3_ragged_idx
+        + (id3_ragged_idx >= rank.index_select(0, id3_ca))
+        + target_start.index_select(0, idx_t).index_select(0, id3_ca)
+    )
+    id3_ba = edges_by_target.index_select(0, position_ba)
+
+    return id_swap, id3_ba, id3_ca, id3_ragged_idx
+
+
 def calculate_interatomic_vectors(
     R: torch.Tensor, id_s: torch.Tensor, id_t: torch.Tensor, offsets_st: torch.Tensor
 ) -> Tuple[torch.Tensor, torch.Tensor]:
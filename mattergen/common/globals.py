@@ -6,3 +6,8 @@ from pathlib import Path
 PROJECT_ROOT = Path(__file__).resolve().parent.parent
 GENERATED_CRYSTALS_ZIP_FILE_NAME = "generated_crystals_cif.zip"
 GENERATED_CRYSTALS_EXTXYZ_FILE_NAME = "generated_crystals.extxyz"
+GENERATED_TRAJECTORIES_ZIP_FILE_NAME = "generated_trajectories.zip"
+GENERATED_TRAJECTORIES_DIR_NAME = "generated_trajectories"
+GENERATION_MANIFEST_FILE_NAME = "generation_manifest.json"
+GENERATION_BATCHES_DIR_NAME = "batches"
+GENERATION_SAMPLE_SEEDS_FILE_NAME = "sample_seeds.json"
@@ -0,0 +1,69 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import numpy as np
+import pytest
+import torch
+
+from mattergen.common.data.batch_sampler import AtomBudgetBatchSampler
+from mattergen.common.data.condition_factory import (
+    get_composition_data_loader,
+    get_number_of_atoms_condition_loader,
+)
+
+
+@pytest.mark.parametrize("shuffle", [True, False])
+@pytest.mark.parametrize("window_size", [None, 7])
+@pytest.mark.parametrize("max_batch_size", [None, 4])
+def test_atom_budget_batch_sampler(
+    shuffle: bool, window_size: int | None, max_batch_size: int | None
+):
+    num_atoms = np.random.default_rng(0).integers(1, 21, size=50)
+    num_atoms[3] = 40  # larger than the budget
+    sampler = AtomBudgetBatchSampler(
+        num_atoms=num_atoms,
+        max_atoms_per_batch=30,
+        max_batch_size=max_batch_size,
+        window_size=window_size,
+        shuffle=shuffle,
+        generator=torch.Generator().manual_seed(0),
+    )
+
+    num_batches = len(sampler)
+    batches = list(sampler)
+    assert len(batches) == num_batches
+    # Every crystal is sampled exactly once.
+    assert sorted(ix for batch in batches for ix in batch) == list(range(len(num_atoms)))
+    for batch in batches:
+        assert num_atoms[batch].sum() <= 30 or len(batch) == 1
+        assert max_batch_size is None or len(batch) <= max_batch_size
+    assert [3] in batches
+
+
+def test_atom_budget_batch_sampler_sorts_within_window():
+    num_atoms = [10, 1, 10, 1, 10, 1]
+    sampler = AtomBudgetBatchSampler(num_atoms=num_atoms, max_atoms_per_batch=20)
+    assert list(sampler) == [[1, 3, 5, 0], [2, 4]]
+
+
+def test_number_of_atoms_condition_loader_with_atom_budget():
+    loader = get_number_of_atoms_condition_loader(
+        num_atoms_distribution="ALEX_MP_20",
+        num_samples=100,
+        batch_size=16,
+        max_atoms_per_batch=64,
+    )
+    num_atoms_per_batch = [batch.num_atoms for batch, _ in loader]
+    assert sum(len(n) for n in num_atoms_per_batch) == 100
+    assert all(n.sum() <= 64 and len(n) <= 16 for n in num_atoms_per_batch)
+
+
+def test_composition_data_loader_with_atom_budget():
+    loader = get_composition_data_loader(
+        target_compositions_dict=[{"Na": 1, "Cl": 1}, {"Li": 4, "Fe": 4, "P": 4, "O": 16}],
+        num_structures_to_generate_per_composition=5,
+        batch_size=8,
+        max_atoms_per_batch=60,
+    )
+    num_atoms_per_batch = [batch.num_atoms.tolist() for batch, _ in loader]
+    assert num_atoms_per_batch == [[2] * 5 + [28], [28, 28], [28, 28]]
@@ -0,0 +1,85 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import json
+from collections import Counter
+from pathlib import Path
+
+import pytest
+import torch
+from pymatgen.core import Lattice, Structure
+
+from mattergen.common.data.condition_factory import (
+    CONDITION_ROW,
+    get_condition_table_loader,
+    get_structure_condition_loader,
+    load_condition_table,
+)
+
+CONDITIONS = [
+    {"dft_bulk_modulus": bulk_modulus, "chemical_system": chemical_system}
+    for bulk_modulus in [100.0, 200.0, 300.0]
+    for chemical_system in ["Li-O", "Na-Cl"]
+]
+
+
+def test_condition_table_loader_mixes_conditions():
+    torch.manual_seed(0)
+    loader = get_condition_table_loader(
+        num_atoms_distribution="ALEX_MP_20",
+        conditions=CONDITIONS,
+        num_samples_per_condition=5,
+        batch_size=8,
+    )
+    batches = [batch for batch, _ in loader]
+    assert [batch.get_batch_size() for batch in batches] == [8, 8, 8, 6]
+    # Rows are mixed within batches.
+    assert len(set(batches[0][CONDITION_ROW].tolist())) > 1
+
+    rows = Counter()
+    for batch in batches:
+        for row, bulk_modulus, chemical_system in zip(
+            batch[CONDITION_ROW].tolist(), batch.dft_bulk_modulus.tolist(), batch.chemical_system
+        ):
+            assert bulk_modulus == CONDITIONS[row]["dft_bulk_modulus"]
+            assert chemical_system == CONDITIONS[row]["chemical_system"]
+            rows[row] += 1
+    assert rows == {row: 5 for row in range(len(CONDITIONS))}
+
+
+def test_structure_condition_loader_with_condition_table():
+    structures = [
+        Structure(
+            Lattice.cubic(4.0),
+            ["Na"] * num_atoms,
+            torch.rand(num_atoms, 3).numpy(),
+            properties={CONDITION_ROW: row},
+        )
+        for num_atoms, row in [(2, 3), (4, 0)]
+    ]
+    batches = [
+        batch for batch, _ in get_structure_condition_loader(structures, conditions=CONDITIONS)
+    ]
+    assert [batch.num_atoms.item() for batch in batches] == [2, 4]
+    assert [batch[CONDITION_ROW].item() for batch in batches] == [3, 0]
+    assert [batch.dft_bulk_modulus.item() for batch in batches] == [200.0, 100.0]
+    assert [batch.chemical_system for batch in batches] == [["Na-Cl"], ["Li-O"]]
+
+
+def test_load_condition_table(tmp_path: Path):
+    csv_path = tmp_path / "conditions.csv"
+    csv_path.write_text(
+        "dft_bulk_modulus,chemical_system\n"
+        + "".join(f"{c['dft_bulk_modulus']},{c['chemical_system']}\n" for c in CONDITIONS)
+    )
+    json_path = tmp_path / "conditions.json"
+    json_path.write_text(json.dumps(CONDITIONS))
+    assert load_condition_table(csv_path) == CONDITIONS
+    assert load_condition_table(json_path) == CONDITIONS
+
+    json_path.write_text(json.dumps([{"dft_bulk_modulus": 100.0}, {"dft_band_gap": 1.0}]))
+    with pytest.raises(ValueError):
+        load_condition_table(json_path)
+    csv_path.write_text("dft_bulk_modulus,chemical_system\n100.0,\n")
+    with pytest.raises(ValueError):
+        load_condition_table(csv_path)
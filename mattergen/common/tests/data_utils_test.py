@@ -16,6 +16,7 @@ from pymatgen.transformations.standard_transformations import RotationTransforma
 
 from mattergen.common.tests.testutils import get_mp_20_debug_batch
 from mattergen.common.utils import data_utils
+from mattergen.common.utils.ocp_graph_utils import radius_graph_pbc, radius_graph_pbc_cell_list
 
 
 def test_lattice_params_matrix():
@@ -520,6 +521,53 @@ def test_rdf(natom: int, rcut: float):
     )
 
 
+@pytest.mark.parametrize(
+    "lattice_scale, max_radius, max_neighbors, max_cell_images",
+    [
+        (1.0, 5.0, 50, 20),
+        # Neighbors are truncated.
+        (1.0, 5.0, 12, 20),
+        # Periodic images are truncated.
+        (1.0, 5.0, 1000, 1),
+        (1.0, 7.0, 1000, 5),
+        # Small and skewed cells, with many periodic images and cells thinner than the radius.
+        (0.3, 3.0, 1000, 10),
+    ],
+)
+def test_radius_graph_pbc_cell_list(
+    lattice_scale: float, max_radius: float, max_neighbors: int, max_cell_images: int
+):
+    torch.manual_seed(0)
+    num_atoms = torch.tensor([1, 2, 5, 40, 3, 12])
+    lattice = torch.stack(
+        [
+            lattice_scale * (n * 11.0) ** (1 / 3) * (torch.eye(3) + 0.15 * torch.randn(3, 3))
+            for n in num_atoms.tolist()
+        ]
+    )
+    # Some atoms are outside of the unit cell.
+    frac_coords = 1.4 * torch.rand(int(num_atoms.sum()), 3) - 0.2
+    cart_coords = torch.einsum(
+        "ni,nij->nj", frac_coords, torch.repeat_interleave(lattice, num_atoms, dim=0)
+    )
+    kwargs = dict(
+        pos=cart_coords,
+        pbc=torch.tensor([True, True, True]),
+        natoms=num_atoms,
+        cell=lattice,
+        radius=max_radius,
+        max_num_neighbors_threshold=max_neighbors,
+        max_cell_images_per_dim=max_cell_images,
+    )
+    expected = radius_graph_pbc(**kwargs)
+    output = radius_graph_pbc_cell_list(**kwargs)
+    assert len(expected[0].T) > 0
+    for x, expected_x in zip(output[:3], expected[:3]):
+        assert torch.equal(x, expected_x)
+    for x, expected_x in zip(output[3:], expected[3:]):
+        torch.testing.assert_close(x, expected_x)
+
+
 def test_polar_decomposition():
     # load some data
     batch = get_mp_20_debug_batch()
@@ -0,0 +1,68 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import io
+import multiprocessing
+import os
+from pathlib import Path
+from zipfile import ZipFile
+
+import ase.io
+import pytest
+import torch
+from pymatgen.io.ase import AseAtomsAdaptor
+
+from mattergen.common.data.chemgraph import ChemGraph
+from mattergen.common.data.collate import collate
+from mattergen.common.globals import (
+    GENERATED_CRYSTALS_EXTXYZ_FILE_NAME,
+    GENERATED_CRYSTALS_ZIP_FILE_NAME,
+)
+from mattergen.common.utils import eval_utils
+from mattergen.common.utils.generated_batch import GeneratedBatch
+
+
+@pytest.mark.parametrize("num_workers", [1, 2])
+@pytest.mark.parametrize("as_generated_batch", [True, False])
+def test_save_structures(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch, num_workers: int, as_generated_batch: bool
+):
+    monkeypatch.setattr(eval_utils, "SERIALIZATION_CHUNK_SIZE", 2)
+    torch.manual_seed(0)
+    generated = GeneratedBatch.from_chemgraph(
+        collate(
+            [
+                ChemGraph(
+                    pos=torch.rand(n, 3),
+                    atomic_numbers=torch.randint(1, 90, (n,)),
+                    cell=(torch.eye(3) * 4.0 + torch.randn(3, 3))[None],
+                    num_atoms=torch.tensor([n]),
+                )
+                for n in [3, 1, 5, 2, 4]
+            ]
+        )
+    )
+    structures = generated if as_generated_batch else list(generated)
+    ase_atoms = [AseAtomsAdaptor.get_atoms(s) for s in generated]
+
+    eval_utils.save_structures(tmp_path, structures[:3], num_workers=num_workers)
+    eval_utils.append_structures(tmp_path, structures[3:], start_index=3, num_workers=num_workers)
+
+    expected_extxyz = io.StringIO()
+    ase.io.write(expected_extxyz, ase_atoms, format="extxyz")
+    assert (tmp_path / GENERATED_CRYSTALS_EXTXYZ_FILE_NAME).read_text() == (
+        expected_extxyz.getvalue()
+    )
+    with ZipFile(tmp_path / GENERATED_CRYSTALS_ZIP_FILE_NAME) as zip_obj:
+        assert zip_obj.namelist() == [f"gen_{ix}.cif" for ix in range(5)]
+        for ix, atoms in enumerate(ase_atoms):
+            expected_cif = io.BytesIO()
+            ase.io.write(expected_cif, atoms, format="cif")
+            assert zip_obj.read(f"gen_{ix}.cif") == expected_cif.getvalue()
+
+
+def test_default_num_serialization_workers(monkeypatch: pytest.MonkeyPatch):
+    assert eval_utils._default_num_serialization_workers() <= max(1, (os.cpu_count() or 1) // 2)
+    # Worker processes, e.g. of generate_parallel, do not start processes of their own.
+    monkeypatch.setattr(multiprocessing, "parent_process", lambda: object())
+    assert eval_utils._default_num_serialization_workers() == 1
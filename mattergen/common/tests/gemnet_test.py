@@ -1,26 +1,38 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT License.
 
+import weakref
 from copy import deepcopy
 from itertools import chain, permutations
 from typing import List, Tuple
 
+import pytest
 import torch
 from pymatgen.core.structure import Structure
 from scipy.spatial.transform import Rotation
+from torch.utils._python_dispatch import TorchDispatchMode
+from torch.utils._pytree import tree_flatten
 from torch_geometric.data import Batch, Data
+from torch_sparse import SparseTensor
 
 from mattergen.common.gemnet.gemnet import GemNetT
 from mattergen.common.gemnet.layers.embedding_block import AtomEmbedding
+from mattergen.common.gemnet.utils import ragged_range, repeat_blocks, symmetric_edge_triplets
 from mattergen.common.tests.testutils import get_mp_20_debug_batch
 from mattergen.common.utils.data_utils import (
     cart_to_frac_coords_with_lattice,
     frac_to_cart_coords_with_lattice,
     lattice_matrix_to_params_torch,
     lattice_params_to_matrix_torch,
+    radius_graph_pbc,
 )
 from mattergen.common.utils.eval_utils import make_structure
 from mattergen.common.utils.globals import MODELS_PROJECT_ROOT
+from mattergen.diffusion.inference_options import (
+    InferenceCache,
+    InferenceOptions,
+    using_inference_options,
+)
 
 ### UTILS ###
 
@@ -96,6 +108,41 @@ def get_cubic_data(supercell: Tuple[int, int, int]) -> Tuple[Tuple, Tuple]:
     return reformat_batch(batch=normal_batch), reformat_batch(batch=supercell_batch)
 
 
+class PeakTensorMemory(TorchDispatchMode):
+    """Tracks the peak size of the tensors allocated by the operators run within this context and still alive."""
+
+    def __init__(self):
+        super().__init__()
+        self.current = 0
+        self.peak = 0
+        self._storages: set[int] = set()
+
+    def _free(self, key: int, nbytes: int):
+        self._storages.discard(key)
+        self.current -= nbytes
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        out = func(*args, **(kwargs or {}))
+        inputs = {
+            x.untyped_storage().data_ptr()
+            for x in tree_flatten((args, kwargs))[0]
+            if isinstance(x, torch.Tensor)
+        }
+        for x in tree_flatten(out)[0]:
+            if not isinstance(x, torch.Tensor):
+                continue
+            storage = x.untyped_storage()
+            key, nbytes = storage.data_ptr(), storage.nbytes()
+            # Views share the storage of their input.
+            if nbytes == 0 or key in inputs or key in self._storages:
+                continue
+            self._storages.add(key)
+            self.current += nbytes
+            weakref.finalize(storage, self._free, key, nbytes)
+        self.peak = max(self.peak, self.current)
+        return out
+
+
 ### TESTS ###
 
 
@@ -383,3 +430,143 @@ def test_rotation_invariance():
     assert torch.allclose(forces @ rotation_matrix, forces_rotated, atol=1e-3)
 
     assert torch.allclose(rotation_matrix.T @ stress @ rotation_matrix, stress_rotated, atol=1e-3)
+
+
+def test_neighbor_list_reuse():
+    torch.manual_seed(0)
+    model = get_model(max_neighbors=20, cutoff=5.0, regress_stress=True, max_cell_images_per_dim=20)
+    model.eval()
+    batch = get_mp_20_debug_batch()
+    batch = Batch.from_data_list(batch.to_data_list()[:8])
+    lattice = lattice_params_to_matrix_torch(batch.lengths, batch.angles)
+    frac_coords = batch.frac_coords.clone()
+    # The first atom crosses the cell boundary in the second step.
+    frac_coords[0, 0] = 0.9999
+    options = InferenceOptions(neighbor_list_skin=1.0)
+    cache = InferenceCache()
+    num_builds = []
+    for step in range(6):
+        if step == 1:
+            frac_coords[0, 0] = 0.0001
+        elif step == 4:
+            # Too far for the skin.
+            frac_coords = frac_coords + 0.1
+        else:
+            frac_coords = frac_coords + 1e-3 * torch.randn_like(frac_coords)
+            lattice = lattice @ (torch.eye(3) + 1e-4 * torch.randn(len(lattice), 3, 3))
+        frac_coords = frac_coords % 1.0
+        inputs = (None, frac_coords, batch.atom_types, batch.num_atoms, batch.batch)
+        with torch.no_grad():
+            expected = model(*inputs, lattice=lattice)
+            pos = frac_to_cart_coords_with_lattice(frac_coords, batch.num_atoms, lattice)
+            expected_graph = model.generate_interaction_graph(
+                pos, lattice, batch.num_atoms, None, None, None
+            )
+            with using_inference_options(options, cache):
+                output = model(*inputs, lattice=lattice)
+                graph = model.generate_interaction_graph(
+                    pos, lattice, batch.num_atoms, None, None, None
+                )
+        for x, expected_x in zip(graph, expected_graph):
+            assert torch.equal(x, expected_x)
+        torch.testing.assert_close(output.forces, expected.forces)
+        torch.testing.assert_close(output.stress, expected.stress)
+        num_builds.append(cache.neighbor_lists[model].neighbor_list.num_builds)
+    assert num_builds == [1, 1, 1, 1, 2, 2]
+
+
+def _symmetric_edge_triplets_with_torch_sparse(
+    edge_index: torch.Tensor, neighbors: torch.Tensor, num_atoms: int
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+    # Reference implementation with repeat_blocks and a torch_sparse adjacency.
+    block_sizes = neighbors // 2
+    block_sizes = torch.masked_select(block_sizes, block_sizes > 0)
+    id_swap = repeat_blocks(
+        block_sizes,
+        repeats=2,
+        continuous_indexing=False,
+        start_idx=block_sizes[0],
+        block_inc=block_sizes[:-1] + block_sizes[1:],
+        repeat_inc=-block_sizes,
+    )
+    idx_s, idx_t = edge_index
+    adj = SparseTensor(
+        row=idx_t,
+        col=idx_s,
+        value=torch.arange(idx_s.size(0)),
+        sparse_sizes=(num_atoms, num_atoms),
+    )
+    adj_edges = adj[idx_t]
+    id3_ba = adj_edges.storage.value()
+    id3_ca = adj_edges.storage.row()
+    mask = id3_ba != id3_ca
+    id3_ba = id3_ba[mask]
+    id3_ca = id3_ca[mask]
+    id3_ragged_idx = ragged_range(torch.bincount(id3_ca, minlength=idx_s.size(0)))
+    return id_swap, id3_ba, id3_ca, id3_ragged_idx
+
+
+@pytest.mark.parametrize("cutoff, max_neighbors", [(3.0, 20), (7.0, 50)])
+def test_symmetric_edge_triplets(cutoff: float, max_neighbors: int):
+    model = get_model(max_neighbors=max_neighbors, cutoff=cutoff, max_cell_images_per_dim=5)
+    batch = get_mp_20_debug_batch()
+    lattice = lattice_params_to_matrix_torch(batch.lengths, batch.angles)
+    pos = frac_to_cart_coords_with_lattice(batch.frac_coords, batch.num_atoms, lattice)
+    edge_index, cell_offsets, neighbors = radius_graph_pbc(
+        pos, lattice, batch.num_atoms, cutoff, max_neighbors, max_cell_images_per_dim=5
+    )
+    _, _, edge_index, neighbors = model._symmetric_edge_order(edge_index, cell_offsets, neighbors)
+    # Periodic copies of the same edge.
+    assert torch.unique(edge_index, dim=1).shape[1] < edge_index.shape[1]
+    num_atoms = int(batch.num_atoms.sum())
+
+    indices = symmetric_edge_triplets(edge_index, neighbors, num_atoms)
+    expected = _symmetric_edge_triplets_with_torch_sparse(edge_index, neighbors, num_atoms)
+    for x, expected_x in zip(indices, expected):
+        assert torch.equal(x, expected_x)
+
+
+@pytest.mark.parametrize("max_triplets_per_chunk", [1, 200, 10**9])
+def test_chunked_message_passing(max_triplets_per_chunk: int):
+    torch.manual_seed(0)
+    model = get_model(max_neighbors=20, cutoff=5.0, regress_stress=True, max_cell_images_per_dim=20)
+    model.eval()
+    batch = get_mp_20_debug_batch()
+    batch = Batch.from_data_list(batch.to_data_list()[:8])
+    inputs = (torch.randn(8, 4), batch.frac_coords, batch.atom_types, batch.num_atoms, batch.batch)
+    lattice = lattice_params_to_matrix_torch(batch.lengths, batch.angles)
+    with torch.no_grad():
+        expected = model(*inputs, lattice=lattice)
+        options = InferenceOptions(max_triplets_per_chunk=max_triplets_per_chunk)
+        with using_inference_options(options):
+            output = model(*inputs, lattice=lattice)
+    torch.testing.assert_close(output.forces, expected.forces)
+    torch.testing.assert_close(output.stress, expected.stress)
+    torch.testing.assert_close(output.energy, expected.energy)
+
+
+def test_chunked_message_passing_peak_memory():
+    torch.manual_seed(0)
+    model = get_model(max_neighbors=20, cutoff=5.0, regress_stress=True)
+    model.eval()
+    batch = get_mp_20_debug_batch()
+    batch = Batch.from_data_list(batch.to_data_list()[:8])
+    inputs = (torch.randn(8, 4), batch.frac_coords, batch.atom_types, batch.num_atoms, batch.batch)
+    lattice = lattice_params_to_matrix_torch(batch.lengths, batch.angles)
+    # Reuse the neighbor list of the first call, so that only message passing is measured.
+    cache = InferenceCache()
+    peaks = []
+    with torch.no_grad():
+        with using_inference_options(InferenceOptions(neighbor_list_skin=1.0), cache):
+            model(*inputs, lattice=lattice)
+        for max_triplets_per_chunk in [None, 30000, 10000, 3000]:
+            options = InferenceOptions(
+                neighbor_list_skin=1.0, max_triplets_per_chunk=max_triplets_per_chunk
+            )
+            with using_inference_options(options, cache), PeakTensorMemory() as memory:
+                model(*inputs, lattice=lattice)
+            peaks.append(memory.peak)
+    # The edge and triplet messages of one chunk at a time dominate the peak memory, which shrinks with the chunk size
+    # down to the edge embeddings, the basis functions and the graph, which are not chunked.
+    assert peaks[1] > peaks[2] > peaks[3]
+    assert peaks[3] < 0.7 * peaks[0]
@@ -0,0 +1,87 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import io
+from pathlib import Path
+
+import ase.io
+import numpy as np
+import pytest
+import torch
+from pymatgen.io.ase import AseAtomsAdaptor
+
+from mattergen.common.data.chemgraph import ChemGraph
+from mattergen.common.data.collate import collate
+from mattergen.common.data.condition_factory import CONDITION_ROW
+from mattergen.common.utils.data_utils import lattice_matrix_to_params_torch
+from mattergen.common.utils.generated_batch import GeneratedBatch
+from mattergen.generator import structure_from_model_output
+
+
+@pytest.fixture
+def batch() -> ChemGraph:
+    torch.manual_seed(0)
+    batch = collate(
+        [
+            ChemGraph(
+                pos=torch.rand(n, 3),
+                atomic_numbers=torch.randint(1, 90, (n,)),
+                cell=(torch.eye(3) * 4.0 + torch.randn(3, 3))[None],
+                num_atoms=torch.tensor([n]),
+            )
+            for n in [3, 1, 5, 2]
+        ]
+    )
+    return batch.replace(**{CONDITION_ROW: torch.tensor([0, 1, 1, 0])})
+
+
+def test_from_chemgraph(batch: ChemGraph):
+    generated = GeneratedBatch.from_chemgraph(batch)
+    lengths, angles = lattice_matrix_to_params_torch(batch.cell)
+    expected = structure_from_model_output(
+        batch.pos, batch.atomic_numbers, lengths, angles, batch.num_atoms
+    )
+    assert len(generated) == len(expected) == 4
+    for structure, expected_structure, condition_row in zip(generated, expected, [0, 1, 1, 0]):
+        np.testing.assert_allclose(
+            structure.lattice.matrix, expected_structure.lattice.matrix, atol=1e-5
+        )
+        np.testing.assert_allclose(structure.frac_coords, expected_structure.frac_coords)
+        assert structure.species == expected_structure.species
+        assert structure.properties == {CONDITION_ROW: condition_row}
+    assert generated[-1].composition == expected[-1].composition
+    with pytest.raises(IndexError):
+        generated[4]
+
+
+def test_write_extxyz(batch: ChemGraph):
+    structures = list(GeneratedBatch.from_chemgraph(batch))
+    expected = io.StringIO()
+    ase.io.write(expected, [AseAtomsAdaptor.get_atoms(s) for s in structures], format="extxyz")
+
+    generated = GeneratedBatch.from_structures(structures)
+    f = io.StringIO()
+    generated.write_extxyz(f)
+    assert f.getvalue() == expected.getvalue()
+    for atoms, structure in zip(generated.to_ase_atoms(), structures):
+        expected_atoms = AseAtomsAdaptor.get_atoms(structure)
+        np.testing.assert_allclose(atoms.positions, expected_atoms.positions)
+        np.testing.assert_allclose(atoms.cell, expected_atoms.cell)
+        assert atoms.info == expected_atoms.info
+
+
+def test_slice_concatenate_and_npz(tmp_path: Path, batch: ChemGraph):
+    generated = GeneratedBatch.from_chemgraph(batch)
+    parts = [generated[:1], generated[1:3], generated[3:]]
+    assert [len(part) for part in parts] == [1, 2, 1]
+    assert parts[1][1] == generated[2]
+    assert parts[1][1].properties == generated[2].properties
+
+    concatenated = GeneratedBatch.concatenate(parts)
+    generated.save_npz(tmp_path / "generated.npz")
+    loaded = GeneratedBatch.load_npz(tmp_path / "generated.npz")
+    for other in [concatenated, loaded]:
+        assert list(other) == list(generated)
+        assert list(other.properties) == [CONDITION_ROW]
+        np.testing.assert_array_equal(other.properties[CONDITION_ROW], [0, 1, 1, 0])
+    assert len(GeneratedBatch.concatenate([])) == 0
@@ -0,0 +1,73 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import numpy as np
+import torch
+from pymatgen.core import Lattice, Structure
+from torch_geometric.data import Batch
+
+from mattergen.common.data.chemgraph import ChemGraph
+from mattergen.common.diffusion.screening import CrystalScreen
+from mattergen.common.tests.testutils import get_mp_20_debug_batch
+from mattergen.common.utils.data_utils import lattice_params_to_matrix_torch
+from mattergen.evaluation.metrics.structure import structure_validity
+
+
+def _get_structures(batch: ChemGraph) -> list[Structure]:
+    return [
+        Structure(
+            lattice=Lattice(cell.numpy()),
+            species=atomic_numbers.tolist(),
+            coords=frac_coords.numpy(),
+        )
+        for cell, atomic_numbers, frac_coords in zip(
+            batch.cell,
+            batch.atomic_numbers.split(batch.num_atoms.tolist()),
+            batch.pos.split(batch.num_atoms.tolist()),
+        )
+    ]
+
+
+def _get_batch() -> ChemGraph:
+    batch = get_mp_20_debug_batch()
+    # Shrink some of the cells, so that their atoms get too close together.
+    scale = torch.linspace(0.2, 1.0, len(batch.num_atoms))
+    cell = lattice_params_to_matrix_torch(batch.lengths, batch.angles) * scale[:, None, None]
+    return Batch.from_data_list(
+        [
+            ChemGraph(
+                pos=frac_coords,
+                cell=cell[i : i + 1],
+                atomic_numbers=atomic_numbers,
+                num_atoms=num_atoms,
+            )
+            for i, (frac_coords, atomic_numbers, num_atoms) in enumerate(
+                zip(
+                    batch.frac_coords.split(batch.num_atoms.tolist()),
+                    batch.atom_types.split(batch.num_atoms.tolist()),
+                    batch.num_atoms,
+                )
+            )
+        ]
+    )
+
+
+def test_crystal_screen_distance_matches_structure_validity():
+    batch = _get_batch()
+    keep = CrystalScreen()(batch)
+    expected = torch.tensor([structure_validity(s) for s in _get_structures(batch)])
+    assert not expected.all() and expected.any()
+    assert torch.equal(keep, expected)
+
+
+def test_crystal_screen_density_and_num_elements():
+    batch = _get_batch()
+    structures = _get_structures(batch)
+    density = np.array([s.density for s in structures])
+    num_elements = np.array([len(s.composition.elements) for s in structures])
+
+    keep = CrystalScreen(min_interatomic_distance=None, density_range=(2.0, 8.0))(batch)
+    assert torch.equal(keep, torch.from_numpy((density >= 2.0) & (density <= 8.0)))
+
+    keep = CrystalScreen(min_interatomic_distance=None, max_num_elements=2)(batch)
+    assert torch.equal(keep, torch.from_numpy(num_elements <= 2))
@@ -0,0 +1,122 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import io
+from pathlib import Path
+from zipfile import ZipFile
+
+import ase.io
+import numpy as np
+import pytest
+import torch
+
+from mattergen.common.data.chemgraph import ChemGraph
+from mattergen.common.data.collate import collate
+from mattergen.common.utils.generated_batch import GeneratedBatch
+from mattergen.common.utils.trajectory_utils import (
+    TrajectoryFile,
+    copy_trajectory_chunk,
+    export_trajectories_to_extxyz,
+    load_trajectory,
+    save_trajectory_chunk,
+)
+
+
+def _get_frames(num_frames: int) -> list[ChemGraph]:
+    torch.manual_seed(0)
+    batch = collate(
+        [
+            ChemGraph(
+                pos=torch.rand(n, 3),
+                atomic_numbers=torch.randint(1, 90, (n,)),
+                cell=(torch.eye(3) * 4.0 + torch.randn(3, 3))[None],
+                num_atoms=torch.tensor([n]),
+            )
+            for n in [3, 1, 2]
+        ]
+    )
+    frames = []
+    for ix_frame in range(num_frames):
+        atomic_numbers = batch.atomic_numbers.clone()
+        if ix_frame < 2:
+            # Only the atom types of the first structure change, in the first two frames. 101 is the
+            # largest type the model can produce (the mask token of discrete diffusion).
+            atomic_numbers[:3] = ix_frame + 100
+        frames.append(
+            batch.replace(
+                pos=torch.rand_like(batch.pos),
+                cell=batch.cell + 0.1 * torch.randn_like(batch.cell),
+                atomic_numbers=atomic_numbers,
+            )
+        )
+    return frames
+
+
+@pytest.mark.parametrize("position_dtype", [np.float16, np.float32])
+def test_save_and_read_trajectory_chunk(tmp_path: Path, position_dtype: type):
+    frames = _get_frames(num_frames=4)
+    path = tmp_path / "batch_00000.mgtraj"
+    save_trajectory_chunk(
+        path, frames, final_batch=frames[-1], start_index=5, position_dtype=position_dtype
+    )
+
+    trajectory_file = TrajectoryFile(path)
+    assert (trajectory_file.start_index, trajectory_file.num_frames) == (5, 4)
+    assert len(trajectory_file) == 3
+    # Trajectory 1 consists of atom 3 of the batch.
+    trajectory = trajectory_file[1]
+    expected = GeneratedBatch.concatenate(
+        [GeneratedBatch.from_chemgraph(frame)[1:2] for frame in frames]
+    )
+    assert trajectory.pos.dtype == position_dtype
+    np.testing.assert_allclose(
+        trajectory.pos, expected.pos, atol=1e-3 if position_dtype == np.float16 else 0
+    )
+    np.testing.assert_allclose(trajectory.cell, expected.cell)
+    np.testing.assert_array_equal(trajectory.atomic_numbers, expected.atomic_numbers)
+    np.testing.assert_array_equal(trajectory.num_atoms, [1, 1, 1, 1])
+    np.testing.assert_array_equal(
+        trajectory_file[0].atomic_numbers.reshape(4, 3)[:, 0],
+        [100, 101] + [frames[-1].atomic_numbers[0].item()] * 2,
+    )
+    assert trajectory_file._trajectories[0]["arrays"]["atomic_numbers"]["dtype"] == "|u1"
+
+    copy_trajectory_chunk(path, tmp_path / "copy" / "batch_00000.mgtraj", index_offset=10)
+    copied = load_trajectory(tmp_path / "copy", 16)
+    np.testing.assert_array_equal(copied.pos, trajectory.pos)
+    with pytest.raises(IndexError):
+        load_trajectory(tmp_path / "copy", 18)
+
+
+def test_save_trajectory_chunk_rejects_atom_types_beyond_uint8(tmp_path: Path):
+    frames = _get_frames(num_frames=2)
+    frames[0] = frames[0].replace(atomic_numbers=frames[0].atomic_numbers + 200)
+    with pytest.raises(ValueError, match="between 0 and 255"):
+        save_trajectory_chunk(
+            tmp_path / "batch_00000.mgtraj", frames, final_batch=frames[-1], start_index=0
+        )
+
+
+def test_export_trajectories_to_extxyz(tmp_path: Path):
+    frames = _get_frames(num_frames=3)
+    # Atom types are not recorded, e.g., for crystal structure prediction.
+    recorded = [{"pos": frame.pos, "cell": frame.cell} for frame in frames]
+    save_trajectory_chunk(
+        tmp_path / "batch_00000.mgtraj",
+        recorded,  # type: ignore
+        final_batch=frames[-1],
+        start_index=0,
+        position_dtype=np.float32,
+    )
+    export_trajectories_to_extxyz(tmp_path, output_file=tmp_path / "trajectories.zip")
+    with ZipFile(tmp_path / "trajectories.zip") as zip_obj:
+        assert sorted(zip_obj.namelist()) == ["gen_0.extxyz", "gen_1.extxyz", "gen_2.extxyz"]
+        trajectory = ase.io.read(
+            io.StringIO(zip_obj.read("gen_0.extxyz").decode()), index=":", format="extxyz"
+        )
+    assert len(trajectory) == 3
+    for atoms, frame in zip(trajectory, frames):
+        expected = GeneratedBatch.from_chemgraph(frame)[0]
+        np.testing.assert_allclose(atoms.cell.array, expected.lattice.matrix, atol=1e-6)
+        np.testing.assert_allclose(atoms.positions, expected.cart_coords, atol=1e-6)
+        assert atoms.get_atomic_numbers().tolist() == frames[-1].atomic_numbers[:3].tolist()
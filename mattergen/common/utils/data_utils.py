@@ -4,6 +4,7 @@
 # Adapted from https://github.com/txie-93/cdvae/blob/main/cdvae/common/data_utils.py
 
 from functools import lru_cache
+from typing import Literal
 
 import numpy as np
 import torch
@@ -11,9 +12,14 @@ from pymatgen.core import Element
 
 from mattergen.common.data.chemgraph import ChemGraph
 from mattergen.common.utils.ocp_graph_utils import radius_graph_pbc as radius_graph_pbc_ocp
+from mattergen.common.utils.ocp_graph_utils import radius_graph_pbc_cell_list
 
 EPSILON = 1e-5
 
+# "all_pairs" computes the distances of all pairs of atoms of a crystal, "cell_list" only of nearby pairs, which takes
+# time and memory linear instead of quadratic in the number of atoms per crystal. Both give the same graph.
+RadiusGraphAlgorithm = Literal["all_pairs", "cell_list"]
+
 
 @lru_cache
 def get_atomic_number(symbol: str) -> int:
@@ -236,6 +242,7 @@ def radius_graph_pbc(
     max_num_neighbors_threshold: int,
     max_cell_images_per_dim: int = 10,
     topk_per_pair: torch.Tensor | None = None,
+    algorithm: RadiusGraphAlgorithm = "all_pairs",
 ) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
     """Computes pbc graph edges under pbc.
 
@@ -250,6 +257,7 @@ def radius_graph_pbc(
         num_atoms.shape=[Ncrystal]
         max_cell_images_per_dim -- constrain the max. number of cell images per dimension in event
                                 that infinitesimal angles between lattice vectors are encountered.
+        algorithm -- "all_pairs" or "cell_list", see RadiusGraphAlgorithm.
 
     WARNING: It is possible (and has been observed) that for rare cases when periodic atom images are
     on or close to the cut off radius boundary, doing these operations in 32 bit floating point can
@@ -260,7 +268,9 @@ def radius_graph_pbc(
     of these errors in 32-bit should be negligible in practice.
     """
     assert topk_per_pair is None, "non None values of topk_per_pair is not supported"
-    edge_index, unit_cell, num_neighbors_image, _, _ = radius_graph_pbc_ocp(
+    radius_graph_fns = {"all_pairs": radius_graph_pbc_ocp, "cell_list": radius_graph_pbc_cell_list}
+    assert algorithm in radius_graph_fns, f"Unknown radius graph algorithm {algorithm}."
+    edge_index, unit_cell, num_neighbors_image, _, _ = radius_graph_fns[algorithm](
         pos=cart_coords,
         cell=lattice,
         natoms=num_atoms,
@@ -1,11 +1,15 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT License.
 
+import io
 import logging
+import multiprocessing
 import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 from pathlib import Path
 from tempfile import TemporaryDirectory
-from typing import Sequence
+from typing import Iterator, Literal, Sequence
 from zipfile import ZipFile
 
 import ase.io
@@ -20,6 +24,7 @@ from mattergen.common.globals import (
     GENERATED_CRYSTALS_ZIP_FILE_NAME,
 )
 from mattergen.common.utils.data_classes import MatterGenCheckpointInfo
+from mattergen.common.utils.generated_batch import GeneratedBatch
 from mattergen.common.utils.globals import get_device
 from mattergen.diffusion.lightning_module import DiffusionLightningModule
 
@@ -103,23 +108,125 @@ def get_crystals_list(
     return crystal_array_list
 
 
-def save_structures(output_path: Path, structures: Sequence[Structure]) -> None:
+# Number of structures that a worker of `save_structures` converts to extxyz and cif files at a time.
+SERIALIZATION_CHUNK_SIZE = 256
+
+
+def _serialize_structures(structures: Sequence[Structure]) -> tuple[str, list[bytes]]:
+    """Returns the extxyz file contents of the structures and the cif file contents of each structure."""
+    extxyz = io.StringIO()
+    if isinstance(structures, GeneratedBatch):
+        # Skip building pymatgen structures.
+        ase_atoms = structures.to_ase_atoms()
+        structures.write_extxyz(extxyz)
+    else:
+        ase_atoms = [AseAtomsAdaptor.get_atoms(x) for x in structures]
+        ase.io.write(extxyz, ase_atoms, format="extxyz")
+    cifs = []
+    for ase_atom in ase_atoms:
+        cif = io.BytesIO()
+        ase.io.write(cif, ase_atom, format="cif")
+        cifs.append(cif.getvalue())
+    return extxyz.getvalue(), cifs
+
+
+def _iter_serialized_chunks(
+    structures: Sequence[Structure], num_workers: int | None
+) -> Iterator[tuple[str, list[bytes]]]:
+    """Yields the outputs of `_serialize_structures` for consecutive chunks of the structures, in order.
+    The chunks are serialized in `num_workers` processes (default: see `_default_num_serialization_workers`) if there is
+    more than one.
+    """
+    chunks = [
+        structures[start : start + SERIALIZATION_CHUNK_SIZE]
+        for start in range(0, len(structures), SERIALIZATION_CHUNK_SIZE)
+    ]
+    if num_workers is None:
+        num_workers = _default_num_serialization_workers()
+    num_workers = min(num_workers, len(chunks))
+    if num_workers <= 1:
+        yield from map(_serialize_structures, chunks)
+        return
+    yield from _serialization_pool(num_workers).map(_serialize_structures, chunks)
+
+
+@lru_cache
+def _serialization_pool(num_workers: int) -> ProcessPoolExecutor:
+    """Worker processes for `_iter_serialized_chunks`. They are kept for later calls, as starting them takes a while."""
+    # Do not fork: the parent process may hold the model and CUDA state.
+    return ProcessPoolExecutor(
+        max_workers=num_workers, mp_context=torch.multiprocessing.get_context("spawn")
+    )
+
+
+def _default_num_serialization_workers() -> int:
+    """Half of the available cores, leaving the others to sampling, or a single one within a worker process (e.g., of
+    `CrystalGenerator.generate_parallel`), which only has its own share of the cores."""
+    if multiprocessing.parent_process() is not None:
+        return 1
+    num_cores = (
+        len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+    )
+    return max(1, num_cores // 2)
+
+
+def _write_structures(
+    output_path: Path,
+    structures: Sequence[Structure],
+    start_index: int,
+    mode: Literal["w", "a"],
+    num_workers: int | None,
+) -> None:
+    try:
+        with (
+            open(output_path / GENERATED_CRYSTALS_EXTXYZ_FILE_NAME, mode) as f,
+            ZipFile(output_path / GENERATED_CRYSTALS_ZIP_FILE_NAME, mode) as zip_obj,
+        ):
+            ix = start_index
+            for extxyz, cifs in _iter_serialized_chunks(structures, num_workers):
+                f.write(extxyz)
+                for cif in cifs:
+                    zip_obj.writestr(f"gen_{ix}.cif", cif)
+                    ix += 1
+    except IOError as e:
+        print(f"Got error {e} writing the generated structures to disk.")
+
+
+def save_structures(
+    output_path: Path, structures: Sequence[Structure], num_workers: int | None = None
+) -> None:
     """Save structures to disk in a extxyz file and a compressed zip file containing cif files.
 
+    The files are written in memory in chunks of `SERIALIZATION_CHUNK_SIZE` structures, which are spread over
+    `num_workers` processes (default: half of the available cores) when there are several chunks.
+
     Args:
         output_path: path to a directory where the results are written.
         structures: sequence of structures.
+        num_workers: number of processes that serialize the structures.
     """
-    ase_atoms = [AseAtomsAdaptor.get_atoms(x) for x in structures]
-    try:
-        ase.io.write(output_path / GENERATED_CRYSTALS_EXTXYZ_FILE_NAME, ase_atoms)
+    _write_structures(output_path, structures, start_index=0, mode="w", num_workers=num_workers)
 
-        with ZipFile(output_path / GENERATED_CRYSTALS_ZIP_FILE_NAME, "w") as zip_obj:
-            for ix, ase_atom in enumerate(ase_atoms):
-                ase.io.write(f"/tmp/gen_{ix}.cif", ase_atom, format="cif")
-                zip_obj.write(f"/tmp/gen_{ix}.cif", arcname=f"gen_{ix}.cif")
-    except IOError as e:
-        print(f"Got error {e} writing the generated structures to disk.")
+
+def append_structures(
+    output_path: Path,
+    structures: Sequence[Structure],
+    start_index: int,
+    num_workers: int | None = None,
+) -> None:
+    """Append structures to the extxyz file and the zip file of cif files written by `save_structures`.
+    Files are created if they do not exist yet. Both files are closed again before returning, so that everything
+    written so far stays readable if the process is interrupted.
+
+    Args:
+        output_path: path to a directory where the results are written.
+        structures: sequence of structures.
+        start_index: index of the first structure, used to name the cif files.
+        num_workers: number of processes that serialize the structures, as for `save_structures`.
+    """
+    _write_structures(
+        output_path, structures, start_index=start_index, mode="a", num_workers=num_workers
+    )
 
 
 def load_structures(input_path: Path) -> Sequence[Structure]:
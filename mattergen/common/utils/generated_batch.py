@@ -0,0 +1,237 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+from functools import cached_property
+from pathlib import Path
+from typing import Iterator, Sequence, TextIO, overload
+
+import ase
+import numpy as np
+import torch
+from ase.data import chemical_symbols
+from pymatgen.core import Lattice, Structure
+
+from mattergen.common.data.chemgraph import ChemGraph
+from mattergen.common.data.condition_factory import CONDITION_ROW
+from mattergen.common.utils.data_utils import (
+    lattice_matrix_to_params_torch,
+    lattice_params_to_matrix_torch,
+)
+
+_SYMBOLS = np.array(chemical_symbols)
+
+
+@dataclass(frozen=True, eq=False)
+class GeneratedBatch(Sequence[Structure]):
+    """Generated structures stored as flat arrays, as they come out of the sampler.
+
+    Indexing returns a pymatgen `Structure`, which is only built when it is accessed. Writing the structures to .extxyz
+    or .npz files works on the arrays directly, without building a `Structure` for each sample.
+    """
+
+    # [total_num_atoms, 3], fractional coordinates
+    pos: np.ndarray
+    # [num_structures, 3, 3], lattice vectors as rows
+    cell: np.ndarray
+    # [total_num_atoms]
+    atomic_numbers: np.ndarray
+    # [num_structures]
+    num_atoms: np.ndarray
+    # Scalar properties of each structure, e.g., the row of the condition table it was generated for. Values are
+    # arrays of shape [num_structures] and end up in `Structure.properties`.
+    properties: dict[str, np.ndarray] = field(default_factory=dict)
+
+    @classmethod
+    def from_chemgraph(cls, batch: ChemGraph) -> GeneratedBatch:
+        """The structures of a batch of generated samples. The lattices are rotated into the standard orientation of
+        `Lattice.from_parameters`, as for the structures that `mattergen-generate` has always written.
+        """
+        batch = batch.to("cpu")
+        properties = {}
+        if CONDITION_ROW in batch:
+            # Label the structures with the row of the condition table that they were generated for.
+            properties[CONDITION_ROW] = batch[CONDITION_ROW].reshape(-1).numpy()
+        return cls.from_arrays(
+            pos=batch.pos.reshape(-1, 3).numpy(),
+            cell=batch.cell.reshape(-1, 3, 3).numpy(),
+            atomic_numbers=batch.atomic_numbers.reshape(-1).numpy(),
+            num_atoms=batch.num_atoms.reshape(-1).numpy(),
+            properties=properties,
+        )
+
+    @classmethod
+    def from_arrays(
+        cls,
+        pos: np.ndarray,
+        cell: np.ndarray,
+        atomic_numbers: np.ndarray,
+        num_atoms: np.ndarray,
+        properties: dict[str, np.ndarray] | None = None,
+    ) -> GeneratedBatch:
+        """Like the constructor, but rotates the lattices into the standard orientation of `Lattice.from_parameters`."""
+        lengths, angles = lattice_matrix_to_params_torch(torch.tensor(cell, dtype=torch.float32))
+        return cls(
+            pos=pos,
+            cell=lattice_params_to_matrix_torch(lengths, angles).numpy(),
+            atomic_numbers=atomic_numbers,
+            num_atoms=num_atoms,
+            properties=properties or {},
+        )
+
+    @classmethod
+    def from_structures(cls, structures: Sequence[Structure]) -> GeneratedBatch:
+        """Only the numerical properties that all structures have are kept."""
+        if isinstance(structures, GeneratedBatch):
+            return structures
+        if not structures:
+            return cls.concatenate([])
+        property_keys = [
+            key for key in structures[0].properties if all(key in s.properties for s in structures)
+        ]
+        return cls(
+            pos=np.concatenate([s.frac_coords for s in structures]).reshape(-1, 3),
+            cell=np.stack([s.lattice.matrix for s in structures]),
+            atomic_numbers=np.concatenate([s.atomic_numbers for s in structures]).astype(np.int64),
+            num_atoms=np.array([len(s) for s in structures], dtype=np.int64),
+            properties={
+                key: np.array([s.properties[key] for s in structures])
+                for key in property_keys
+                if all(isinstance(s.properties[key], (int, float)) for s in structures)
+            },
+        )
+
+    @classmethod
+    def concatenate(cls, batches: Sequence[GeneratedBatch]) -> GeneratedBatch:
+        if not batches:
+            return cls(
+                pos=np.zeros((0, 3)),
+                cell=np.zeros((0, 3, 3)),
+                atomic_numbers=np.zeros(0, dtype=np.int64),
+                num_atoms=np.zeros(0, dtype=np.int64),
+            )
+        if len(batches) == 1:
+            return batches[0]
+        property_keys = set(batches[0].properties)
+        assert all(
+            set(b.properties) == property_keys for b in batches
+        ), "All batches must have the same properties."
+        return cls(
+            pos=np.concatenate([b.pos for b in batches]),
+            cell=np.concatenate([b.cell for b in batches]),
+            atomic_numbers=np.concatenate([b.atomic_numbers for b in batches]),
+            num_atoms=np.concatenate([b.num_atoms for b in batches]),
+            properties={
+                key: np.concatenate([b.properties[key] for b in batches]) for key in property_keys
+            },
+        )
+
+    @cached_property
+    def offsets(self) -> np.ndarray:
+        """[num_structures + 1], the atoms of structure `i` are `offsets[i]:offsets[i + 1]`."""
+        return np.concatenate([[0], np.cumsum(self.num_atoms)])
+
+    @cached_property
+    def cartesian_pos(self) -> np.ndarray:
+        """[total_num_atoms, 3], Cartesian coordinates."""
+        # In double precision, as pymatgen does.
+        cell_per_atom = np.repeat(self.cell.astype(np.float64), self.num_atoms, axis=0)
+        return np.einsum("ni,nij->nj", self.pos.astype(np.float64), cell_per_atom)
+
+    def __len__(self) -> int:
+        return len(self.num_atoms)
+
+    @overload
+    def __getitem__(self, index: int) -> Structure: ...
+
+    @overload
+    def __getitem__(self, index: slice) -> GeneratedBatch: ...
+
+    def __getitem__(self, index: int | slice) -> Structure | GeneratedBatch:
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            assert step == 1, "Only contiguous slices are supported."
+            atoms = slice(self.offsets[start], self.offsets[max(start, stop)])
+            return GeneratedBatch(
+                pos=self.pos[atoms],
+                cell=self.cell[start:stop],
+                atomic_numbers=self.atomic_numbers[atoms],
+                num_atoms=self.num_atoms[start:stop],
+                properties={key: value[start:stop] for key, value in self.properties.items()},
+            )
+        if not -len(self) <= index < len(self):
+            raise IndexError(f"Index {index} out of range for {len(self)} structures.")
+        index = index % len(self)
+        atoms = slice(self.offsets[index], self.offsets[index + 1])
+        return Structure(
+            lattice=Lattice(self.cell[index]),
+            species=self.atomic_numbers[atoms],
+            coords=self.pos[atoms],
+            coords_are_cartesian=False,
+            properties={key: value[index].item() for key, value in self.properties.items()},
+        )
+
+    def __iter__(self) -> Iterator[Structure]:
+        return (self[i] for i in range(len(self)))
+
+    def to_ase_atoms(self) -> list[ase.Atoms]:
+        """The structures as ase `Atoms`, as returned by `AseAtomsAdaptor.get_atoms`."""
+        cartesian_pos = self.cartesian_pos
+        return [
+            ase.Atoms(
+                numbers=self.atomic_numbers[start:stop],
+                positions=cartesian_pos[start:stop],
+                cell=cell,
+                pbc=True,
+                info={key: value[i].item() for key, value in self.properties.items()},
+            )
+            for i, (start, stop, cell) in enumerate(
+                zip(self.offsets[:-1], self.offsets[1:], self.cell)
+            )
+        ]
+
+    def write_extxyz(self, f: TextIO) -> None:
+        """Write the structures to an open text file in the extended XYZ format, as `ase.io.write` does for the
+        structures as ase `Atoms`."""
+        symbols = _SYMBOLS[self.atomic_numbers].tolist()
+        cartesian_pos = self.cartesian_pos.tolist()
+        for i, (start, stop) in enumerate(
+            zip(self.offsets[:-1].tolist(), self.offsets[1:].tolist())
+        ):
+            lattice = " ".join(str(x) for x in self.cell[i].reshape(-1).tolist())
+            info = "".join(f" {key}={value[i].item()}" for key, value in self.properties.items())
+            f.write(
+                f'{stop - start}\nLattice="{lattice}" Properties=species:S:1:pos:R:3{info} pbc="T T T"\n'
+            )
+            f.writelines(
+                f"{symbol:<2s} {x:16.8f} {y:16.8f} {z:16.8f}\n"
+                for symbol, (x, y, z) in zip(symbols[start:stop], cartesian_pos[start:stop])
+            )
+
+    def save_npz(self, path: Path) -> None:
+        """Save the arrays uncompressed, so that they are written to the file as they are."""
+        np.savez(
+            path,
+            pos=self.pos,
+            cell=self.cell,
+            atomic_numbers=self.atomic_numbers,
+            num_atoms=self.num_atoms,
+            **{f"properties.{key}": value for key, value in self.properties.items()},
+        )
+
+    @classmethod
+    def load_npz(cls, path: Path) -> GeneratedBatch:
+        with np.load(path) as data:
+            return cls(
+                pos=data["pos"],
+                cell=data["cell"],
+                atomic_numbers=data["atomic_numbers"],
+                num_atoms=data["num_atoms"],
+                properties={
+                    key.removeprefix("properties."): data[key]
+                    for key in data.files
+                    if key.startswith("properties.")
+                },
+            )
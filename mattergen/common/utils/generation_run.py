@@ -0,0 +1,199 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import hashlib
+import json
+import os
+import random
+import shutil
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Any, Iterable, Sequence
+
+import numpy as np
+import torch
+from pymatgen.core.structure import Structure
+
+from mattergen.common.data.chemgraph import ChemGraph
+from mattergen.common.globals import (
+    GENERATED_CRYSTALS_EXTXYZ_FILE_NAME,
+    GENERATED_TRAJECTORIES_DIR_NAME,
+    GENERATION_BATCHES_DIR_NAME,
+    GENERATION_MANIFEST_FILE_NAME,
+    GENERATION_SAMPLE_SEEDS_FILE_NAME,
+)
+from mattergen.common.utils.eval_utils import append_structures, load_structures
+from mattergen.common.utils.generated_batch import GeneratedBatch
+from mattergen.common.utils.trajectory_utils import TRAJECTORY_FILE_SUFFIX, save_trajectory_chunk
+from mattergen.diffusion.sampling.recording import Frame
+
+
+def seed_everything(seed: int) -> None:
+    """Seed the global random number generators of torch, numpy and python."""
+    torch.manual_seed(seed)
+    np.random.seed(seed % 2**32)
+    random.seed(seed)
+
+
+def get_batch_seed(seed: int, batch_index: int) -> int:
+    """Seed for sampling the batch with the given index, such that each batch can be sampled on its own."""
+    return int(np.random.SeedSequence(seed, spawn_key=(batch_index,)).generate_state(1)[0])
+
+
+def draw_run_seed() -> int:
+    return int(np.random.SeedSequence().generate_state(1)[0])
+
+
+def fingerprint(obj: Any) -> str:
+    """Hash of a JSON-serializable object (other values are converted to strings), to tell whether two runs were set up
+    the same way."""
+    return hashlib.sha256(json.dumps(obj, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+@dataclass
+class GenerationManifest:
+    """Keeps track of the finished batches of a resumable generation run.
+
+    The manifest and the outputs of each finished batch are stored in the run directory. The outputs of batch `i`
+    are written to `{run_dir}/batches/batch_{i:05d}` and only become visible once they are complete, so that a run can be
+    killed at any point and resumed with `CrystalGenerator(resume=True)` or `mattergen-generate --resume`.
+
+    Each batch is sampled with a seed derived from the seed of the run and its index, so a resumed run generates the same
+    structures as an uninterrupted one, provided that it is set up the same way. To check this, the manifest keeps
+    fingerprints of the parts of the setup that the structures depend on, e.g., the sampling config and the checkpoint.
+    """
+
+    seed: int
+    batch_size: int
+    num_batches: int
+    # Number of structures of each finished batch, by batch index.
+    finished_batches: dict[int, int] = field(default_factory=dict)
+    # Fingerprint (see `fingerprint`) of each part of the setup of the run, by name.
+    fingerprints: dict[str, str] = field(default_factory=dict)
+
+    @classmethod
+    def load(cls, run_dir: Path) -> "GenerationManifest | None":
+        path = run_dir / GENERATION_MANIFEST_FILE_NAME
+        if not path.exists():
+            return None
+        with open(path) as f:
+            manifest = json.load(f)
+        manifest["finished_batches"] = {int(k): v for k, v in manifest["finished_batches"].items()}
+        return cls(**manifest)
+
+    def save(self, run_dir: Path) -> None:
+        # Write to a temporary file first, so that the manifest is never left half-written.
+        path = run_dir / GENERATION_MANIFEST_FILE_NAME
+        tmp_path = path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(asdict(self), f, indent=2)
+        os.replace(tmp_path, path)
+
+    def check_compatible(
+        self, seed: int | None, batch_size: int, num_batches: int, fingerprints: dict[str, str]
+    ) -> None:
+        """Raises ValueError if a run with the given settings would not continue this run."""
+        if seed is not None and seed != self.seed:
+            raise ValueError(
+                f"Cannot resume generation run with seed {self.seed} using a different seed {seed}."
+            )
+        if (batch_size, num_batches) != (self.batch_size, self.num_batches):
+            raise ValueError(
+                f"Cannot resume generation run with batch_size={self.batch_size} and num_batches={self.num_batches} "
+                f"using batch_size={batch_size} and num_batches={num_batches}."
+            )
+        changed = sorted(
+            name
+            for name in set(fingerprints) | set(self.fingerprints)
+            if fingerprints.get(name) != self.fingerprints.get(name)
+        )
+        if changed:
+            raise ValueError(
+                f"Cannot resume generation run with a different setup: {', '.join(changed)} changed. "
+                "Use the same model, sampling config, conditions and inference options as for the original run."
+            )
+
+
+@dataclass
+class SampleSeeds:
+    """Records how the sampling noise of the structures in an output directory is keyed (see
+    `mattergen.diffusion.per_sample_rng`), so that single structures can be regenerated with `CrystalGenerator.regenerate`.
+
+    The structures are split into consecutive segments, e.g., one for each worker of a multi-process run. The noise of a
+    structure in a segment with a seed is keyed by (seed, index of the structure within the segment). Segments without a
+    seed were not sampled with keyed noise (unseeded runs or continuous batching) and cannot be regenerated.
+    """
+
+    # (seed or None, number of structures) of each segment.
+    segments: list[tuple[int | None, int]]
+
+    @classmethod
+    def load(cls, output_dir: Path) -> "SampleSeeds | None":
+        path = output_dir / GENERATION_SAMPLE_SEEDS_FILE_NAME
+        if not path.exists():
+            return None
+        with open(path) as f:
+            segments = json.load(f)["segments"]
+        return cls(segments=[(seed, num_structures) for seed, num_structures in segments])
+
+    def save(self, output_dir: Path) -> None:
+        with open(output_dir / GENERATION_SAMPLE_SEEDS_FILE_NAME, "w") as f:
+            json.dump(asdict(self), f, indent=2)
+
+    @classmethod
+    def concatenate(cls, sample_seeds: Iterable["SampleSeeds"]) -> "SampleSeeds":
+        return cls(segments=[segment for s in sample_seeds for segment in s.segments])
+
+    def get(self, structure_index: int) -> tuple[int, int]:
+        """The seed and the sample index that the noise of the structure with the given index is keyed by."""
+        start = 0
+        for seed, num_structures in self.segments:
+            if structure_index < start + num_structures:
+                if seed is None:
+                    raise ValueError(
+                        f"Structure {structure_index} was not sampled with per-structure seeds (the run was unseeded "
+                        "or used continuous batching), so it cannot be regenerated."
+                    )
+                return seed, structure_index - start
+            start += num_structures
+        raise ValueError(
+            f"There is no structure {structure_index}, the run has {start} structures."
+        )
+
+
+def get_batch_dir(run_dir: Path, batch_index: int) -> Path:
+    return run_dir / GENERATION_BATCHES_DIR_NAME / f"batch_{batch_index:05d}"
+
+
+def save_finished_batch(
+    run_dir: Path,
+    manifest: GenerationManifest,
+    batch_index: int,
+    structures: Sequence[Structure],
+    frames: list[Frame] | None = None,
+    final_batch: ChemGraph | None = None,
+) -> None:
+    """Write the outputs of a finished batch to the run directory and mark it as finished in the manifest."""
+    batch_dir = get_batch_dir(run_dir, batch_index)
+    tmp_dir = batch_dir.with_name(batch_dir.name + ".tmp")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    tmp_dir.mkdir(parents=True)
+    append_structures(tmp_dir, structures, start_index=0)
+    if frames is not None:
+        assert final_batch is not None
+        save_trajectory_chunk(
+            tmp_dir / GENERATED_TRAJECTORIES_DIR_NAME / f"batch_00000{TRAJECTORY_FILE_SUFFIX}",
+            frames=frames,
+            final_batch=final_batch,
+            start_index=0,
+        )
+    shutil.rmtree(batch_dir, ignore_errors=True)
+    os.replace(tmp_dir, batch_dir)
+    manifest.finished_batches[batch_index] = len(structures)
+    manifest.save(run_dir)
+
+
+def load_finished_batch(run_dir: Path, batch_index: int) -> GeneratedBatch:
+    return GeneratedBatch.from_structures(
+        load_structures(get_batch_dir(run_dir, batch_index) / GENERATED_CRYSTALS_EXTXYZ_FILE_NAME)
+    )
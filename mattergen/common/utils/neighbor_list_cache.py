@@ -0,0 +1,172 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+from __future__ import annotations
+
+import torch
+
+from mattergen.common.utils.data_utils import (
+    RadiusGraphAlgorithm,
+    cart_to_frac_coords_with_lattice,
+    radius_graph_pbc,
+)
+from mattergen.common.utils.ocp_graph_utils import get_max_neighbors_mask
+
+
+class VerletNeighborList:
+    """
+    Periodic neighbor lists of a batch of crystals that are only rebuilt when the atoms or lattices have moved enough.
+
+    The list is built with `radius_graph_pbc` for `cutoff + skin`, without limiting the number of neighbors. As long as
+    no atom has moved by more than half the skin since, taking the strain of its lattice into account, the list contains
+    all pairs within the cutoff. Each call then only computes the distances of the listed pairs, keeps those within the
+    cutoff and limits the number of neighbors, which gives the same graph, with the edges in the same order, as
+    `radius_graph_pbc` for the cutoff.
+
+    Args:
+        cutoff: cutoff radius of the graph.
+        skin: margin beyond the cutoff up to which pairs are listed.
+        max_num_neighbors_threshold: maximum number of neighbors per atom, as for `radius_graph_pbc`.
+        max_cell_images_per_dim: maximum number of periodic images per lattice vector, as for `radius_graph_pbc`.
+        algorithm: how `radius_graph_pbc` finds the listed pairs.
+    """
+
+    def __init__(
+        self,
+        cutoff: float,
+        skin: float,
+        max_num_neighbors_threshold: int,
+        max_cell_images_per_dim: int = 10,
+        algorithm: RadiusGraphAlgorithm = "all_pairs",
+    ):
+        self.cutoff = cutoff
+        self.skin = skin
+        self.max_num_neighbors_threshold = max_num_neighbors_threshold
+        self.max_cell_images_per_dim = max_cell_images_per_dim
+        self.algorithm = algorithm
+        # Fractional coordinates, lattices and numbers of atoms at the last rebuild, where the fractional
+        # coordinates follow the atoms across the cell boundaries, see `_follow_wrapped_atoms`.
+        self._frac_coords: torch.Tensor | None = None
+        self._lattice: torch.Tensor | None = None
+        self._num_atoms: torch.Tensor | None = None
+        # Listed pairs: index of the center atom, of the neighbor, the cell of the neighbor and the crystal.
+        self._index1: torch.Tensor | None = None
+        self._index2: torch.Tensor | None = None
+        self._cell_offsets: torch.Tensor | None = None
+        self._crystal: torch.Tensor | None = None
+        # Indices of the listed pairs that were returned by the last call.
+        self._selected: torch.Tensor | None = None
+        # Whether the last call returned a different graph than the call before.
+        self.graph_changed = True
+        self.num_builds = 0
+
+    def __call__(
+        self, cart_coords: torch.Tensor, lattice: torch.Tensor, num_atoms: torch.Tensor
+    ) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """Returns edge_index, to_jimages and num_bonds, as `radius_graph_pbc` does for the cutoff."""
+        frac_coords = cart_to_frac_coords_with_lattice(cart_coords, num_atoms, lattice)
+        rebuilt = self._needs_rebuild(frac_coords, lattice, num_atoms)
+        if rebuilt:
+            self._build(cart_coords, frac_coords, lattice, num_atoms)
+        wrapped = self._follow_wrapped_atoms(frac_coords)
+
+        assert self._index1 is not None and self._index2 is not None
+        assert self._cell_offsets is not None and self._crystal is not None
+        # As in `radius_graph_pbc`.
+        pbc_offsets = torch.bmm(self._cell_offsets[:, None], lattice[self._crystal])[:, 0]
+        distance_squared = torch.sum(
+            (cart_coords[self._index1] - (cart_coords[self._index2] + pbc_offsets)) ** 2, dim=-1
+        )
+        selected = torch.nonzero(
+            (distance_squared <= self.cutoff**2) & (distance_squared > 0.0001)
+        ).flatten()
+        mask_num_neighbors, num_bonds = get_max_neighbors_mask(
+            natoms=num_atoms,
+            index=self._index1[selected],
+            atom_distance_squared=distance_squared[selected],
+            max_num_neighbors_threshold=self.max_num_neighbors_threshold,
+        )
+        if not torch.all(mask_num_neighbors):
+            selected = selected[mask_num_neighbors]
+
+        self.graph_changed = (
+            rebuilt
+            or wrapped
+            or self._selected is None
+            or not torch.equal(selected, self._selected)
+        )
+        self._selected = selected
+        edge_index = torch.stack([self._index2[selected], self._index1[selected]])
+        return edge_index, self._cell_offsets[selected], num_bonds
+
+    def _needs_rebuild(
+        self, frac_coords: torch.Tensor, lattice: torch.Tensor, num_atoms: torch.Tensor
+    ) -> bool:
+        if (
+            self._frac_coords is None
+            or self._lattice is None
+            or self._num_atoms is None
+            or not torch.equal(num_atoms, self._num_atoms)
+        ):
+            return True
+        # Displacement of each atom since the last rebuild, by the shortest path across the cell boundaries.
+        delta = frac_coords - self._frac_coords
+        delta = delta - torch.round(delta)
+        lattice_per_atom = torch.repeat_interleave(lattice, num_atoms, dim=0)
+        displacement = torch.einsum("bi,bij->bj", delta, lattice_per_atom).norm(dim=-1)
+        crystal = torch.repeat_interleave(
+            torch.arange(len(num_atoms), device=num_atoms.device), num_atoms
+        )
+        max_displacement = torch.zeros_like(lattice[:, 0, 0]).scatter_reduce(
+            0, crystal, displacement, reduce="amax"
+        )
+        # A pair at distance r at the last rebuild is now at least r * (1 - strain) - 2 * max_displacement apart,
+        # where strain is the largest relative change in length of any vector under the change of the lattice.
+        strain = torch.linalg.matrix_norm(
+            torch.linalg.pinv(self._lattice) @ (lattice - self._lattice), ord=2
+        )
+        return bool(
+            torch.any(2 * max_displacement + strain * (self.cutoff + self.skin) > self.skin).item()
+        )
+
+    def _build(
+        self,
+        cart_coords: torch.Tensor,
+        frac_coords: torch.Tensor,
+        lattice: torch.Tensor,
+        num_atoms: torch.Tensor,
+    ) -> None:
+        edge_index, cell_offsets, num_pairs = radius_graph_pbc(
+            cart_coords=cart_coords,
+            lattice=lattice,
+            num_atoms=num_atoms,
+            radius=self.cutoff + self.skin,
+            # List all pairs, the number of neighbors is limited on each call.
+            max_num_neighbors_threshold=torch.iinfo(torch.long).max,
+            max_cell_images_per_dim=self.max_cell_images_per_dim,
+            algorithm=self.algorithm,
+        )
+        self._index2, self._index1 = edge_index
+        self._cell_offsets = cell_offsets
+        self._crystal = torch.repeat_interleave(
+            torch.arange(len(num_atoms), device=num_atoms.device), num_pairs
+        )
+        self._frac_coords = frac_coords
+        self._lattice = lattice
+        self._num_atoms = num_atoms
+        self._selected = None
+        self.num_builds += 1
+
+    def _follow_wrapped_atoms(self, frac_coords: torch.Tensor) -> bool:
+        """
+        Updates the listed pairs of atoms that were wrapped back into the unit cell since the last call, such that the
+        cell offsets refer to the new fractional coordinates. Returns whether any atom was wrapped.
+        """
+        assert self._frac_coords is not None and self._cell_offsets is not None
+        shift = torch.round(frac_coords - self._frac_coords)
+        if not torch.any(shift != 0).item():
+            return False
+        self._frac_coords = self._frac_coords + shift
+        # The vector of pair (i, j) is f_j + offset - f_i, which must not change.
+        self._cell_offsets = self._cell_offsets + shift[self._index1] - shift[self._index2]
+        return True
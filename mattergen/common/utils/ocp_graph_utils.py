@@ -332,3 +332,184 @@ def get_max_neighbors_mask(
     mask_num_neighbors.index_fill_(0, index_sort, True)
 
     return mask_num_neighbors, num_neighbors_image
+
+
+def radius_graph_pbc_cell_list(
+    pos: torch.Tensor,
+    pbc: torch.Tensor | None,
+    natoms: torch.Tensor,
+    cell: torch.Tensor,
+    radius: float,
+    max_num_neighbors_threshold: int,
+    max_cell_images_per_dim: int = sys.maxsize,
+) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+    """Computes the same graph as `radius_graph_pbc`, with the edges in the same order, using cell lists.
+
+    `radius_graph_pbc` computes the distances of all pairs of atoms of each structure in all periodic images within
+    reach, so its time and memory grow quadratically with the number of atoms per structure. Here, the unit cell of each
+    structure is divided into bins that are at least `radius` wide in each direction, and each atom is only paired with
+    the atoms in the bins around its own, including those across the periodic boundaries. For structures of a given
+    density, time and memory then grow linearly with the number of atoms.
+
+    Only structures that are periodic in all three directions are supported. Arguments and return values are as for
+    `radius_graph_pbc`.
+    """
+    assert pbc is not None and bool(torch.all(pbc)), "Only fully periodic structures are supported."
+    device = pos.device
+    batch_size = len(natoms)
+    crystal = torch.repeat_interleave(torch.arange(batch_size, device=device), natoms)
+
+    # Bin the atoms by their fractional coordinates.
+    inv_cell = torch.linalg.inv(cell)
+    frac = torch.einsum("ni,nij->nj", pos, inv_cell[crystal])
+    # Unit cells by which the atoms are wrapped into the unit cell.
+    wrap = torch.floor(frac)
+    frac = frac - wrap
+    # Distances between the lattice planes spanned by two of the lattice vectors.
+    plane_distance = 1 / torch.linalg.norm(inv_cell, dim=1)
+    num_bins = torch.clamp(torch.floor(plane_distance / radius), min=1).long()
+    # Periodic images that `radius_graph_pbc` considers in each direction, computed as there.
+    cross = [torch.cross(cell[:, (d + 1) % 3], cell[:, (d + 2) % 3], dim=-1) for d in range(3)]
+    cell_vol = torch.sum(cell[:, 0] * cross[0], dim=-1, keepdim=True)
+    max_rep = [
+        min(
+            int(torch.ceil(radius * torch.norm(c / cell_vol, p=2, dim=-1)).max()),
+            max_cell_images_per_dim,
+        )
+        for c in cross
+    ]
+    max_images = torch.tensor(max_rep, device=device)
+    # Cartesian offsets of these images, computed as in `radius_graph_pbc`, so that the distances of the edges are
+    # the same to the last bit. The image with cell offsets (i, j, k) is at index
+    # ((i + r0) * n1 + (j + r1)) * n2 + k + r2, where rd = max_rep[d] and nd = 2 * rd + 1.
+    cells_per_dim = [
+        torch.arange(-rep, rep + 1, device=device, dtype=torch.float) for rep in max_rep
+    ]
+    image_offsets = torch.cartesian_prod(*cells_per_dim)
+    num_images = 2 * max_images + 1
+    pbc_offsets_table = torch.bmm(
+        cell.transpose(1, 2), image_offsets.T[None].expand(batch_size, -1, -1)
+    ).transpose(1, 2)
+    # Number of bins in each direction, on either side of the bin of an atom, that may contain its neighbors, with a
+    # margin so that rounding errors in the fractional coordinates do not lose pairs. There is no need to look beyond
+    # the periodic images that `radius_graph_pbc` considers, which are relative to the unwrapped positions.
+    wrap_range = (wrap.max(dim=0).values - wrap.min(dim=0).values).long() if len(pos) else 0
+    reach = torch.minimum(
+        torch.ceil(radius * (1 + 1e-5) * num_bins / plane_distance).long(),
+        num_bins * (max_images + wrap_range + 1) - 1,
+    )
+
+    num_bins_crystal = num_bins.prod(dim=1)
+    bin_offset = torch.cumsum(num_bins_crystal, dim=0) - num_bins_crystal
+
+    # Bins are numbered across the batch, in row-major order within each structure.
+    def flat_bin_index(ix_crystal: torch.Tensor, bin_index: torch.Tensor) -> torch.Tensor:
+        shape = num_bins[ix_crystal]
+        return bin_offset[ix_crystal] + (
+            (bin_index[:, 0] * shape[:, 1] + bin_index[:, 1]) * shape[:, 2] + bin_index[:, 2]
+        )
+
+    atom_bin_index = torch.minimum((frac * num_bins[crystal]).long(), num_bins[crystal] - 1)
+    atom_bin = flat_bin_index(crystal, atom_bin_index)
+    # Atoms sorted by bin, and where the atoms of each bin start.
+    atoms_by_bin = torch.argsort(atom_bin, stable=True)
+    bin_count = torch.bincount(atom_bin, minlength=int(num_bins_crystal.sum()))
+    bin_start = torch.cumsum(bin_count, dim=0) - bin_count
+
+    # Bins around the bin of each atom, within the reach of its structure.
+    max_reach = reach.max(dim=0).values.tolist() if batch_size > 0 else [0, 0, 0]
+    stencil = torch.cartesian_prod(*[torch.arange(-r, r + 1, device=device) for r in max_reach])
+    within_reach = torch.all(stencil.abs()[None] <= reach[:, None], dim=-1)
+    center, ix_stencil = torch.nonzero(within_reach[crystal], as_tuple=True)
+    center_crystal = crystal[center]
+    neighbor_bin_index = atom_bin_index[center] + stencil[ix_stencil]
+    # Bins beyond the unit cell are those of a periodic image.
+    image = torch.div(neighbor_bin_index, num_bins[center_crystal], rounding_mode="floor")
+    neighbor_bin = flat_bin_index(
+        center_crystal, neighbor_bin_index - image * num_bins[center_crystal]
+    )
+
+    # Pair each atom with all atoms in the bins around it.
+    num_candidates = bin_count[neighbor_bin]
+    candidate = torch.repeat_interleave(
+        torch.arange(len(num_candidates), device=device), num_candidates
+    )
+    candidate_start = torch.cumsum(num_candidates, dim=0) - num_candidates
+    within_bin = torch.arange(len(candidate), device=device) - candidate_start.index_select(
+        0, candidate
+    )
+    index2 = atoms_by_bin.index_select(
+        0, bin_start.index_select(0, neighbor_bin.index_select(0, candidate)) + within_bin
+    )
+
+    # Most candidates are beyond the radius. Discard them by their distances in the wrapped positions, where the
+    # vector from each atom to the bins around it only needs to be computed once, with a margin for rounding errors.
+    wrapped_pos = torch.einsum("ni,nij->nj", frac, cell[crystal])
+    image_shift = torch.bmm(image.to(pos.dtype)[:, None], cell[center_crystal])[:, 0]
+    anchor = image_shift - wrapped_pos.index_select(0, center)
+    wrapped_distance_squared = torch.sum(
+        (wrapped_pos.index_select(0, index2) + anchor.index_select(0, candidate)) ** 2, dim=-1
+    )
+    near = torch.nonzero(wrapped_distance_squared <= (radius + 1e-3) ** 2).flatten()
+    candidate = candidate.index_select(0, near)
+    index1 = center.index_select(0, candidate)
+    index2 = index2.index_select(0, near)
+    # Cell offsets of the neighbors with respect to the positions that were passed in.
+    cell_offsets = (
+        image.index_select(0, candidate)
+        - wrap.index_select(0, index2)
+        + wrap.index_select(0, index1)
+    ).to(torch.float)
+
+    mask = torch.all(cell_offsets.abs() <= max_images, dim=-1)
+    index1 = index1[mask]
+    index2 = index2[mask]
+    cell_offsets = cell_offsets[mask]
+    image_index = (
+        (cell_offsets.long() + max_images)
+        * torch.stack(
+            [num_images[1] * num_images[2], num_images[2], torch.ones_like(num_images[0])]
+        )
+    ).sum(dim=-1)
+
+    # As in `radius_graph_pbc`.
+    pbc_offsets = pbc_offsets_table[crystal[index1], image_index]
+    atom_distance_squared = torch.sum((pos[index1] - (pos[index2] + pbc_offsets)) ** 2, dim=-1)
+    mask = torch.le(atom_distance_squared, radius * radius) & torch.gt(
+        atom_distance_squared, 0.0001
+    )
+    index1 = index1[mask]
+    index2 = index2[mask]
+    cell_offsets = cell_offsets[mask]
+    atom_distance_squared = atom_distance_squared[mask]
+
+    # Order the edges as `radius_graph_pbc` does: by atom, neighbor and cell offset.
+    order = torch.argsort((index1 * len(pos) + index2) * len(image_offsets) + image_index[mask])
+    index1 = index1[order]
+    index2 = index2[order]
+    cell_offsets = cell_offsets[order]
+    atom_distance_squared = atom_distance_squared[order]
+
+    mask_num_neighbors, num_neighbors_image = get_max_neighbors_mask(
+        natoms=natoms,
+        index=index1,
+        atom_distance_squared=atom_distance_squared,
+        max_num_neighbors_threshold=max_num_neighbors_threshold,
+    )
+    if not torch.all(mask_num_neighbors):
+        # Mask out the atoms to ensure each atom has at most max_num_neighbors_threshold neighbors
+        index1 = index1[mask_num_neighbors]
+        index2 = index2[mask_num_neighbors]
+        cell_offsets = cell_offsets[mask_num_neighbors]
+        atom_distance_squared = atom_distance_squared[mask_num_neighbors]
+
+    edge_index = torch.stack((index2, index1))
+    cell_repeated = torch.repeat_interleave(cell, num_neighbors_image, dim=0)
+    offsets = -cell_offsets.view(-1, 1, 3).bmm(cell_repeated.float()).view(-1, 3)
+    return (
+        edge_index,
+        cell_offsets,
+        num_neighbors_image,
+        offsets,
+        torch.sqrt(atom_distance_squared),
+    )
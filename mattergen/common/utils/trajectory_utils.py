@@ -0,0 +1,235 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+"""Binary files with the recorded denoising trajectories of generated structures.
+
+Each file holds the trajectories of one batch of generated structures. It starts with `_MAGIC`, the format version
+and the length of a JSON header, followed by the header and the arrays. The header contains the index of the first
+structure of the batch among all generated structures, the number of frames, and for each trajectory the number of
+atoms and where its arrays are:
+  - pos: [num_frames, num_atoms, 3], fractional coordinates, by default in half precision.
+  - cell: [num_frames, 3, 3], lattice vectors as rows, in single precision.
+  - atomic_numbers_frames: [num_changes], the frames at which any atom type changes, starting with frame 0.
+  - atomic_numbers: [num_changes, num_atoms], the atom types from each of these frames on, as uint8.
+The arrays of each trajectory are stored one after the other and aligned, so that a trajectory can be memory-mapped
+without reading the others (see `TrajectoryFile`).
+"""
+
+from __future__ import annotations
+
+import io
+import json
+import shutil
+import struct
+from pathlib import Path
+from typing import Any, Iterator, Sequence
+from zipfile import ZipFile
+
+import numpy as np
+import numpy.typing as npt
+
+from mattergen.common.data.chemgraph import ChemGraph
+from mattergen.common.utils.generated_batch import GeneratedBatch
+from mattergen.diffusion.sampling.recording import Frame
+
+# Fields needed to turn a recorded frame into a crystal structure.
+TRAJECTORY_FIELDS = ("pos", "cell", "atomic_numbers")
+TRAJECTORY_FILE_SUFFIX = ".mgtraj"
+
+_MAGIC = b"MGTRAJ"
+_VERSION = 2
+# Version 1 stored the atom types as int16. Readers take the types from the header, so both versions can be read.
+_READABLE_VERSIONS = (1, 2)
+# Format version and header length.
+_PREAMBLE = struct.Struct("<HQ")
+# Arrays start at multiples of this many bytes.
+_ALIGNMENT = 64
+
+
+def _aligned(offset: int) -> int:
+    return -(-offset // _ALIGNMENT) * _ALIGNMENT
+
+
+def save_trajectory_chunk(
+    path: Path,
+    frames: Sequence[Frame],
+    final_batch: ChemGraph,
+    start_index: int,
+    position_dtype: npt.DTypeLike = np.float16,
+) -> None:
+    """Save the recorded denoising frames of one batch of generated structures to a trajectory file.
+
+    Fields in TRAJECTORY_FIELDS that were not recorded (e.g., fixed atom types for crystal structure prediction) are
+    taken from the final batch.
+
+    Args:
+        path: trajectory file to write.
+        frames: recorded frames, as returned by `PredictorCorrector.sample_with_record`.
+        final_batch: the generated batch. Its `num_atoms` determine how the frames are split into structures.
+        start_index: index of the first structure of this batch among all generated structures.
+        position_dtype: floating point type in which the positions are stored. Half precision resolves fractional
+            coordinates to about 5e-4, which is plenty to look at trajectories.
+    """
+    num_frames = max(len(frames), 1)
+    fields = {}
+    for k in TRAJECTORY_FIELDS:
+        if frames and all(k in frame for frame in frames):
+            fields[k] = np.stack([frame[k].detach().cpu().numpy() for frame in frames])
+        else:
+            final = final_batch[k].detach().cpu().numpy()
+            fields[k] = np.broadcast_to(final, (num_frames, *final.shape))
+
+    num_atoms = final_batch.num_atoms.cpu().tolist()
+    offsets = np.concatenate([[0], np.cumsum(num_atoms)]).tolist()
+    arrays: list[np.ndarray] = []
+    trajectories = []
+    for ix, (start, stop) in enumerate(zip(offsets[:-1], offsets[1:])):
+        atomic_numbers = fields["atomic_numbers"][:, start:stop]
+        changed = np.any(atomic_numbers[1:] != atomic_numbers[:-1], axis=1)
+        atomic_numbers_frames = np.concatenate([[0], np.flatnonzero(changed) + 1])
+        trajectory_arrays = {
+            "pos": fields["pos"][:, start:stop].astype(position_dtype),
+            "cell": fields["cell"][:, ix].astype(np.float32),
+            "atomic_numbers_frames": atomic_numbers_frames.astype(np.int32),
+            # Atomic numbers (including the mask token) fit into 8 bits.
+            "atomic_numbers": _to_uint8(atomic_numbers[atomic_numbers_frames]),
+        }
+        trajectories.append({"num_atoms": stop - start, "arrays": {}})
+        for name, array in trajectory_arrays.items():
+            trajectories[-1]["arrays"][name] = {
+                "offset": len(arrays),  # Replaced by the byte offset below.
+                "dtype": array.dtype.str,
+                "shape": list(array.shape),
+            }
+            arrays.append(np.ascontiguousarray(array))
+
+    byte_offsets = []
+    offset = 0
+    for array in arrays:
+        byte_offsets.append(offset)
+        offset = _aligned(offset + array.nbytes)
+    for trajectory in trajectories:
+        for spec in trajectory["arrays"].values():
+            spec["offset"] = byte_offsets[spec["offset"]]
+
+    header = {"start_index": start_index, "num_frames": num_frames, "trajectories": trajectories}
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "wb") as f:
+        _write_header(f, header)
+        data_offset = f.tell()
+        for array, byte_offset in zip(arrays, byte_offsets):
+            f.seek(data_offset + byte_offset)
+            f.write(array.tobytes())
+
+
+def _to_uint8(atomic_numbers: np.ndarray) -> np.ndarray:
+    if atomic_numbers.size and (atomic_numbers.min() < 0 or atomic_numbers.max() > 255):
+        raise ValueError(
+            f"Atom types must be between 0 and 255 to be stored, got {atomic_numbers.min()} to "
+            f"{atomic_numbers.max()}."
+        )
+    return atomic_numbers.astype(np.uint8)
+
+
+def _write_header(f: io.BufferedWriter, header: dict[str, Any]) -> None:
+    """Writes the preamble and the header, padded such that the arrays start aligned."""
+    header_bytes = json.dumps(header).encode()
+    f.write(_MAGIC + _PREAMBLE.pack(_VERSION, len(header_bytes)) + header_bytes)
+    f.write(b"\0" * (_aligned(f.tell()) - f.tell()))
+
+
+def _read_header(f: io.BufferedReader, path: Path) -> dict[str, Any]:
+    """Reads the header and leaves `f` at the start of the arrays."""
+    if f.read(len(_MAGIC)) != _MAGIC:
+        raise ValueError(f"{path} is not a trajectory file.")
+    version, header_length = _PREAMBLE.unpack(f.read(_PREAMBLE.size))
+    if version not in _READABLE_VERSIONS:
+        raise ValueError(f"Unsupported trajectory file version {version} in {path}.")
+    header = json.loads(f.read(header_length))
+    f.seek(_aligned(f.tell()))
+    return header
+
+
+def copy_trajectory_chunk(source: Path, destination: Path, index_offset: int) -> None:
+    """Copy a trajectory file, adding `index_offset` to the indices of its structures."""
+    with open(source, "rb") as source_file:
+        header = _read_header(source_file, source)
+        header["start_index"] += index_offset
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        with open(destination, "wb") as destination_file:
+            _write_header(destination_file, header)
+            shutil.copyfileobj(source_file, destination_file)
+
+
+class TrajectoryFile(Sequence[GeneratedBatch]):
+    """Reads a file written by `save_trajectory_chunk`.
+
+    The file is memory-mapped, and `trajectory_file[i]` only reads the arrays of the `i`-th trajectory of the file,
+    as a `GeneratedBatch` with one structure per frame. As for generated structures, the lattices are rotated into the
+    standard orientation of `Lattice.from_parameters`.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        with open(path, "rb") as f:
+            header = _read_header(f, path)
+            data_offset = f.tell()
+        self.start_index: int = header["start_index"]
+        self.num_frames: int = header["num_frames"]
+        self._trajectories: list[dict[str, Any]] = header["trajectories"]
+        self._data = np.memmap(path, dtype=np.uint8, mode="r", offset=data_offset)
+
+    def __len__(self) -> int:
+        return len(self._trajectories)
+
+    def _array(self, spec: dict[str, Any]) -> np.ndarray:
+        dtype = np.dtype(spec["dtype"])
+        size = int(np.prod(spec["shape"])) * dtype.itemsize
+        return self._data[spec["offset"] : spec["offset"] + size].view(dtype).reshape(spec["shape"])
+
+    def __getitem__(self, index: int) -> GeneratedBatch:  # type: ignore[override]
+        trajectory = self._trajectories[index]
+        arrays = {name: self._array(spec) for name, spec in trajectory["arrays"].items()}
+        num_atoms = trajectory["num_atoms"]
+        # The atom types of each frame are those of the last change at or before it.
+        ix_change = (
+            np.searchsorted(arrays["atomic_numbers_frames"], np.arange(self.num_frames), "right")
+            - 1
+        )
+        return GeneratedBatch.from_arrays(
+            pos=arrays["pos"].reshape(-1, 3),
+            cell=arrays["cell"],
+            atomic_numbers=arrays["atomic_numbers"][ix_change].reshape(-1).astype(np.int64),
+            num_atoms=np.full(self.num_frames, num_atoms),
+        )
+
+    def __iter__(self) -> Iterator[GeneratedBatch]:
+        return (self[i] for i in range(len(self)))
+
+
+def iter_trajectory_files(trajectory_dir: Path) -> Iterator[TrajectoryFile]:
+    for path in sorted(trajectory_dir.glob(f"*{TRAJECTORY_FILE_SUFFIX}")):
+        yield TrajectoryFile(path)
+
+
+def load_trajectory(trajectory_dir: Path, index: int) -> GeneratedBatch:
+    """The recorded trajectory of the generated structure with the given index, with one structure per frame.
+    Only the headers of the other trajectory files in `trajectory_dir` are read."""
+    for trajectory_file in iter_trajectory_files(trajectory_dir):
+        if (
+            trajectory_file.start_index
+            <= index
+            < trajectory_file.start_index + len(trajectory_file)
+        ):
+            return trajectory_file[index - trajectory_file.start_index]
+    raise IndexError(f"No trajectory of structure {index} in {trajectory_dir}.")
+
+
+def export_trajectories_to_extxyz(trajectory_dir: Path, output_file: Path) -> None:
+    """Write the trajectories in all files in `trajectory_dir` to a zip file with one .extxyz file per generated structure."""
+    with ZipFile(output_file, "w") as zip_obj:
+        for trajectory_file in iter_trajectory_files(trajectory_dir):
+            for ix, trajectory in enumerate(trajectory_file, start=trajectory_file.start_index):
+                str_io = io.StringIO()
+                trajectory.write_extxyz(str_io)
+                zip_obj.writestr(f"gen_{ix}.extxyz", str_io.getvalue())
@@ -1,7 +1,7 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT License.
 
-from typing import Callable
+from typing import Any, Callable, Iterable
 
 import torch
 import torch.nn as nn
@@ -9,9 +9,11 @@ import torch.nn as nn
 from mattergen.common.data.chemgraph import ChemGraph
 from mattergen.common.data.types import PropertySourceId
 from mattergen.common.utils.globals import MAX_ATOMIC_NUM, SELECTED_ATOMIC_NUMBERS
+from mattergen.diffusion.inference_options import cached_conditioning
 from mattergen.diffusion.model_utils import NoiseLevelEncoding
 from mattergen.diffusion.score_models.base import ScoreModel
 from mattergen.property_embeddings import (
+    _USE_UNCONDITIONAL_EMBEDDING,
     ChemicalSystemMultiHotEmbedding,
     get_property_embeddings,
     get_use_unconditional_embedding,
@@ -46,6 +48,19 @@ def mask_logits(logits: torch.Tensor, mask: torch.Tensor) -> torch.Tensor:
     return logits + (1 - mask) * -1e10
 
 
+def conditioning_inputs(x: ChemGraph, cond_fields: Iterable[str]) -> list[Any]:
+    """The fields of x that conditioning on `cond_fields` depends on, as inputs for `cached_conditioning`."""
+    use_unconditional_embedding = (
+        x[_USE_UNCONDITIONAL_EMBEDDING] if _USE_UNCONDITIONAL_EMBEDDING in x else {}
+    )
+    cond_fields = list(cond_fields)
+    return (
+        [x["num_atoms"]]
+        + [x[k] if k in x else None for k in cond_fields]
+        + [use_unconditional_embedding.get(k) for k in cond_fields]
+    )
+
+
 def mask_disallowed_elements(
     logits: torch.FloatTensor,
     x: ChemGraph | None = None,
@@ -56,6 +71,9 @@ def mask_disallowed_elements(
     Mask out atom types that are disallowed in general,
     as well as potentially all elements not in the chemical system we condition on.
 
+    The masks only depend on the conditions of the batch, so they are cached during sampling, see
+    `mattergen.diffusion.inference_options`.
+
     Args:
         logits (torch.Tensor): Logits of shape (batch_size, num_classes)
         x (ChemGraph)
@@ -63,66 +81,95 @@ def mask_disallowed_elements(
         predictions_are_zero_based (bool, optional): Whether the logits are zero-based. Defaults to True. Basically, if we're using D3PM,
             the logits are zero-based (model predicts atomic number index)
     """
+    has_chemical_system = (
+        x is not None and "chemical_system" in x and x["chemical_system"] is not None
+    )
+    k_hot_mask, keep_logits = cached_conditioning(
+        key=(mask_disallowed_elements, logits.shape[1], logits.device, predictions_are_zero_based),
+        inputs=conditioning_inputs(x, ["chemical_system"]) if has_chemical_system else [],
+        compute=lambda: _element_masks(
+            num_classes=logits.shape[1],
+            device=logits.device,
+            x=x if has_chemical_system else None,
+            predictions_are_zero_based=predictions_are_zero_based,
+        ),
+    )
+    # Set the logits for disallowed elements to -inf
+    logits = mask_logits(logits=logits, mask=k_hot_mask)
+
+    # Optionally, also mask out elements that are not in the chemical system we condition on
+    if keep_logits is not None:
+        # mypy
+        assert batch_idx is not None, "batch_idx must be provided if condition is not None"
+        # Mask out all logits outside the chemical system we condition on
+        logits = mask_logits(logits, keep_logits[batch_idx])
+
+    return logits
+
+
+def _element_masks(
+    num_classes: int,
+    device: torch.device,
+    x: ChemGraph | None,
+    predictions_are_zero_based: bool,
+) -> tuple[torch.Tensor, torch.Tensor | None]:
+    """
+    Masks for `mask_disallowed_elements`: of the generally allowed elements, shape (1, num_classes), and, if x is
+    given, of the elements in the chemical system that each structure is conditioned on, shape (Nbatch, num_classes).
+    """
     # First, mask out generally undesired elements
     # (1, num_selected_elements)
-    selected_atomic_numbers = torch.tensor(SELECTED_ATOMIC_NUMBERS, device=logits.device)
+    selected_atomic_numbers = torch.tensor(SELECTED_ATOMIC_NUMBERS, device=device)
     predictions_are_one_based = not predictions_are_zero_based
     # (num_atoms, num_classes)
     one_hot_selected_elements = atomic_numbers_to_mask(
         atomic_numbers=selected_atomic_numbers + int(predictions_are_one_based),
-        max_atomic_num=logits.shape[1],
+        max_atomic_num=num_classes,
     )
     # (1, num_classes)
     k_hot_mask = one_hot_selected_elements.sum(0)[None]
-    # Set the logits for disallowed elements to -inf
-    logits = mask_logits(logits=logits, mask=k_hot_mask)
+    if x is None:
+        return k_hot_mask, None
 
-    # Optionally, also mask out elements that are not in the chemical system we condition on
-    if x is not None and "chemical_system" in x and x["chemical_system"] is not None:
-        try:
-            # torch.BoolTensor, shape (batch_size, 1)  -- do not mask logits when we use an unconditional embedding
-            do_not_mask_atom_logits = get_use_unconditional_embedding(
-                batch=x, cond_field="chemical_system"
-            )
-        except KeyError:
-            # if no mask provided to use conditional/unconditional labels then do not mask logits
-            do_not_mask_atom_logits = torch.ones(
-                (len(x["chemical_system"]), 1), dtype=torch.bool, device=x["num_atoms"].device
-            )
-
-        # mypy
-        assert batch_idx is not None, "batch_idx must be provided if condition is not None"
-        # Only mask atom types where the condition is not masked
-        # A 1 means that we do not alter the logit, a 0 means that we change the logit to -inf
-        # keep_logits.shape=(Nbatch, MAX_ATOMIC_NUM+1)
+    try:
+        # torch.BoolTensor, shape (batch_size, 1)  -- do not mask logits when we use an unconditional embedding
+        do_not_mask_atom_logits = get_use_unconditional_embedding(
+            batch=x, cond_field="chemical_system"
+        )
+    except KeyError:
+        # if no mask provided to use conditional/unconditional labels then do not mask logits
+        do_not_mask_atom_logits = torch.ones(
+            (len(x["chemical_system"]), 1), dtype=torch.bool, device=x["num_atoms"].device
+        )
 
-        # 1 = keep logit, 0 = set logit to -inf, shape = (Nbatch, MAX_ATOMIC_NUM+1)
-        keep_all_logits = torch.ones((len(x["chemical_system"]), 1), device=x["num_atoms"].device)
+    # Only mask atom types where the condition is not masked
+    # A 1 means that we do not alter the logit, a 0 means that we change the logit to -inf
+    # keep_logits.shape=(Nbatch, MAX_ATOMIC_NUM+1)
 
-        # torch.Tensor, shape=(Nbatch,MAX_ATOMIC_NUM+1) -- 1s where elements are present in chemical system condition, 0 elsewhere
-        multi_hot_chemical_system = ChemicalSystemMultiHotEmbedding.sequences_to_multi_hot(
-            x=ChemicalSystemMultiHotEmbedding.convert_to_list_of_str(x=x["chemical_system"]),
-            device=x["num_atoms"].device,
-        )
+    # 1 = keep logit, 0 = set logit to -inf, shape = (Nbatch, MAX_ATOMIC_NUM+1)
+    keep_all_logits = torch.ones((len(x["chemical_system"]), 1), device=x["num_atoms"].device)
 
-        keep_logits = torch.where(
-            do_not_mask_atom_logits,
-            keep_all_logits,
-            multi_hot_chemical_system,
-        )
-        # This is converting the 1-based chemical system condition to a 0-based
-        # condition -- we're doing it on the multi-hot representation of the
-        # chemical system, so we need to shift the indices by one.
-        if predictions_are_zero_based:
-            keep_logits = keep_logits[:, 1:]
-            # If we use mask diffusion, logits is shape [batch_size, MAX_ATOMIC_NUM + 1]
-            # instead of [batch_size, MAX_ATOMIC_NUM], so we have to add one dummy column
-            if keep_logits.shape[1] == logits.shape[1] - 1:
-                keep_logits = torch.cat([keep_logits, torch.zeros_like(keep_logits[:, :1])], dim=-1)
-        # Mask out all logits outside the chemical system we condition on
-        logits = mask_logits(logits, keep_logits[batch_idx])
+    # torch.Tensor, shape=(Nbatch,MAX_ATOMIC_NUM+1) -- 1s where elements are present in chemical system condition, 0 elsewhere
+    multi_hot_chemical_system = ChemicalSystemMultiHotEmbedding.sequences_to_multi_hot(
+        x=ChemicalSystemMultiHotEmbedding.convert_to_list_of_str(x=x["chemical_system"]),
+        device=x["num_atoms"].device,
+    )
 
-    return logits
+    keep_logits = torch.where(
+        do_not_mask_atom_logits,
+        keep_all_logits,
+        multi_hot_chemical_system,
+    )
+    # This is converting the 1-based chemical system condition to a 0-based
+    # condition -- we're doing it on the multi-hot representation of the
+    # chemical system, so we need to shift the indices by one.
+    if predictions_are_zero_based:
+        keep_logits = keep_logits[:, 1:]
+        # If we use mask diffusion, logits is shape [batch_size, MAX_ATOMIC_NUM + 1]
+        # instead of [batch_size, MAX_ATOMIC_NUM], so we have to add one dummy column
+        if keep_logits.shape[1] == num_classes - 1:
+            keep_logits = torch.cat([keep_logits, torch.zeros_like(keep_logits[:, :1])], dim=-1)
+    return k_hot_mask, keep_logits
 
 
 def get_chemgraph_from_denoiser_output(
@@ -225,7 +272,7 @@ class GemNetTDenoiser(ScoreModel):
                 lattice update: (N_crystals, 3, 3)
                 predicted atom types: (N_atoms, MAX_ATOMIC_NUM)
         """
-        (frac_coords, lattice, atom_types, num_atoms, batch) = (
+        frac_coords, lattice, atom_types, num_atoms, batch = (
             x["pos"],
             x["cell"],
             x["atomic_numbers"],
@@ -237,9 +284,13 @@ class GemNetTDenoiser(ScoreModel):
         t_enc = self.noise_level_encoding(t).to(lattice.device)
         z_per_crystal = t_enc
 
-        # evaluate property embedding values
-        property_embedding_values = get_property_embeddings(
-            batch=x, property_embeddings=self.property_embeddings
+        # evaluate property embedding values, once per batch during sampling
+        property_embedding_values = cached_conditioning(
+            key=(self, "property_embeddings"),
+            inputs=conditioning_inputs(x, self.property_embeddings),
+            compute=lambda: get_property_embeddings(
+                batch=x, property_embeddings=self.property_embeddings
+            ),
         )
 
         if len(property_embedding_values) > 0:
@@ -22,6 +22,7 @@ import numpy as np
 import torch
 from torch_scatter import scatter_add
 
+from mattergen.diffusion import per_sample_rng
 from mattergen.diffusion.corruption.corruption import B, Corruption, maybe_expand
 from mattergen.diffusion.data.batched_data import BatchedData
 
@@ -136,7 +137,7 @@ class BaseVPSDE(SDE):
         conditioning_data: Optional[BatchedData] = None,
         batch_idx: B = None,
     ) -> torch.Tensor:
-        return torch.randn(*shape)
+        return per_sample_rng.randn(shape, batch_idx)
 
     def prior_logp(
         self,
@@ -242,7 +243,7 @@ class VESDE(SDE):
         conditioning_data: Optional[BatchedData] = None,
         batch_idx: B = None,
     ) -> torch.Tensor:
-        return torch.randn(*shape) * self.sigma_max
+        return per_sample_rng.randn(shape, batch_idx) * self.sigma_max
 
     def prior_logp(
         self,
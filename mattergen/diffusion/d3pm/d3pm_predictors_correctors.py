@@ -5,6 +5,7 @@ from typing import Optional, cast
 
 import torch
 
+from mattergen.diffusion import per_sample_rng
 from mattergen.diffusion.corruption.corruption import Corruption
 from mattergen.diffusion.corruption.d3pm_corruption import D3PMCorruption
 from mattergen.diffusion.corruption.sde_lib import ScoreFunction
@@ -70,7 +71,7 @@ class D3PMAncestralSamplingPredictor(Predictor):
 
         # sample from categorical distribution
         x_sample = self.corruption._to_non_zero_based(
-            torch.distributions.Categorical(logits=class_logits).sample()
+            per_sample_rng.sample_categorical(class_logits, batch_idx)
         )
 
         # convert logit output to normalized probabilities
@@ -94,7 +95,7 @@ class D3PMAncestralSamplingPredictor(Predictor):
             )
 
             x_sample = self.corruption._to_non_zero_based(
-                torch.distributions.Categorical(logits=class_logits).sample()
+                per_sample_rng.sample_categorical(class_logits, batch_idx)
             )
 
             # get expected atom type
@@ -104,3 +105,74 @@ class D3PMAncestralSamplingPredictor(Predictor):
 
         # (sampled states), (expected states)
         return x_sample, class_expected
+
+
+class D3PMJumpPredictor(D3PMAncestralSamplingPredictor):
+    """
+    Ancestral sampling predictor for D3PM which can skip discrete timesteps.
+
+    The corruption keeps its own number of discrete timesteps N (the number the model was trained with),
+    while the sampler may take far fewer steps. At each step, the current state is taken to be at discrete
+    timestep to_discrete_time(t) + 1 and we sample from q(x_s | x_{s + k}, x_0) with the model's prediction of x_0,
+    where s is the discrete timestep corresponding to t + dt and k is the number of skipped timesteps.
+    Atoms for which s equals the current timestep are left unchanged. When the sampler uses the same N as the corruption,
+    this is equivalent to `D3PMAncestralSamplingPredictor` except at the last step, which always jumps to s=0.
+    """
+
+    # The sampler's number of steps need not match the N of the corruption.
+    supports_skipping_steps = True
+
+    def __init__(
+        self,
+        *,
+        corruption: D3PMCorruption,
+        score_fn: ScoreFunction,
+    ):
+        super().__init__(corruption=corruption, score_fn=score_fn, predict_x0=True)
+
+    def update_given_score(
+        self,
+        *,
+        x: torch.Tensor,
+        t: torch.Tensor,
+        dt: torch.Tensor,
+        batch_idx: torch.LongTensor,
+        score: torch.Tensor,
+        batch: Optional[BatchedData],
+    ) -> SampleAndMean:
+        assert isinstance(self.corruption, D3PMCorruption)
+        current_t = to_discrete_time(t=t, N=self.N, T=self.corruption.T) + 1
+        next_t = to_discrete_time(t=(t + dt).clamp(min=0.0), N=self.N, T=self.corruption.T)
+        # Jump all the way to x_0 once we are within one discrete timestep of it.
+        next_t = torch.where(next_t > 0, next_t + 1, next_t)
+        next_t = torch.minimum(next_t, current_t)[batch_idx]
+        step_size = current_t[batch_idx] - next_t
+
+        class_probs = torch.softmax(score, dim=-1)
+        x_zero_based = self.corruption._to_zero_based(x)
+        # d3pm only supports a scalar step_size, so we group atoms by the number of skipped timesteps.
+        # Atoms whose step does not cross a discrete timestep (step_size 0) keep their current type.
+        class_logits = torch.zeros_like(score)
+        for k in torch.unique(step_size[step_size > 0]).tolist():
+            idx = step_size == k
+            class_logits[idx], _ = self.corruption.d3pm.sample_and_compute_posterior_q(
+                x_0=class_probs[idx],
+                t=next_t[idx],
+                make_one_hot=False,
+                samples=x_zero_based[idx],
+                return_logits=True,
+                step_size=k,
+            )
+        # Sample all atoms at once, so that the noise of an atom does not depend on the other atoms in the batch.
+        changed = step_size > 0
+        x_sample = torch.where(
+            changed,
+            self.corruption._to_non_zero_based(
+                per_sample_rng.sample_categorical(class_logits, batch_idx)
+            ),
+            x,
+        )
+        class_expected = torch.where(
+            changed, self.corruption._to_non_zero_based(torch.argmax(class_logits, dim=-1)), x
+        )
+        return x_sample, class_expected
@@ -9,6 +9,7 @@ from dataclasses import dataclass, replace
 from typing import Any, Mapping, Protocol, Sequence, TypeVar, runtime_checkable
 
 import torch
+from torch_geometric.data import Batch
 from torch_scatter import scatter
 
 T = TypeVar("T")
@@ -186,3 +187,97 @@ def _construct_batch_idx(data_list: list[Any], field_name: str) -> torch.LongTen
         torch.arange(0, batch_size),
         torch.tensor([x[field_name].shape[0] for x in data_list]),
     )
+
+
+def concatenate_batches(first: T, second: T) -> T:
+    """Stack two batches that have the same fields into one batch, with the samples of `first`
+    followed by the samples of `second`.
+
+    Supports `SimpleBatchedData` and PyG-style batches (e.g., `ChemGraphBatch`). The result is
+    only meant to be fed through a score model; PyG bookkeeping needed for `to_data_list` is not
+    updated.
+    """
+    if isinstance(first, SimpleBatchedData):
+        assert isinstance(second, SimpleBatchedData)
+        offset = first.get_batch_size()
+        return SimpleBatchedData(
+            data={k: _concatenate_values(v, second.data[k]) for k, v in first.data.items()},
+            batch_idx={
+                k: None if v is None else torch.cat([v, second.batch_idx[k] + offset])
+                for k, v in first.batch_idx.items()
+            },
+        )
+    return _concatenate_pyg_batches(first, second)
+
+
+def _concatenate_pyg_batches(first: Any, second: Any) -> Any:
+    values = {}
+    for key in first.keys():
+        value = first[key]
+        if key == "ptr":
+            values[key] = torch.cat([value, second[key][1:] + value[-1]])
+        elif isinstance(value, torch.Tensor):
+            # `__inc__` gives the number of graphs for `batch` and the number of nodes for index fields.
+            values[key] = torch.cat(
+                [value, second[key] + first.__inc__(key, value)],
+                dim=first.__cat_dim__(key, value),
+            )
+        else:
+            values[key] = _concatenate_values(value, second[key])
+    out = first.replace(**values)
+    out._num_graphs = first.num_graphs + second.num_graphs
+    return out
+
+
+def _concatenate_values(first: Any, second: Any) -> Any:
+    if isinstance(first, torch.Tensor):
+        return torch.cat([first, second])
+    if isinstance(first, list):
+        return first + second
+    if isinstance(first, Mapping):
+        return {k: _concatenate_values(v, second[k]) for k, v in first.items()}
+    # Scalars and other metadata are shared by both batches.
+    return first
+
+
+def select_samples(batch: T, indices: torch.Tensor) -> T:
+    """Return a batch with the samples of `batch` at the given indices, which must be sorted in increasing order.
+
+    Supports `SimpleBatchedData` and PyG-style batches (e.g., `ChemGraphBatch`).
+    """
+    if isinstance(batch, SimpleBatchedData):
+        new_index = torch.full((batch.get_batch_size(),), -1, dtype=torch.long)
+        new_index[indices.cpu()] = torch.arange(len(indices))
+        data, batch_idx = {}, {}
+        for k, v in batch.data.items():
+            idx = batch.batch_idx[k]
+            if idx is None:
+                data[k] = (
+                    v[indices.to(v.device)]
+                    if isinstance(v, torch.Tensor)
+                    else [v[i] for i in indices.tolist()]
+                )
+                batch_idx[k] = None
+            else:
+                new_idx = new_index.to(idx.device)[idx]
+                keep = new_idx >= 0
+                data[k] = v[keep]
+                batch_idx[k] = new_idx[keep]
+        return SimpleBatchedData(data=data, batch_idx=batch_idx)  # type: ignore
+    return Batch.from_data_list(batch.index_select(indices))  # type: ignore
+
+
+def merge_batches(batches: Sequence[T]) -> T:
+    """Stack batches with the same fields into one batch.
+
+    Unlike for `concatenate_batches`, the samples of the merged batch can be selected again with `select_samples`.
+    For PyG-style batches, this rebuilds the batch from a list of samples.
+    """
+    if isinstance(batches[0], SimpleBatchedData):
+        merged = batches[0]
+        for batch in batches[1:]:
+            merged = concatenate_batches(merged, batch)
+        return merged
+    return Batch.from_data_list(
+        [sample for batch in batches for sample in batch.to_data_list()]  # type: ignore
+    )
@@ -0,0 +1,197 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+"""Options for how score models run during sampling.
+
+The sampler enters `using_inference_options(options, cache)` around each call of the score model, and score models read
+the options that they support with `current_inference_options()`. Each model decides how to implement an option, but
+its outputs must be the same as without it, up to floating-point rounding:
+
+- precision: with "bf16-mixed", score models run the layers that they wrap in `autocast(device)` in bfloat16, which is
+  much faster for matrix multiplications on hardware with bfloat16 support (e.g., CPUs with AVX512-BF16 or AMX, and
+  recent GPUs). Numerically sensitive computations (e.g., basis functions of distances or the aggregation of outputs)
+  stay outside of `autocast`, and outputs are returned in full precision, so that the sampler runs in full precision.
+  Precisions are named as for the `precision` flag of the Lightning trainer.
+- compile_model: score models run the parts of their forward pass that they wrap in `CompiledFunction` with
+  `torch.compile`, with dynamic shapes, so that one compiled graph serves batches of any numbers of atoms, edges and
+  triplets. The wrapped parts should only take and return tensors and avoid data-dependent control flow, e.g., the
+  interaction blocks of GemNet, but not the construction of its graph. Compilation happens in the first call and takes
+  a while; if it fails, e.g., because no C++ compiler is available on CPU, the model falls back to eager mode.
+- neighbor_list_skin: between two denoising steps the atoms only move a little, so score models that build a neighbor
+  list on each call instead keep a list of the pairs within their cutoff plus the skin in the `InferenceCache`, and
+  only rebuild it once an atom may have moved by more than half the skin (Verlet lists). The listed pairs are filtered
+  to the cutoff on every call.
+- max_triplets_per_chunk: score models that pass messages along triplets (e.g., GemNet), whose number grows with the
+  square of the number of neighbors, process them in chunks of at most about this many triplets, so that the memory of
+  the messages is bounded by the chunk size rather than by the size of the batch. What else is chunked is up to the
+  model, e.g., GemNet also processes the edges of each chunk together, but keeps a few embeddings per edge, the basis
+  functions and the graph for the whole batch.
+
+Independently of the options, score models compute values that only depend on the conditions of the batch (e.g., the
+embeddings of property values) with `cached_conditioning`, which keeps them in the `InferenceCache` of the context, if
+any, so that they are only computed in the first of the thousands of denoising steps. The sampler holds the cache for as
+long as it denoises the same batch, and clears it when the samples in the batch change.
+"""
+
+from __future__ import annotations
+
+import logging
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Any, Callable, ContextManager, Hashable, Iterator, Sequence, TypeVar
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+INFERENCE_PRECISIONS: dict[str, torch.dtype | None] = {
+    "32": None,
+    "bf16-mixed": torch.bfloat16,
+}
+
+
+@dataclass(frozen=True)
+class InferenceOptions:
+    """How score models run during sampling, see the module docstring.
+
+    Args:
+        precision: "32", or "bf16-mixed" to run the heavy layers in bfloat16.
+        compile_model: whether to run the parts that score models wrap in `CompiledFunction` with `torch.compile`.
+        neighbor_list_skin: if given, score models keep their neighbor lists for the cutoff plus this skin, in the units
+            of the positions, across calls. A larger skin means fewer rebuilds, but more pairs to filter on each call.
+        max_triplets_per_chunk: if given, score models pass the messages of at most about this many triplets at a time.
+    """
+
+    precision: str = "32"
+    compile_model: bool = False
+    neighbor_list_skin: float | None = None
+    max_triplets_per_chunk: int | None = None
+
+    def __post_init__(self):
+        if self.precision not in INFERENCE_PRECISIONS:
+            raise ValueError(
+                f"Unknown inference precision {self.precision}, expected one of {list(INFERENCE_PRECISIONS)}."
+            )
+        if self.neighbor_list_skin is not None and self.neighbor_list_skin <= 0:
+            raise ValueError(
+                f"The neighbor list skin must be positive, got {self.neighbor_list_skin}."
+            )
+        if self.max_triplets_per_chunk is not None and self.max_triplets_per_chunk <= 0:
+            raise ValueError(f"The chunk size must be positive, got {self.max_triplets_per_chunk}.")
+
+
+class InferenceCache:
+    """Values that score models keep across calls on the same batch: their neighbor lists and the values that they
+    computed from the conditions of the batch."""
+
+    def __init__(self):
+        # Per-model state, e.g., the neighbor list of a GemNet, keyed by the model.
+        self.neighbor_lists: dict[Any, Any] = {}
+        # Inputs and value of each conditioning entry, by key and the ids of the inputs. The inputs are kept alive, so
+        # that their ids cannot be reused by other objects as long as the entry exists.
+        self._conditioning: dict[tuple[Hashable, tuple[int, ...]], tuple[tuple[Any, ...], Any]] = {}
+
+    @property
+    def num_conditioning_entries(self) -> int:
+        return len(self._conditioning)
+
+    def get_or_compute_conditioning(
+        self, key: Hashable, inputs: Sequence[Any], compute: Callable[[], T]
+    ) -> T:
+        entry_key = (key, tuple(id(x) for x in inputs))
+        entry = self._conditioning.get(entry_key)
+        if entry is None:
+            entry = self._conditioning[entry_key] = (tuple(inputs), compute())
+        return entry[1]
+
+    def clear(self) -> None:
+        """Forget all values, e.g., because the samples in the batch change."""
+        self.neighbor_lists.clear()
+        self._conditioning.clear()
+
+
+_current: ContextVar[tuple[InferenceOptions, InferenceCache | None]] = ContextVar(
+    "inference_options", default=(InferenceOptions(), None)
+)
+
+
+@contextmanager
+def using_inference_options(
+    options: InferenceOptions, cache: InferenceCache | None = None
+) -> Iterator[None]:
+    """Within this context, score models run with `options`, and keep the values that they reuse across calls on the
+    same batch in `cache`. Without a cache, they compute these values on each call."""
+    token = _current.set((options, cache))
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+
+def current_inference_options() -> InferenceOptions:
+    return _current.get()[0]
+
+
+def current_inference_cache() -> InferenceCache | None:
+    return _current.get()[1]
+
+
+def autocast(device: torch.device) -> ContextManager:
+    """Autocast to the lower precision of the current inference options, if any."""
+    dtype = INFERENCE_PRECISIONS[current_inference_options().precision]
+    if dtype is None:
+        return nullcontext()
+    return torch.autocast(device_type=device.type, dtype=dtype)
+
+
+class CompiledFunction:
+    """
+    Calls `fn` compiled with `torch.compile` if the current inference options say so, and `fn` itself otherwise.
+
+    `fn` is compiled lazily on its first compiled call. If compiling or running the compiled function fails, `fn` is
+    called instead, now and on all subsequent calls.
+    """
+
+    def __init__(self, fn: Callable, **compile_kwargs: Any):
+        self._fn = fn
+        self._compile_kwargs = {"dynamic": True, **compile_kwargs}
+        self._compiled: Callable | None = None
+        self._failed = False
+
+    def __call__(self, *args: Any, **kwargs: Any) -> Any:
+        if self._failed or not current_inference_options().compile_model:
+            return self._fn(*args, **kwargs)
+        if self._compiled is None:
+            self._compiled = torch.compile(self._fn, **self._compile_kwargs)
+        try:
+            # Trace conversions of tensors to scalars, e.g., data-dependent sizes, without graph breaks.
+            with torch._dynamo.config.patch(capture_scalar_outputs=True):
+                return self._compiled(*args, **kwargs)
+        except Exception as e:
+            logger.warning(f"Compiling {self._fn} failed, falling back to eager mode: {e}")
+            self._failed = True
+            self._compiled = None
+            return self._fn(*args, **kwargs)
+
+    def __getstate__(self) -> dict[str, Any]:
+        # Compiled functions cannot be pickled or copied, they are compiled again when needed.
+        return {**self.__dict__, "_compiled": None}
+
+
+def cached_conditioning(key: Hashable, inputs: Sequence[Any], compute: Callable[[], T]) -> T:
+    """
+    Returns `compute()`, or, within a `using_inference_options` context with a cache, the value that was cached for the
+    same key and the same inputs, compared by identity. `compute` must only depend on `inputs` (and on `key`), which
+    must not be modified in place while the cache is in use.
+
+    Cached values are looked up by the identity of their inputs, e.g., the fields of the batch with the conditions. The
+    conditional and unconditional copies of a batch in classifier-free guidance have different fields, so each gets its
+    own entry, while each of them keeps its fields across denoising steps.
+    """
+    cache = current_inference_cache()
+    if cache is None:
+        return compute()
+    return cache.get_or_compute_conditioning(key, inputs, compute)
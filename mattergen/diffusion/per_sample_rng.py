@@ -0,0 +1,167 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+"""Random noise for sampling that depends only on the sample it belongs to.
+
+By default, the noise drawn during sampling comes from torch's global random number generator, so the noise that a sample
+gets depends on the other samples in its batch. Within a `per_sample_seeds(seed, sample_indices)` context, the noise is
+instead computed by a counter-based generator: each number is a hash of (seed, index of the sample, denoising step of
+the sample, number of the draw within the step, position within the sample). A sample thus gets the same noise whichever
+batch it is sampled in, and a single generated structure can be regenerated on its own, e.g., to record its trajectory.
+
+Samplers mark the start of each denoising step with `begin_step`, so that draws that are only made for some batches
+(e.g., when some sample of the batch has finished) do not shift the noise of later steps.
+"""
+
+from __future__ import annotations
+
+import math
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Iterator, Sequence
+
+import torch
+
+_MASK32 = 0xFFFFFFFF
+
+
+@dataclass
+class _PerSampleSeeds:
+    seed: int
+    # Index of each sample in the batch among all generated samples.
+    sample_indices: torch.Tensor
+    # Current denoising step of each sample, or None before the first step.
+    steps: torch.Tensor | None = None
+    # Number of draws since the start of the step.
+    num_draws: int = 0
+
+
+_current: ContextVar[_PerSampleSeeds | None] = ContextVar("per_sample_seeds", default=None)
+
+
+@contextmanager
+def per_sample_seeds(seed: int, sample_indices: Sequence[int] | torch.Tensor) -> Iterator[None]:
+    """Within this context, the noise drawn with the functions in this module is keyed by (seed, sample index)."""
+    token = _current.set(
+        _PerSampleSeeds(seed=seed, sample_indices=torch.as_tensor(sample_indices, dtype=torch.long))
+    )
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+
+@contextmanager
+def repeat_sample_indices(num_repeats: int) -> Iterator[None]:
+    """Within this context, each of `num_repeats` stacked copies of the current batch gets the same noise as the
+    batch itself would get. Has no effect outside `per_sample_seeds`."""
+    state = _current.get()
+    if state is None:
+        yield
+        return
+    with per_sample_seeds(state.seed, state.sample_indices.repeat(num_repeats)):
+        yield
+
+
+def begin_step(steps: torch.Tensor | None) -> None:
+    """Start a denoising step. `steps` holds a number for each sample in the batch that identifies the step among
+    the steps of that sample, or is None for sampling from the prior. Draws in the same step of a sample must be made
+    in the same order in every batch."""
+    state = _current.get()
+    if state is not None:
+        state.steps = steps
+        state.num_draws = 0
+
+
+def randn_like(x: torch.Tensor, batch_idx: torch.Tensor | None = None) -> torch.Tensor:
+    """Standard normal noise of the same shape as `x`.
+
+    Args:
+        x: tensor whose first dimension runs over the samples (if `batch_idx` is None) or over the items of the samples.
+        batch_idx: index of the sample of each item along the first dimension of `x`.
+    """
+    state = _current.get()
+    if state is None:
+        return torch.randn_like(x)
+    return _normal(state, x.shape, batch_idx, device=x.device).to(x.dtype)
+
+
+def randn(shape: torch.Size | tuple, batch_idx: torch.Tensor | None = None) -> torch.Tensor:
+    """Standard normal noise of the given shape (on the CPU, unless per-sample seeds are used), see `randn_like`."""
+    state = _current.get()
+    if state is None:
+        return torch.randn(*shape)
+    device = batch_idx.device if batch_idx is not None else state.sample_indices.device
+    return _normal(state, torch.Size(shape), batch_idx, device=device)
+
+
+def sample_categorical(logits: torch.Tensor, batch_idx: torch.Tensor | None = None) -> torch.Tensor:
+    """Sample from the categorical distributions given by `logits` along the last dimension."""
+    state = _current.get()
+    if state is None:
+        return torch.distributions.Categorical(logits=logits).sample()
+    u = _uniform(state, logits.shape, batch_idx, device=logits.device)
+    # Gumbel-max trick.
+    return torch.argmax(logits - torch.log(-torch.log(u)), dim=-1)
+
+
+def _normal(
+    state: _PerSampleSeeds,
+    shape: torch.Size,
+    batch_idx: torch.Tensor | None,
+    device: torch.device,
+) -> torch.Tensor:
+    # Box-Muller transform of two independent uniform samples.
+    u = _uniform(state, shape + (2,), batch_idx, device=device)
+    return torch.sqrt(-2.0 * torch.log(u[..., 0])) * torch.cos(2 * math.pi * u[..., 1])
+
+
+def _uniform(
+    state: _PerSampleSeeds,
+    shape: torch.Size,
+    batch_idx: torch.Tensor | None,
+    device: torch.device,
+) -> torch.Tensor:
+    """Uniform samples in (0, 1) of the given shape, keyed by the sample of each item along the first dimension."""
+    sample_indices = state.sample_indices.to(device)
+    num_rows = shape[0]
+    numel_per_row = math.prod(shape[1:])
+    if batch_idx is None:
+        assert num_rows == len(sample_indices), "Expected one row per sample."
+        rows_in_sample = torch.zeros(num_rows, dtype=torch.long, device=device)
+        row_ix = torch.arange(num_rows, device=device)
+    else:
+        batch_idx = batch_idx.to(device)
+        counts = torch.bincount(batch_idx, minlength=len(sample_indices))
+        starts = torch.cumsum(counts, 0) - counts
+        order = torch.argsort(batch_idx, stable=True)
+        rows_in_sample = torch.empty(num_rows, dtype=torch.long, device=device)
+        rows_in_sample[order] = torch.arange(num_rows, device=device) - starts[batch_idx[order]]
+        row_ix = batch_idx
+    row_samples = sample_indices[row_ix][:, None]
+    if state.steps is None:
+        row_steps = torch.full_like(row_samples, -1)
+    else:
+        row_steps = state.steps.to(device=device, dtype=torch.long)[row_ix][:, None]
+    offsets = rows_in_sample[:, None] * numel_per_row + torch.arange(numel_per_row, device=device)
+
+    h = _hash(offsets & _MASK32)
+    h = _hash(h ^ state.num_draws & _MASK32)
+    h = _hash(h ^ (row_steps & _MASK32))
+    h = _hash(h ^ (row_samples & _MASK32))
+    h = _hash(h ^ (row_samples >> 32 & _MASK32))
+    h = _hash(h ^ state.seed & _MASK32)
+    h = _hash(h ^ state.seed >> 32 & _MASK32)
+    state.num_draws += 1
+    # 24 random bits are all a float32 can hold.
+    return ((h >> 8).to(torch.float32) + 0.5).reshape(shape) / 2**24
+
+
+def _hash(x: torch.Tensor) -> torch.Tensor:
+    """Integer hash of 32-bit values stored in an int64 tensor (the lowbias32 function of C. Wellons)."""
+    x = x ^ (x >> 16)
+    x = (x * 0x7FEB352D) & _MASK32
+    x = x ^ (x >> 15)
+    x = (x * 0x846CA68B) & _MASK32
+    return x ^ (x >> 16)
@@ -0,0 +1,330 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+from __future__ import annotations
+
+import logging
+from typing import Callable, Mapping
+
+import torch
+from torch_scatter import scatter_add
+
+from mattergen.diffusion import per_sample_rng
+from mattergen.diffusion.corruption.multi_corruption import apply
+from mattergen.diffusion.sampling.classifier_free_guidance import GuidedPredictorCorrector
+from mattergen.diffusion.sampling.pc_sampler import (
+    Diffusable,
+    PredictorCorrector,
+    SampleAndMeanAndMaybeRecords,
+    _expand,
+    _mask,
+    _mask_replace,
+    _where_accepted,
+)
+from mattergen.diffusion.sampling.recording import Frame
+from mattergen.diffusion.wrapped.wrapped_sde import WrappedSDEMixin
+
+logger = logging.getLogger(__name__)
+
+NoiseFn = Callable[[torch.Tensor], torch.Tensor]
+
+
+class AdaptivePredictorCorrector(PredictorCorrector):
+    """Predictor-corrector sampler with adaptive, per-sample step sizes.
+
+    Instead of a fixed grid of N timesteps, the reverse SDE of the continuous fields is integrated with an embedded pair of
+    a first-order (Euler-Maruyama) and a second-order (improved Euler) update that share the same noise, as in
+    Jolicoeur-Martineau et al., "Gotta Go Fast When Generating Data with Score-Based Models" (https://arxiv.org/abs/2105.14080).
+    The difference between the two estimates is used as a local error estimate: each sample in the batch accepts or rejects
+    its step and chooses its next step size independently, so that easy samples finish in fewer steps.
+
+    Discrete fields are advanced with their predictors by the same (per-sample) step whenever a step is accepted, so their predictors
+    must support skipping timesteps (e.g. `D3PMJumpPredictor`). Once a sample reaches eps_t, a final predictor step to t=0 is taken
+    with the configured predictors. Correctors are not used.
+
+    Samples that have finished still go through the score model with the rest of the batch, so the cost of a batch is set by its
+    hardest sample, unless finished samples are replaced by new ones with `ContinuousBatchingSampler`. After sampling, `num_score_evals` contains the number of calls to the score model and `num_score_evals_per_sample`
+    the number of score evaluations each sample needed.
+    """
+
+    def __init__(
+        self,
+        *,
+        abs_tol: float = 0.001,
+        rel_tol: float = 0.01,
+        safety: float = 0.9,
+        error_exponent: float = 0.9,
+        initial_step_size: float = 0.01,
+        max_iterations: int = 2000,
+        noise_fns: Mapping[str, NoiseFn] | None = None,
+        **kwargs,
+    ):
+        """
+        Args:
+            abs_tol: absolute tolerance of the local error estimate.
+            rel_tol: relative tolerance of the local error estimate.
+            safety: safety factor applied to the proposed step size.
+            error_exponent: the proposed step size is safety * h * error**(-error_exponent).
+            initial_step_size: step size of the first step of each sample.
+            max_iterations: maximum number of (accepted or rejected) steps, after which we stop adapting and take a final step from the current time.
+            noise_fns: optional functions, keyed by field name, that transform standard Gaussian noise, e.g., to make it symmetric for lattices.
+            **kwargs: passed on to parent class constructor.
+        """
+        super().__init__(**kwargs)
+        assert self._screen is None, "Screening is not supported with adaptive sampling."
+        for k in self._multi_corruption.discrete_corruptions:
+            assert getattr(
+                self._predictors.get(k), "supports_skipping_steps", False
+            ), f"Adaptive sampling requires a predictor that can skip steps for discrete field {k}."
+        self._abs_tol = abs_tol
+        self._rel_tol = rel_tol
+        self._safety = safety
+        self._error_exponent = error_exponent
+        self._initial_step_size = initial_step_size
+        self._max_iterations = max_iterations
+        self._noise_fns = dict(noise_fns or {})
+        self.num_score_evals = 0
+        self.num_score_evals_per_sample: torch.Tensor | None = None
+
+    def _score_fn(self, x: Diffusable, t: torch.Tensor) -> Diffusable:
+        self.num_score_evals += 1
+        return super()._score_fn(x, t)
+
+    @torch.inference_mode()
+    def _denoise(
+        self,
+        batch: Diffusable,
+        mask: dict[str, torch.Tensor],
+        record: bool = False,
+    ) -> SampleAndMeanAndMaybeRecords:
+        """Denoise from a prior sample to a t=0 sample, using adaptive step sizes."""
+        recorded_samples = [] if record else None
+        self.num_score_evals = 0
+        mean_batch = batch.clone()
+        state = self._initial_sampling_state(batch)
+        batch_idx = self._multi_corruption._get_batch_indices(batch)
+
+        iteration = 0
+        finished = torch.zeros_like(state["done"])
+        while not finished.all():
+            # The number of steps is not known in advance, so we can only record every k-th iteration.
+            record_step = record and self._recording_policy.should_record(iteration, None)
+            batch, mean_batch, state, finished = self._sampling_step(
+                batch=batch,
+                mean_batch=mean_batch,
+                state=state,
+                mask=mask,
+                recorded_samples=recorded_samples if record_step else None,
+                batch_idx=batch_idx,
+            )
+            iteration += 1
+
+        if (state["iterations"] >= self._max_iterations).any():
+            logger.warning(
+                f"Adaptive sampler stopped adapting after {self._max_iterations} iterations with some samples at t > eps_t."
+            )
+        evals_per_sample = state["evals"]
+        self.num_score_evals_per_sample = evals_per_sample.cpu()
+        logger.info(
+            f"Adaptive sampler used {self.num_score_evals} score model calls; "
+            f"{evals_per_sample.float().mean().item():.1f} score evaluations per sample on average "
+            f"(min {evals_per_sample.min().item()}, max {evals_per_sample.max().item()})."
+        )
+        return batch, mean_batch, recorded_samples
+
+    def _initial_sampling_state(self, batch: Diffusable) -> dict[str, torch.Tensor]:
+        batch_size = batch.get_batch_size()
+        t = torch.full((batch_size,), self._max_t, device=self._device)
+        return {
+            "t": t,
+            "h": torch.full_like(t, self._initial_step_size),
+            "iterations": torch.zeros(batch_size, dtype=torch.long, device=self._device),
+            "evals": torch.zeros(batch_size, dtype=torch.long, device=self._device),
+            "done": torch.zeros(batch_size, dtype=torch.bool, device=self._device),
+        }
+
+    def _sampling_step(
+        self,
+        batch: Diffusable,
+        mean_batch: Diffusable,
+        state: dict[str, torch.Tensor],
+        mask: dict[str, torch.Tensor | None],
+        recorded_samples: list[Frame] | None = None,
+        batch_idx: dict[str, torch.Tensor | None] | None = None,
+    ) -> tuple[Diffusable, Diffusable, dict[str, torch.Tensor], torch.Tensor]:
+        """Take one adaptive step for each sample that has not reached eps_t yet, and the final step to t=0
+        with the configured predictors for each sample that has."""
+        for k in self._predictors:
+            mask.setdefault(k, None)
+        if batch_idx is None:
+            batch_idx = self._multi_corruption._get_batch_indices(batch)
+        t, h, done = state["t"], state["h"], state["done"]
+
+        active = ~done & (t > self._eps_t + 1e-8) & (state["iterations"] < self._max_iterations)
+        arrived = ~done & ~active
+        # Do not step beyond eps_t, and leave other samples where they are.
+        h = torch.where(active, torch.minimum(h, t - self._eps_t), torch.zeros_like(h))
+        s = t - h
+        if recorded_samples is not None:
+            recorded_samples.append(self._recording_policy.frame(batch))
+
+        # Steps of the same sample are keyed by its number of adaptive iterations, and the final step separately.
+        per_sample_rng.begin_step(2 * state["iterations"])
+        score = self._score_fn(batch, t)
+        evals = state["evals"] + (~done).long()
+        accept = torch.zeros_like(active)
+        error = torch.ones_like(h)
+        samples_means = {k: (batch[k], batch[k]) for k in self._multi_corruption.corrupted_fields}
+        if active.any():
+            samples_means, error = self._adaptive_step(
+                batch=batch, score=score, t=t, h=h, mask=mask, batch_idx=batch_idx
+            )
+            accept = active & (error <= 1.0)
+            evals = evals + active.long()
+        # Samples whose step was rejected keep their current values.
+        samples_means = {
+            k: tuple(
+                _where_accepted(accept, batch_idx[k], new_x=x, old_x=batch[k])
+                for x in sample_and_mean
+            )
+            for k, sample_and_mean in samples_means.items()
+        }
+        if arrived.any():
+            per_sample_rng.begin_step(2 * state["iterations"] + 1)
+            # Final step from t to 0 with the configured predictors, as in the last step of PredictorCorrector._denoise.
+            final_samples_means = apply(
+                fns={k: predictor.update_given_score for k, predictor in self._predictors.items()},
+                x=batch,
+                score=score,
+                broadcast=dict(t=t, batch=batch, dt=-t),
+                batch_idx=batch_idx,
+            )
+            for k, final_sample_and_mean in final_samples_means.items():
+                samples_means[k] = tuple(
+                    _where_accepted(arrived, batch_idx[k], new_x=final_x, old_x=x)
+                    for final_x, x in zip(final_sample_and_mean, samples_means[k])
+                )
+        batch, mean_batch = _mask_replace(
+            samples_means=samples_means, batch=batch, mean_batch=mean_batch, mask=mask
+        )
+
+        h_new = self._safety * h * error.clamp(min=1e-8) ** (-self._error_exponent)
+        done = done | arrived
+        state = {
+            "t": torch.where(accept, s, t),
+            "h": torch.where(active, h_new, state["h"]),
+            "iterations": state["iterations"] + active.long(),
+            "evals": evals,
+            "done": done,
+        }
+        return batch, mean_batch, state, done
+
+    def _adaptive_step(
+        self,
+        batch: Diffusable,
+        score: Diffusable,
+        t: torch.Tensor,
+        h: torch.Tensor,
+        mask: dict[str, torch.Tensor | None],
+        batch_idx: dict[str, torch.Tensor | None],
+    ) -> tuple[dict[str, tuple[torch.Tensor, torch.Tensor]], torch.Tensor]:
+        """Proposed (sample, mean) for each field after a step of size h, and the scaled local error estimate per sample."""
+        sdes = self._multi_corruption.sdes
+        s = t - h
+        drift_t, diffusion_t = self._reverse_drift_and_diffusion(batch, t, score)
+        euler = {k: batch[k] - _expand(h, batch_idx[k], batch[k]) * drift_t[k] for k in sdes}
+        proposal = batch.replace(
+            **{
+                k: _mask(old_x=batch[k], new_x=self._wrap(k, v), mask=mask[k])
+                for k, v in euler.items()
+            }
+        )
+        proposal_score = self._score_fn(proposal, s)
+        drift_s, diffusion_s = self._reverse_drift_and_diffusion(proposal, s, proposal_score)
+        heun = {
+            k: batch[k] - 0.5 * _expand(h, batch_idx[k], batch[k]) * (drift_t[k] + drift_s[k])
+            for k in sdes
+        }
+
+        # The error estimate only depends on the drift, so that accepting or rejecting a step does not bias the noise.
+        error = self._error_norm(
+            euler, heun, mask=mask, batch_idx=batch_idx, batch_size=batch.get_batch_size()
+        )
+
+        new_x = {
+            k: heun[k]
+            + 0.5
+            * (diffusion_t[k] + diffusion_s[k])
+            * _expand(h, batch_idx[k], batch[k]).sqrt()
+            * self._noise_fns.get(k, _identity)(per_sample_rng.randn_like(batch[k], batch_idx[k]))
+            for k in sdes
+        }
+        samples_means = {k: (self._wrap(k, new_x[k]), self._wrap(k, heun[k])) for k in sdes}
+        if self._multi_corruption.discrete_corruptions:
+            samples_means.update(
+                apply(
+                    fns={
+                        k: self._predictors[k].update_given_score
+                        for k in self._multi_corruption.discrete_corruptions
+                    },
+                    broadcast=dict(t=t, dt=-h, batch=batch),
+                    x=batch,
+                    score=score,
+                    batch_idx=batch_idx,
+                )
+            )
+        return samples_means, error
+
+    def _reverse_drift_and_diffusion(
+        self, x: Diffusable, t: torch.Tensor, score: Diffusable
+    ) -> tuple[dict[str, torch.Tensor], dict[str, torch.Tensor]]:
+        """Drift (in the direction of decreasing t) and diffusion coefficient of the reverse SDE for each continuous field."""
+        drifts, diffusions = {}, {}
+        for k, sde in self._multi_corruption.sdes.items():
+            drift, diffusion = sde.sde(x[k], t, batch_idx=x.get_batch_idx(k), batch=x)
+            drifts[k] = drift - diffusion**2 * score[k]
+            diffusions[k] = diffusion
+        return drifts, diffusions
+
+    def _wrap(self, k: str, x: torch.Tensor) -> torch.Tensor:
+        sde = self._multi_corruption.sdes[k]
+        return sde.wrap(x) if isinstance(sde, WrappedSDEMixin) else x
+
+    def _error_norm(
+        self,
+        low_order: dict[str, torch.Tensor],
+        high_order: dict[str, torch.Tensor],
+        mask: dict[str, torch.Tensor | None],
+        batch_idx: dict[str, torch.Tensor | None],
+        batch_size: int,
+    ) -> torch.Tensor:
+        """Root mean square of the scaled difference between the two estimates, per sample, over all continuous fields."""
+        squared_error: torch.Tensor | float = 0.0
+        count: torch.Tensor | float = 0.0
+        for k in low_order:
+            delta = torch.clamp(
+                self._rel_tol * torch.maximum(low_order[k].abs(), high_order[k].abs()),
+                min=self._abs_tol,
+            )
+            scaled = ((low_order[k] - high_order[k]) / delta) ** 2
+            weight = torch.ones_like(scaled)
+            if mask[k] is not None:
+                # Fixed (inpainted) entries do not contribute to the error.
+                weight = weight * (1 - mask[k].to(scaled.dtype))
+            scaled = (scaled * weight).reshape(scaled.shape[0], -1).sum(-1)
+            weight = weight.reshape(weight.shape[0], -1).sum(-1)
+            if batch_idx[k] is not None:
+                scaled = scatter_add(scaled, batch_idx[k], dim=0, dim_size=batch_size)
+                weight = scatter_add(weight, batch_idx[k], dim=0, dim_size=batch_size)
+            squared_error = squared_error + scaled
+            count = count + weight
+        assert isinstance(squared_error, torch.Tensor) and isinstance(count, torch.Tensor)
+        return torch.sqrt(squared_error / count.clamp(min=1.0))
+
+
+def _identity(x: torch.Tensor) -> torch.Tensor:
+    return x
+
+
+class GuidedAdaptivePredictorCorrector(GuidedPredictorCorrector, AdaptivePredictorCorrector):
+    """Adaptive step-size sampler with classifier-free guidance."""
@@ -1,11 +1,23 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT License.
 
-from typing import Callable
+from typing import Callable, Mapping, Sequence
 
 import torch
 
-from mattergen.diffusion.sampling.pc_sampler import Diffusable, PredictorCorrector
+from mattergen.diffusion import per_sample_rng
+from mattergen.diffusion.data.batched_data import (
+    concatenate_batches,
+    merge_batches,
+    select_samples,
+)
+from mattergen.diffusion.sampling.pc_sampler import (
+    Diffusable,
+    PredictorCorrector,
+    SampleAndMean,
+    SampleAndMeanAndMaybeRecords,
+    _expand,
+)
 
 BatchTransform = Callable[[Diffusable], Diffusable]
 
@@ -28,12 +40,15 @@ class GuidedPredictorCorrector(PredictorCorrector):
         guidance_scale: float,
         remove_conditioning_fn: BatchTransform,
         keep_conditioning_fn: BatchTransform | None = None,
+        fuse_guidance_passes: bool = False,
         **kwargs,
     ):
         """
         guidance_scale: gamma in p_gamma(x|y)=p(x)p(y|x)**gamma for classifier-free guidance
         remove_conditioning_fn: function that removes conditioning from the data
         keep_conditioning_fn: function that will be applied to the data before evaluating the conditional score. For example, this function might drop some fields that you never want to condition on or add fields that indicate which conditions should be respected.
+        fuse_guidance_passes: if True, the conditional and unconditional copies of the batch are stacked into a single batch of twice the size,
+            so that each guided score evaluation runs one forward pass of the score model instead of two.
         **kwargs: passed on to parent class constructor.
         """
 
@@ -41,6 +56,98 @@ class GuidedPredictorCorrector(PredictorCorrector):
         self._remove_conditioning_fn = remove_conditioning_fn
         self._keep_conditioning_fn = keep_conditioning_fn or identity
         self._guidance_scale = guidance_scale
+        self._fuse_guidance_passes = fuse_guidance_passes
+        # Conditioning templates for the batch that is currently being denoised. The conditioning functions
+        # only touch non-corrupted fields, so we apply them once per batch and only swap in the corrupted fields at each step.
+        self._conditioning_templates: dict[str, Diffusable] = {}
+        # Guidance scale of each sample in the batch during `sample_guidance_sweep`.
+        self._sweep_guidance_scales: torch.Tensor | None = None
+
+    def sample_guidance_sweep(
+        self,
+        conditioning_data: Diffusable,
+        guidance_scales: Sequence[float],
+        mask: Mapping[str, torch.Tensor] | None = None,
+    ) -> list[SampleAndMean]:
+        """Create one sample for each of a batch of conditions at each of the given guidance scales.
+
+        The samples for all guidance scales are denoised together in a single batch, in which each guided score evaluation
+        is one forward pass of the score model: the conditional score is only evaluated for samples with a nonzero guidance scale,
+        and the unconditional score only for samples with a guidance scale other than 1. `self.guidance_scale` is not used.
+        Within `per_sample_rng.per_sample_seeds`, a sample gets the same noise at each guidance scale, i.e., the noise it would get
+        when sampled at that guidance scale alone.
+
+        Args:
+            conditioning_data: batched conditioning data, see `sample`.
+            guidance_scales: guidance scales to sample at.
+            mask: for inpainting, see `sample`.
+        Returns:
+           (batch, mean_batch) for each guidance scale, see `sample`.
+        """
+        num_scales = len(guidance_scales)
+        batch_size = conditioning_data.get_batch_size()
+        repeated = merge_batches([conditioning_data] * num_scales)
+        repeated_mask = {k: torch.cat([v] * num_scales) for k, v in (mask or {}).items()}
+        self._sweep_guidance_scales = torch.tensor(
+            guidance_scales, dtype=torch.float32, device=self._device
+        ).repeat_interleave(batch_size)
+        try:
+            with per_sample_rng.repeat_sample_indices(num_scales):
+                batch, mean_batch = self.sample(repeated, repeated_mask)
+        finally:
+            self._sweep_guidance_scales = None
+        return [
+            (
+                select_samples(batch, torch.arange(i * batch_size, (i + 1) * batch_size)),
+                select_samples(mean_batch, torch.arange(i * batch_size, (i + 1) * batch_size)),
+            )
+            for i in range(num_scales)
+        ]
+
+    def _denoise(
+        self,
+        batch: Diffusable,
+        mask: dict[str, torch.Tensor],
+        record: bool = False,
+    ) -> SampleAndMeanAndMaybeRecords:
+        self._clear_batch_caches()
+        try:
+            return super()._denoise(batch=batch, mask=mask, record=record)
+        finally:
+            self._clear_batch_caches()
+
+    def _clear_batch_caches(self) -> None:
+        super()._clear_batch_caches()
+        self._conditioning_templates = {}
+
+    def _get_template(self, name: str, x: Diffusable) -> Diffusable:
+        template = self._conditioning_templates.get(name)
+        if template is None or template.get_batch_size() != self._template_batch_size(name, x):
+            if name == "conditional":
+                template = self._keep_conditioning_fn(x)
+            elif name == "unconditional":
+                template = self._remove_conditioning_fn(x)
+            elif name == "sweep":
+                needs_conditional, needs_unconditional = self._sweep_passes()
+                template = concatenate_batches(
+                    select_samples(
+                        self._keep_conditioning_fn(x), needs_conditional.nonzero()[:, 0]
+                    ),
+                    select_samples(
+                        self._remove_conditioning_fn(x), needs_unconditional.nonzero()[:, 0]
+                    ),
+                )
+            else:
+                template = concatenate_batches(
+                    self._keep_conditioning_fn(x), self._remove_conditioning_fn(x)
+                )
+            self._conditioning_templates[name] = template
+        return template
+
+    def _with_corrupted_fields(self, name: str, x: Diffusable) -> Diffusable:
+        return self._get_template(name, x).replace(
+            **{k: x[k] for k in self._multi_corruption.corrupted_fields}
+        )
 
     def _score_fn(
         self,
@@ -57,18 +164,27 @@ class GuidedPredictorCorrector(PredictorCorrector):
 
         def get_unconditional_score():
             return super(GuidedPredictorCorrector, self)._score_fn(
-                x=self._remove_conditioning_fn(x), t=t
+                x=self._with_corrupted_fields("unconditional", x), t=t
             )
 
         def get_conditional_score():
             return super(GuidedPredictorCorrector, self)._score_fn(
-                x=self._keep_conditioning_fn(x), t=t
+                x=self._with_corrupted_fields("conditional", x), t=t
             )
 
-        if abs(self._guidance_scale - 1) < 1e-15:
+        if self._sweep_guidance_scales is not None:
+            needs_conditional, needs_unconditional = self._sweep_passes()
+            if not needs_unconditional.any():
+                return get_conditional_score()
+            elif not needs_conditional.any():
+                return get_unconditional_score()
+            return self._sweep_guided_score(x, t)
+        elif abs(self._guidance_scale - 1) < 1e-15:
             return get_conditional_score()
         elif abs(self._guidance_scale) < 1e-15:
             return get_unconditional_score()
+        elif self._fuse_guidance_passes:
+            return self._fused_guided_score(x, t)
         else:
             # guided_score = guidance_factor * conditional_score + (1-guidance_factor) * unconditional_score
 
@@ -82,3 +198,68 @@ class GuidedPredictorCorrector(PredictorCorrector):
                     for k in self._multi_corruption.corrupted_fields
                 }
             )
+
+    def _fused_guided_score(self, x: Diffusable, t: torch.Tensor) -> Diffusable:
+        """Evaluate the conditional and unconditional scores in a single forward pass on a batch of twice the size.
+        The first half of the stacked batch is the conditional copy, the second half the unconditional copy.
+        """
+        fields = self._multi_corruption.corrupted_fields
+        stacked = self._get_template("stacked", x).replace(
+            **{k: torch.cat([x[k], x[k]]) for k in fields}
+        )
+        stacked_score = super()._score_fn(x=stacked, t=torch.cat([t, t]))
+        guided = {}
+        for k in fields:
+            n = x[k].shape[0]
+            conditional_score, unconditional_score = stacked_score[k][:n], stacked_score[k][n:]
+            guided[k] = torch.lerp(unconditional_score, conditional_score, self._guidance_scale)
+        return x.replace(**guided)
+
+    def _sweep_passes(self) -> tuple[torch.Tensor, torch.Tensor]:
+        """Which samples of a guidance sweep need the conditional and which the unconditional score."""
+        assert self._sweep_guidance_scales is not None
+        scales = self._sweep_guidance_scales
+        return scales.abs() >= 1e-15, (scales - 1).abs() >= 1e-15
+
+    def _sweep_guided_score(self, x: Diffusable, t: torch.Tensor) -> Diffusable:
+        """Guided score with the guidance scale of each sample in a guidance sweep, from a single forward pass on the
+        stacked conditional and unconditional copies of the samples that need them."""
+        assert self._sweep_guidance_scales is not None
+        fields = self._multi_corruption.corrupted_fields
+        batch_idx = self._multi_corruption._get_batch_indices(x)
+        passes = self._sweep_passes()
+        # Rows of each field that go into the conditional and the unconditional part of the stacked batch.
+        rows = [
+            {
+                k: (needs if batch_idx[k] is None else needs[batch_idx[k]]).nonzero()[:, 0]
+                for k in fields
+            }
+            for needs in passes
+        ]
+        stacked = self._get_template("sweep", x).replace(
+            **{k: torch.cat([x[k][rows[0][k]], x[k][rows[1][k]]]) for k in fields}
+        )
+        stacked_score = super()._score_fn(x=stacked, t=torch.cat([t[passes[0]], t[passes[1]]]))
+        guided = {}
+        for k in fields:
+            num_conditional = len(rows[0][k])
+            # Scores that are not needed are left at zero, and get zero weight below.
+            conditional_score, unconditional_score = (
+                stacked_score[k].new_zeros((len(x[k]),) + stacked_score[k].shape[1:])
+                for _ in range(2)
+            )
+            conditional_score[rows[0][k]] = stacked_score[k][:num_conditional]
+            unconditional_score[rows[1][k]] = stacked_score[k][num_conditional:]
+            guided[k] = torch.lerp(
+                unconditional_score,
+                conditional_score,
+                _expand(self._sweep_guidance_scales, batch_idx[k], like=conditional_score),
+            )
+        return x.replace(**guided)
+
+    def _template_batch_size(self, name: str, x: Diffusable) -> int:
+        if name == "stacked":
+            return 2 * x.get_batch_size()
+        if name == "sweep":
+            return sum(int(needs.sum()) for needs in self._sweep_passes())
+        return x.get_batch_size()
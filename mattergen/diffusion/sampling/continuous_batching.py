@@ -0,0 +1,146 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+from __future__ import annotations
+
+import logging
+from typing import Iterable, Iterator, Mapping
+
+import torch
+
+from mattergen.diffusion.data.batched_data import BatchedData, merge_batches, select_samples
+from mattergen.diffusion.sampling.pc_sampler import (
+    Diffusable,
+    PredictorCorrector,
+    SampleAndMean,
+    _sample_prior,
+)
+
+logger = logging.getLogger(__name__)
+
+ConditionBatches = Iterable[tuple[BatchedData, Mapping[str, torch.Tensor] | None]]
+
+
+class ContinuousBatchingSampler:
+    """Runs a sampler on a fixed-size pool of trajectories, which are at different points of denoising.
+
+    Whenever a trajectory is finished, it is removed from the pool and replaced by a new prior sample for the next condition
+    from the condition loader, so that the score model keeps running on `pool_size` samples. This is most useful with
+    samplers whose trajectories finish at different times, e.g., `AdaptivePredictorCorrector`: with plain batching,
+    the cost of each batch is set by its slowest trajectory.
+
+    The pool is rebuilt only in steps in which trajectories are retired. Inpainting masks are not supported.
+
+    Args:
+        sampler: sampler that takes the denoising steps, see `PredictorCorrector._sampling_step`.
+        pool_size: number of trajectories that are denoised together.
+    """
+
+    def __init__(self, sampler: PredictorCorrector, pool_size: int):
+        assert pool_size > 0, "pool_size must be positive."
+        self.sampler = sampler
+        self.pool_size = pool_size
+        self.num_steps = 0
+
+    @property
+    def _device(self) -> torch.device:
+        return self.sampler._device
+
+    @torch.inference_mode()
+    def sample(self, condition_loader: ConditionBatches) -> Iterator[SampleAndMean]:
+        """Generate one sample for each condition in `condition_loader`.
+
+        Yields:
+            (batch, mean_batch) of the trajectories that finished in a step, in the order in which they finish.
+            The difference between these is that `mean_batch` has no noise added at the final denoising step.
+        """
+        diffusion_module = self.sampler.diffusion_module
+        if isinstance(diffusion_module, torch.nn.Module):
+            diffusion_module.eval()
+        pending = PendingConditions(condition_loader)
+        self.num_steps = 0
+
+        batch, mean_batch, state = self._refill(None, None, None, pending)
+        while batch is not None:
+            batch, mean_batch, state, finished = self.sampler._sampling_step(
+                batch=batch, mean_batch=mean_batch, state=state, mask={}
+            )
+            self.num_steps += 1
+            if not finished.any():
+                continue
+            finished_ix = finished.nonzero().flatten()
+            # Normal tensors, which callers may modify in place or use with autograd.
+            with torch.inference_mode(False):
+                finished_batch = select_samples(batch, finished_ix)
+                finished_mean_batch = select_samples(mean_batch, finished_ix)
+            yield finished_batch, finished_mean_batch
+
+            keep_ix = (~finished).nonzero().flatten()
+            if len(keep_ix) > 0:
+                batch = select_samples(batch, keep_ix)
+                mean_batch = select_samples(mean_batch, keep_ix)
+                state = {k: v[keep_ix] for k, v in state.items()}
+            else:
+                batch, mean_batch, state = None, None, None
+            batch, mean_batch, state = self._refill(batch, mean_batch, state, pending)
+        logger.info(f"Continuous batching took {self.num_steps} sampling steps.")
+
+    def _refill(
+        self,
+        batch: Diffusable | None,
+        mean_batch: Diffusable | None,
+        state: dict[str, torch.Tensor] | None,
+        pending: PendingConditions,
+    ) -> tuple[Diffusable | None, Diffusable | None, dict[str, torch.Tensor] | None]:
+        """Add prior samples for new conditions until the pool is full or there are no conditions left."""
+        num_missing = self.pool_size - (batch.get_batch_size() if batch is not None else 0)
+        conditioning_data = pending.take(num_missing)
+        if conditioning_data is not None:
+            new_batch = _sample_prior(
+                self.sampler._multi_corruption, conditioning_data.to(self._device), mask=None
+            )
+            new_state = self.sampler._initial_sampling_state(new_batch)
+            if batch is None:
+                batch, mean_batch, state = new_batch, new_batch.clone(), new_state
+            else:
+                assert mean_batch is not None and state is not None
+                batch = merge_batches([batch, new_batch])
+                mean_batch = merge_batches([mean_batch, new_batch])
+                state = {k: torch.cat([v, new_state[k]]) for k, v in state.items()}
+        # The samples in the pool have changed.
+        self.sampler._clear_batch_caches()
+        return batch, mean_batch, state
+
+
+class PendingConditions:
+    """Hands out the conditions of a condition loader in chunks of a given size, e.g., to fill the free slots of the
+    pool of a `ContinuousBatchingSampler`, or to merge the conditions of several requests into one batch."""
+
+    def __init__(self, condition_loader: ConditionBatches):
+        self._batches = iter(condition_loader)
+        self._current: BatchedData | None = None
+        self._offset = 0
+
+    def take(self, n: int) -> BatchedData | None:
+        """Returns a batch of the next (at most) n conditions, or None if there are no conditions left."""
+        chunks = []
+        while n > 0 and not self.is_empty():
+            assert self._current is not None
+            size = min(n, self._current.get_batch_size() - self._offset)
+            chunks.append(
+                select_samples(self._current, torch.arange(self._offset, self._offset + size))
+            )
+            self._offset += size
+            n -= size
+        return merge_batches(chunks) if chunks else None
+
+    def is_empty(self) -> bool:
+        """Whether there are no conditions left."""
+        if self._current is None or self._offset == self._current.get_batch_size():
+            next_batch = next(self._batches, None)
+            if next_batch is None:
+                return True
+            self._current, mask = next_batch
+            assert not mask, "Inpainting masks are not supported with continuous batching."
+            self._offset = 0
+        return False
@@ -3,23 +3,40 @@
 
 from __future__ import annotations
 
-from typing import Generic, Mapping, Tuple, TypeVar
+import logging
+import math
+from typing import Generic, Mapping, Sequence, Tuple, TypeVar
 
 import torch
 from tqdm.auto import tqdm
 
+from mattergen.diffusion import per_sample_rng
 from mattergen.diffusion.corruption.multi_corruption import MultiCorruption, apply
-from mattergen.diffusion.data.batched_data import BatchedData
+from mattergen.diffusion.data.batched_data import BatchedData, select_samples
 from mattergen.diffusion.diffusion_module import DiffusionModule
+from mattergen.diffusion.inference_options import (
+    InferenceCache,
+    InferenceOptions,
+    using_inference_options,
+)
 from mattergen.diffusion.lightning_module import DiffusionLightningModule
 from mattergen.diffusion.sampling.pc_partials import CorrectorPartial, PredictorPartial
+from mattergen.diffusion.sampling.predictors_correctors import LangevinCorrector
+from mattergen.diffusion.sampling.recording import Frame, RecordingPolicy
+from mattergen.diffusion.sampling.screening import SampleScreen
+from mattergen.diffusion.wrapped.wrapped_sde import WrappedSDEMixin
+
+logger = logging.getLogger(__name__)
+
+# The progress bar is only updated every this many denoising steps.
+_PROGRESS_BAR_INTERVAL = 50
 
 Diffusable = TypeVar(
     "Diffusable", bound=BatchedData
 )  # Don't use 'T' because it clashes with the 'T' for time
 SampleAndMean = Tuple[Diffusable, Diffusable]
-SampleAndMeanAndMaybeRecords = Tuple[Diffusable, Diffusable, list[Diffusable] | None]
-SampleAndMeanAndRecords = Tuple[Diffusable, Diffusable, list[Diffusable]]
+SampleAndMeanAndMaybeRecords = Tuple[Diffusable, Diffusable, list[Frame] | None]
+SampleAndMeanAndRecords = Tuple[Diffusable, Diffusable, list[Frame]]
 
 
 class PredictorCorrector(Generic[Diffusable]):
@@ -36,6 +53,11 @@ class PredictorCorrector(Generic[Diffusable]):
         N: int,
         eps_t: float = 1e-3,
         max_t: float | None = None,
+        recording_policy: RecordingPolicy | None = None,
+        screen: SampleScreen | None = None,
+        screening_timesteps: Sequence[float] = (),
+        max_rejections: int = 10,
+        inference_options: InferenceOptions | None = None,
     ):
         """
         Args:
@@ -47,6 +69,14 @@ class PredictorCorrector(Generic[Diffusable]):
             N: number of noise levels
             eps_t: diffusion time to stop denoising at
             max_t: diffusion time to start denoising at. If None, defaults to the maximum diffusion time. You may want to start at T-0.01, say, for numerical stability.
+            recording_policy: which steps and fields `sample_with_record` records. If None, a full copy of the batch is recorded at every step.
+            screen: if given, the estimate of the denoised samples is checked at each of the `screening_timesteps`. Samples that fail the
+                screen are dropped and restart from a new prior sample for the same conditions, so that no more compute is spent on them.
+            screening_timesteps: diffusion times at which to screen the samples. Each is rounded to the next denoising step.
+            max_rejections: maximum number of times a sample may be restarted. After that, it is no longer screened.
+            inference_options: how the score model runs, e.g., its precision, whether it is compiled, and whether it reuses
+                its neighbor lists or chunks its message passing (see `mattergen.diffusion.inference_options`). The sampler
+                itself always runs in full precision.
         """
         self._diffusion_module = diffusion_module
         self.N = N
@@ -61,15 +91,19 @@ class PredictorCorrector(Generic[Diffusable]):
         ), "Must specify at least one predictor or corrector"
         corrector_partials = corrector_partials or {}
         predictor_partials = predictor_partials or {}
-        if self._multi_corruption.discrete_corruptions:
-            # These all have property 'N' because they are D3PM type
-            assert set(c.N for c in self._multi_corruption.discrete_corruptions.values()) == {N}  # type: ignore
-
         self._predictors = {
             k: v(corruption=self._multi_corruption.corruptions[k], score_fn=None)
             for k, v in predictor_partials.items()
         }
 
+        # These all have property 'N' because they are D3PM type. Predictors that can skip discrete
+        # timesteps (e.g. D3PMJumpPredictor) may use fewer sampling steps than the corruption has.
+        assert all(
+            c.N == N  # type: ignore
+            for k, c in self._multi_corruption.discrete_corruptions.items()
+            if not getattr(self._predictors.get(k), "supports_skipping_steps", False)
+        )
+
         self._correctors = {
             k: v(
                 corruption=self._multi_corruption.corruptions[k],
@@ -81,23 +115,53 @@ class PredictorCorrector(Generic[Diffusable]):
         self._eps_t = eps_t
         self._n_steps_corrector = n_steps_corrector
         self._device = device
+        self._recording_policy = recording_policy or RecordingPolicy()
+        self._screen = screen
+        self._screening_steps = torch.tensor(
+            sorted({self._timestep_to_step(t) for t in screening_timesteps}),
+            dtype=torch.long,
+            device=device,
+        )
+        self._max_rejections = max_rejections
+        self._inference_options = inference_options or InferenceOptions()
+        # Neighbor lists and embedded conditions that score models keep for the batch that is being denoised
+        self._inference_cache = InferenceCache()
+        # Decreasing timesteps from T to eps_t
+        self._timesteps = torch.linspace(self._max_t, self._eps_t, self.N, device=device)
+        self._dt = -torch.tensor((self._max_t - self._eps_t) / (self.N - 1), device=device)
+        # Number of samples that were dropped by the screen in the last call to `sample` or `sample_with_record`.
+        self.num_rejected = 0
 
     @property
     def diffusion_module(self) -> DiffusionModule:
         return self._diffusion_module
 
+    @property
+    def updates_depend_on_batch(self) -> bool:
+        """Whether the update of a sample depends on the other samples in its batch, i.e., whether it runs Langevin
+        correctors whose step sizes are averaged over the batch (see `LangevinCorrector`)."""
+        return self._n_steps_corrector > 0 and any(
+            isinstance(c, LangevinCorrector) and not c.per_sample_step_size
+            for c in self._correctors.values()
+        )
+
     @property
     def _multi_corruption(self) -> MultiCorruption:
         return self._diffusion_module.corruption
 
     def _score_fn(self, x: Diffusable, t: torch.Tensor) -> Diffusable:
-        return self._diffusion_module.score_fn(x, t)
+        with using_inference_options(self._inference_options, self._inference_cache):
+            return self._diffusion_module.score_fn(x, t)
+
+    def _timestep_to_step(self, t: float) -> int:
+        """Index of the first denoising step at a time <= t."""
+        step = math.ceil((self._max_t - t) / (self._max_t - self._eps_t) * (self.N - 1) - 1e-6)
+        return min(max(step, 0), self.N - 1)
 
     @classmethod
     def from_pl_module(cls, pl_module: DiffusionLightningModule, **kwargs) -> PredictorCorrector:
         return cls(diffusion_module=pl_module.diffusion_module, device=pl_module.device, **kwargs)
 
-    @torch.no_grad()
     def sample(
         self, conditioning_data: BatchedData, mask: Mapping[str, torch.Tensor] | None = None
     ) -> SampleAndMean:
@@ -109,11 +173,10 @@ class PredictorCorrector(Generic[Diffusable]):
                 Shapes of values in `mask` must match the shapes of values in `conditioning_data`.
         Returns:
            (batch, mean_batch). The difference between these is that `mean_batch` has no noise added at the final denoising step.
-
+           Sampling runs in inference mode, but the returned tensors are normal tensors.
         """
         return self._sample_maybe_record(conditioning_data, mask=mask, record=False)[:2]
 
-    @torch.no_grad()
     def sample_with_record(
         self, conditioning_data: BatchedData, mask: Mapping[str, torch.Tensor] | None = None
     ) -> SampleAndMeanAndRecords:
@@ -129,7 +192,7 @@ class PredictorCorrector(Generic[Diffusable]):
         """
         return self._sample_maybe_record(conditioning_data, mask=mask, record=True)
 
-    @torch.no_grad()
+    @torch.inference_mode()
     def _sample_maybe_record(
         self,
         conditioning_data: BatchedData,
@@ -146,7 +209,7 @@ class PredictorCorrector(Generic[Diffusable]):
            (batch, mean_batch, recorded_samples, recorded_predictions).
            The difference between the former two is that `mean_batch` has no noise added at the final denoising step.
            The latter two are only returned if `record` is True, and contain the samples and predictions from each step of the diffusion process.
-
+           Sampling runs in inference mode, but the returned tensors are normal tensors, which callers may modify in place or use with autograd.
         """
         if isinstance(self._diffusion_module, torch.nn.Module):
             self._diffusion_module.eval()
@@ -154,72 +217,243 @@ class PredictorCorrector(Generic[Diffusable]):
         conditioning_data = conditioning_data.to(self._device)
         mask = {k: v.to(self._device) for k, v in mask.items()}
         batch = _sample_prior(self._multi_corruption, conditioning_data, mask=mask)
-        return self._denoise(batch=batch, mask=mask, record=record)
+        self._clear_batch_caches()
+        batch, mean_batch, recorded_samples = self._denoise(batch=batch, mask=mask, record=record)
+        with torch.inference_mode(False):
+            return batch.clone(), mean_batch.clone(), recorded_samples
 
-    @torch.no_grad()
+    @torch.inference_mode()
     def _denoise(
         self,
         batch: Diffusable,
         mask: dict[str, torch.Tensor],
         record: bool = False,
     ) -> SampleAndMeanAndMaybeRecords:
-        """Denoise from a prior sample to a t=eps_t sample."""
+        """Denoise from a prior sample to a t=eps_t sample.
+
+        With a screen, samples that are restarted need more than N steps. Samples that are done in the meantime are left as they are.
+        """
         recorded_samples = None
         if record:
             recorded_samples = []
+        mean_batch = batch.clone()
+        state = self._initial_sampling_state(batch)
+        self.num_rejected = 0
+        # The samples in the batch do not change during denoising, so neither do their batch indices.
+        batch_idx = self._multi_corruption._get_batch_indices(batch)
+
+        finished = torch.zeros(batch.get_batch_size(), dtype=torch.bool, device=self._device)
+        progress_bar = tqdm(total=self.N, mininterval=5)
+        i = 0
+        # Without a screen, all samples finish after N steps.
+        while i < self.N or (self._screen is not None and not finished.all()):
+            record_step = record and self._recording_policy.should_record(i, self.N)
+            new_batch, new_mean_batch, state, new_finished = self._sampling_step(
+                batch=batch,
+                mean_batch=mean_batch,
+                state=state,
+                mask=mask,
+                recorded_samples=recorded_samples if record_step else None,
+                batch_idx=batch_idx,
+            )
+            if self._screen is not None and finished.any():
+                new_batch, new_mean_batch = (
+                    new.replace(
+                        **{
+                            k: _where_accepted(~finished, batch_idx[k], new_x=new[k], old_x=old[k])
+                            for k in self._multi_corruption.corrupted_fields
+                        }
+                    )
+                    for new, old in ((new_batch, batch), (new_mean_batch, mean_batch))
+                )
+            batch, mean_batch = new_batch, new_mean_batch
+            finished = finished | new_finished
+            i += 1
+            if i % _PROGRESS_BAR_INTERVAL == 0:
+                progress_bar.update(min(i, self.N) - progress_bar.n)
+        progress_bar.update(min(i, self.N) - progress_bar.n)
+        progress_bar.close()
+        if self.num_rejected:
+            logger.info(
+                f"Screening dropped {self.num_rejected} samples; denoising took {i} instead of {self.N} steps."
+            )
+
+        return batch, mean_batch, recorded_samples
+
+    def _initial_sampling_state(self, batch: Diffusable) -> dict[str, torch.Tensor]:
+        """Per-sample state of the sampler at the start of denoising. All values have the batch size as first dimension."""
+        batch_size = batch.get_batch_size()
+        return {
+            "step": torch.zeros(batch_size, dtype=torch.long, device=self._device),
+            # Number of times the sample was dropped by the screen and restarted.
+            "attempt": torch.zeros(batch_size, dtype=torch.long, device=self._device),
+        }
+
+    def _sampling_step(
+        self,
+        batch: Diffusable,
+        mean_batch: Diffusable,
+        state: dict[str, torch.Tensor],
+        mask: dict[str, torch.Tensor | None],
+        recorded_samples: list[Frame] | None = None,
+        batch_idx: dict[str, torch.Tensor | None] | None = None,
+    ) -> tuple[Diffusable, Diffusable, dict[str, torch.Tensor], torch.Tensor]:
+        """Take one denoising step for each sample in the batch.
+
+        Samples may be at different points of denoising, as tracked by `state`, so that finished samples can be
+        replaced by new ones (see `ContinuousBatchingSampler`).
+
+        Args:
+            batch: current samples.
+            mean_batch: current samples without the noise of the last step.
+            state: per-sample sampler state, as returned by `_initial_sampling_state` or the previous call.
+            mask: for inpainting, see `sample`.
+            recorded_samples: if given, the frames of this step are appended to it.
+            batch_idx: batch indices of the corrupted fields of `batch`, if known.
+
+        Returns:
+            (batch, mean_batch, state, finished), where `finished` is a boolean tensor that indicates which samples are fully denoised.
+        """
         for k in self._predictors:
             mask.setdefault(k, None)
         for k in self._correctors:
             mask.setdefault(k, None)
-        mean_batch = batch.clone()
 
-        # Decreasing timesteps from T to eps_t
-        timesteps = torch.linspace(self._max_t, self._eps_t, self.N, device=self._device)
-        dt = -torch.tensor((self._max_t - self._eps_t) / (self.N - 1)).to(self._device)
-
-        for i in tqdm(range(self.N), miniters=50, mininterval=5):
-            # Set the timestep
-            t = torch.full((batch.get_batch_size(),), timesteps[i], device=self._device)
-
-            # Corrector updates.
-            if self._correctors:
-                for _ in range(self._n_steps_corrector):
-                    score = self._score_fn(batch, t)
-                    fns = {
-                        k: corrector.step_given_score for k, corrector in self._correctors.items()
-                    }
-                    samples_means: dict[str, Tuple[torch.Tensor, torch.Tensor]] = apply(
-                        fns=fns,
-                        broadcast={"t": t, "dt": dt},
-                        x=batch,
-                        score=score,
-                        batch_idx=self._multi_corruption._get_batch_indices(batch),
-                    )
-                    if record:
-                        recorded_samples.append(batch.clone().to("cpu"))
-                    batch, mean_batch = _mask_replace(
-                        samples_means=samples_means, batch=batch, mean_batch=mean_batch, mask=mask
-                    )
+        if batch_idx is None:
+            batch_idx = self._multi_corruption._get_batch_indices(batch)
+        dt = self._dt
+        t = self._timesteps[state["step"].clamp(max=self.N - 1)]
+        per_sample_rng.begin_step(state["step"] + (self.N + 1) * state["attempt"])
+
+        # Corrector updates.
+        if self._correctors:
+            for _ in range(self._n_steps_corrector):
+                score = self._score_fn(batch, t)
+                fns = {k: corrector.step_given_score for k, corrector in self._correctors.items()}
+                samples_means: dict[str, Tuple[torch.Tensor, torch.Tensor]] = apply(
+                    fns=fns,
+                    broadcast={"t": t, "dt": dt},
+                    x=batch,
+                    score=score,
+                    batch_idx=batch_idx,
+                )
+                if recorded_samples is not None:
+                    recorded_samples.append(self._recording_policy.frame(batch))
+                batch, mean_batch = _mask_replace(
+                    samples_means=samples_means, batch=batch, mean_batch=mean_batch, mask=mask
+                )
+
+        # Predictor updates
+        x_t = batch
+        score = self._score_fn(batch, t)
+        predictor_fns = {
+            k: predictor.update_given_score for k, predictor in self._predictors.items()
+        }
+        samples_means = apply(
+            fns=predictor_fns,
+            x=batch,
+            score=score,
+            broadcast=dict(t=t, batch=batch, dt=dt),
+            batch_idx=batch_idx,
+        )
+        if recorded_samples is not None:
+            recorded_samples.append(self._recording_policy.frame(batch))
+        batch, mean_batch = _mask_replace(
+            samples_means=samples_means, batch=batch, mean_batch=mean_batch, mask=mask
+        )
 
-            # Predictor updates
-            score = self._score_fn(batch, t)
-            predictor_fns = {
-                k: predictor.update_given_score for k, predictor in self._predictors.items()
-            }
-            samples_means = apply(
-                fns=predictor_fns,
-                x=batch,
+        state = {**state, "step": state["step"] + 1}
+        if self._screen is not None:
+            batch, mean_batch, state = self._screen_samples(
+                x_t=x_t,
                 score=score,
-                broadcast=dict(t=t, batch=batch, dt=dt),
-                batch_idx=self._multi_corruption._get_batch_indices(batch),
+                t=t,
+                batch=batch,
+                mean_batch=mean_batch,
+                state=state,
+                mask=mask,
+                batch_idx=batch_idx,
+            )
+        return batch, mean_batch, state, state["step"] >= self.N
+
+    def _screen_samples(
+        self,
+        x_t: Diffusable,
+        score: Diffusable,
+        t: torch.Tensor,
+        batch: Diffusable,
+        mean_batch: Diffusable,
+        state: dict[str, torch.Tensor],
+        mask: dict[str, torch.Tensor | None],
+        batch_idx: dict[str, torch.Tensor | None],
+    ) -> tuple[Diffusable, Diffusable, dict[str, torch.Tensor]]:
+        """Restart the samples that fail the screen in a screening step from new prior samples."""
+        assert self._screen is not None
+        screened = torch.isin(state["step"] - 1, self._screening_steps) & (
+            state["attempt"] < self._max_rejections
+        )
+        if not screened.any():
+            return batch, mean_batch, state
+        x0 = self._estimate_x0(x_t, score, t, batch_idx)
+        keep = torch.ones_like(screened)
+        if screened.all():
+            keep = self._screen(x0).to(keep.device)
+        else:
+            screened_ix = screened.nonzero().flatten()
+            keep[screened_ix] = self._screen(select_samples(x0, screened_ix)).to(keep.device)
+        reject = screened & ~keep
+        if not reject.any():
+            return batch, mean_batch, state
+
+        attempt = state["attempt"] + reject.long()
+        # The conditions (and inpainted values) of the samples are still in the batch.
+        prior = _sample_prior(
+            self._multi_corruption,
+            batch,
+            mask={k: v for k, v in mask.items() if v is not None},
+            noise_steps=(self.N + 1) * attempt - 1,
+        )
+        restarted = {
+            k: _where_accepted(reject, batch_idx[k], new_x=prior[k], old_x=batch[k])
+            for k in self._multi_corruption.corrupted_fields
+        }
+        self.num_rejected += int(reject.sum())
+        state = {
+            **state,
+            "step": torch.where(reject, torch.zeros_like(state["step"]), state["step"]),
+            "attempt": attempt,
+        }
+        return batch.replace(**restarted), mean_batch.replace(**restarted), state
+
+    def _estimate_x0(
+        self,
+        x_t: Diffusable,
+        score: Diffusable,
+        t: torch.Tensor,
+        batch_idx: dict[str, torch.Tensor | None],
+    ) -> Diffusable:
+        """Estimate of the denoised samples given the score at time t: the posterior mean for continuous fields,
+        and the most likely class for discrete fields."""
+        x0 = {}
+        for k, sde in self._multi_corruption.sdes.items():
+            alpha_t, sigma_t = sde.mean_coeff_and_std(
+                x=x_t[k], t=t, batch_idx=batch_idx[k], batch=x_t
             )
-            if record:
-                recorded_samples.append(batch.clone().to("cpu"))
-            batch, mean_batch = _mask_replace(
-                samples_means=samples_means, batch=batch, mean_batch=mean_batch, mask=mask
+            limit_mean = (
+                sde.get_limit_mean(x=x_t[k], batch=x_t) if hasattr(sde, "get_limit_mean") else 0.0
             )
+            x0[k] = (x_t[k] - (1 - alpha_t) * limit_mean + sigma_t**2 * score[k]) / alpha_t
+            if isinstance(sde, WrappedSDEMixin):
+                x0[k] = sde.wrap(x0[k])
+        for k, corruption in self._multi_corruption.discrete_corruptions.items():
+            assert hasattr(corruption, "_to_non_zero_based")
+            x0[k] = corruption._to_non_zero_based(score[k].argmax(dim=-1))
+        return x_t.replace(**x0)
 
-        return batch, mean_batch, recorded_samples
+    def _clear_batch_caches(self) -> None:
+        """Called whenever the samples in the batch that is being denoised change. Subclasses that cache
+        per-batch data must clear it here."""
+        self._inference_cache.clear()
 
 
 def _mask_replace(
@@ -228,14 +462,16 @@ def _mask_replace(
     mean_batch: BatchedData,
     mask: dict[str, torch.Tensor | None],
 ) -> SampleAndMean:
-    # Apply masks
-    samples_means = apply(
-        fns={k: _mask_both for k in samples_means},
-        broadcast={},
-        sample_and_mean=samples_means,
-        mask=mask,
-        old_x=batch,
-    )
+    # Apply masks. The predictors and correctors return new tensors, so we can mask them in place.
+    for k, (sample, mean) in samples_means.items():
+        msk = mask.get(k)
+        if msk is None:
+            continue
+        old_x = batch[k]
+        if sample is not old_x:
+            sample.lerp_(old_x, msk)
+        if mean is not sample and mean is not old_x:
+            mean.lerp_(old_x, msk)
 
     # Put the updated values in `batch` and `mean_batch`
     batch = batch.replace(**{k: v[0] for k, v in samples_means.items()})
@@ -243,12 +479,6 @@ def _mask_replace(
     return batch, mean_batch
 
 
-def _mask_both(
-    *, sample_and_mean: Tuple[torch.Tensor, torch.Tensor], old_x: torch.Tensor, mask: torch.Tensor
-) -> Tuple[torch.Tensor, torch.Tensor]:
-    return tuple(_mask(old_x=old_x, new_x=x, mask=mask) for x in sample_and_mean)  # type: ignore
-
-
 def _mask(*, old_x: torch.Tensor, new_x: torch.Tensor, mask: torch.Tensor | None) -> torch.Tensor:
     """Replace new_x with old_x where mask is 1."""
     if mask is None:
@@ -261,7 +491,9 @@ def _sample_prior(
     multi_corruption: MultiCorruption,
     conditioning_data: BatchedData,
     mask: Mapping[str, torch.Tensor] | None,
+    noise_steps: torch.Tensor | None = None,
 ) -> BatchedData:
+    per_sample_rng.begin_step(noise_steps)
     samples = {
         k: multi_corruption.corruptions[k]
         .prior_sampling(
@@ -277,3 +509,20 @@ def _sample_prior(
         if k in multi_corruption.corrupted_fields:
             samples[k].lerp_(conditioning_data[k], msk)
     return conditioning_data.replace(**samples)
+
+
+def _expand(x: torch.Tensor, batch_idx: torch.Tensor | None, like: torch.Tensor) -> torch.Tensor:
+    """Expand a per-sample tensor to the shape of `like`."""
+    if batch_idx is not None:
+        x = x[batch_idx]
+    return x.reshape(x.shape + (1,) * (like.dim() - x.dim()))
+
+
+def _where_accepted(
+    accept: torch.Tensor,
+    batch_idx: torch.Tensor | None,
+    new_x: torch.Tensor,
+    old_x: torch.Tensor,
+) -> torch.Tensor:
+    """Take new_x for entries that belong to samples whose step was accepted, old_x otherwise."""
+    return torch.where(_expand(accept, batch_idx, like=new_x), new_x, old_x)
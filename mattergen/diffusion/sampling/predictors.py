@@ -13,6 +13,7 @@ import logging
 
 import torch
 
+from mattergen.diffusion import per_sample_rng
 from mattergen.diffusion.corruption.corruption import Corruption
 from mattergen.diffusion.corruption.sde_lib import SDE, ScoreFunction, check_score_fn_defined
 from mattergen.diffusion.data.batched_data import BatchedData
@@ -112,7 +113,7 @@ class AncestralSamplingPredictor(Predictor):
             batch=batch,
         )
         # Sample random noise.
-        z = torch.randn_like(x_coeff)
+        z = per_sample_rng.randn_like(x_coeff, batch_idx)
 
         mean = x_coeff * x + score_coeff * score
         sample = mean + std * z
@@ -167,3 +168,74 @@ class AncestralSamplingPredictor(Predictor):
     @classmethod
     def is_compatible(cls, corruption: Corruption) -> bool:
         return super().is_compatible(corruption) and not isinstance(corruption, WrappedSDEMixin)
+
+
+class DDIMPredictor(Predictor):
+    """Suitable for all linear SDEs. Allows taking few, large steps.
+
+    Like the ancestral sampler, this predictor converts the score prediction into a prediction of x_0 and
+    the noise eps = -sigma_t * score, but then jumps to time s = t + dt as in DDIM (Song et al., https://arxiv.org/abs/2010.02502):
+
+    x_s = alpha_s * x_0 + limit_mean * (1 - alpha_s) + sqrt(sigma_s^2 - std^2) * eps + std * z
+
+    where std = eta * (standard deviation of the ancestral sampling step). For eta=0 this is a first-order exponential
+    integrator of the probability flow ODE, i.e., sampling is deterministic given the prior sample.
+    For eta=1 the noise level matches `AncestralSamplingPredictor`.
+    """
+
+    def __init__(
+        self,
+        corruption: Corruption,
+        score_fn: ScoreFunction | None,
+        eta: float = 0.0,
+    ):
+        super().__init__(corruption, score_fn=score_fn)
+        self.eta = eta
+
+    def update_given_score(
+        self,
+        *,
+        x: torch.Tensor,
+        t: torch.Tensor,
+        dt: torch.Tensor,
+        batch_idx: torch.LongTensor,
+        score: torch.Tensor,
+        batch: BatchedData | None,
+    ) -> SampleAndMean:
+        sde = self.corruption
+        assert isinstance(sde, SDE)
+        s = t + dt
+        if batch_idx is None:
+            is_time_zero = s <= 0
+        else:
+            is_time_zero = s[batch_idx] <= 0
+        alpha_t, sigma_t = sde.mean_coeff_and_std(x=x, t=t, batch_idx=batch_idx, batch=batch)
+        alpha_s, sigma_s = sde.mean_coeff_and_std(
+            x=x, t=s.clamp(min=0.0), batch_idx=batch_idx, batch=batch
+        )
+        sigma_s[is_time_zero] = 0
+        limit_mean = self._get_limit_mean(x=x, batch=batch)
+
+        x0 = (x - (1 - alpha_t) * limit_mean + sigma_t**2 * score) / alpha_t
+        eps = -sigma_t * score
+        # Standard deviation of the ancestral step, see AncestralSamplingPredictor._get_coeffs.
+        sigma2_t_given_s = (sigma_t**2 - sigma_s**2 * alpha_t**2 / alpha_s**2).clamp(min=0.0)
+        std = self.eta * torch.sqrt(sigma2_t_given_s) * sigma_s / sigma_t
+        mean = (
+            alpha_s * x0
+            + (1 - alpha_s) * limit_mean
+            + torch.sqrt((sigma_s**2 - std**2).clamp(min=0.0)) * eps
+        )
+        sample = mean + std * self._sample_noise(mean, batch_idx)
+        return sample, mean
+
+    def _get_limit_mean(self, x: torch.Tensor, batch: BatchedData | None) -> torch.Tensor | float:
+        """Mean of the prior distribution. Zero for VESDE and VPSDE."""
+        return 0.0
+
+    def _sample_noise(self, like: torch.Tensor, batch_idx: torch.LongTensor) -> torch.Tensor:
+        return per_sample_rng.randn_like(like, batch_idx)
+
+    @classmethod
+    def is_compatible(cls, corruption: Corruption) -> bool:
+        return super().is_compatible(corruption) and not isinstance(corruption, WrappedSDEMixin)
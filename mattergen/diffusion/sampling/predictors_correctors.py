@@ -13,6 +13,7 @@ import abc
 import torch
 from torch_scatter import scatter_add
 
+from mattergen.diffusion import per_sample_rng
 from mattergen.diffusion.corruption.corruption import maybe_expand
 from mattergen.diffusion.corruption.sde_lib import (
     VESDE,
@@ -49,6 +50,7 @@ class LangevinCorrector(Sampler):
         n_steps: int,
         snr: float = 0.2,
         max_step_size: float = 1.0,
+        per_sample_step_size: bool = False,
     ):
         """The Langevin corrector.
 
@@ -58,11 +60,16 @@ class LangevinCorrector(Sampler):
             n_steps: number of Langevin steps at each noise level
             snr: signal-to-noise ratio
             max_step_size: largest coefficient that the score can be multiplied by for each Langevin step.
+            per_sample_step_size: if True, the step size of each sample is set by the norms of its own score and noise,
+                instead of by their averages over the batch, so that the update of a sample does not depend on the other
+                samples in its batch, e.g., to regenerate single structures (see `mattergen.diffusion.per_sample_rng`).
+                The norms of single samples fluctuate more, which biases the samples if they have few dimensions.
         """
         super().__init__(corruption=corruption, score_fn=score_fn)
         self.n_steps = n_steps
         self.snr = snr
         self.max_step_size = torch.tensor(max_step_size)
+        self.per_sample_step_size = per_sample_step_size
 
     @classmethod
     def is_compatible(cls, corruption: Corruption):
@@ -91,28 +98,36 @@ class LangevinCorrector(Sampler):
             alpha = torch.ones_like(t)
         return alpha
 
+    def score_and_noise_norms(
+        self, score: torch.Tensor, noise: torch.Tensor, batch_idx: torch.LongTensor | None
+    ) -> tuple[torch.Tensor, torch.Tensor]:
+        """Norms of the score and the noise that set the step size, averaged over the samples in the batch, or,
+        with `per_sample_step_size`, those of each sample, shape (batch_size,)."""
+        grad_norm_square = torch.square(score).reshape(score.shape[0], -1).sum(dim=1)
+        noise_norm_square = torch.square(noise).reshape(noise.shape[0], -1).sum(dim=1)
+        if batch_idx is not None:
+            grad_norm_square = scatter_add(grad_norm_square, dim=-1, index=batch_idx)
+            noise_norm_square = scatter_add(noise_norm_square, dim=-1, index=batch_idx)
+        grad_norm = grad_norm_square.sqrt()
+        noise_norm = noise_norm_square.sqrt()
+        if self.per_sample_step_size:
+            return grad_norm, noise_norm
+        return grad_norm.mean(), noise_norm.mean()
+
     def step_given_score(
         self, *, x, batch_idx: torch.LongTensor | None, score, t: torch.Tensor, dt: torch.Tensor
     ) -> SampleAndMean:
         alpha = self.get_alpha(t, dt=dt)
         snr = self.snr
-        noise = torch.randn_like(score)
-        grad_norm_square = torch.square(score).reshape(score.shape[0], -1).sum(dim=1)
-        noise_norm_square = torch.square(noise).reshape(noise.shape[0], -1).sum(dim=1)
-        if batch_idx is None:
-            grad_norm = grad_norm_square.sqrt().mean()
-            noise_norm = noise_norm_square.sqrt().mean()
-        else:
-            grad_norm = torch.sqrt(scatter_add(grad_norm_square, dim=-1, index=batch_idx)).mean()
-
-            noise_norm = torch.sqrt(scatter_add(noise_norm_square, dim=-1, index=batch_idx)).mean()
+        noise = per_sample_rng.randn_like(score, batch_idx)
+        grad_norm, noise_norm = self.score_and_noise_norms(score, noise, batch_idx)
 
         # If gradient is zero (i.e., we are sampling from an improper distribution that's flat over the whole of R^n)
         # the step_size blows up. Clip step_size to avoid this.
         # The EGNN reports zero scores when there are no edges between nodes.
         step_size = (snr * noise_norm / grad_norm) ** 2 * 2 * alpha
         step_size = torch.minimum(step_size, self.max_step_size)
-        step_size[grad_norm == 0, :] = self.max_step_size
+        step_size = torch.where(grad_norm == 0, self.max_step_size, step_size)
 
         # Expand step size to batch structure (score and noise have the same shape).
         step_size = maybe_expand(step_size, batch_idx, score)
@@ -0,0 +1,60 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+from __future__ import annotations
+
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Sequence
+
+import numpy as np
+import torch
+
+from mattergen.diffusion.data.batched_data import BatchedData
+
+# A recorded frame: either a full copy of the batch, or only the recorded fields.
+Frame = BatchedData | dict[str, torch.Tensor]
+
+
+@dataclass(frozen=True)
+class RecordingPolicy:
+    """Determines which denoising steps and which fields are recorded by `PredictorCorrector.sample_with_record`.
+
+    Args:
+        every: record every `every`-th step. The last step is always recorded.
+        num_log_spaced: if given, record (about) this many steps instead, log-spaced such that the recorded steps are
+            dense towards the end of denoising, where most of the structure forms. Ignored by samplers that do not know
+            the number of steps in advance.
+        fields: fields to record. If None, a full copy of the batch is recorded at each recorded step; otherwise, only
+            a dictionary with the given fields.
+    """
+
+    every: int = 1
+    num_log_spaced: int | None = None
+    fields: Sequence[str] | None = None
+
+    def __post_init__(self):
+        assert self.every >= 1, "every must be a positive integer."
+        assert self.num_log_spaced is None or self.num_log_spaced >= 1
+
+    def should_record(self, step: int, num_steps: int | None) -> bool:
+        """Whether to record the frames of denoising step `step` (counting from 0) out of `num_steps`."""
+        if num_steps is not None and step == num_steps - 1:
+            return True
+        if self.num_log_spaced is not None and num_steps is not None:
+            return step in _log_spaced_steps(num_steps, self.num_log_spaced)
+        return step % self.every == 0
+
+    def frame(self, batch: BatchedData) -> Frame:
+        """Copy the recorded fields of `batch` to the CPU. The copies are normal tensors, also in inference mode."""
+        with torch.inference_mode(False):
+            if self.fields is None:
+                return batch.clone().to("cpu")
+            return {k: batch[k].detach().to("cpu", copy=True) for k in self.fields}
+
+
+@lru_cache
+def _log_spaced_steps(num_steps: int, num_log_spaced: int) -> frozenset[int]:
+    # Distance to the last step is log-spaced, so that steps close to the end are recorded densely.
+    steps_to_go = np.unique(np.round(np.geomspace(1, num_steps, num_log_spaced)).astype(int)) - 1
+    return frozenset((num_steps - 1 - steps_to_go).tolist())
@@ -0,0 +1,20 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+from typing import Protocol
+
+import torch
+
+from mattergen.diffusion.data.batched_data import BatchedData
+
+
+class SampleScreen(Protocol):
+    """Decides which samples are worth denoising further, see `PredictorCorrector`."""
+
+    def __call__(self, x0: BatchedData) -> torch.Tensor:
+        """Returns a boolean tensor of shape (batch_size,) that is False for the samples to drop.
+
+        Args:
+            x0: estimate of the fully denoised samples at the current step.
+        """
+        ...
@@ -0,0 +1,120 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+from argparse import Namespace
+from typing import Type
+
+import pytest
+import torch
+
+from mattergen.diffusion.corruption.d3pm_corruption import D3PMCorruption
+from mattergen.diffusion.corruption.multi_corruption import MultiCorruption
+from mattergen.diffusion.corruption.sde_lib import VESDE, VPSDE
+from mattergen.diffusion.d3pm import d3pm
+from mattergen.diffusion.d3pm.d3pm_predictors_correctors import D3PMJumpPredictor
+from mattergen.diffusion.data.batched_data import SimpleBatchedData
+from mattergen.diffusion.diffusion_module import DiffusionModule
+from mattergen.diffusion.model_target import ModelTarget
+from mattergen.diffusion.sampling.adaptive_pc_sampler import AdaptivePredictorCorrector
+from mattergen.diffusion.sampling.predictors import AncestralSamplingPredictor
+from mattergen.diffusion.tests.test_reverse_sampling import (
+    _get_conditioning_data,
+    get_diffusion_module,
+    score_given_xt,
+)
+
+
+@pytest.mark.parametrize("sde_type", [VPSDE, VESDE])
+def test_adaptive_reverse_sampling(sde_type: Type):
+    fields = ["x", "y"]
+    batch_size = 10_000
+    x0_mean = torch.tensor(-3.0)
+    x0_std = torch.tensor(4.3)
+    multi_corruption = MultiCorruption(sdes={f: sde_type() for f in fields})
+    sampler = AdaptivePredictorCorrector(
+        diffusion_module=get_diffusion_module(
+            multi_corruption=multi_corruption, x0_mean=x0_mean, x0_std=x0_std
+        ),
+        device=torch.device("cpu"),
+        predictor_partials={k: AncestralSamplingPredictor for k in fields},
+        n_steps_corrector=0,
+        N=1000,
+        eps_t=0.001,
+        rel_tol=0.01,
+        abs_tol=0.001,
+    )
+
+    samples, _ = sampler.sample(
+        conditioning_data=_get_conditioning_data(batch_size=batch_size, fields=fields)
+    )
+
+    means = torch.tensor([samples[k].mean() for k in fields])
+    stds = torch.tensor([samples[k].std() for k in fields])
+    assert torch.isclose(means.mean(), x0_mean, atol=2e-1)
+    assert torch.isclose(stds.mean(), x0_std, atol=2e-1)
+    assert sampler.num_score_evals_per_sample is not None
+    assert sampler.num_score_evals_per_sample.shape == (batch_size,)
+    # Much cheaper than 1000 predictor steps, and every sample needs at least the final step.
+    assert sampler.num_score_evals_per_sample.float().mean() < 500
+    assert sampler.num_score_evals_per_sample.min() >= 1
+    assert sampler.num_score_evals >= sampler.num_score_evals_per_sample.max()
+
+
+def test_adaptive_sampling_with_discrete_field():
+    """Discrete fields are advanced with a step-skipping predictor and should end up fully unmasked."""
+    dim = 7
+    batch_size = 16
+    atoms_per_sample = 3
+    multi_corruption = MultiCorruption(
+        sdes={"x": VPSDE()},
+        discrete_corruptions={
+            "a": D3PMCorruption(
+                d3pm=d3pm.MaskDiffusion(
+                    dim=dim,
+                    schedule=d3pm.create_discrete_diffusion_schedule(
+                        kind="standard", num_steps=1000
+                    ),
+                ),
+                offset=1,
+            )
+        },
+    )
+    batch_idx = torch.arange(batch_size).repeat_interleave(atoms_per_sample)
+    target = torch.randint(1, dim, batch_idx.shape)
+
+    def model(x, t):
+        logits = torch.full((target.shape[0], dim), -1e3)
+        logits[torch.arange(target.shape[0]), target - 1] = 0.0
+        out = score_given_xt(
+            x,
+            t,
+            multi_corruption=multi_corruption,
+            x0_mean=torch.tensor(0.0),
+            x0_std=torch.tensor(1.0),
+        )
+        return out.replace(a=logits)
+
+    diffusion_module = DiffusionModule(
+        model=model,
+        corruption=multi_corruption,
+        loss_fn=Namespace(model_targets={"x": ModelTarget.score_times_std}),  # type: ignore
+    )
+    sampler = AdaptivePredictorCorrector(
+        diffusion_module=diffusion_module,
+        device=torch.device("cpu"),
+        predictor_partials={
+            "x": AncestralSamplingPredictor,
+            "a": D3PMJumpPredictor,
+        },
+        n_steps_corrector=0,
+        N=20,
+    )
+    conditioning_data = SimpleBatchedData(
+        data={"x": torch.randn(batch_size, 1), "a": torch.ones_like(target)},
+        batch_idx={"x": None, "a": batch_idx},
+    )
+
+    samples, _ = sampler.sample(conditioning_data=conditioning_data)
+
+    assert torch.equal(samples["a"], target)
+    assert samples["x"].shape == (batch_size, 1)
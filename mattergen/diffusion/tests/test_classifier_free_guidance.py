@@ -0,0 +1,101 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+from argparse import Namespace
+
+import pytest
+import torch
+
+from mattergen.diffusion.corruption.multi_corruption import MultiCorruption
+from mattergen.diffusion.corruption.sde_lib import VPSDE
+from mattergen.diffusion.data.batched_data import BatchedData, collate_fn
+from mattergen.diffusion.diffusion_module import DiffusionModule
+from mattergen.diffusion.model_target import ModelTarget
+from mattergen.diffusion.per_sample_rng import per_sample_seeds
+from mattergen.diffusion.sampling.classifier_free_guidance import GuidedPredictorCorrector
+from mattergen.diffusion.sampling.predictors import AncestralSamplingPredictor
+
+
+def conditional_model(x: BatchedData, t: torch.Tensor) -> BatchedData:
+    # The output depends on whether the conditional embedding is used, like a real score model.
+    shift = x["use_cond"][x.get_batch_idx("foo")] * x["target"][x.get_batch_idx("foo")]
+    return x.replace(foo=-(x["foo"] - shift) * t[x.get_batch_idx("foo")][:, None])
+
+
+def set_use_cond(value: float):
+    def fn(x: BatchedData) -> BatchedData:
+        return x.replace(use_cond=torch.full_like(x["use_cond"], value))
+
+    return fn
+
+
+def _get_sampler(fuse_guidance_passes: bool, guidance_scale: float) -> GuidedPredictorCorrector:
+    multi_corruption: MultiCorruption = MultiCorruption(sdes={"foo": VPSDE()})
+    diffusion_module = DiffusionModule(
+        model=conditional_model,  # type: ignore
+        corruption=multi_corruption,
+        loss_fn=Namespace(model_targets={"foo": ModelTarget.score_times_std}),  # type: ignore
+    )
+    return GuidedPredictorCorrector(
+        guidance_scale=guidance_scale,
+        remove_conditioning_fn=set_use_cond(0.0),
+        keep_conditioning_fn=set_use_cond(1.0),
+        fuse_guidance_passes=fuse_guidance_passes,
+        diffusion_module=diffusion_module,
+        predictor_partials={"foo": AncestralSamplingPredictor},  # type: ignore
+        corrector_partials={},
+        n_steps_corrector=1,
+        device=torch.device("cpu"),
+        N=20,
+    )
+
+
+@pytest.mark.parametrize("guidance_scale", [0.0, 1.0, 2.0])
+def test_fused_guidance_matches_two_pass_guidance(guidance_scale: float):
+    conditioning_data = collate_fn(
+        [
+            dict(
+                foo=torch.randn(i + 1, 3),
+                target=torch.full((1, 1), float(i)),
+                use_cond=torch.zeros(1, 1),
+            )
+            for i in range(5)
+        ],
+        dense_field_names=["target", "use_cond"],
+    )
+
+    samples = {}
+    for fuse in [False, True]:
+        torch.manual_seed(0)
+        samples[fuse], _ = _get_sampler(
+            fuse_guidance_passes=fuse, guidance_scale=guidance_scale
+        ).sample(conditioning_data=conditioning_data.clone())
+
+    assert torch.allclose(samples[True]["foo"], samples[False]["foo"], atol=1e-5)
+
+
+def test_guidance_sweep_matches_single_runs():
+    conditioning_data = collate_fn(
+        [
+            dict(
+                foo=torch.randn(i + 1, 3),
+                target=torch.full((1, 1), float(i)),
+                use_cond=torch.zeros(1, 1),
+            )
+            for i in range(5)
+        ],
+        dense_field_names=["target", "use_cond"],
+    )
+    guidance_scales = [0.0, 1.0, 2.0, 4.0]
+    sampler = _get_sampler(fuse_guidance_passes=False, guidance_scale=0.0)
+    with per_sample_seeds(seed=0, sample_indices=range(5)):
+        sweep = sampler.sample_guidance_sweep(conditioning_data.clone(), guidance_scales)
+
+    assert len(sweep) == len(guidance_scales)
+    for guidance_scale, (_, mean) in zip(guidance_scales, sweep):
+        with per_sample_seeds(seed=0, sample_indices=range(5)):
+            _, expected = _get_sampler(
+                fuse_guidance_passes=False, guidance_scale=guidance_scale
+            ).sample(conditioning_data=conditioning_data.clone())
+        assert torch.allclose(mean["foo"], expected["foo"], atol=1e-5)
+        assert torch.equal(mean.get_batch_idx("foo"), expected.get_batch_idx("foo"))
@@ -0,0 +1,119 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+from typing import Type
+
+import pytest
+import torch
+
+from mattergen.diffusion.corruption.multi_corruption import MultiCorruption
+from mattergen.diffusion.corruption.sde_lib import VESDE, VPSDE
+from mattergen.diffusion.data.batched_data import SimpleBatchedData, merge_batches
+from mattergen.diffusion.sampling.adaptive_pc_sampler import AdaptivePredictorCorrector
+from mattergen.diffusion.sampling.continuous_batching import (
+    ContinuousBatchingSampler,
+    PendingConditions,
+)
+from mattergen.diffusion.sampling.pc_sampler import PredictorCorrector
+from mattergen.diffusion.sampling.predictors import AncestralSamplingPredictor
+from mattergen.diffusion.tests.test_reverse_sampling import get_diffusion_module
+
+
+def _get_condition_loader(num_batches: int, batch_size: int, fields: list[str]):
+    """Batches of conditions with a per-sample 'id' field, so that we can check that every condition is sampled once."""
+    return [
+        (
+            SimpleBatchedData(
+                data={
+                    **{k: torch.randn(batch_size, 1) for k in fields},
+                    "id": torch.arange(i * batch_size, (i + 1) * batch_size)[:, None],
+                },
+                batch_idx={k: None for k in fields + ["id"]},
+            ),
+            None,
+        )
+        for i in range(num_batches)
+    ]
+
+
+@pytest.mark.parametrize("sde_type", [VPSDE, VESDE])
+def test_continuous_batching_adaptive(sde_type: Type):
+    fields = ["x", "y"]
+    x0_mean = torch.tensor(-3.0)
+    x0_std = torch.tensor(4.3)
+    multi_corruption = MultiCorruption(sdes={f: sde_type() for f in fields})
+    sampler = AdaptivePredictorCorrector(
+        diffusion_module=get_diffusion_module(
+            multi_corruption=multi_corruption, x0_mean=x0_mean, x0_std=x0_std
+        ),
+        device=torch.device("cpu"),
+        predictor_partials={k: AncestralSamplingPredictor for k in fields},
+        n_steps_corrector=0,
+        N=1000,
+        eps_t=0.001,
+    )
+    continuous_sampler = ContinuousBatchingSampler(sampler=sampler, pool_size=1000)
+
+    results = list(
+        continuous_sampler.sample(
+            _get_condition_loader(num_batches=5, batch_size=1000, fields=fields)
+        )
+    )
+    samples = merge_batches([sample for sample, _ in results])
+
+    assert sorted(samples["id"].flatten().tolist()) == list(range(5000))
+    # Trajectories finish at different times, so retired trajectories are replaced throughout sampling.
+    assert len(results) > 5
+    means = torch.tensor([samples[k].mean() for k in fields])
+    stds = torch.tensor([samples[k].std() for k in fields])
+    assert torch.isclose(means.mean(), x0_mean, atol=2e-1)
+    assert torch.isclose(stds.mean(), x0_std, atol=2e-1)
+
+
+def test_continuous_batching_matches_batched_sampling():
+    """With a fixed number of steps, all trajectories in the pool finish together, as in plain batched sampling."""
+    fields = ["x"]
+    multi_corruption = MultiCorruption(sdes={"x": VPSDE()})
+    sampler = PredictorCorrector(
+        diffusion_module=get_diffusion_module(
+            multi_corruption=multi_corruption, x0_mean=torch.tensor(0.0), x0_std=torch.tensor(1.0)
+        ),
+        device=torch.device("cpu"),
+        predictor_partials={"x": AncestralSamplingPredictor},
+        n_steps_corrector=0,
+        N=10,
+    )
+    condition_loader = _get_condition_loader(num_batches=3, batch_size=4, fields=fields)
+    continuous_sampler = ContinuousBatchingSampler(sampler=sampler, pool_size=5)
+
+    torch.manual_seed(0)
+    results = list(continuous_sampler.sample(condition_loader))
+
+    assert [sample.get_batch_size() for sample, _ in results] == [5, 5, 2]
+    assert continuous_sampler.num_steps == 30
+    assert torch.cat([sample["id"] for sample, _ in results]).flatten().tolist() == list(range(12))
+
+    # Same random numbers as batched sampling of the first five conditions.
+    torch.manual_seed(0)
+    first_five = SimpleBatchedData(
+        data={k: torch.cat([c[k] for c, _ in condition_loader[:2]])[:5] for k in ["x", "id"]},
+        batch_idx={"x": None, "id": None},
+    )
+    expected_sample, expected_mean = sampler.sample(first_five)
+    assert torch.allclose(results[0][0]["x"], expected_sample["x"])
+    assert torch.allclose(results[0][1]["x"], expected_mean["x"])
+
+
+def test_pending_conditions():
+    pending = PendingConditions(_get_condition_loader(num_batches=3, batch_size=4, fields=["x"]))
+    sizes, ids = [], []
+    # Chunks span the batches of the condition loader.
+    for n in [3, 6, 1, 5]:
+        chunk = pending.take(n)
+        assert chunk is not None
+        sizes.append(chunk.get_batch_size())
+        ids.extend(chunk["id"].flatten().tolist())
+    assert sizes == [3, 6, 1, 2]
+    assert ids == list(range(12))
+    assert pending.is_empty()
+    assert pending.take(1) is None
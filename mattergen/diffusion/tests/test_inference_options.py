@@ -0,0 +1,100 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import copy
+import logging
+
+import pytest
+import torch
+
+from mattergen.diffusion.inference_options import (
+    CompiledFunction,
+    InferenceCache,
+    InferenceOptions,
+    cached_conditioning,
+    current_inference_options,
+    using_inference_options,
+)
+
+COMPILED = InferenceOptions(compile_model=True)
+
+
+def _failing_backend(graph_module: torch.fx.GraphModule, example_inputs):
+    raise RuntimeError("No compiler available.")
+
+
+def test_compiled_function_only_compiles_in_context():
+    num_graphs = 0
+
+    def counting_backend(graph_module: torch.fx.GraphModule, example_inputs):
+        nonlocal num_graphs
+        num_graphs += 1
+        return graph_module.forward
+
+    fn = CompiledFunction(lambda x: x.sin() * 2, backend=counting_backend)
+    x = torch.randn(5)
+    assert torch.equal(fn(x), x.sin() * 2)
+    assert num_graphs == 0
+    with using_inference_options(COMPILED):
+        torch.testing.assert_close(fn(x), x.sin() * 2)
+        assert fn(torch.randn(7)).shape == (7,)
+    assert num_graphs == 1
+    with using_inference_options(InferenceOptions(compile_model=False)):
+        fn(x)
+    assert num_graphs == 1
+
+    # Compiled functions are not copied, but compiled again when needed.
+    assert copy.deepcopy(fn)._compiled is None
+
+
+def test_compiled_function_falls_back_to_eager(caplog):
+    fn = CompiledFunction(lambda x: x.cos() + 1, backend=_failing_backend)
+    x = torch.randn(5)
+    with using_inference_options(COMPILED), caplog.at_level(logging.WARNING):
+        assert torch.equal(fn(x), x.cos() + 1)
+        assert torch.equal(fn(x), x.cos() + 1)
+    assert fn._failed
+    assert sum("falling back to eager mode" in r.message for r in caplog.records) == 1
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [dict(precision="16-mixed"), dict(neighbor_list_skin=0.0), dict(max_triplets_per_chunk=0)],
+)
+def test_inference_options_reject_invalid_values(kwargs):
+    with pytest.raises(ValueError):
+        InferenceOptions(**kwargs)
+
+
+def test_using_inference_options_restores_previous_options():
+    options = InferenceOptions(precision="bf16-mixed", max_triplets_per_chunk=100)
+    with using_inference_options(options):
+        assert current_inference_options() is options
+        with using_inference_options(InferenceOptions()):
+            assert current_inference_options().precision == "32"
+        assert current_inference_options() is options
+    assert current_inference_options() == InferenceOptions()
+
+
+def test_cached_conditioning_uses_the_cache_of_the_context():
+    num_calls = 0
+
+    def compute():
+        nonlocal num_calls
+        num_calls += 1
+        return num_calls
+
+    x, y = torch.zeros(2), torch.zeros(2)
+    # Without a cache, values are computed on each call.
+    assert cached_conditioning("key", [x], compute) == 1
+    assert cached_conditioning("key", [x], compute) == 2
+    cache = InferenceCache()
+    with using_inference_options(InferenceOptions(), cache):
+        assert cached_conditioning("key", [x], compute) == 3
+        assert cached_conditioning("key", [x], compute) == 3
+        # Equal inputs are different inputs.
+        assert cached_conditioning("key", [y], compute) == 4
+        assert cached_conditioning("other", [x], compute) == 5
+    assert cache.num_conditioning_entries == 3
+    cache.clear()
+    assert cache.num_conditioning_entries == 0
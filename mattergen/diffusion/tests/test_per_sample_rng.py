@@ -0,0 +1,159 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+from contextlib import nullcontext
+from functools import partial
+from typing import Type
+
+import pytest
+import torch
+
+from mattergen.diffusion import per_sample_rng
+from mattergen.diffusion.corruption.multi_corruption import MultiCorruption
+from mattergen.diffusion.corruption.sde_lib import VESDE, VPSDE
+from mattergen.diffusion.data.batched_data import SimpleBatchedData, select_samples
+from mattergen.diffusion.per_sample_rng import per_sample_seeds
+from mattergen.diffusion.sampling.adaptive_pc_sampler import AdaptivePredictorCorrector
+from mattergen.diffusion.sampling.pc_sampler import PredictorCorrector
+from mattergen.diffusion.sampling.predictors import AncestralSamplingPredictor
+from mattergen.diffusion.sampling.predictors_correctors import LangevinCorrector
+from mattergen.diffusion.tests.test_reverse_sampling import get_diffusion_module
+
+
+def test_noise_does_not_depend_on_batch():
+    batch_idx = torch.tensor([0, 0, 1, 1, 1, 2])
+    with per_sample_seeds(seed=1, sample_indices=[5, 6, 7]):
+        node_noise = per_sample_rng.randn_like(torch.zeros(6, 3), batch_idx)
+        graph_noise = per_sample_rng.randn((3, 3, 3))
+    # Sample 6 on its own, with its nodes in a different order in the batch.
+    with per_sample_seeds(seed=1, sample_indices=[6, 0]):
+        single_node_noise = per_sample_rng.randn_like(
+            torch.zeros(5, 3), torch.tensor([0, 1, 0, 1, 0])
+        )
+        single_graph_noise = per_sample_rng.randn((2, 3, 3))
+    assert torch.equal(single_node_noise[[0, 2, 4]], node_noise[2:5])
+    assert torch.equal(single_graph_noise[0], graph_noise[1])
+
+    # Different seeds and different draws give different noise.
+    with per_sample_seeds(seed=2, sample_indices=[5, 6, 7]):
+        other_seed_noise = per_sample_rng.randn_like(torch.zeros(6, 3), batch_idx)
+        second_draw = per_sample_rng.randn_like(torch.zeros(6, 3), batch_idx)
+    assert not torch.isclose(other_seed_noise, node_noise).any()
+    assert not torch.isclose(second_draw, other_seed_noise).any()
+
+
+def test_noise_distribution():
+    with per_sample_seeds(seed=3, sample_indices=range(1000)):
+        noise = per_sample_rng.randn((1000, 1000))
+        probs = torch.tensor([0.2, 0.3, 0.5])
+        categories = per_sample_rng.sample_categorical(probs.log().expand(1000, 100, 3))
+    assert torch.isclose(noise.mean(), torch.tensor(0.0), atol=1e-2)
+    assert torch.isclose(noise.std(), torch.tensor(1.0), atol=1e-2)
+    assert torch.allclose(
+        torch.bincount(categories.flatten()) / categories.numel(), probs, atol=1e-2
+    )
+
+
+@pytest.mark.parametrize("n_steps_corrector", [0, 1])
+@pytest.mark.parametrize("sde_type", [VPSDE, VESDE])
+@pytest.mark.parametrize("sampler_type", [PredictorCorrector, AdaptivePredictorCorrector])
+def test_regenerate_single_sample(sde_type: Type, sampler_type: Type, n_steps_corrector: int):
+    """A sample drawn on its own with per-sample seeds is the same as when drawn in a batch."""
+    multi_corruption = MultiCorruption(sdes={"x": sde_type(), "y": sde_type()})
+    sampler = sampler_type(
+        diffusion_module=get_diffusion_module(
+            multi_corruption=multi_corruption, x0_mean=torch.tensor(-3.0), x0_std=torch.tensor(4.3)
+        ),
+        device=torch.device("cpu"),
+        predictor_partials={k: AncestralSamplingPredictor for k in ["x", "y"]},
+        corrector_partials={
+            k: partial(LangevinCorrector, per_sample_step_size=True) for k in ["x", "y"]
+        },
+        n_steps_corrector=n_steps_corrector,
+        N=50,
+        eps_t=0.001,
+    )
+    conditioning_data = SimpleBatchedData(
+        data={"x": torch.zeros(8, 1), "y": torch.zeros(8, 2)},
+        batch_idx={"x": None, "y": None},
+    )
+    with per_sample_seeds(seed=42, sample_indices=range(100, 108)):
+        samples, _ = sampler.sample(conditioning_data)
+
+    ix = torch.tensor([5])
+    with per_sample_seeds(seed=42, sample_indices=[105]):
+        single_sample, _ = sampler.sample(select_samples(conditioning_data, ix))
+    expected = select_samples(samples, ix)
+    for k in ["x", "y"]:
+        assert torch.allclose(single_sample[k], expected[k], atol=1e-5)
+
+    # Other seeds give other samples.
+    with per_sample_seeds(seed=43, sample_indices=[105]):
+        other_sample, _ = sampler.sample(select_samples(conditioning_data, ix))
+    assert not torch.allclose(other_sample["x"], expected["x"])
+
+
+def test_langevin_step_does_not_depend_on_batch():
+    corrector = LangevinCorrector(
+        corruption=VPSDE(), score_fn=None, n_steps=1, per_sample_step_size=True
+    )
+    batch_idx = torch.tensor([0, 0, 1, 1, 1, 2])
+    x = torch.randn(6, 3)
+    # Scores of very different magnitudes, so that averaged step sizes would differ from per-sample ones.
+    score = torch.randn(6, 3) * torch.tensor([1.0, 1.0, 100.0, 100.0, 100.0, 0.01])[:, None]
+    t = torch.full((3,), 0.5)
+    dt = torch.full((3,), -0.01)
+    with per_sample_seeds(seed=1, sample_indices=[5, 6, 7]):
+        per_sample_rng.begin_step(torch.zeros(3))
+        x_batch, _ = corrector.step_given_score(x=x, batch_idx=batch_idx, score=score, t=t, dt=dt)
+    with per_sample_seeds(seed=1, sample_indices=[6]):
+        per_sample_rng.begin_step(torch.zeros(1))
+        x_single, _ = corrector.step_given_score(
+            x=x[2:5],
+            batch_idx=torch.zeros(3, dtype=torch.long),
+            score=score[2:5],
+            t=t[:1],
+            dt=dt[:1],
+        )
+    torch.testing.assert_close(x_single, x_batch[2:5])
+
+
+@pytest.mark.parametrize("per_sample_step_size", [False, True])
+def test_langevin_norms_do_not_depend_on_seeding(per_sample_step_size: bool):
+    corrector = LangevinCorrector(
+        corruption=VPSDE(), score_fn=None, n_steps=1, per_sample_step_size=per_sample_step_size
+    )
+    batch_idx = torch.tensor([0, 0, 1, 1, 1, 2])
+    score = torch.randn(6, 3)
+    noise = torch.randn(6, 3)
+    grad_norm = torch.stack([score[start:end].norm() for start, end in [(0, 2), (2, 5), (5, 6)]])
+    expected = grad_norm if per_sample_step_size else grad_norm.mean()
+    # The step sizes follow the same rule with and without per-sample seeds, only the noise differs.
+    for sample_seeds in [nullcontext(), per_sample_seeds(seed=1, sample_indices=[5, 6, 7])]:
+        with sample_seeds:
+            norms = corrector.score_and_noise_norms(score, noise, batch_idx)
+        torch.testing.assert_close(norms[0], expected)
+
+
+def test_updates_depend_on_batch():
+    multi_corruption = MultiCorruption(sdes={"x": VPSDE()})
+
+    def get_sampler(corrector_partial, n_steps_corrector: int) -> PredictorCorrector:
+        return PredictorCorrector(
+            diffusion_module=get_diffusion_module(
+                x0_mean=torch.tensor(0.0),
+                x0_std=torch.tensor(1.0),
+                multi_corruption=multi_corruption,
+            ),
+            device=torch.device("cpu"),
+            predictor_partials={"x": AncestralSamplingPredictor},
+            corrector_partials={"x": corrector_partial},
+            n_steps_corrector=n_steps_corrector,
+            N=10,
+        )
+
+    assert get_sampler(LangevinCorrector, n_steps_corrector=1).updates_depend_on_batch
+    assert not get_sampler(LangevinCorrector, n_steps_corrector=0).updates_depend_on_batch
+    assert not get_sampler(
+        partial(LangevinCorrector, per_sample_step_size=True), n_steps_corrector=1
+    ).updates_depend_on_batch
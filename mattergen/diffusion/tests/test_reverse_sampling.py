@@ -16,12 +16,14 @@ import pytest
 import torch
 
 from mattergen.diffusion.corruption.multi_corruption import MultiCorruption
-from mattergen.diffusion.corruption.sde_lib import SDE
+from mattergen.diffusion.corruption.sde_lib import SDE, VPSDE
 from mattergen.diffusion.data.batched_data import BatchedData, SimpleBatchedData
 from mattergen.diffusion.diffusion_module import DiffusionModule
 from mattergen.diffusion.exceptions import IncompatibleSampler
 from mattergen.diffusion.model_target import ModelTarget
 from mattergen.diffusion.sampling.pc_sampler import PredictorCorrector
+from mattergen.diffusion.sampling.predictors import AncestralSamplingPredictor, DDIMPredictor
+from mattergen.diffusion.sampling.recording import RecordingPolicy
 from mattergen.diffusion.tests.conftest import (
     DEFAULT_CORRECTORS,
     DEFAULT_PREDICTORS,
@@ -163,7 +165,110 @@ def test_wrapped_reverse_sampling(sde_type: Type, predictor_type: Type, correcto
     assert torch.isclose(stds.mean(), empirical_x0_std, atol=1e-1)
 
 
+def test_few_step_ddim_reverse_sampling():
+    """The deterministic DDIM predictor should recover the data distribution in few steps.
+
+    We only test VPSDE here: for VESDE, the probability flow ODE does not correct for the mismatch between
+    the prior and the marginal at time T, which is large for the toy data distribution used in this test.
+    """
+    fields = ["x", "y", "z", "a"]
+    batch_size = 10_000
+    x0_mean = torch.tensor(-3.0)
+    x0_std = torch.tensor(4.3)
+
+    multi_corruption: MultiCorruption = MultiCorruption(sdes={f: VPSDE() for f in fields})
+    multi_sampler = PredictorCorrector(
+        diffusion_module=get_diffusion_module(
+            multi_corruption=multi_corruption, x0_mean=x0_mean, x0_std=x0_std
+        ),
+        device=torch.device("cpu"),
+        predictor_partials={k: partial(DDIMPredictor, eta=0.0) for k in fields},
+        corrector_partials={},
+        n_steps_corrector=0,
+        N=100,
+        eps_t=0.001,
+        max_t=None,
+    )
+    conditioning_data = _get_conditioning_data(batch_size=batch_size, fields=fields)
+
+    samples, _ = multi_sampler.sample(conditioning_data=conditioning_data)
+    means = torch.tensor([samples[k].mean() for k in multi_corruption.corruptions.keys()])
+    stds = torch.tensor([samples[k].std() for k in multi_corruption.corruptions.keys()])
+    assert torch.isclose(means.mean(), x0_mean, atol=1e-1)
+    assert torch.isclose(stds.mean(), x0_std, atol=1e-1)
+
+
+@pytest.mark.parametrize(
+    "recording_policy, expected_steps",
+    [
+        (None, list(range(20))),
+        (RecordingPolicy(every=7, fields=["x"]), [0, 7, 14, 19]),
+        (RecordingPolicy(num_log_spaced=4, fields=["x"]), [0, 13, 17, 19]),
+    ],
+)
+def test_sample_with_record(recording_policy: RecordingPolicy | None, expected_steps: List[int]):
+    fields = ["x", "y"]
+    N = 20
+    multi_corruption = MultiCorruption(sdes={f: VPSDE() for f in fields})
+    sampler = PredictorCorrector(
+        diffusion_module=get_diffusion_module(
+            multi_corruption=multi_corruption, x0_mean=torch.tensor(0.0), x0_std=torch.tensor(1.0)
+        ),
+        device=torch.device("cpu"),
+        predictor_partials={k: AncestralSamplingPredictor for k in fields},
+        corrector_partials={k: DEFAULT_CORRECTORS[0] for k in fields},
+        n_steps_corrector=1,
+        N=N,
+        recording_policy=recording_policy,
+    )
+    assert [
+        i for i in range(N) if (recording_policy or RecordingPolicy()).should_record(i, N)
+    ] == expected_steps
+
+    samples, mean_samples, records = sampler.sample_with_record(
+        conditioning_data=_get_conditioning_data(batch_size=5, fields=fields)
+    )
+    # Sampling runs in inference mode, but callers get normal tensors.
+    assert not any(
+        batch[k].is_inference() for batch in [samples, mean_samples, *records] for k in ["x"]
+    )
+    samples["x"].add_(1.0)
+
+    # One frame for the corrector step and one for the predictor step.
+    assert len(records) == 2 * len(expected_steps)
+    if recording_policy is None:
+        assert all(isinstance(frame, BatchedData) for frame in records)
+    else:
+        assert all(set(frame.keys()) == {"x"} for frame in records)
+        assert all(frame["x"].shape == (5, 1) for frame in records)
+
+
 def _get_conditioning_data(batch_size: int, fields: List[str]) -> SimpleBatchedData:
     return SimpleBatchedData(
         data={k: torch.randn(batch_size, 1) for k in fields}, batch_idx={k: None for k in fields}
     )
+
+
+@pytest.mark.parametrize("n_steps_corrector", [0, 1])
+def test_inpainting_keeps_masked_values(n_steps_corrector: int):
+    fields = ["x", "y"]
+    multi_corruption: MultiCorruption = MultiCorruption(sdes={f: VPSDE() for f in fields})
+    multi_sampler = PredictorCorrector(
+        diffusion_module=get_diffusion_module(
+            multi_corruption=multi_corruption, x0_mean=torch.tensor(0.0), x0_std=torch.tensor(1.0)
+        ),
+        device=torch.device("cpu"),
+        predictor_partials={k: AncestralSamplingPredictor for k in fields},
+        corrector_partials={k: DEFAULT_CORRECTORS[0] for k in fields},
+        n_steps_corrector=n_steps_corrector,
+        N=20,
+    )
+    conditioning_data = _get_conditioning_data(batch_size=10, fields=fields)
+    conditioning_data = conditioning_data.replace(x=torch.arange(10.0)[:, None])
+    mask = {"x": (torch.arange(10) % 2 == 0).float()[:, None]}
+    samples, mean_samples = multi_sampler.sample(conditioning_data=conditioning_data, mask=mask)
+    for batch in [samples, mean_samples]:
+        assert torch.equal(batch["x"][::2], conditioning_data["x"][::2])
+        assert not torch.isclose(batch["x"][1::2], conditioning_data["x"][1::2]).any()
+    # Fields without a mask are sampled everywhere.
+    assert not torch.isclose(samples["y"], conditioning_data["y"]).any()
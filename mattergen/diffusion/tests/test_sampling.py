@@ -8,11 +8,20 @@ from typing import Callable, Dict, List, Type, Union
 import pytest
 import torch
 
+from mattergen.diffusion.corruption.d3pm_corruption import D3PMCorruption
 from mattergen.diffusion.corruption.sde_lib import SDE, VESDE, VPSDE
-from mattergen.diffusion.d3pm.d3pm_predictors_correctors import D3PMAncestralSamplingPredictor
+from mattergen.diffusion.d3pm import d3pm
+from mattergen.diffusion.d3pm.d3pm_predictors_correctors import (
+    D3PMAncestralSamplingPredictor,
+    D3PMJumpPredictor,
+)
 from mattergen.diffusion.exceptions import IncompatibleSampler
 from mattergen.diffusion.sampling import predictors_correctors as pc
-from mattergen.diffusion.sampling.predictors import AncestralSamplingPredictor, Predictor
+from mattergen.diffusion.sampling.predictors import (
+    AncestralSamplingPredictor,
+    DDIMPredictor,
+    Predictor,
+)
 from mattergen.diffusion.tests.conftest import (
     DEFAULT_CORRECTORS,
     DEFAULT_PREDICTORS,
@@ -22,12 +31,14 @@ from mattergen.diffusion.tests.conftest import (
 )
 from mattergen.diffusion.wrapped.wrapped_predictors_correctors import (
     WrappedAncestralSamplingPredictor,
+    WrappedDDIMPredictor,
     WrappedLangevinCorrector,
 )
 from mattergen.diffusion.wrapped.wrapped_sde import WrappedVESDE, WrappedVPSDE
 
 D3PM_SAMPLERS = [
     D3PMAncestralSamplingPredictor,
+    D3PMJumpPredictor,
 ]
 INCOMPATIBLE_SAMPLERS: Dict[
     Type[SDE], List[Type[Union[Predictor, pc.LangevinCorrector]]]
@@ -35,26 +46,33 @@ INCOMPATIBLE_SAMPLERS: Dict[
 INCOMPATIBLE_SAMPLERS[VPSDE] = [
     WrappedLangevinCorrector,
     WrappedAncestralSamplingPredictor,
+    WrappedDDIMPredictor,
     *D3PM_SAMPLERS,
 ]
 INCOMPATIBLE_SAMPLERS[VESDE] = [
     WrappedLangevinCorrector,
     WrappedAncestralSamplingPredictor,
+    WrappedDDIMPredictor,
     *D3PM_SAMPLERS,
 ]
 INCOMPATIBLE_SAMPLERS[WrappedVPSDE] = [
     AncestralSamplingPredictor,
+    DDIMPredictor,
     pc.LangevinCorrector,
     *D3PM_SAMPLERS,
 ]
 INCOMPATIBLE_SAMPLERS[WrappedVESDE] = [
     AncestralSamplingPredictor,
+    DDIMPredictor,
     pc.LangevinCorrector,
     *D3PM_SAMPLERS,
 ]
 
 
-@pytest.mark.parametrize("predictor_type", DEFAULT_PREDICTORS + WRAPPED_PREDICTORS)
+@pytest.mark.parametrize(
+    "predictor_type",
+    DEFAULT_PREDICTORS + WRAPPED_PREDICTORS + [DDIMPredictor, WrappedDDIMPredictor],
+)
 @pytest.mark.parametrize("sde_type", SDE_TYPES)
 def test_predictor(make_state_batch: Callable, predictor_type: Type, sde_type, EPS: float):
     """Tests whether implemented predictors return arrays of consistent
@@ -84,6 +102,46 @@ def test_predictor(make_state_batch: Callable, predictor_type: Type, sde_type, E
         assert x.shape == x_mean.shape == old_x.shape
 
 
+@pytest.mark.parametrize(
+    "ancestral_type, ddim_type",
+    [
+        (AncestralSamplingPredictor, DDIMPredictor),
+        (WrappedAncestralSamplingPredictor, WrappedDDIMPredictor),
+    ],
+)
+@pytest.mark.parametrize("sde_type", SDE_TYPES)
+def test_ddim_with_eta_one_is_ancestral(
+    make_state_batch: Callable, ancestral_type: Type, ddim_type: Type, sde_type, EPS: float
+):
+    """With eta=1, the DDIM predictor injects as much noise as the ancestral sampling predictor,
+    and the two should coincide."""
+    if not ddim_type.is_compatible(sde_type()):
+        return
+    tiny_state_batch = make_state_batch(sde_type)
+    sde = sde_type()
+    batch_size = tiny_state_batch.get_batch_size()
+    t = torch.rand(batch_size) * (sde.T - EPS) + EPS
+    dt = torch.tensor(-(sde.T - EPS) / 50)
+    x = tiny_state_batch["foo"]
+    score = torch.randn_like(x)
+    batch_idx = tiny_state_batch.get_batch_idx("foo")
+
+    results = []
+    for predictor in [
+        ancestral_type(corruption=sde, score_fn=None),
+        ddim_type(corruption=sde, score_fn=None, eta=1.0),
+    ]:
+        torch.manual_seed(0)
+        results.append(
+            predictor.update_given_score(
+                x=x, t=t, dt=dt, batch_idx=batch_idx, score=score, batch=tiny_state_batch
+            )
+        )
+    (ancestral_sample, ancestral_mean), (ddim_sample, ddim_mean) = results
+    torch.testing.assert_close(ancestral_mean, ddim_mean, rtol=1e-3, atol=1e-3)
+    torch.testing.assert_close(ancestral_sample, ddim_sample, rtol=1e-3, atol=1e-3)
+
+
 def dummy_score_fn(x, t, batch_idx):
     score = torch.zeros(*x.shape[:2])
     return score
@@ -111,3 +169,37 @@ def test_corrector(make_state_batch: Callable, corrector_type: Type, sde_type, E
         )
 
         assert x.shape == x_mean.shape == old_x.shape
+
+
+@pytest.mark.parametrize("num_sampling_steps", [1000, 50, 7])
+def test_d3pm_jump_predictor(num_sampling_steps: int):
+    """With a perfect prediction of x_0, the jump predictor should unmask all atoms
+    to their target types, however few sampling steps it takes."""
+    dim = 11
+    schedule = d3pm.create_discrete_diffusion_schedule(kind="standard", num_steps=1000)
+    corruption = D3PMCorruption(d3pm=d3pm.MaskDiffusion(dim=dim, schedule=schedule), offset=1)
+    batch_idx = torch.arange(8).repeat_interleave(5)
+    target = torch.randint(1, dim, batch_idx.shape)
+    # Class dim (one-based) is the absorbing mask state.
+    x = torch.full_like(target, dim)
+    logits = torch.full((target.shape[0], dim), -1e3)
+    logits[torch.arange(target.shape[0]), target - 1] = 0.0
+
+    predictor = D3PMJumpPredictor(corruption=corruption, score_fn=None)
+    eps_t = 1 / num_sampling_steps
+    timesteps = torch.linspace(corruption.T, eps_t, num_sampling_steps)
+    dt = -torch.tensor((corruption.T - eps_t) / (num_sampling_steps - 1))
+    n_masked = []
+    for t in timesteps:
+        x, _ = predictor.update_given_score(
+            x=x,
+            t=torch.full((8,), t.item()),
+            dt=dt,
+            batch_idx=batch_idx,
+            score=logits,
+            batch=None,
+        )
+        n_masked.append((x == dim).sum().item())
+    assert torch.equal(x, target)
+    # Atoms never get re-masked.
+    assert n_masked == sorted(n_masked, reverse=True)
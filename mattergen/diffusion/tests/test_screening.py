@@ -0,0 +1,102 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import pytest
+import torch
+
+from mattergen.diffusion.corruption.multi_corruption import MultiCorruption
+from mattergen.diffusion.corruption.sde_lib import VPSDE
+from mattergen.diffusion.data.batched_data import BatchedData, SimpleBatchedData
+from mattergen.diffusion.sampling.adaptive_pc_sampler import AdaptivePredictorCorrector
+from mattergen.diffusion.sampling.pc_sampler import PredictorCorrector
+from mattergen.diffusion.sampling.predictors import AncestralSamplingPredictor
+from mattergen.diffusion.tests.test_reverse_sampling import get_diffusion_module
+
+
+class _PositiveScreen:
+    """Keeps the samples whose estimate of x is positive and counts the screened samples."""
+
+    def __init__(self):
+        self.num_screened = 0
+
+    def __call__(self, x0: BatchedData) -> torch.Tensor:
+        self.num_screened += x0.get_batch_size()
+        return x0["x"][:, 0] > 0
+
+
+def _get_sampler(**kwargs) -> PredictorCorrector:
+    multi_corruption = MultiCorruption(sdes={"x": VPSDE(), "y": VPSDE()})
+    return PredictorCorrector(
+        diffusion_module=get_diffusion_module(
+            multi_corruption=multi_corruption, x0_mean=torch.tensor(0.0), x0_std=torch.tensor(1.0)
+        ),
+        device=torch.device("cpu"),
+        predictor_partials={k: AncestralSamplingPredictor for k in ["x", "y"]},
+        n_steps_corrector=0,
+        N=100,
+        eps_t=0.001,
+        **kwargs,
+    )
+
+
+def _conditioning_data(batch_size: int) -> SimpleBatchedData:
+    return SimpleBatchedData(
+        data={"x": torch.zeros(batch_size, 1), "y": torch.zeros(batch_size, 2)},
+        batch_idx={"x": None, "y": None},
+    )
+
+
+def test_screening_restarts_failing_samples():
+    torch.manual_seed(0)
+    batch_size = 1000
+    screen = _PositiveScreen()
+    sampler = _get_sampler(screen=screen, screening_timesteps=[0.2], max_rejections=100)
+    samples, _ = sampler.sample(_conditioning_data(batch_size))
+
+    assert samples.get_batch_size() == batch_size
+    # About half of the samples fail the screen on each attempt.
+    assert 0.7 * batch_size < sampler.num_rejected < 1.3 * batch_size
+    assert screen.num_screened == batch_size + sampler.num_rejected
+    # Without screening, half of the samples would be negative.
+    assert (samples["x"] > 0).float().mean() > 0.75
+    assert torch.isfinite(samples["y"]).all()
+
+
+@pytest.mark.parametrize("max_rejections", [0, 2])
+def test_screening_max_rejections(max_rejections: int):
+    batch_size = 10
+    sampler = _get_sampler(
+        screen=lambda x0: torch.zeros(x0.get_batch_size(), dtype=torch.bool),
+        screening_timesteps=[0.5, 0.1],
+        max_rejections=max_rejections,
+    )
+    samples, _ = sampler.sample(_conditioning_data(batch_size))
+    assert samples.get_batch_size() == batch_size
+    assert sampler.num_rejected == max_rejections * batch_size
+
+
+def test_timestep_to_step():
+    sampler = _get_sampler()
+    assert sampler._timestep_to_step(1.0) == 0
+    assert sampler._timestep_to_step(0.0) == sampler.N - 1
+    timesteps = torch.linspace(1.0, 0.001, sampler.N)
+    step = sampler._timestep_to_step(0.3)
+    assert timesteps[step] <= 0.3 < timesteps[step - 1]
+
+
+def test_adaptive_sampling_does_not_support_screening():
+    multi_corruption = MultiCorruption(sdes={"x": VPSDE()})
+    with pytest.raises(AssertionError):
+        AdaptivePredictorCorrector(
+            diffusion_module=get_diffusion_module(
+                multi_corruption=multi_corruption,
+                x0_mean=torch.tensor(0.0),
+                x0_std=torch.tensor(1.0),
+            ),
+            device=torch.device("cpu"),
+            predictor_partials={"x": AncestralSamplingPredictor},
+            n_steps_corrector=0,
+            N=10,
+            screen=_PositiveScreen(),
+            screening_timesteps=[0.5],
+        )
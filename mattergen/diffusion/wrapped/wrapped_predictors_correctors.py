@@ -81,6 +81,14 @@ class WrappedAncestralSamplingPredictor(
         )
 
 
+class WrappedDDIMPredictor(WrappedPredictorMixin, predictors.DDIMPredictor):
+    @classmethod
+    def is_compatible(cls, corruption: Corruption):
+        return isinstance(corruption, (sde_lib.VPSDE, sde_lib.VESDE)) and isinstance(
+            corruption, WrappedSDEMixin
+        )
+
+
 class WrappedLangevinCorrector(WrappedCorrectorMixin, pc.LangevinCorrector):
     @classmethod
     def is_compatible(cls, corruption: Corruption):
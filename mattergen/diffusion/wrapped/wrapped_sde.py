@@ -53,7 +53,11 @@ class WrappedSDEMixin:
     ) -> torch.Tensor:
         _super = super()
         assert isinstance(self, SDE) and hasattr(_super, "prior_sampling")
-        return self.wrap(_super.prior_sampling(shape=shape, conditioning_data=conditioning_data))
+        return self.wrap(
+            _super.prior_sampling(
+                shape=shape, conditioning_data=conditioning_data, batch_idx=batch_idx
+            )
+        )
 
     def wrap(self, x):
         assert isinstance(self, SDE) and hasattr(self, "wrapping_boundary")
@@ -0,0 +1,371 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+"""A long-lived generation service that keeps the model loaded and batches requests together.
+
+`GenerationServer` queues generation requests and runs them on a single worker thread. The conditions of all queued
+requests that can share a batch (same guidance factor, same conditioned properties, and either all or none for crystal
+structure prediction) are merged into batches of up to `max_batch_size` structures, so that small requests
+do not each run their own, mostly empty batch. The structures of each request are streamed back batch by batch.
+
+`make_http_server` exposes a `GenerationServer` as a local HTTP endpoint, see `mattergen-serve`.
+"""
+
+from __future__ import annotations
+
+import dataclasses
+import io
+import json
+import logging
+import queue
+import threading
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Iterator
+
+import ase.io
+import torch
+from hydra.utils import instantiate
+from pymatgen.core.structure import Structure
+from pymatgen.io.ase import AseAtomsAdaptor
+
+from mattergen.common.data.condition_factory import ConditionLoader
+from mattergen.common.data.types import TargetProperty
+from mattergen.diffusion.data.batched_data import BatchedData, merge_batches
+from mattergen.diffusion.sampling.continuous_batching import PendingConditions
+from mattergen.diffusion.sampling.pc_sampler import PredictorCorrector
+from mattergen.generator import CrystalGenerator, structures_from_batch
+
+logger = logging.getLogger(__name__)
+
+# (guidance factor, conditioned properties, crystal structure prediction)
+CompatibilityKey = tuple[float, tuple[str, ...], bool]
+
+
+@dataclass(frozen=True)
+class GenerationRequest:
+    """A request for `num_samples` structures.
+
+    Args:
+        num_samples: number of structures to generate. For crystal structure prediction, this is split evenly across the
+            target compositions, as in `CrystalGenerator`, and must be a multiple of their number.
+        properties_to_condition_on: property values to condition on.
+        diffusion_guidance_factor: guidance factor for classifier-free guidance.
+        target_compositions: compositions for crystal structure prediction, as `{element: number_of_atoms}` dictionaries.
+    """
+
+    num_samples: int
+    properties_to_condition_on: TargetProperty | None = None
+    diffusion_guidance_factor: float = 0.0
+    target_compositions: list[dict[str, int]] | None = None
+
+    def __post_init__(self):
+        if self.num_samples <= 0:
+            raise ValueError("num_samples must be positive.")
+        if self.target_compositions and self.num_samples % len(self.target_compositions) != 0:
+            raise ValueError(
+                f"num_samples ({self.num_samples}) must be a multiple of the number of target compositions "
+                f"({len(self.target_compositions)})."
+            )
+
+    @classmethod
+    def from_dict(cls, d: dict[str, Any]) -> GenerationRequest:
+        unknown = set(d) - {f.name for f in dataclasses.fields(cls)}
+        if unknown:
+            raise ValueError(f"Unknown request fields: {sorted(unknown)}")
+        if "num_samples" not in d:
+            raise ValueError("num_samples is required.")
+        return cls(**d)
+
+    @property
+    def compatibility_key(self) -> CompatibilityKey:
+        """Requests with the same key can be sampled in the same batch."""
+        return (
+            float(self.diffusion_guidance_factor),
+            tuple(sorted(self.properties_to_condition_on or {})),
+            bool(self.target_compositions),
+        )
+
+
+class GenerationJob:
+    """A submitted `GenerationRequest`, whose structures arrive batch by batch."""
+
+    def __init__(self, request: GenerationRequest, condition_loader: ConditionLoader):
+        self.request = request
+        self._conditions = PendingConditions(condition_loader)
+        # Lists of structures, followed by None when the job is done, or by an exception if it failed.
+        self._results: queue.Queue[list[Structure] | BaseException | None] = queue.Queue()
+
+    def results(self) -> Iterator[list[Structure]]:
+        """Yields the structures of the job as they are generated. Raises RuntimeError if generation failed."""
+        while True:
+            result = self._results.get()
+            if result is None:
+                return
+            if isinstance(result, BaseException):
+                raise RuntimeError("Generation failed.") from result
+            yield result
+
+    def structures(self) -> list[Structure]:
+        """Waits for the job to finish and returns all its structures."""
+        return [structure for structures in self.results() for structure in structures]
+
+
+class GenerationServer:
+    """Runs generation requests on a loaded model, merging the requests that can share a batch.
+
+    Call `start` to start the worker thread, and `submit` to queue a request. The samplers and condition loader
+    factories are built once per kind of request and reused. They are built without holding the lock, so that requests
+    of other kinds are not held up meanwhile.
+
+    Args:
+        generator: the generator whose model, sampling config and number of atoms distribution are used.
+            `diffusion_guidance_factor`, `properties_to_condition_on` and `target_compositions_dict` come from the requests instead.
+        max_batch_size: maximum number of structures in a batch.
+    """
+
+    def __init__(self, generator: CrystalGenerator, max_batch_size: int = 64):
+        assert max_batch_size > 0, "max_batch_size must be positive."
+        self.generator = generator
+        self.max_batch_size = max_batch_size
+        # Number of batches that were sampled.
+        self.num_batches = 0
+        self._jobs: list[GenerationJob] = []
+        self._condition = threading.Condition()
+        self._samplers: dict[tuple[float, bool], PredictorCorrector] = {}
+        self._condition_loader_factories: dict[tuple[float, bool], Callable] = {}
+        self._thread: threading.Thread | None = None
+        self._stopping = False
+
+    def prepare(self) -> None:
+        """Loads the model and builds the sampler for unconditional requests, so that the first request does not wait for them."""
+        self._get_sampler(GenerationRequest(num_samples=1))
+
+    def start(self) -> None:
+        """Starts the worker thread."""
+        assert self._thread is None, "The server has been started already."
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name="generation-server", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stops the worker thread after the current batch. Jobs that are not finished fail."""
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        with self._condition:
+            for job in self._jobs:
+                job._results.put(RuntimeError("The generation server was stopped."))
+            self._jobs = []
+
+    def submit(self, request: GenerationRequest) -> GenerationJob:
+        """Queues a request. Raises ValueError if the model cannot generate it."""
+        sampler = self._get_sampler(request)
+        trained_on = sampler.diffusion_module.model.cond_fields_model_was_trained_on  # type: ignore
+        unsupported = set(request.properties_to_condition_on or {}) - set(trained_on)
+        if unsupported:
+            raise ValueError(f"The model was not trained to condition on {sorted(unsupported)}.")
+        job = GenerationJob(request, self._get_condition_loader(request))
+        with self._condition:
+            self._jobs.append(job)
+            self._condition.notify_all()
+        return job
+
+    def generate(self, request: GenerationRequest) -> list[Structure]:
+        """Submits a request and waits for its structures."""
+        return self.submit(request).structures()
+
+    @property
+    def num_queued_jobs(self) -> int:
+        with self._condition:
+            return len(self._jobs)
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                while not self._jobs and not self._stopping:
+                    self._condition.wait()
+                if self._stopping:
+                    return
+                batch_jobs, conditioning_data = self._next_batch()
+            if conditioning_data is None:
+                continue
+            try:
+                mean = self._sample(batch_jobs[0][0].request, conditioning_data)
+                structures = structures_from_batch(mean.to("cpu"))
+            except Exception as e:
+                logger.exception("Generation failed.")
+                self._finish_jobs([job for job, _ in batch_jobs], error=e)
+                continue
+            self.num_batches += 1
+            offset = 0
+            for job, num_samples in batch_jobs:
+                job._results.put(structures[offset : offset + num_samples])
+                offset += num_samples
+            self._finish_jobs([job for job, _ in batch_jobs if job._conditions.is_empty()])
+
+    def _next_batch(self) -> tuple[list[tuple[GenerationJob, int]], BatchedData | None]:
+        """Takes the conditions of the next batch from the oldest job and the queued jobs that are compatible with it.
+        Must be called with the lock held."""
+        key = self._jobs[0].request.compatibility_key
+        batch_jobs, chunks = [], []
+        remaining = self.max_batch_size
+        for job in list(self._jobs):
+            if remaining == 0:
+                break
+            if job.request.compatibility_key != key:
+                continue
+            chunk = job._conditions.take(remaining)
+            if chunk is None:
+                # The job has no conditions left.
+                self._jobs.remove(job)
+                job._results.put(None)
+                continue
+            batch_jobs.append((job, chunk.get_batch_size()))
+            chunks.append(chunk)
+            remaining -= chunk.get_batch_size()
+        return batch_jobs, merge_batches(chunks) if chunks else None
+
+    def _finish_jobs(self, jobs: list[GenerationJob], error: BaseException | None = None) -> None:
+        with self._condition:
+            for job in jobs:
+                if job in self._jobs:
+                    self._jobs.remove(job)
+                    job._results.put(error)
+
+    @torch.inference_mode()
+    def _sample(self, request: GenerationRequest, conditioning_data: BatchedData) -> BatchedData:
+        _, mean = self._get_sampler(request).sample(conditioning_data, None)
+        return mean
+
+    def _get_sampler(self, request: GenerationRequest) -> PredictorCorrector:
+        key = (float(request.diffusion_guidance_factor), bool(request.target_compositions))
+        with self._condition:
+            sampler = self._samplers.get(key)
+        if sampler is None:
+            sampler = self.generator.get_sampler(self._load_sampling_config(request))
+            with self._condition:
+                # Another request may have built a sampler for the same key in the meantime.
+                sampler = self._samplers.setdefault(key, sampler)
+        return sampler
+
+    def _get_condition_loader(self, request: GenerationRequest) -> ConditionLoader:
+        key = (float(request.diffusion_guidance_factor), bool(request.target_compositions))
+        with self._condition:
+            condition_loader_factory = self._condition_loader_factories.get(key)
+        if condition_loader_factory is None:
+            condition_loader_factory = instantiate(
+                self._load_sampling_config(request).condition_loader_partial
+            )
+            with self._condition:
+                condition_loader_factory = self._condition_loader_factories.setdefault(
+                    key, condition_loader_factory
+                )
+        if request.target_compositions:
+            return condition_loader_factory(
+                target_compositions_dict=request.target_compositions,
+                num_structures_to_generate_per_composition=request.num_samples
+                // len(request.target_compositions),
+            )
+        return condition_loader_factory(
+            num_samples=request.num_samples, properties=request.properties_to_condition_on
+        )
+
+    def _load_sampling_config(self, request: GenerationRequest):
+        generator = dataclasses.replace(
+            self.generator, diffusion_guidance_factor=request.diffusion_guidance_factor
+        )
+        return generator.load_sampling_config(
+            batch_size=self.max_batch_size,
+            num_batches=1,
+            target_compositions_dict=request.target_compositions,
+        )
+
+
+def structure_to_cif(structure: Structure) -> str:
+    """CIF file contents of a structure, as written to the output files by `CrystalGenerator`."""
+    cif = io.BytesIO()
+    ase.io.write(cif, AseAtomsAdaptor.get_atoms(structure), format="cif")
+    return cif.getvalue().decode()
+
+
+class _GenerationRequestHandler(BaseHTTPRequestHandler):
+    """Serves `GET /health` and `POST /generate`.
+
+    `POST /generate` takes a JSON `GenerationRequest` and streams back one JSON line per generated batch,
+    `{"structures": [<cif>, ...]}`, followed by `{"done": true, "num_structures": <n>}`.
+    """
+
+    server: "_HTTPServer"
+
+    def do_GET(self):
+        if self.path != "/health":
+            self._send_json(404, {"error": f"Unknown path {self.path}"})
+            return
+        self._send_json(
+            200, {"status": "ok", "num_queued_jobs": self.server.generation_server.num_queued_jobs}
+        )
+
+    def do_POST(self):
+        if self.path != "/generate":
+            self._send_json(404, {"error": f"Unknown path {self.path}"})
+            return
+        try:
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            request = GenerationRequest.from_dict(json.loads(body))
+            job = self.server.generation_server.submit(request)
+        except (ValueError, TypeError) as e:
+            self._send_json(400, {"error": str(e)})
+            return
+        except Exception as e:
+            logger.exception("Submitting the generation request failed.")
+            self._send_json(500, {"error": f"Internal error: {e}"})
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.end_headers()
+        num_structures = 0
+        try:
+            for structures in job.results():
+                self._write_line({"structures": [structure_to_cif(s) for s in structures]})
+                num_structures += len(structures)
+        except RuntimeError as e:
+            self._write_line({"error": f"{e} {e.__cause__}"})
+            return
+        self._write_line({"done": True, "num_structures": num_structures})
+
+    def _write_line(self, obj: dict) -> None:
+        self.wfile.write(json.dumps(obj).encode() + b"\n")
+        self.wfile.flush()
+
+    def _send_json(self, status: int, obj: dict) -> None:
+        body = json.dumps(obj).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args) -> None:
+        logger.info(format, *args)
+
+
+class _HTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: tuple[str, int], generation_server: GenerationServer):
+        super().__init__(address, _GenerationRequestHandler)
+        self.generation_server = generation_server
+
+
+def make_http_server(
+    generation_server: GenerationServer, host: str = "127.0.0.1", port: int = 8000
+) -> ThreadingHTTPServer:
+    """HTTP server for a generation server. Call `serve_forever` on the result to serve requests (pass `port=0`
+    to pick a free port, see `server_address`). Responses are streamed; each connection serves one request.
+    """
+    return _HTTPServer((host, port), generation_server)
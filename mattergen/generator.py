@@ -1,37 +1,75 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT License.
 
+import dataclasses
 import io
 import os
-from dataclasses import dataclass
+import shutil
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from dataclasses import dataclass, field
 from pathlib import Path
+from typing import Container, ContextManager, Iterator, Sequence
 from zipfile import ZipFile
 
-import ase.io
 import hydra
+import numpy as np
 import torch
 from hydra.utils import instantiate
 from omegaconf import DictConfig, OmegaConf
 from pymatgen.core.structure import Structure
-from pymatgen.io.ase import AseAtomsAdaptor
 from tqdm import tqdm
 
 from mattergen.common.data.chemgraph import ChemGraph
-from mattergen.common.data.collate import collate
-from mattergen.common.data.condition_factory import ConditionLoader
+from mattergen.common.data.condition_factory import (
+    ConditionLoader,
+    get_structure_condition_loader,
+)
 from mattergen.common.data.num_atoms_distribution import NUM_ATOMS_DISTRIBUTIONS
 from mattergen.common.data.types import TargetProperty
+from mattergen.common.globals import (
+    GENERATED_CRYSTALS_EXTXYZ_FILE_NAME,
+    GENERATED_CRYSTALS_ZIP_FILE_NAME,
+    GENERATED_TRAJECTORIES_DIR_NAME,
+    GENERATED_TRAJECTORIES_ZIP_FILE_NAME,
+    GENERATION_SAMPLE_SEEDS_FILE_NAME,
+)
 from mattergen.common.utils.data_utils import lattice_matrix_to_params_torch
 from mattergen.common.utils.eval_utils import (
     MatterGenCheckpointInfo,
+    append_structures,
     get_crystals_list,
     load_model_diffusion,
+    load_structures,
     make_structure,
-    save_structures,
+)
+from mattergen.common.utils.generated_batch import GeneratedBatch
+from mattergen.common.utils.generation_run import (
+    GenerationManifest,
+    SampleSeeds,
+    draw_run_seed,
+    fingerprint,
+    get_batch_dir,
+    get_batch_seed,
+    load_finished_batch,
+    save_finished_batch,
+    seed_everything,
 )
 from mattergen.common.utils.globals import DEFAULT_SAMPLING_CONFIG_PATH, get_device
+from mattergen.common.utils.trajectory_utils import (
+    TRAJECTORY_FILE_SUFFIX,
+    copy_trajectory_chunk,
+    save_trajectory_chunk,
+)
+from mattergen.diffusion.data.batched_data import merge_batches
+from mattergen.diffusion.inference_options import InferenceOptions
 from mattergen.diffusion.lightning_module import DiffusionLightningModule
+from mattergen.diffusion.per_sample_rng import per_sample_seeds
+from mattergen.diffusion.sampling.classifier_free_guidance import GuidedPredictorCorrector
+from mattergen.diffusion.sampling.continuous_batching import ContinuousBatchingSampler
 from mattergen.diffusion.sampling.pc_sampler import PredictorCorrector
+from mattergen.diffusion.sampling.recording import Frame
 
 
 def draw_samples_from_sampler(
@@ -41,7 +79,55 @@ def draw_samples_from_sampler(
     output_path: Path | None = None,
     cfg: DictConfig | None = None,
     record_trajectories: bool = True,
-) -> list[Structure]:
+    pool_size: int | None = None,
+    seed: int | None = None,
+    manifest: GenerationManifest | None = None,
+) -> GeneratedBatch:
+    return GeneratedBatch.concatenate(
+        list(
+            draw_samples_from_sampler_iter(
+                sampler=sampler,
+                condition_loader=condition_loader,
+                properties_to_condition_on=properties_to_condition_on,
+                output_path=output_path,
+                cfg=cfg,
+                record_trajectories=record_trajectories,
+                pool_size=pool_size,
+                seed=seed,
+                manifest=manifest,
+            )
+        )
+    )
+
+
+def draw_samples_from_sampler_iter(
+    sampler: PredictorCorrector,
+    condition_loader: ConditionLoader,
+    properties_to_condition_on: TargetProperty | None = None,
+    output_path: Path | None = None,
+    cfg: DictConfig | None = None,
+    record_trajectories: bool = True,
+    pool_size: int | None = None,
+    seed: int | None = None,
+    manifest: GenerationManifest | None = None,
+) -> Iterator[GeneratedBatch]:
+    """Draw samples batch by batch and yield the generated structures of each batch.
+
+    If `output_path` is given, the structures of each batch are appended to the output files
+    before the batch is yielded, so that nothing has to be kept in memory across batches.
+    If `record_trajectories` is True, the frames recorded by the sampler (see `RecordingPolicy`) are written
+    to one trajectory file per batch in `output_path / GENERATED_TRAJECTORIES_DIR_NAME`. Use
+    `mattergen.common.utils.trajectory_utils.export_trajectories_to_extxyz` to convert them to .extxyz files.
+
+    If `pool_size` is given, samples are drawn with continuous batching (see `ContinuousBatchingSampler`): finished
+    structures are replaced by new ones right away, and are yielded in groups of about `pool_size` structures in the order
+    in which they finish. Trajectories are not recorded with continuous batching.
+
+    If `seed` is given, each batch is sampled with its own seed derived from `seed`. If in addition a `manifest` is given,
+    `output_path` is a resumable run directory (see `GenerationManifest`): batches that the manifest lists as finished are
+    loaded from disk instead of being sampled again, and the outputs of the other batches are saved as soon as they are
+    finished. The output files are assembled from the saved batches at the end, and are the same as for an uninterrupted run.
+    """
 
     # Dict
     properties_to_condition_on = properties_to_condition_on or {}
@@ -49,43 +135,200 @@ def draw_samples_from_sampler(
     # we cannot conditional sample on something on which the model was not trained to condition on
     assert all([key in sampler.diffusion_module.model.cond_fields_model_was_trained_on for key in properties_to_condition_on.keys()])  # type: ignore
 
-    all_samples_list = []
-    all_trajs_list = []
-    for conditioning_data, mask in tqdm(condition_loader, desc="Generating samples"):
+    if record_trajectories and pool_size is not None:
+        print("Trajectories are not recorded with continuous batching.")
+    if manifest is not None:
+        assert output_path is not None, "Resumable runs need an output path."
+        assert pool_size is None, "Resuming is not supported with continuous batching."
+        assert seed == manifest.seed
+    # Trajectories are only recorded if we can write them somewhere.
+    record_trajectories = record_trajectories and output_path is not None and pool_size is None
+    if output_path is not None:
+        assert cfg is not None
+        # Start from empty output files, as we append to them below.
+        for file_name in [
+            GENERATED_CRYSTALS_EXTXYZ_FILE_NAME,
+            GENERATED_CRYSTALS_ZIP_FILE_NAME,
+            GENERATED_TRAJECTORIES_ZIP_FILE_NAME,
+            GENERATION_SAMPLE_SEEDS_FILE_NAME,
+        ]:
+            (output_path / file_name).unlink(missing_ok=True)
+        shutil.rmtree(output_path / GENERATED_TRAJECTORIES_DIR_NAME, ignore_errors=True)
 
-        # generate samples
-        if record_trajectories:
-            sample, mean, intermediate_samples = sampler.sample_with_record(conditioning_data, mask)
-            all_trajs_list.extend(list_of_time_steps_to_list_of_trajectories(intermediate_samples))
+    num_generated = 0
+    for ix_batch, (mean, intermediate_samples) in enumerate(
+        _sample_batches(
+            sampler,
+            condition_loader,
+            record_trajectories,
+            pool_size,
+            seed=seed,
+            finished_batches=manifest.finished_batches if manifest is not None else (),
+        )
+    ):
+        if mean is None:
+            # Finished in an earlier run.
+            assert output_path is not None and manifest is not None
+            generated_strucs = load_finished_batch(output_path, ix_batch)
         else:
-            sample, mean = sampler.sample(conditioning_data, mask)
-        all_samples_list.extend(mean.to_data_list())
-    all_samples = collate(all_samples_list)
-    assert isinstance(all_samples, ChemGraph)
-    lengths, angles = lattice_matrix_to_params_torch(all_samples.cell)
-    all_samples = all_samples.replace(lengths=lengths, angles=angles)
-
-    generated_strucs = structure_from_model_output(
-        all_samples["pos"].reshape(-1, 3),
-        all_samples["atomic_numbers"].reshape(-1),
-        all_samples["lengths"].reshape(-1, 3),
-        all_samples["angles"].reshape(-1, 3),
-        all_samples["num_atoms"].reshape(-1),
-    )
+            mean = mean.to("cpu")
+            generated_strucs = structures_from_batch(mean)
 
+            if manifest is not None:
+                assert output_path is not None
+                save_finished_batch(
+                    output_path,
+                    manifest,
+                    batch_index=ix_batch,
+                    structures=generated_strucs,
+                    frames=intermediate_samples,
+                    final_batch=mean,
+                )
+            elif output_path is not None:
+                # Save structures to disk in both a extxyz file and a compressed zip file.
+                append_structures(output_path, generated_strucs, start_index=num_generated)
+
+                if intermediate_samples is not None:
+                    save_trajectory_chunk(
+                        output_path
+                        / GENERATED_TRAJECTORIES_DIR_NAME
+                        / f"batch_{ix_batch:05d}{TRAJECTORY_FILE_SUFFIX}",
+                        frames=intermediate_samples,
+                        final_batch=mean,
+                        start_index=num_generated,
+                    )
+        num_generated += len(generated_strucs)
+        yield generated_strucs
+
+    if manifest is not None:
+        assert output_path is not None
+        merge_generation_outputs(
+            [get_batch_dir(output_path, ix) for ix in sorted(manifest.finished_batches)],
+            output_path,
+        )
     if output_path is not None:
-        assert cfg is not None
-        # Save structures to disk in both a extxyz file and a compressed zip file.
-        # do this before uploading to mongo in case there is an authentication error
-        save_structures(output_path, generated_strucs)
+        # Continuous batching does not key the sampling noise by structure, see _sample_batches.
+        SampleSeeds(segments=[(seed if pool_size is None else None, num_generated)]).save(
+            output_path
+        )
 
-        if record_trajectories:
-            dump_trajectories(
-                output_path=output_path,
-                all_trajs_list=all_trajs_list,
+
+def draw_guidance_sweep_from_sampler(
+    sampler: GuidedPredictorCorrector,
+    condition_loader: ConditionLoader,
+    guidance_scales: Sequence[float],
+    output_paths: Sequence[Path] | None = None,
+    seed: int | None = None,
+) -> list[GeneratedBatch]:
+    """Draw samples for each condition of the condition loader at each of the given guidance scales, see
+    `GuidedPredictorCorrector.sample_guidance_sweep`. Returns the generated structures for each guidance scale.
+
+    If `output_paths` is given, the structures for each guidance scale are appended to the output files in the corresponding
+    output path batch by batch. Trajectories are not recorded. If `seed` is given, batches are seeded as in `draw_samples_from_sampler_iter`,
+    and each structure gets the same sampling noise as in a run with the same seed at a single guidance scale.
+    """
+    if output_paths is not None:
+        assert len(output_paths) == len(guidance_scales)
+        for output_path in output_paths:
+            output_path.mkdir(parents=True, exist_ok=True)
+            (output_path / GENERATED_CRYSTALS_EXTXYZ_FILE_NAME).unlink(missing_ok=True)
+            (output_path / GENERATED_CRYSTALS_ZIP_FILE_NAME).unlink(missing_ok=True)
+            (output_path / GENERATION_SAMPLE_SEEDS_FILE_NAME).unlink(missing_ok=True)
+    if seed is not None:
+        seed_everything(seed)
+
+    generated_structures: list[list[GeneratedBatch]] = [[] for _ in guidance_scales]
+    num_generated = 0
+    for ix_batch, (conditioning_data, mask) in enumerate(
+        tqdm(condition_loader, desc="Generating samples")
+    ):
+        batch_size = conditioning_data.get_batch_size()
+        sample_seeds: ContextManager = nullcontext()
+        if seed is not None:
+            seed_everything(get_batch_seed(seed, ix_batch))
+            sample_seeds = per_sample_seeds(
+                seed, torch.arange(num_generated, num_generated + batch_size)
             )
+        with sample_seeds:
+            results = sampler.sample_guidance_sweep(conditioning_data, guidance_scales, mask)
+        for ix_scale, (_, mean) in enumerate(results):
+            structures = structures_from_batch(mean.to("cpu"))
+            if output_paths is not None:
+                append_structures(output_paths[ix_scale], structures, start_index=num_generated)
+            generated_structures[ix_scale].append(structures)
+        num_generated += batch_size
+    if output_paths is not None:
+        for output_path in output_paths:
+            SampleSeeds(segments=[(seed, num_generated)]).save(output_path)
+    return [GeneratedBatch.concatenate(structures) for structures in generated_structures]
+
+
+def _sample_batches(
+    sampler: PredictorCorrector,
+    condition_loader: ConditionLoader,
+    record_trajectories: bool,
+    pool_size: int | None,
+    seed: int | None = None,
+    finished_batches: Container[int] = (),
+) -> Iterator[tuple[ChemGraph | None, list[Frame] | None]]:
+    """Yields batches of generated structures (without the noise of the last step) and their trajectories (if recorded).
+
+    If `seed` is given, each batch is sampled with its own seed derived from `seed`, so that the results do not depend
+    on which other batches are sampled. Except with continuous batching, the sampling noise of each structure is moreover
+    keyed by (seed, index of the structure), so that single structures can be regenerated (see `CrystalGenerator.regenerate`).
+    For batches in `finished_batches`, nothing is sampled and (None, None) is yielded.
+    """
+    if seed is not None:
+        # The order in which the condition loader returns the conditions may be random, too.
+        seed_everything(seed)
+    if pool_size is None:
+        num_structures = 0
+        for ix_batch, (conditioning_data, mask) in enumerate(
+            tqdm(condition_loader, desc="Generating samples")
+        ):
+            batch_size = conditioning_data.get_batch_size()
+            num_structures += batch_size
+            if ix_batch in finished_batches:
+                yield None, None
+                continue
+            sample_seeds: ContextManager = nullcontext()
+            if seed is not None:
+                seed_everything(get_batch_seed(seed, ix_batch))
+                sample_seeds = per_sample_seeds(
+                    seed, torch.arange(num_structures - batch_size, num_structures)
+                )
+            with sample_seeds:
+                if record_trajectories:
+                    _, mean, intermediate_samples = sampler.sample_with_record(
+                        conditioning_data, mask
+                    )
+                else:
+                    _, mean = sampler.sample(conditioning_data, mask)
+                    intermediate_samples = None
+            yield mean, intermediate_samples
+        return
+
+    assert not finished_batches, "Resuming is not supported with continuous batching."
+    # Structures finish a few at a time, so we gather them into batches of about pool_size structures.
+    finished: list[ChemGraph] = []
+    num_finished = 0
+    progress_bar = tqdm(desc="Generating samples", unit=" structures")
+    for _, mean in ContinuousBatchingSampler(sampler=sampler, pool_size=pool_size).sample(
+        condition_loader
+    ):
+        finished.append(mean.to("cpu"))
+        num_finished += mean.get_batch_size()
+        progress_bar.update(mean.get_batch_size())
+        if num_finished >= pool_size:
+            yield merge_batches(finished), None
+            finished, num_finished = [], 0
+    if finished:
+        yield merge_batches(finished), None
+    progress_bar.close()
 
-    return generated_strucs
+
+def structures_from_batch(batch: ChemGraph) -> GeneratedBatch:
+    return GeneratedBatch.from_chemgraph(batch)
 
 
 def list_of_time_steps_to_list_of_trajectories(
@@ -111,17 +354,24 @@ def list_of_time_steps_to_list_of_trajectories(
 def dump_trajectories(
     output_path: Path,
     all_trajs_list: list[list[ChemGraph]],
+) -> None:
+    (output_path / GENERATED_TRAJECTORIES_ZIP_FILE_NAME).unlink(missing_ok=True)
+    append_trajectories(output_path=output_path, trajs_list=all_trajs_list, start_index=0)
+
+
+def append_trajectories(
+    output_path: Path,
+    trajs_list: list[list[ChemGraph]],
+    start_index: int,
 ) -> None:
     try:
         # We gather all trajectories in a single zip file as .extxyz files.
         # This way we can view them easily after downloading.
-        with ZipFile(output_path / "generated_trajectories.zip", "w") as zip_obj:
-            for ix, traj in enumerate(all_trajs_list):
-                strucs = structures_from_trajectory(traj)
-                ase_atoms = [AseAtomsAdaptor.get_atoms(crystal) for crystal in strucs]
+        with ZipFile(output_path / GENERATED_TRAJECTORIES_ZIP_FILE_NAME, "a") as zip_obj:
+            for ix, traj in enumerate(trajs_list, start=start_index):
+                frames = GeneratedBatch.concatenate([structures_from_batch(x) for x in traj])
                 str_io = io.StringIO()
-                ase.io.write(str_io, ase_atoms, format="extxyz")
-                str_io.flush()
+                frames.write_extxyz(str_io)
                 zip_obj.writestr(f"gen_{ix}.extxyz", str_io.getvalue())
     except IOError as e:
         print(f"Got error {e} writing the trajectory to disk.")
@@ -168,6 +418,91 @@ def structures_from_trajectory(traj: list[ChemGraph]) -> list[Structure]:
     return all_strucs
 
 
+def merge_generation_outputs(worker_output_paths: list[Path], output_path: Path) -> int:
+    """Merge the outputs of several generation runs, in the given order, into the output files in `output_path`.
+    Structures and trajectory chunks are renumbered consecutively.
+
+    Returns:
+        the total number of structures.
+    """
+    (output_path / GENERATED_CRYSTALS_EXTXYZ_FILE_NAME).unlink(missing_ok=True)
+    (output_path / GENERATED_CRYSTALS_ZIP_FILE_NAME).unlink(missing_ok=True)
+    trajectory_dir = output_path / GENERATED_TRAJECTORIES_DIR_NAME
+    shutil.rmtree(trajectory_dir, ignore_errors=True)
+
+    num_structures = 0
+    num_trajectory_chunks = 0
+    with (
+        open(output_path / GENERATED_CRYSTALS_EXTXYZ_FILE_NAME, "wb") as extxyz_file,
+        ZipFile(output_path / GENERATED_CRYSTALS_ZIP_FILE_NAME, "w") as zip_obj,
+    ):
+        for worker_output_path in worker_output_paths:
+            worker_extxyz = worker_output_path / GENERATED_CRYSTALS_EXTXYZ_FILE_NAME
+            if not worker_extxyz.exists():
+                continue
+            with open(worker_extxyz, "rb") as f:
+                shutil.copyfileobj(f, extxyz_file)
+
+            with ZipFile(worker_output_path / GENERATED_CRYSTALS_ZIP_FILE_NAME) as worker_zip:
+                names = worker_zip.namelist()
+                for name in names:
+                    ix = int(Path(name).stem.removeprefix("gen_"))
+                    zip_obj.writestr(f"gen_{num_structures + ix}.cif", worker_zip.read(name))
+
+            for chunk_path in sorted(
+                (worker_output_path / GENERATED_TRAJECTORIES_DIR_NAME).glob(
+                    f"*{TRAJECTORY_FILE_SUFFIX}"
+                )
+            ):
+                copy_trajectory_chunk(
+                    chunk_path,
+                    trajectory_dir / f"batch_{num_trajectory_chunks:05d}{TRAJECTORY_FILE_SUFFIX}",
+                    index_offset=num_structures,
+                )
+                num_trajectory_chunks += 1
+            num_structures += len(names)
+    return num_structures
+
+
+def _generate_worker(
+    generator: "CrystalGenerator",
+    rank: int,
+    num_workers: int,
+    seed: int,
+    batch_size: int,
+    num_batches: int,
+    num_samples_per_condition: int,
+    target_compositions_dict: list[dict[str, float]] | None,
+    output_dir: str,
+) -> int:
+    """Runs in a worker process of `CrystalGenerator.generate_parallel`."""
+    # Each worker gets its own share of the cores, so that the workers do not compete for them.
+    if hasattr(os, "sched_getaffinity"):
+        cpus = sorted(os.sched_getaffinity(0))
+        worker_cpus = np.array_split(cpus, num_workers)[rank].tolist()
+        if worker_cpus:
+            os.sched_setaffinity(0, worker_cpus)
+            torch.set_num_threads(len(worker_cpus))
+    else:
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // num_workers))
+    if torch.cuda.is_available():
+        torch.cuda.set_device(rank % torch.cuda.device_count())
+    # A seeded run of its own, so that its structures can be regenerated with the worker seed.
+    generator = dataclasses.replace(generator, seed=seed)
+
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    num_generated = 0
+    for structures in generator.generate_iter(
+        batch_size=batch_size,
+        num_batches=num_batches,
+        target_compositions_dict=target_compositions_dict,
+        output_dir=output_dir,
+        num_samples_per_condition=num_samples_per_condition,
+    ):
+        num_generated += len(structures)
+    return num_generated
+
+
 @dataclass
 class CrystalGenerator:
     checkpoint_info: MatterGenCheckpointInfo
@@ -177,10 +512,23 @@ class CrystalGenerator:
     num_batches: int | None = None
     target_compositions_dict: list[dict[str, float]] | None = None
     num_atoms_distribution: str = "ALEX_MP_20"
+    # If set, batches are packed up to this many atoms (and at most batch_size structures)
+    max_atoms_per_batch: int | None = None
+    # If set, use continuous batching with this many structures in flight, see ContinuousBatchingSampler
+    pool_size: int | None = None
+    # If set, each batch is sampled with its own seed derived from this one, so that runs are reproducible
+    seed: int | None = None
+    # If True, continue the generation run in the output directory, see GenerationManifest
+    resume: bool = False
+    # How the score model runs, e.g., in which precision, see mattergen.diffusion.inference_options
+    inference_options: InferenceOptions = field(default_factory=InferenceOptions)
 
     # Conditional generation
     diffusion_guidance_factor: float = 0.0
     properties_to_condition_on: TargetProperty | None = None
+    # If set, generate the same number of structures for each of these properties (see get_condition_table_loader),
+    # instead of conditioning all structures on properties_to_condition_on
+    condition_table: list[TargetProperty] | None = None
 
     # Additional overrides, only has an effect when using a diffusion-codebase model
     sampling_config_overrides: list[str] | None = None
@@ -205,6 +553,13 @@ class CrystalGenerator:
             f"but got {self.num_atoms_distribution}. To add your own distribution, "
             "please add it to mattergen.common.data.num_atoms_distribution.NUM_ATOMS_DISTRIBUTIONS."
         )
+        if self.condition_table:
+            assert (
+                not self.properties_to_condition_on
+            ), "Use either properties_to_condition_on or a condition table, not both."
+            assert (
+                not self.target_compositions_dict
+            ), "Condition tables are not supported for crystal structure prediction."
         if self.target_compositions_dict:
             assert self.cfg.lightning_module.diffusion_module.loss_fn.weights.get(
                 "atomic_numbers", 0.0
@@ -264,45 +619,132 @@ class CrystalGenerator:
         target_compositions_dict: list[dict[str, float]] | None = None,
     ) -> ConditionLoader:
         condition_loader_partial = instantiate(sampling_config.condition_loader_partial)
+        if self.condition_table:
+            return condition_loader_partial(conditions=self.condition_table)
         if not target_compositions_dict:
             return condition_loader_partial(properties=self.properties_to_condition_on)
 
         return condition_loader_partial(target_compositions_dict=target_compositions_dict)
 
+    def get_num_samples_per_condition(
+        self,
+        batch_size: int,
+        num_batches: int,
+        target_compositions_dict: list[dict[str, float]] | None = None,
+    ) -> int:
+        """Returns the number of structures to generate per row of the condition table, per target composition (crystal
+        structure prediction) or, without either, in total, for `batch_size * num_batches` structures in total.
+
+        Raises:
+            ValueError: if the structures cannot be split evenly across the rows of the condition table.
+        """
+        num_samples = num_batches * batch_size
+        if self.condition_table:
+            if num_samples < len(self.condition_table):
+                raise ValueError(
+                    f"The condition table has {len(self.condition_table)} rows, but only {num_samples} structures "
+                    "are to be generated. Generate at least one structure per row."
+                )
+            if num_samples % len(self.condition_table) != 0:
+                raise ValueError(
+                    f"The {num_samples} structures cannot be split evenly across the {len(self.condition_table)} rows "
+                    "of the condition table. Choose batch_size * num_batches as a multiple of the number of rows."
+                )
+            return num_samples // len(self.condition_table)
+        if target_compositions_dict:
+            return num_samples // len(target_compositions_dict)
+        return num_samples
+
+    def _get_num_conditions(self, target_compositions_dict: list[dict[str, float]] | None) -> int:
+        """Number of rows of the condition table or of target compositions, 1 without either."""
+        if self.condition_table:
+            return len(self.condition_table)
+        if target_compositions_dict:
+            return len(target_compositions_dict)
+        return 1
+
+    def split_samples_across_workers(
+        self,
+        num_workers: int,
+        batch_size: int,
+        num_batches: int,
+        target_compositions_dict: list[dict[str, float]] | None = None,
+    ) -> list[int]:
+        """Returns the number of structures per condition (see `get_num_samples_per_condition`) that each of
+        `num_workers` workers generates. The numbers add up to that of a single process. Without a condition table or
+        target compositions, or with a single one, the workers get whole batches.
+
+        Raises:
+            ValueError: if the structures cannot be split evenly across the rows of the condition table.
+        """
+        num_samples_per_condition = self.get_num_samples_per_condition(
+            batch_size=batch_size,
+            num_batches=num_batches,
+            target_compositions_dict=target_compositions_dict,
+        )
+        if self._get_num_conditions(target_compositions_dict) == 1:
+            return [
+                len(shard) * batch_size
+                for shard in np.array_split(np.arange(num_batches), num_workers)
+            ]
+        return [
+            len(shard)
+            for shard in np.array_split(np.arange(num_samples_per_condition), num_workers)
+        ]
+
     def load_sampling_config(
         self,
         batch_size: int,
         num_batches: int,
         target_compositions_dict: list[dict[str, float]] | None = None,
+        num_samples_per_condition: int | None = None,
     ) -> DictConfig:
         """
         Create a sampling config from the given parameters.
         We specify certain sampling hyperparameters via the sampling config that is loaded via hydra.
+        The condition loader generates `num_samples_per_condition` structures per condition (see
+        `get_num_samples_per_condition`), which by default are split from `batch_size * num_batches`.
         """
+        if num_samples_per_condition is None:
+            num_samples_per_condition = self.get_num_samples_per_condition(
+                batch_size=batch_size,
+                num_batches=num_batches,
+                target_compositions_dict=target_compositions_dict,
+            )
         if self.sampling_config_overrides is None:
             sampling_config_overrides = []
         else:
             # avoid modifying the original list
             sampling_config_overrides = self.sampling_config_overrides.copy()
-        if not target_compositions_dict:
+        if self.condition_table:
+            # `condition_loader_partial` for per-sample properties, with the same number of structures per row
+            sampling_config_overrides += [
+                "condition_loader_partial._target_=mattergen.common.data.condition_factory.get_condition_table_loader",
+                f"+condition_loader_partial.num_atoms_distribution={self.num_atoms_distribution}",
+                f"+condition_loader_partial.batch_size={batch_size}",
+                f"+condition_loader_partial.num_samples_per_condition={num_samples_per_condition}",
+                f"sampler_partial.guidance_scale={self.diffusion_guidance_factor}",
+            ]
+        elif not target_compositions_dict:
             # Default `condition_loader_partial` is
             # mattergen.common.data.condition_factory.get_number_of_atoms_condition_loader
             sampling_config_overrides += [
                 f"+condition_loader_partial.num_atoms_distribution={self.num_atoms_distribution}",
                 f"+condition_loader_partial.batch_size={batch_size}",
-                f"+condition_loader_partial.num_samples={num_batches * batch_size}",
+                f"+condition_loader_partial.num_samples={num_samples_per_condition}",
                 f"sampler_partial.guidance_scale={self.diffusion_guidance_factor}",
             ]
         else:
             # `condition_loader_partial` for fixed atom type (crystal structure prediction)
-            num_structures_to_generate_per_composition = (
-                num_batches * batch_size // len(target_compositions_dict)
-            )
             sampling_config_overrides += [
                 "condition_loader_partial._target_=mattergen.common.data.condition_factory.get_composition_data_loader",
-                f"+condition_loader_partial.num_structures_to_generate_per_composition={num_structures_to_generate_per_composition}",
+                f"+condition_loader_partial.num_structures_to_generate_per_composition={num_samples_per_condition}",
                 f"+condition_loader_partial.batch_size={batch_size}",
             ]
+        if self.max_atoms_per_batch is not None:
+            sampling_config_overrides.append(
+                f"+condition_loader_partial.max_atoms_per_batch={self.max_atoms_per_batch}"
+            )
         return self._load_sampling_config(
             sampling_config_overrides=sampling_config_overrides,
             sampling_config_path=self.sampling_config_path,
@@ -336,13 +778,128 @@ class CrystalGenerator:
         self._model = model
         self._cfg = self.checkpoint_info.config
 
+    def _get_sampler_and_condition_loader(
+        self,
+        batch_size: int,
+        num_batches: int,
+        target_compositions_dict: list[dict[str, float]] | None,
+        num_samples_per_condition: int | None = None,
+    ) -> tuple[PredictorCorrector, ConditionLoader]:
+        # print config for debugging and reproducibility
+        print("\nModel config:")
+        print(OmegaConf.to_yaml(self.cfg, resolve=True))
+
+        sampling_config = self.load_sampling_config(
+            batch_size=batch_size,
+            num_batches=num_batches,
+            target_compositions_dict=target_compositions_dict,
+            num_samples_per_condition=num_samples_per_condition,
+        )
+
+        print("\nSampling config:")
+        print(OmegaConf.to_yaml(sampling_config, resolve=True))
+        condition_loader = self.get_condition_loader(sampling_config, target_compositions_dict)
+
+        return self.get_sampler(sampling_config), condition_loader
+
+    def get_sampler(self, sampling_config: DictConfig) -> PredictorCorrector:
+        """Instantiates the sampler of a sampling config for the model."""
+        sampler = instantiate(sampling_config.sampler_partial)(
+            pl_module=self.model, inference_options=self.inference_options
+        )
+        if self.condition_table:
+            # we cannot conditional sample on something on which the model was not trained to condition on
+            assert all(
+                key in sampler.diffusion_module.model.cond_fields_model_was_trained_on  # type: ignore
+                for key in self.condition_table[0].keys()
+            ), "The condition table sets properties that the model was not trained on."
+        return sampler
+
+    def _get_run_fingerprints(
+        self,
+        sampling_config: DictConfig,
+        target_compositions_dict: list[dict[str, float]] | None,
+    ) -> dict[str, str]:
+        """Fingerprints of the parts of the setup that the generated structures depend on, see `GenerationManifest`."""
+        checkpoint_path = Path(self.checkpoint_info.checkpoint_path).resolve()
+        checkpoint_stat = checkpoint_path.stat()
+        return {
+            "sampling config": fingerprint(OmegaConf.to_container(sampling_config, resolve=True)),
+            "conditions": fingerprint(
+                {
+                    "properties_to_condition_on": self.properties_to_condition_on,
+                    "condition_table": self.condition_table,
+                    "target_compositions_dict": target_compositions_dict,
+                }
+            ),
+            # Checkpoints are too large to hash. Their modification time also changes when, e.g., last.ckpt is
+            # overwritten by further training.
+            "checkpoint": fingerprint(
+                {
+                    "path": checkpoint_path,
+                    "size": checkpoint_stat.st_size,
+                    "mtime_ns": checkpoint_stat.st_mtime_ns,
+                    "config_overrides": self.checkpoint_info.config_overrides,
+                }
+            ),
+            "inference options": fingerprint(dataclasses.asdict(self.inference_options)),
+        }
+
+    def _prepare_run(
+        self,
+        batch_size: int,
+        num_batches: int,
+        output_path: Path | None,
+        target_compositions_dict: list[dict[str, float]] | None = None,
+        num_samples_per_condition: int | None = None,
+    ) -> tuple[int | None, GenerationManifest | None]:
+        """Returns the seed and, for resumable runs, the manifest of the run in `output_path`.
+
+        Resumable runs always have a seed: without one, a resumed run would not generate the same structures as an uninterrupted one.
+        Raises ValueError if the run in `output_path` was set up differently, see `GenerationManifest.check_compatible`.
+        """
+        if not self.resume:
+            if self.seed is not None:
+                seed_everything(self.seed)
+            return self.seed, None
+        assert output_path is not None, "Resumable runs need an output directory."
+        fingerprints = self._get_run_fingerprints(
+            self.load_sampling_config(
+                batch_size=batch_size,
+                num_batches=num_batches,
+                target_compositions_dict=target_compositions_dict,
+                num_samples_per_condition=num_samples_per_condition,
+            ),
+            target_compositions_dict,
+        )
+        manifest = GenerationManifest.load(output_path)
+        if manifest is None:
+            manifest = GenerationManifest(
+                seed=self.seed if self.seed is not None else draw_run_seed(),
+                batch_size=batch_size,
+                num_batches=num_batches,
+                fingerprints=fingerprints,
+            )
+            output_path.mkdir(parents=True, exist_ok=True)
+            manifest.save(output_path)
+        else:
+            manifest.check_compatible(
+                self.seed, batch_size=batch_size, num_batches=num_batches, fingerprints=fingerprints
+            )
+            print(
+                f"Resuming generation run in {output_path}: {len(manifest.finished_batches)} of {num_batches} batches are finished."
+            )
+        # The condition loader may draw random numbers, too.
+        seed_everything(manifest.seed)
+        return manifest.seed, manifest
+
     def generate(
         self,
         batch_size: int | None = None,
         num_batches: int | None = None,
         target_compositions_dict: list[dict[str, float]] | None = None,
         output_dir: str = "outputs",
-    ) -> list[Structure]:
+    ) -> GeneratedBatch:
         # Prioritize the runtime provided batch_size, num_batches and target_compositions_dict
         batch_size = batch_size or self.batch_size
         num_batches = num_batches or self.num_batches
@@ -350,23 +907,15 @@ class CrystalGenerator:
         assert batch_size is not None
         assert num_batches is not None
 
-        # print config for debugging and reproducibility
-        print("\nModel config:")
-        print(OmegaConf.to_yaml(self.cfg, resolve=True))
-
-        sampling_config = self.load_sampling_config(
+        seed, manifest = self._prepare_run(
+            batch_size, num_batches, Path(output_dir), target_compositions_dict
+        )
+        sampler, condition_loader = self._get_sampler_and_condition_loader(
             batch_size=batch_size,
             num_batches=num_batches,
             target_compositions_dict=target_compositions_dict,
         )
 
-        print("\nSampling config:")
-        print(OmegaConf.to_yaml(sampling_config, resolve=True))
-        condition_loader = self.get_condition_loader(sampling_config, target_compositions_dict)
-
-        sampler_partial = instantiate(sampling_config.sampler_partial)
-        sampler = sampler_partial(pl_module=self.model)
-
         generated_structures = draw_samples_from_sampler(
             sampler=sampler,
             condition_loader=condition_loader,
@@ -374,6 +923,261 @@ class CrystalGenerator:
             output_path=Path(output_dir),
             properties_to_condition_on=self.properties_to_condition_on,
             record_trajectories=self.record_trajectories,
+            pool_size=self.pool_size,
+            seed=seed,
+            manifest=manifest,
         )
 
         return generated_structures
+
+    def generate_iter(
+        self,
+        batch_size: int | None = None,
+        num_batches: int | None = None,
+        target_compositions_dict: list[dict[str, float]] | None = None,
+        output_dir: str | None = "outputs",
+        num_samples_per_condition: int | None = None,
+    ) -> Iterator[GeneratedBatch]:
+        """Like `generate`, but yields the structures of each batch as soon as it has been generated,
+        and appends them to the output files in `output_dir` (unless it is None). Memory use does not grow with the number of batches.
+        If `num_samples_per_condition` is given, this many structures are generated per row of the condition table or per
+        target composition, instead of splitting `batch_size * num_batches` structures across them (see `load_sampling_config`).
+        """
+        # Prioritize the runtime provided batch_size, num_batches and target_compositions_dict
+        batch_size = batch_size or self.batch_size
+        num_batches = num_batches or self.num_batches
+        target_compositions_dict = target_compositions_dict or self.target_compositions_dict
+        assert batch_size is not None
+        assert num_batches is not None
+
+        output_path = Path(output_dir) if output_dir is not None else None
+        seed, manifest = self._prepare_run(
+            batch_size,
+            num_batches,
+            output_path,
+            target_compositions_dict,
+            num_samples_per_condition=num_samples_per_condition,
+        )
+        sampler, condition_loader = self._get_sampler_and_condition_loader(
+            batch_size=batch_size,
+            num_batches=num_batches,
+            target_compositions_dict=target_compositions_dict,
+            num_samples_per_condition=num_samples_per_condition,
+        )
+
+        yield from draw_samples_from_sampler_iter(
+            sampler=sampler,
+            condition_loader=condition_loader,
+            cfg=self.cfg,
+            output_path=output_path,
+            properties_to_condition_on=self.properties_to_condition_on,
+            record_trajectories=self.record_trajectories,
+            pool_size=self.pool_size,
+            seed=seed,
+            manifest=manifest,
+        )
+
+    def regenerate(
+        self,
+        structure_indices: Sequence[int],
+        output_dir: str = "outputs",
+        regenerated_dir: str | None = None,
+    ) -> GeneratedBatch:
+        """Regenerates the structures with the given indices of the seeded run in `output_dir`, one at a time,
+        and writes them (with their trajectories) to `regenerated_dir` (default: `{output_dir}/regenerated`).
+
+        In seeded runs, the sampling noise of each structure only depends on the seed and the index of the structure
+        (see `mattergen.diffusion.per_sample_rng`), so a single structure can be regenerated at batch size 1, e.g., to record
+        the trajectories of the interesting structures only. The seeds are read from the record that the run left in
+        `output_dir` (see `SampleSeeds`), which also covers multi-process runs. The generator must otherwise be set up as
+        for the original run (model, sampling config and conditions). The regenerated structures agree with the original
+        ones up to floating point differences, provided that the sampler does not average its Langevin step sizes over
+        the batch (see `PredictorCorrector.updates_depend_on_batch`).
+
+        Raises:
+            ValueError: if the run in `output_dir` did not key the sampling noise by structure (unseeded runs and
+                continuous batching) or left no record of its seeds.
+        """
+        output_path = Path(output_dir)
+        regenerated_path = (
+            Path(regenerated_dir) if regenerated_dir is not None else output_path / "regenerated"
+        )
+        sample_seeds = SampleSeeds.load(output_path)
+        if sample_seeds is None:
+            raise ValueError(
+                f"{output_path} has no record of the seeds its structures were sampled with, so they cannot be regenerated."
+            )
+        # (seed, sample index) that the noise of each structure is keyed by.
+        sample_keys = [sample_seeds.get(ix) for ix in structure_indices]
+
+        generated_structures = load_structures(output_path / GENERATED_CRYSTALS_EXTXYZ_FILE_NAME)
+        # The conditions come from the structures, not from the condition loader of the sampling config.
+        sampling_config = self.load_sampling_config(
+            batch_size=1,
+            num_batches=len(structure_indices),
+            target_compositions_dict=self.target_compositions_dict,
+            num_samples_per_condition=1,
+        )
+        sampler = self.get_sampler(sampling_config)
+        if sampler.updates_depend_on_batch:
+            warnings.warn(
+                "The step sizes of the Langevin correctors are averaged over the batch, so the regenerated structures "
+                "only approximately match the original ones. Set `per_sample_step_size: true` for the correctors in the "
+                "sampling config of both runs to regenerate structures exactly."
+            )
+        condition_loader = get_structure_condition_loader(
+            [generated_structures[ix] for ix in structure_indices],
+            fixed_atom_types=bool(self.target_compositions_dict),
+            properties=self.properties_to_condition_on,
+            conditions=self.condition_table,
+        )
+
+        shutil.rmtree(regenerated_path, ignore_errors=True)
+        regenerated_path.mkdir(parents=True)
+        regenerated_structures = []
+        for ix, (seed, sample_index), (conditioning_data, mask) in zip(
+            structure_indices, sample_keys, condition_loader
+        ):
+            with per_sample_seeds(seed, [sample_index]):
+                _, mean, intermediate_samples = sampler.sample_with_record(conditioning_data, mask)
+            mean = mean.to("cpu")
+            structures = structures_from_batch(mean)
+            append_structures(regenerated_path, structures, start_index=ix)
+            save_trajectory_chunk(
+                regenerated_path
+                / GENERATED_TRAJECTORIES_DIR_NAME
+                / f"gen_{ix:05d}{TRAJECTORY_FILE_SUFFIX}",
+                frames=intermediate_samples,
+                final_batch=mean,
+                start_index=ix,
+            )
+            regenerated_structures.append(structures)
+        return GeneratedBatch.concatenate(regenerated_structures)
+
+    def generate_guidance_sweep(
+        self,
+        guidance_factors: Sequence[float],
+        batch_size: int | None = None,
+        num_batches: int | None = None,
+        target_compositions_dict: list[dict[str, float]] | None = None,
+        output_dir: str = "outputs",
+    ) -> dict[float, GeneratedBatch]:
+        """Like `generate`, but generates the same conditions at each of the given diffusion guidance factors
+        (`diffusion_guidance_factor` is not used). The structures for guidance factor `g` are written to `{output_dir}/guidance_{g}`.
+
+        The samples for all guidance factors are denoised together, and each denoising step evaluates the score model
+        in one forward pass, which only includes the unconditional pass for guidance factors other than 1 and the conditional pass
+        for nonzero guidance factors. With a seed, each structure gets the same sampling noise at every guidance factor, so that
+        differences between the guidance factors are not masked by sampling noise. Trajectories are not recorded.
+        """
+        # Prioritize the runtime provided batch_size, num_batches and target_compositions_dict
+        batch_size = batch_size or self.batch_size
+        num_batches = num_batches or self.num_batches
+        target_compositions_dict = target_compositions_dict or self.target_compositions_dict
+        assert batch_size is not None
+        assert num_batches is not None
+        assert not self.resume, "Resuming is not supported for guidance sweeps."
+        assert self.pool_size is None, "Continuous batching is not supported for guidance sweeps."
+        assert len(set(guidance_factors)) == len(
+            guidance_factors
+        ), "Guidance factors must be unique."
+
+        if self.seed is not None:
+            seed_everything(self.seed)
+        sampler, condition_loader = self._get_sampler_and_condition_loader(
+            batch_size=batch_size,
+            num_batches=num_batches,
+            target_compositions_dict=target_compositions_dict,
+        )
+        assert isinstance(
+            sampler, GuidedPredictorCorrector
+        ), "Guidance sweeps need a sampler with classifier-free guidance."
+        output_paths = [Path(output_dir) / f"guidance_{g}" for g in guidance_factors]
+        generated_structures = draw_guidance_sweep_from_sampler(
+            sampler=sampler,
+            condition_loader=condition_loader,
+            guidance_scales=guidance_factors,
+            output_paths=output_paths,
+            seed=self.seed,
+        )
+        return dict(zip(guidance_factors, generated_structures))
+
+    def generate_parallel(
+        self,
+        num_workers: int,
+        batch_size: int | None = None,
+        num_batches: int | None = None,
+        target_compositions_dict: list[dict[str, float]] | None = None,
+        output_dir: str = "outputs",
+        seed: int | None = None,
+    ) -> GeneratedBatch:
+        """Like `generate`, but splits the structures across `num_workers` processes, each with its own copy of the model.
+
+        Each worker is pinned to its own share of the CPU cores (and, if available, to a GPU) and gets a different random seed.
+        The outputs of the workers are merged into the usual output files in `output_dir`, and their structures can be
+        regenerated like those of a seeded run (see `regenerate`).
+        With a condition table or in crystal structure prediction mode, the structures of each row or composition are split
+        across the workers (see `split_samples_across_workers`), so that the workers together generate the same number of
+        structures per row or composition as a single process.
+        """
+        # Prioritize the runtime provided batch_size, num_batches and target_compositions_dict
+        batch_size = batch_size or self.batch_size
+        num_batches = num_batches or self.num_batches
+        target_compositions_dict = target_compositions_dict or self.target_compositions_dict
+        assert batch_size is not None
+        assert num_batches is not None
+        assert num_workers > 0, "num_workers must be positive."
+        assert not self.resume, "Resuming is not supported with multiple workers."
+        seed = seed if seed is not None else self.seed
+
+        output_path = Path(output_dir)
+        # Fails here rather than in the workers, after they have loaded the model.
+        num_samples_per_condition_per_worker = self.split_samples_across_workers(
+            num_workers,
+            batch_size=batch_size,
+            num_batches=num_batches,
+            target_compositions_dict=target_compositions_dict,
+        )
+        num_conditions = self._get_num_conditions(target_compositions_dict)
+        num_batches_per_worker = [
+            -(-num_samples_per_condition * num_conditions // batch_size)
+            for num_samples_per_condition in num_samples_per_condition_per_worker
+        ]
+        worker_seeds = [
+            int(s.generate_state(1)[0]) for s in np.random.SeedSequence(seed).spawn(num_workers)
+        ]
+        worker_output_paths = [output_path / f"worker_{rank}" for rank in range(num_workers)]
+        # Do not send a loaded model to the workers, each worker loads its own copy.
+        # The workers are seeded with the worker seeds.
+        generator = dataclasses.replace(self, _model=None)
+        with ProcessPoolExecutor(
+            max_workers=num_workers, mp_context=torch.multiprocessing.get_context("spawn")
+        ) as executor:
+            futures = [
+                executor.submit(
+                    _generate_worker,
+                    generator,
+                    rank=rank,
+                    num_workers=num_workers,
+                    seed=worker_seeds[rank],
+                    batch_size=batch_size,
+                    num_batches=num_batches_per_worker[rank],
+                    num_samples_per_condition=num_samples_per_condition_per_worker[rank],
+                    target_compositions_dict=target_compositions_dict,
+                    output_dir=str(worker_output_paths[rank]),
+                )
+                for rank in range(num_workers)
+                if num_batches_per_worker[rank] > 0
+            ]
+            for future in futures:
+                future.result()
+
+        merge_generation_outputs(worker_output_paths, output_path)
+        # The structures of each worker are keyed by the worker seed and their index among the structures of the worker.
+        worker_sample_seeds = [SampleSeeds.load(path) for path in worker_output_paths]
+        SampleSeeds.concatenate(s for s in worker_sample_seeds if s is not None).save(output_path)
+        for worker_output_path in worker_output_paths:
+            shutil.rmtree(worker_output_path, ignore_errors=True)
+        return GeneratedBatch.from_structures(
+            load_structures(output_path / GENERATED_CRYSTALS_EXTXYZ_FILE_NAME)
+        )
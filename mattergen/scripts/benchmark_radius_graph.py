@@ -0,0 +1,99 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import time
+from typing import get_args
+
+import fire
+import torch
+
+from mattergen.common.utils.data_utils import RadiusGraphAlgorithm, radius_graph_pbc
+from mattergen.common.utils.globals import get_device
+
+
+def random_crystals(
+    num_atoms: int, batch_size: int, volume_per_atom: float, device: torch.device
+) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """Cartesian coordinates, lattices and numbers of atoms of a batch of random crystals of the given density."""
+    num_atoms_per_crystal = torch.full((batch_size,), num_atoms, device=device)
+    length = (num_atoms * volume_per_atom) ** (1 / 3)
+    lattice = length * (
+        torch.eye(3, device=device) + 0.1 * torch.randn(batch_size, 3, 3, device=device)
+    )
+    frac_coords = torch.rand(batch_size * num_atoms, 3, device=device)
+    cart_coords = torch.einsum(
+        "ni,nij->nj", frac_coords, torch.repeat_interleave(lattice, num_atoms, dim=0)
+    )
+    return cart_coords, lattice, num_atoms_per_crystal
+
+
+def main(
+    num_atoms: list[int] = [20, 50, 100, 200, 400, 800],
+    batch_size: int = 4,
+    cutoff: float = 7.0,
+    max_neighbors: int = 50,
+    max_cell_images_per_dim: int = 5,
+    volume_per_atom: float = 15.0,
+    num_repeats: int = 3,
+    max_all_pairs_atoms: int = 400,
+):
+    """
+    Compare how the time (and, on GPU, the peak memory) to build the periodic radius graph scales with the number of
+    atoms per crystal for the "all_pairs" and "cell_list" algorithms of `radius_graph_pbc`.
+
+    Args:
+        num_atoms: Numbers of atoms per crystal to benchmark. (default: [20, 50, 100, 200, 400, 800])
+        batch_size: Number of random crystals per batch. (default: 4)
+        cutoff: Radius of the graph, in Angstrom. (default: 7.0)
+        max_neighbors: Maximum number of neighbors per atom. (default: 50)
+        max_cell_images_per_dim: Maximum number of periodic images per lattice vector. (default: 5)
+        volume_per_atom: Density of the random crystals, in cubic Angstrom per atom. (default: 15.0)
+        num_repeats: Number of timed calls per setting, after one untimed call. (default: 3)
+        max_all_pairs_atoms: Largest number of atoms per crystal for which "all_pairs" is run, since its memory grows
+            quadratically. (default: 400)
+    """
+    device = get_device()
+    torch.manual_seed(0)
+    print(f"{'atoms':>6} {'algorithm':>10} {'edges':>9} {'ms/call':>9} {'peak MB':>9}")
+    for n in num_atoms:
+        cart_coords, lattice, num_atoms_per_crystal = random_crystals(
+            n, batch_size=batch_size, volume_per_atom=volume_per_atom, device=device
+        )
+        for algorithm in get_args(RadiusGraphAlgorithm):
+            if algorithm == "all_pairs" and n > max_all_pairs_atoms:
+                continue
+
+            def build_graph() -> torch.Tensor:
+                return radius_graph_pbc(
+                    cart_coords=cart_coords,
+                    lattice=lattice,
+                    num_atoms=num_atoms_per_crystal,
+                    radius=cutoff,
+                    max_num_neighbors_threshold=max_neighbors,
+                    max_cell_images_per_dim=max_cell_images_per_dim,
+                    algorithm=algorithm,
+                )[0]
+
+            num_edges = build_graph().shape[1]
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+                torch.cuda.reset_peak_memory_stats()
+            start = time.perf_counter()
+            for _ in range(num_repeats):
+                build_graph()
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+                peak_memory = f"{torch.cuda.max_memory_allocated() / 2**20:9.1f}"
+            else:
+                peak_memory = f"{'-':>9}"
+            milliseconds = (time.perf_counter() - start) / num_repeats * 1000
+            print(f"{n:>6} {algorithm:>10} {num_edges:>9} {milliseconds:>9.1f} {peak_memory}")
+
+
+def _main():
+    # use fire instead of argparse to allow for the specification of list values via the CLI
+    fire.Fire(main)
+
+
+if __name__ == "__main__":
+    _main()
@@ -0,0 +1,141 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import dataclasses
+import time
+from pathlib import Path
+from typing import Literal
+
+import fire
+import torch
+from hydra.utils import instantiate
+
+from mattergen.common.utils.data_classes import (
+    PRETRAINED_MODEL_NAME,
+    MatterGenCheckpointInfo,
+)
+from mattergen.diffusion.data.batched_data import BatchedData
+from mattergen.diffusion.inference_options import InferenceOptions
+from mattergen.diffusion.sampling.pc_sampler import PredictorCorrector, _sample_prior
+from mattergen.generator import CrystalGenerator
+
+
+@torch.inference_mode()
+def sampling_steps_per_second(
+    sampler: PredictorCorrector,
+    warmup_batch: BatchedData,
+    batch: BatchedData,
+    num_warmup_steps: int,
+    num_steps: int,
+) -> float:
+    """
+    Returns the steady-state number of denoising steps per second of the sampler.
+
+    The sampler first takes `num_warmup_steps` steps on `warmup_batch`, e.g., to compile the model, and is then timed
+    for `num_steps` steps on `batch`. With different batches, the timed steps include any recompilation for new sizes.
+    """
+    sampler.diffusion_module.eval()  # type: ignore
+    elapsed = 0.0
+    for conditioning_data, n in ((warmup_batch, num_warmup_steps), (batch, num_steps)):
+        sampler._clear_batch_caches()
+        x = _sample_prior(sampler._multi_corruption, conditioning_data.to(sampler._device), mask={})
+        mean_x = x.clone()
+        state = sampler._initial_sampling_state(x)
+        batch_idx = sampler._multi_corruption._get_batch_indices(x)
+        start = time.perf_counter()
+        for _ in range(n):
+            x, mean_x, state, _ = sampler._sampling_step(
+                batch=x, mean_batch=mean_x, state=state, mask={}, batch_idx=batch_idx
+            )
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        elapsed = time.perf_counter() - start
+    return num_steps / elapsed
+
+
+def main(
+    pretrained_name: PRETRAINED_MODEL_NAME | None = None,
+    model_path: str | None = None,
+    batch_size: int = 16,
+    num_steps: int = 20,
+    num_warmup_steps: int = 3,
+    precision: str = "32",
+    config_overrides: list[str] | None = None,
+    checkpoint_epoch: Literal["best", "last"] | int = "last",
+    sampling_config_path: str | None = None,
+    sampling_config_name: str = "default",
+    sampling_config_overrides: list[str] | None = None,
+    strict_checkpoint_loading: bool = True,
+):
+    """
+    Compare the sampling speed of a model in eager mode and compiled with `torch.compile` (`--compile_model`).
+
+    For each mode, the sampler takes `num_warmup_steps` untimed steps on one batch, which includes compiling the model,
+    and is then timed for `num_steps` steps on another batch with a different number of atoms. The steady-state steps
+    per second of both modes are printed.
+
+    Args:
+        batch_size: Number of structures per batch. (default: 16)
+        num_steps: Number of timed denoising steps. (default: 20)
+        num_warmup_steps: Number of untimed denoising steps before timing. (default: 3)
+        precision: Precision of the score model in both modes, "32" or "bf16-mixed". (default: "32")
+        The other arguments are as for `mattergen-generate`.
+    """
+    assert (
+        pretrained_name is not None or model_path is not None
+    ), "Either pretrained_name or model_path must be provided."
+    assert (
+        pretrained_name is None or model_path is None
+    ), "Only one of pretrained_name or model_path can be provided."
+
+    config_overrides = config_overrides or []
+    if pretrained_name is not None:
+        checkpoint_info = MatterGenCheckpointInfo.from_hf_hub(
+            pretrained_name, config_overrides=config_overrides
+        )
+    else:
+        checkpoint_info = MatterGenCheckpointInfo(
+            model_path=Path(model_path).resolve(),
+            load_epoch=checkpoint_epoch,
+            config_overrides=config_overrides,
+            strict_checkpoint_loading=strict_checkpoint_loading,
+        )
+    generator = CrystalGenerator(
+        checkpoint_info=checkpoint_info,
+        sampling_config_name=sampling_config_name,
+        sampling_config_path=Path(sampling_config_path) if sampling_config_path else None,
+        sampling_config_overrides=sampling_config_overrides or [],
+        inference_options=InferenceOptions(precision=str(precision)),
+    )
+    sampling_config = generator.load_sampling_config(batch_size=batch_size, num_batches=2)
+    warmup_batch, batch = (
+        conditioning_data
+        for conditioning_data, _ in generator.get_condition_loader(sampling_config)
+    )
+    steps_per_second = {}
+    for compile_model in (False, True):
+        sampler = instantiate(sampling_config.sampler_partial)(
+            pl_module=generator.model,
+            inference_options=dataclasses.replace(
+                generator.inference_options, compile_model=compile_model
+            ),
+        )
+        steps_per_second[compile_model] = sampling_steps_per_second(
+            sampler,
+            warmup_batch=warmup_batch,
+            batch=batch,
+            num_warmup_steps=num_warmup_steps,
+            num_steps=num_steps,
+        )
+    print(f"eager:    {steps_per_second[False]:.3f} steps/s")
+    print(f"compiled: {steps_per_second[True]:.3f} steps/s")
+    print(f"speedup:  {steps_per_second[True] / steps_per_second[False]:.2f}x")
+
+
+def _main():
+    # use fire instead of argparse to allow for the specification of dictionary values via the CLI
+    fire.Fire(main)
+
+
+if __name__ == "__main__":
+    _main()
@@ -0,0 +1,39 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+from pathlib import Path
+
+import fire
+
+from mattergen.common.globals import (
+    GENERATED_TRAJECTORIES_DIR_NAME,
+    GENERATED_TRAJECTORIES_ZIP_FILE_NAME,
+)
+from mattergen.common.utils.trajectory_utils import export_trajectories_to_extxyz
+
+
+def main(output_path: str, save_as: str | None = None):
+    """
+    Convert the denoising trajectories recorded by `mattergen-generate` to .extxyz files.
+
+    Args:
+        output_path: Output directory of `mattergen-generate`.
+        save_as: Path of the zip file to write. (default: `{output_path}/generated_trajectories.zip`)
+    """
+    output_path = Path(output_path)
+    export_trajectories_to_extxyz(
+        trajectory_dir=output_path / GENERATED_TRAJECTORIES_DIR_NAME,
+        output_file=(
+            Path(save_as)
+            if save_as is not None
+            else output_path / GENERATED_TRAJECTORIES_ZIP_FILE_NAME
+        ),
+    )
+
+
+def _main():
+    fire.Fire(main)
+
+
+if __name__ == "__main__":
+    _main()
@@ -7,11 +7,13 @@ from typing import Literal
 
 import fire
 
+from mattergen.common.data.condition_factory import load_condition_table
 from mattergen.common.data.types import TargetProperty
 from mattergen.common.utils.data_classes import (
     PRETRAINED_MODEL_NAME,
     MatterGenCheckpointInfo,
 )
+from mattergen.diffusion.inference_options import InferenceOptions
 from mattergen.generator import CrystalGenerator
 
 
@@ -31,6 +33,19 @@ def main(
     diffusion_guidance_factor: float | None = None,
     strict_checkpoint_loading: bool = True,
     target_compositions: list[dict[str, int]] | None = None,
+    stream: bool = False,
+    max_atoms_per_batch: int | None = None,
+    pool_size: int | None = None,
+    num_workers: int = 1,
+    seed: int | None = None,
+    resume: bool = False,
+    regenerate: list[int] | None = None,
+    guidance_sweep: list[float] | None = None,
+    condition_table: str | None = None,
+    precision: str = "32",
+    compile_model: bool = False,
+    neighbor_list_skin: float | None = None,
+    max_triplets_per_chunk: int | None = None,
 ):
     """
     Evaluate diffusion model against molecular metrics.
@@ -48,6 +63,42 @@ def main(
         strict_checkpoint_loading: Whether to raise an exception when not all parameters from the checkpoint can be matched to the model.
         target_compositions: List of dictionaries with target compositions to condition on. Each dictionary should have the form `{element: number_of_atoms}`. If None, the target compositions are not conditioned on.
            Only supported for models trained for crystal structure prediction (CSP) (default: None)
+        stream: Whether to append the structures of each batch to the output files as soon as the batch is generated, instead of writing all structures at the end.
+           Memory use then does not grow with the number of batches, and batches that were finished before an interruption are kept. (default: False)
+        max_atoms_per_batch: If given, structures of similar size are packed into batches of at most this many atoms (and at most `batch_size` structures),
+           which bounds peak memory and evens out the time per batch. The total number of structures is still `batch_size * num_batches`. (default: None)
+        pool_size: If given, use continuous batching: this many structures are denoised together, and each finished structure is replaced by a new one right away.
+           Most useful with samplers whose structures finish at different times, e.g., `--sampling-config-name=adaptive`. Trajectories are not recorded. (default: None)
+        num_workers: Number of worker processes. If larger than 1, the batches are split across the workers, each with its own copy of the model,
+           its own share of the CPU cores (and GPU, if several are available) and its own random seed. With `condition_table` or `target_compositions`, the structures
+           of each row or composition are split across the workers instead. The outputs are merged at the end. (default: 1)
+        seed: Random seed. Each batch (or, if `num_workers > 1`, each worker) is sampled with its own seed derived from this one,
+           so that runs with the same seed generate the same structures. Unless `pool_size` is given, the sampling noise of each
+           structure only depends on the seed (of its worker) and the index of the structure, see `regenerate`. (default: None)
+        resume: Whether to continue an interrupted run in `output_path`. The outputs of each batch are saved as soon as the batch is finished,
+           and only the missing batches are generated when the run is resumed. The final output files are the same as for an uninterrupted run.
+           Must be used with the same `batch_size`, `num_batches` and `seed` (if any) for the original and the resumed run. Resuming a run with a different
+           model, sampling config, conditions or inference options fails. (default: False)
+        regenerate: Indices of structures of a seeded or multi-worker run in `output_path` to regenerate one at a time, with their trajectories,
+           instead of generating new structures. Pass the same options as for the original run. The results are written to `{output_path}/regenerated`.
+           Runs with `pool_size` cannot be regenerated. (default: None)
+        guidance_sweep: Diffusion guidance factors to generate the same conditions at, instead of `diffusion_guidance_factor`. The structures for all
+           guidance factors are sampled together, sharing each forward pass of the model, and are written to `{output_path}/guidance_{factor}`. (default: None)
+        condition_table: Path to a .csv or .json file with one set of properties to condition on per row, instead of `properties_to_condition_on`.
+           The `batch_size * num_batches` structures, a multiple of the number of rows, are split evenly across the rows, and structures for different rows are generated in the same batches.
+           Each structure is labelled with its row in the `condition_row` field of the output .extxyz file. (default: None)
+        precision: Precision of the score model, "32" or "bf16-mixed". With "bf16-mixed", the embeddings, dense layers and interaction blocks of
+           GemNet run in bfloat16, which is faster on hardware with bfloat16 support, e.g., CPUs with AVX512-BF16 or AMX. The scores then differ from
+           the full-precision ones by about a percent. (default: "32")
+        compile_model: Whether to compile the interaction blocks of the model with `torch.compile`. Compilation takes a few minutes in the first sampling step
+           and then speeds up each step. The compiled blocks handle any number of atoms, edges and triplets, so that batches of different sizes do not
+           trigger recompilation. If compilation fails, e.g., without a C++ compiler, the model runs uncompiled. (default: False)
+        neighbor_list_skin: If given, the model lists the pairs of atoms within its cutoff plus this skin (in Angstrom), and only rebuilds the list
+           once an atom may have moved by more than half the skin. In between, each sampling step only filters the listed pairs to the cutoff,
+           which gives the same graph as building it from scratch. Late in denoising, when the atoms barely move, the list is rarely rebuilt. (default: None)
+        max_triplets_per_chunk: If given, the model passes the messages of its triplets (pairs of edges to the same atom) and of their edges in chunks of
+           at most about this many triplets, which bounds its peak memory for large structures. Very small chunks are slow. The outputs are the same as
+           without chunking. (default: None)
 
     NOTE: When specifying dictionary values via the CLI, make sure there is no whitespace between the key and value, e.g., `--properties_to_condition_on={key1:value1}`.
     """
@@ -91,8 +142,31 @@ def main(
             diffusion_guidance_factor if diffusion_guidance_factor is not None else 0.0
         ),
         target_compositions_dict=target_compositions,
+        max_atoms_per_batch=max_atoms_per_batch,
+        pool_size=pool_size,
+        seed=seed,
+        resume=resume,
+        condition_table=load_condition_table(condition_table) if condition_table else None,
+        inference_options=InferenceOptions(
+            precision=str(precision),
+            compile_model=compile_model,
+            neighbor_list_skin=neighbor_list_skin,
+            max_triplets_per_chunk=max_triplets_per_chunk,
+        ),
     )
-    generator.generate(output_dir=Path(output_path))
+    if guidance_sweep:
+        generator.generate_guidance_sweep(
+            guidance_factors=[float(g) for g in guidance_sweep], output_dir=output_path
+        )
+    elif regenerate:
+        generator.regenerate(structure_indices=regenerate, output_dir=output_path)
+    elif num_workers > 1:
+        generator.generate_parallel(num_workers=num_workers, output_dir=output_path, seed=seed)
+    elif stream:
+        for _ in generator.generate_iter(output_dir=Path(output_path)):
+            pass
+    else:
+        generator.generate(output_dir=Path(output_path))
 
 
 def _main():
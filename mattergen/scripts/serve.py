@@ -0,0 +1,89 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+from pathlib import Path
+from typing import Literal
+
+import fire
+
+from mattergen.common.utils.data_classes import (
+    PRETRAINED_MODEL_NAME,
+    MatterGenCheckpointInfo,
+)
+from mattergen.generation_server import GenerationServer, make_http_server
+from mattergen.generator import CrystalGenerator
+
+
+def main(
+    pretrained_name: PRETRAINED_MODEL_NAME | None = None,
+    model_path: str | None = None,
+    host: str = "127.0.0.1",
+    port: int = 8000,
+    max_batch_size: int = 64,
+    config_overrides: list[str] | None = None,
+    checkpoint_epoch: Literal["best", "last"] | int = "last",
+    sampling_config_path: str | None = None,
+    sampling_config_name: str = "default",
+    sampling_config_overrides: list[str] | None = None,
+    strict_checkpoint_loading: bool = True,
+):
+    """
+    Serve generation requests over HTTP with a model that stays loaded.
+
+    Requests are sent as JSON to `POST /generate`, e.g., `{"num_samples": 16, "properties_to_condition_on": {"dft_mag_density": 0.15},
+    "diffusion_guidance_factor": 2.0}`; see `GenerationRequest` for the fields. The response streams one JSON line per generated batch,
+    `{"structures": [<cif>, ...]}`, followed by `{"done": true, "num_structures": <n>}`. Requests that arrive while a batch is
+    being generated are merged into shared batches where possible. `GET /health` reports the number of queued requests.
+
+    Args:
+        host: Address to listen on. The server has no authentication, so only expose it on trusted networks. (default: 127.0.0.1)
+        port: Port to listen on. (default: 8000)
+        max_batch_size: Maximum number of structures generated in one batch. (default: 64)
+        The other arguments are as for `mattergen-generate`.
+    """
+    assert (
+        pretrained_name is not None or model_path is not None
+    ), "Either pretrained_name or model_path must be provided."
+    assert (
+        pretrained_name is None or model_path is None
+    ), "Only one of pretrained_name or model_path can be provided."
+
+    config_overrides = config_overrides or []
+    if pretrained_name is not None:
+        checkpoint_info = MatterGenCheckpointInfo.from_hf_hub(
+            pretrained_name, config_overrides=config_overrides
+        )
+    else:
+        checkpoint_info = MatterGenCheckpointInfo(
+            model_path=Path(model_path).resolve(),
+            load_epoch=checkpoint_epoch,
+            config_overrides=config_overrides,
+            strict_checkpoint_loading=strict_checkpoint_loading,
+        )
+    generator = CrystalGenerator(
+        checkpoint_info=checkpoint_info,
+        sampling_config_name=sampling_config_name,
+        sampling_config_path=Path(sampling_config_path) if sampling_config_path else None,
+        sampling_config_overrides=sampling_config_overrides or [],
+    )
+    generation_server = GenerationServer(generator, max_batch_size=max_batch_size)
+    generation_server.prepare()
+    generation_server.start()
+    http_server = make_http_server(generation_server, host=host, port=port)
+    print(f"Serving generation requests on http://{host}:{http_server.server_address[1]}")
+    try:
+        http_server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        http_server.server_close()
+        generation_server.stop()
+
+
+def _main():
+    # use fire instead of argparse to allow for the specification of dictionary values via the CLI
+    fire.Fire(main)
+
+
+if __name__ == "__main__":
+    _main()
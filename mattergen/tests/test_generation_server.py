@@ -0,0 +1,154 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import json
+import threading
+import urllib.error
+import urllib.request
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+from mattergen.common.utils.data_classes import MatterGenCheckpointInfo
+from mattergen.generation_server import GenerationRequest, GenerationServer, make_http_server
+from mattergen.generator import CrystalGenerator
+
+
+class _FakeSampler:
+    """Places the atoms at random positions in a cubic cell, with atom type 1 + guidance scale."""
+
+    def __init__(self, guidance_scale: float):
+        self.guidance_scale = guidance_scale
+        self.batch_sizes: list[int] = []
+        self.diffusion_module = SimpleNamespace(
+            model=SimpleNamespace(cond_fields_model_was_trained_on=["dft_band_gap"])
+        )
+
+    def sample(self, conditioning_data, mask):
+        self.batch_sizes.append(conditioning_data.get_batch_size())
+        sample = conditioning_data.replace(
+            pos=torch.rand_like(conditioning_data.pos),
+            cell=torch.eye(3).expand(conditioning_data.get_batch_size(), 3, 3) * 5.0,
+            atomic_numbers=torch.full_like(
+                conditioning_data.atomic_numbers, 1 + int(self.guidance_scale)
+            ),
+        )
+        return sample, sample
+
+
+class _FakeGenerationServer(GenerationServer):
+    def _get_sampler(self, request: GenerationRequest) -> _FakeSampler:  # type: ignore
+        key = float(request.diffusion_guidance_factor)
+        if key not in self._samplers:
+            self._samplers[key] = _FakeSampler(key)  # type: ignore
+        return self._samplers[key]  # type: ignore
+
+
+def _get_server(max_batch_size: int) -> GenerationServer:
+    generator = CrystalGenerator(
+        checkpoint_info=MatterGenCheckpointInfo(model_path="unused"),  # type: ignore
+    )
+    return _FakeGenerationServer(generator, max_batch_size=max_batch_size)
+
+
+def test_generation_server_merges_compatible_requests():
+    server = _get_server(max_batch_size=8)
+    jobs = [
+        server.submit(GenerationRequest(num_samples=3)),
+        server.submit(GenerationRequest(num_samples=2, diffusion_guidance_factor=1.0)),
+        server.submit(GenerationRequest(num_samples=4)),
+        server.submit(
+            GenerationRequest(num_samples=10, properties_to_condition_on={"dft_band_gap": 1.0})
+        ),
+    ]
+    server.start()
+    try:
+        results = [list(job.results()) for job in jobs]
+    finally:
+        server.stop()
+
+    # The first and third request share a batch. The fourth request is split across two batches.
+    assert [[len(structures) for structures in result] for result in results] == [
+        [3],
+        [2],
+        [4],
+        [8, 2],
+    ]
+    assert server._samplers[0.0].batch_sizes == [7, 8, 2]  # type: ignore
+    assert server._samplers[1.0].batch_sizes == [2]  # type: ignore
+    assert server.num_batches == 4
+    for result, atomic_number in zip(results, [1, 2, 1, 1]):
+        for structures in result:
+            assert all(set(s.atomic_numbers) == {atomic_number} for s in structures)
+
+
+def test_generation_server_rejects_invalid_requests():
+    server = _get_server(max_batch_size=8)
+    with pytest.raises(ValueError):
+        server.submit(GenerationRequest(num_samples=1, properties_to_condition_on={"foo": 1.0}))
+    with pytest.raises(ValueError):
+        GenerationRequest(num_samples=0)
+    with pytest.raises(ValueError):
+        GenerationRequest.from_dict({"num_samples": 1, "bar": 2})
+    # The structures cannot be split evenly across the compositions.
+    with pytest.raises(ValueError):
+        GenerationRequest(num_samples=3, target_compositions=[{"Li": 1}, {"Na": 1}])
+
+
+def test_generation_http_server():
+    server = _get_server(max_batch_size=4)
+    server.start()
+    http_server = make_http_server(server, port=0)
+    thread = threading.Thread(target=http_server.serve_forever, daemon=True)
+    thread.start()
+    url = f"http://127.0.0.1:{http_server.server_address[1]}"
+    try:
+        with urllib.request.urlopen(f"{url}/health") as response:
+            assert json.loads(response.read())["status"] == "ok"
+
+        request = urllib.request.Request(
+            f"{url}/generate",
+            data=json.dumps({"num_samples": 6, "diffusion_guidance_factor": 1.0}).encode(),
+            method="POST",
+        )
+        with urllib.request.urlopen(request) as response:
+            lines = [json.loads(line) for line in response.read().splitlines()]
+        assert [len(line["structures"]) for line in lines[:-1]] == [4, 2]
+        assert all(cif.startswith("data_") for line in lines[:-1] for cif in line["structures"])
+        assert lines[-1] == {"done": True, "num_structures": 6}
+
+        bad_request = urllib.request.Request(
+            f"{url}/generate", data=json.dumps({"num_samples": -1}).encode(), method="POST"
+        )
+        with pytest.raises(urllib.error.HTTPError) as e:
+            urllib.request.urlopen(bad_request)
+        assert e.value.code == 400
+    finally:
+        http_server.shutdown()
+        http_server.server_close()
+        server.stop()
+
+
+def test_generation_http_server_reports_internal_errors(monkeypatch):
+    server = _get_server(max_batch_size=4)
+
+    def submit(request: GenerationRequest):
+        raise RuntimeError("out of memory")
+
+    monkeypatch.setattr(server, "submit", submit)
+    http_server = make_http_server(server, port=0)
+    thread = threading.Thread(target=http_server.serve_forever, daemon=True)
+    thread.start()
+    url = f"http://127.0.0.1:{http_server.server_address[1]}"
+    try:
+        request = urllib.request.Request(
+            f"{url}/generate", data=json.dumps({"num_samples": 2}).encode(), method="POST"
+        )
+        with pytest.raises(urllib.error.HTTPError) as e:
+            urllib.request.urlopen(request)
+        assert e.value.code == 500
+        assert json.loads(e.value.read()) == {"error": "Internal error: out of memory"}
+    finally:
+        http_server.shutdown()
+        http_server.server_close()
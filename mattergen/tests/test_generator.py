@@ -1,11 +1,43 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT License.
 
+import io
+from collections import Counter
+from pathlib import Path
+from types import SimpleNamespace
 from typing import List
+from zipfile import ZipFile
 
+import ase.io
 import pytest
+import torch
+from omegaconf import OmegaConf
 
+from mattergen.common.data.chemgraph import ChemGraph
+from mattergen.common.data.collate import collate
+from mattergen.common.data.condition_factory import CONDITION_ROW, get_condition_table_loader
+from mattergen.common.globals import (
+    GENERATED_CRYSTALS_EXTXYZ_FILE_NAME,
+    GENERATED_CRYSTALS_ZIP_FILE_NAME,
+    GENERATED_TRAJECTORIES_DIR_NAME,
+    GENERATED_TRAJECTORIES_ZIP_FILE_NAME,
+)
+from mattergen.common.utils.data_classes import MatterGenCheckpointInfo
+from mattergen.common.utils.eval_utils import load_structures
+from mattergen.common.utils.generation_run import GenerationManifest, SampleSeeds, get_batch_dir
 from mattergen.common.utils.globals import MAX_ATOMIC_NUM
+from mattergen.common.utils.trajectory_utils import (
+    TRAJECTORY_FILE_SUFFIX,
+    export_trajectories_to_extxyz,
+)
+from mattergen.diffusion.inference_options import InferenceOptions
+from mattergen.generator import (
+    CrystalGenerator,
+    draw_guidance_sweep_from_sampler,
+    draw_samples_from_sampler,
+    draw_samples_from_sampler_iter,
+    merge_generation_outputs,
+)
 from mattergen.property_embeddings import ChemicalSystemMultiHotEmbedding
 
 
@@ -22,3 +54,473 @@ def test_chemical_system_to_multi_hot(chemical_system: List[str]) -> None:
         MAX_ATOMIC_NUM + 1,
     )
     assert multi_hot_encoding.sum() == len(chemical_system)
+
+
+class _FakeSampler:
+    """Returns the conditioning data as the sample, and a two-step trajectory."""
+
+    updates_depend_on_batch = False
+
+    def __init__(self):
+        self.diffusion_module = SimpleNamespace(
+            model=SimpleNamespace(cond_fields_model_was_trained_on=[])
+        )
+
+    def sample(self, conditioning_data, mask):
+        return conditioning_data, conditioning_data
+
+    def sample_with_record(self, conditioning_data, mask):
+        return conditioning_data, conditioning_data, [conditioning_data, conditioning_data]
+
+
+class _NoisyFakeSampler(_FakeSampler):
+    """Like _FakeSampler, but adds random noise to the positions."""
+
+    def sample(self, conditioning_data, mask):
+        sample = conditioning_data.replace(pos=torch.rand_like(conditioning_data.pos))
+        return sample, sample
+
+    def sample_with_record(self, conditioning_data, mask):
+        sample, mean = self.sample(conditioning_data, mask)
+        return sample, mean, [conditioning_data, sample]
+
+
+class _FakeSweepSampler(_FakeSampler):
+    """Returns the conditioning data with positions scaled by the guidance scale for each guidance scale."""
+
+    def sample_guidance_sweep(self, conditioning_data, guidance_scales, mask):
+        return [
+            (conditioning_data, conditioning_data.replace(pos=conditioning_data.pos * g))
+            for g in guidance_scales
+        ]
+
+
+class _RandomFakeSampler(_FakeSampler):
+    """Places sodium atoms at random positions in a cubic cell."""
+
+    def sample(self, conditioning_data, mask):
+        sample = conditioning_data.replace(
+            pos=torch.rand_like(conditioning_data.pos),
+            cell=torch.eye(3).expand(conditioning_data.get_batch_size(), 3, 3) * 5.0,
+            atomic_numbers=torch.full_like(conditioning_data.atomic_numbers, 11),
+        )
+        return sample, sample
+
+
+def _get_batch(num_atoms: List[int]) -> ChemGraph:
+    return collate(
+        [
+            ChemGraph(
+                pos=torch.rand(n, 3),
+                atomic_numbers=torch.randint(1, 20, (n,)),
+                cell=(torch.eye(3) * 4.0 + 0.1 * torch.rand(3, 3))[None],
+                num_atoms=torch.tensor([n]),
+            )
+            for n in num_atoms
+        ]
+    )
+
+
+@pytest.mark.parametrize("record_trajectories", [True, False])
+def test_draw_samples_from_sampler_iter(tmp_path: Path, record_trajectories: bool):
+    condition_loader = [(_get_batch([2, 3]), None), (_get_batch([4]), None)]
+    trajectory_dir = tmp_path / GENERATED_TRAJECTORIES_DIR_NAME
+    structures_iter = draw_samples_from_sampler_iter(
+        sampler=_FakeSampler(),  # type: ignore
+        condition_loader=condition_loader,  # type: ignore
+        output_path=tmp_path,
+        cfg=OmegaConf.create({}),
+        record_trajectories=record_trajectories,
+    )
+
+    first_batch = next(structures_iter)
+    assert [len(s) for s in first_batch] == [2, 3]
+    # The first batch is on disk before the second one is generated.
+    assert len(load_structures(tmp_path / GENERATED_CRYSTALS_EXTXYZ_FILE_NAME)) == 2
+    if record_trajectories:
+        assert [p.name for p in trajectory_dir.iterdir()] == [
+            f"batch_00000{TRAJECTORY_FILE_SUFFIX}"
+        ]
+    second_batch = next(structures_iter)
+    assert [len(s) for s in second_batch] == [4]
+    with pytest.raises(StopIteration):
+        next(structures_iter)
+
+    for file_name in [GENERATED_CRYSTALS_EXTXYZ_FILE_NAME, GENERATED_CRYSTALS_ZIP_FILE_NAME]:
+        saved = load_structures(tmp_path / file_name)
+        assert sorted(len(s) for s in saved) == [2, 3, 4]
+    with ZipFile(tmp_path / GENERATED_CRYSTALS_ZIP_FILE_NAME) as zip_obj:
+        assert sorted(zip_obj.namelist()) == ["gen_0.cif", "gen_1.cif", "gen_2.cif"]
+    if record_trajectories:
+        assert sorted(p.name for p in trajectory_dir.iterdir()) == [
+            f"batch_00000{TRAJECTORY_FILE_SUFFIX}",
+            f"batch_00001{TRAJECTORY_FILE_SUFFIX}",
+        ]
+        export_trajectories_to_extxyz(
+            trajectory_dir, output_file=tmp_path / GENERATED_TRAJECTORIES_ZIP_FILE_NAME
+        )
+        with ZipFile(tmp_path / GENERATED_TRAJECTORIES_ZIP_FILE_NAME) as zip_obj:
+            assert sorted(zip_obj.namelist()) == ["gen_0.extxyz", "gen_1.extxyz", "gen_2.extxyz"]
+            trajectory = ase.io.read(
+                io.StringIO(zip_obj.read("gen_2.extxyz").decode()), index=":", format="extxyz"
+            )
+        # Two recorded frames of the structure with 4 atoms.
+        assert [len(atoms) for atoms in trajectory] == [4, 4]
+    else:
+        assert not trajectory_dir.exists()
+
+    # Generating again into the same directory overwrites the previous results.
+    structures = draw_samples_from_sampler(
+        sampler=_FakeSampler(),  # type: ignore
+        condition_loader=condition_loader[:1],  # type: ignore
+        output_path=tmp_path,
+        cfg=OmegaConf.create({}),
+        record_trajectories=record_trajectories,
+    )
+    assert len(structures) == 2
+    assert len(load_structures(tmp_path / GENERATED_CRYSTALS_EXTXYZ_FILE_NAME)) == 2
+    if record_trajectories:
+        assert [p.name for p in trajectory_dir.iterdir()] == [
+            f"batch_00000{TRAJECTORY_FILE_SUFFIX}"
+        ]
+
+
+def test_merge_generation_outputs(tmp_path: Path):
+    worker_output_paths = [tmp_path / "worker_0", tmp_path / "worker_1", tmp_path / "worker_2"]
+    for worker_output_path, condition_loader in zip(
+        worker_output_paths,
+        [[(_get_batch([2, 3]), None), (_get_batch([4]), None)], [(_get_batch([5]), None)], []],
+    ):
+        worker_output_path.mkdir()
+        draw_samples_from_sampler(
+            sampler=_FakeSampler(),  # type: ignore
+            condition_loader=condition_loader,  # type: ignore
+            output_path=worker_output_path,
+            cfg=OmegaConf.create({}),
+        )
+
+    assert merge_generation_outputs(worker_output_paths, tmp_path) == 4
+
+    assert [len(s) for s in load_structures(tmp_path / GENERATED_CRYSTALS_EXTXYZ_FILE_NAME)] == [
+        2,
+        3,
+        4,
+        5,
+    ]
+    with ZipFile(tmp_path / GENERATED_CRYSTALS_ZIP_FILE_NAME) as zip_obj:
+        assert sorted(zip_obj.namelist()) == [f"gen_{i}.cif" for i in range(4)]
+    export_trajectories_to_extxyz(
+        tmp_path / GENERATED_TRAJECTORIES_DIR_NAME,
+        output_file=tmp_path / GENERATED_TRAJECTORIES_ZIP_FILE_NAME,
+    )
+    with ZipFile(tmp_path / GENERATED_TRAJECTORIES_ZIP_FILE_NAME) as zip_obj:
+        trajectory = ase.io.read(
+            io.StringIO(zip_obj.read("gen_3.extxyz").decode()), index=":", format="extxyz"
+        )
+    assert [len(atoms) for atoms in trajectory] == [5, 5]
+
+
+def test_resume_generation_run(tmp_path: Path):
+    condition_loader = [
+        (_get_batch([2, 3]), None),
+        (_get_batch([4]), None),
+        (_get_batch([5]), None),
+    ]
+
+    def run(output_path: Path, manifest: GenerationManifest | None = None):
+        return draw_samples_from_sampler_iter(
+            sampler=_NoisyFakeSampler(),  # type: ignore
+            condition_loader=condition_loader,  # type: ignore
+            output_path=output_path,
+            cfg=OmegaConf.create({}),
+            seed=42,
+            manifest=manifest,
+        )
+
+    reference_path = tmp_path / "reference"
+    reference_path.mkdir()
+    reference = [s for structures in run(reference_path) for s in structures]
+
+    run_path = tmp_path / "run"
+    run_path.mkdir()
+    manifest = GenerationManifest(seed=42, batch_size=2, num_batches=3)
+    manifest.save(run_path)
+    structures_iter = run(run_path, manifest)
+    next(structures_iter)
+    next(structures_iter)
+    # Interrupt the run after two batches.
+    del structures_iter
+    manifest = GenerationManifest.load(run_path)
+    assert manifest is not None
+    assert manifest.finished_batches == {0: 2, 1: 1}
+    assert not (run_path / GENERATED_CRYSTALS_EXTXYZ_FILE_NAME).exists()
+
+    torch.manual_seed(0)  # The random state before resuming does not matter.
+    resumed = [s for structures in run(run_path, manifest) for s in structures]
+    assert GenerationManifest.load(run_path) == GenerationManifest(
+        seed=42, batch_size=2, num_batches=3, finished_batches={0: 2, 1: 1, 2: 1}
+    )
+    assert resumed == reference
+    assert SampleSeeds.load(run_path) == SampleSeeds(segments=[(42, 4)])
+    for file_name in [GENERATED_CRYSTALS_EXTXYZ_FILE_NAME, GENERATED_CRYSTALS_ZIP_FILE_NAME]:
+        assert load_structures(run_path / file_name) == load_structures(reference_path / file_name)
+    for path in [reference_path, run_path]:
+        export_trajectories_to_extxyz(
+            path / GENERATED_TRAJECTORIES_DIR_NAME,
+            output_file=path / GENERATED_TRAJECTORIES_ZIP_FILE_NAME,
+        )
+    with (
+        ZipFile(run_path / GENERATED_TRAJECTORIES_ZIP_FILE_NAME) as run_zip,
+        ZipFile(reference_path / GENERATED_TRAJECTORIES_ZIP_FILE_NAME) as reference_zip,
+    ):
+        assert sorted(run_zip.namelist()) == [f"gen_{i}.extxyz" for i in range(4)]
+        for name in run_zip.namelist():
+            assert run_zip.read(name) == reference_zip.read(name)
+
+    with pytest.raises(ValueError):
+        manifest.check_compatible(seed=43, batch_size=2, num_batches=3, fingerprints={})
+    with pytest.raises(ValueError):
+        manifest.check_compatible(seed=None, batch_size=2, num_batches=4, fingerprints={})
+    with pytest.raises(ValueError):
+        manifest.check_compatible(
+            seed=None, batch_size=2, num_batches=3, fingerprints={"checkpoint": "abc"}
+        )
+    # Batches are reseeded on resume, nothing else is stored with them.
+    assert sorted(p.name for p in get_batch_dir(run_path, 0).iterdir()) == [
+        GENERATED_CRYSTALS_EXTXYZ_FILE_NAME,
+        GENERATED_CRYSTALS_ZIP_FILE_NAME,
+        GENERATED_TRAJECTORIES_DIR_NAME,
+    ]
+
+
+def test_resume_rejects_different_setup(tmp_path: Path):
+    checkpoint = tmp_path / "model" / "checkpoints" / "last.ckpt"
+    checkpoint.parent.mkdir(parents=True)
+    checkpoint.write_bytes(b"weights")
+    run_path = tmp_path / "run"
+
+    def prepare_run(**kwargs):
+        generator = CrystalGenerator(
+            checkpoint_info=MatterGenCheckpointInfo(model_path=str(tmp_path / "model")),
+            seed=42,
+            resume=True,
+            **{"properties_to_condition_on": {"dft_band_gap": 1.0}, **kwargs},
+        )
+        return generator._prepare_run(batch_size=2, num_batches=3, output_path=run_path)
+
+    _, manifest = prepare_run()
+    assert manifest is not None
+    assert set(manifest.fingerprints) == {
+        "sampling config",
+        "conditions",
+        "checkpoint",
+        "inference options",
+    }
+    assert prepare_run() == (42, manifest)
+    for kwargs, changed in [
+        ({"properties_to_condition_on": {"dft_band_gap": 2.0}}, "conditions"),
+        ({"diffusion_guidance_factor": 2.0}, "sampling config"),
+        ({"sampling_config_name": "fast"}, "sampling config"),
+        ({"sampling_config_overrides": ["sampler_partial.N=10"]}, "sampling config"),
+        ({"inference_options": InferenceOptions(precision="bf16-mixed")}, "inference options"),
+    ]:
+        with pytest.raises(ValueError, match=changed):
+            prepare_run(**kwargs)
+    checkpoint.write_bytes(b"other weights")
+    with pytest.raises(ValueError, match="checkpoint"):
+        prepare_run()
+
+
+def test_sample_seeds(tmp_path: Path):
+    # E.g., a multi-process run whose second worker used continuous batching.
+    sample_seeds = SampleSeeds.concatenate(
+        [
+            SampleSeeds(segments=[(7, 3)]),
+            SampleSeeds(segments=[(None, 2)]),
+            SampleSeeds(segments=[(8, 2)]),
+        ]
+    )
+    sample_seeds.save(tmp_path)
+    assert SampleSeeds.load(tmp_path) == sample_seeds
+    assert [sample_seeds.get(ix) for ix in [0, 2, 5, 6]] == [(7, 0), (7, 2), (8, 0), (8, 1)]
+    for ix in [3, 7]:
+        with pytest.raises(ValueError):
+            sample_seeds.get(ix)
+
+
+def test_draw_guidance_sweep_from_sampler(tmp_path: Path):
+    condition_loader = [(_get_batch([2, 3]), None), (_get_batch([4]), None)]
+    guidance_scales = [0.5, 1.0]
+    output_paths = [tmp_path / f"guidance_{g}" for g in guidance_scales]
+    structures = draw_guidance_sweep_from_sampler(
+        sampler=_FakeSweepSampler(),  # type: ignore
+        condition_loader=condition_loader,  # type: ignore
+        guidance_scales=guidance_scales,
+        output_paths=output_paths,
+    )
+    assert [[len(s) for s in structures_for_scale] for structures_for_scale in structures] == [
+        [2, 3, 4],
+        [2, 3, 4],
+    ]
+    for structures_for_scale, output_path in zip(structures, output_paths):
+        assert load_structures(output_path / GENERATED_CRYSTALS_EXTXYZ_FILE_NAME) == list(
+            structures_for_scale
+        )
+    # The structures for each guidance scale are generated from the same conditions.
+    assert torch.allclose(
+        torch.tensor(structures[0][2].cart_coords) * 2, torch.tensor(structures[1][2].cart_coords)
+    )
+
+
+def test_draw_samples_with_condition_table(tmp_path: Path):
+    conditions = [{"dft_bulk_modulus": bulk_modulus} for bulk_modulus in [100.0, 200.0, 300.0]]
+    condition_loader = get_condition_table_loader(
+        num_atoms_distribution="ALEX_MP_20",
+        conditions=conditions,
+        num_samples_per_condition=4,
+        batch_size=5,
+    )
+    structures = draw_samples_from_sampler(
+        sampler=_RandomFakeSampler(),  # type: ignore
+        condition_loader=condition_loader,
+        output_path=tmp_path,
+        cfg=OmegaConf.create({}),
+        record_trajectories=False,
+    )
+    # Each structure is labelled with the row of its conditions, also in the output file.
+    rows = [structure.properties[CONDITION_ROW] for structure in structures]
+    assert sorted(rows) == [0, 0, 0, 0, 1, 1, 1, 1, 2, 2, 2, 2]
+    saved = load_structures(tmp_path / GENERATED_CRYSTALS_EXTXYZ_FILE_NAME)
+    assert [structure.properties[CONDITION_ROW] for structure in saved] == rows
+
+
+@pytest.mark.parametrize("batch_size, num_batches", [(2, 1), (5, 1), (2, 2)])
+def test_condition_table_needs_even_split(batch_size: int, num_batches: int):
+    generator = CrystalGenerator(
+        checkpoint_info=MatterGenCheckpointInfo(model_path="unused"),  # type: ignore
+        condition_table=[
+            {"dft_bulk_modulus": bulk_modulus} for bulk_modulus in [100.0, 200.0, 300.0]
+        ],
+    )
+    # Fewer structures than rows, or a number of structures that is not a multiple of the number of rows.
+    with pytest.raises(ValueError):
+        generator.get_num_samples_per_condition(batch_size=batch_size, num_batches=num_batches)
+    with pytest.raises(ValueError):
+        generator.load_sampling_config(batch_size=batch_size, num_batches=num_batches)
+
+
+def test_regenerate_condition_table_run(tmp_path: Path):
+    conditions = [{"dft_bulk_modulus": bulk_modulus} for bulk_modulus in [100.0, 200.0]]
+    condition_loader = get_condition_table_loader(
+        num_atoms_distribution="ALEX_MP_20",
+        conditions=conditions,
+        num_samples_per_condition=3,
+        batch_size=4,
+    )
+    structures = draw_samples_from_sampler(
+        sampler=_RandomFakeSampler(),  # type: ignore
+        condition_loader=condition_loader,
+        output_path=tmp_path,
+        cfg=OmegaConf.create({}),
+        record_trajectories=False,
+        seed=42,
+    )
+
+    class _RecordingSampler(_RandomFakeSampler):
+        def __init__(self):
+            super().__init__()
+            self.conditioning_data = []
+
+        def sample_with_record(self, conditioning_data, mask):
+            self.conditioning_data.append(conditioning_data)
+            sample, mean = self.sample(conditioning_data, mask)
+            return sample, mean, [sample, sample]
+
+    sampler = _RecordingSampler()
+    generator = CrystalGenerator(
+        checkpoint_info=MatterGenCheckpointInfo(model_path="unused"),  # type: ignore
+        condition_table=conditions,
+    )
+    generator.get_sampler = lambda sampling_config: sampler  # type: ignore
+    # Regeneration samples one structure at a time, fewer than the rows of the condition table.
+    regenerated = generator.regenerate(structure_indices=[4], output_dir=str(tmp_path))
+    assert len(regenerated) == 1
+    assert len(regenerated[0]) == len(structures[4])
+    # The structure is conditioned on the properties of its row.
+    row = structures[4].properties[CONDITION_ROW]
+    (conditioning_data,) = sampler.conditioning_data
+    assert conditioning_data[CONDITION_ROW].tolist() == [row]
+    assert conditioning_data["dft_bulk_modulus"].tolist() == [conditions[row]["dft_bulk_modulus"]]
+
+
+def _count_conditions(
+    generator: CrystalGenerator,
+    batch_size: int,
+    num_samples_per_condition: int,
+    target_compositions_dict=None,
+) -> Counter:
+    sampling_config = generator.load_sampling_config(
+        batch_size=batch_size,
+        num_batches=1,
+        target_compositions_dict=target_compositions_dict,
+        num_samples_per_condition=num_samples_per_condition,
+    )
+    counts: Counter = Counter()
+    for conditioning_data, _ in generator.get_condition_loader(
+        sampling_config, target_compositions_dict
+    ):
+        if generator.condition_table:
+            counts.update(conditioning_data[CONDITION_ROW].tolist())
+        else:
+            counts.update(conditioning_data["num_atoms"].tolist())
+    return counts
+
+
+def test_split_condition_table_across_workers(tmp_path: Path):
+    generator = CrystalGenerator(
+        checkpoint_info=MatterGenCheckpointInfo(model_path="unused"),  # type: ignore
+        condition_table=[
+            {"dft_bulk_modulus": bulk_modulus} for bulk_modulus in [100.0, 200.0, 300.0, 400.0]
+        ],
+    )
+    # 12 structures, 3 per row, are split by row rather than by batch: 6 structures per worker would not
+    # split evenly across the 4 rows.
+    shares = generator.split_samples_across_workers(2, batch_size=3, num_batches=4)
+    assert shares == [2, 1]
+    counts = sum(
+        (_count_conditions(generator, batch_size=3, num_samples_per_condition=n) for n in shares),
+        Counter(),
+    )
+    assert counts == {0: 3, 1: 3, 2: 3, 3: 3}
+    # Invalid runs fail before any worker is started.
+    with pytest.raises(ValueError):
+        generator.generate_parallel(
+            num_workers=2, batch_size=3, num_batches=1, output_dir=str(tmp_path)
+        )
+
+
+def test_split_target_compositions_across_workers():
+    generator = CrystalGenerator(
+        checkpoint_info=MatterGenCheckpointInfo(model_path="unused"),  # type: ignore
+    )
+    target_compositions_dict = [{"Fe": 1}, {"Na": 1, "Cl": 1}, {"Li": 2, "O": 1}]
+    shares = generator.split_samples_across_workers(
+        2, batch_size=4, num_batches=3, target_compositions_dict=target_compositions_dict
+    )
+    assert shares == [2, 2]
+    counts = sum(
+        (
+            _count_conditions(
+                generator,
+                batch_size=4,
+                num_samples_per_condition=n,
+                target_compositions_dict=target_compositions_dict,
+            )
+            for n in shares
+        ),
+        Counter(),
+    )
+    # As many structures per composition (told apart by their number of atoms) as in a single process.
+    assert counts == {1: 4, 2: 4, 3: 4}
+    # Without conditions, the workers get whole batches.
+    assert generator.split_samples_across_workers(2, batch_size=4, num_batches=3) == [8, 4]
@@ -8,8 +8,18 @@ from torch_scatter import scatter_add
 from mattergen.common.data.chemgraph import ChemGraph
 from mattergen.common.data.collate import collate
 from mattergen.common.data.transform import set_chemical_system_string
-from mattergen.common.utils.globals import MAX_ATOMIC_NUM
-from mattergen.denoiser import mask_disallowed_elements
+from mattergen.common.gemnet.gemnet import GemNetT
+from mattergen.common.gemnet.layers.embedding_block import AtomEmbedding
+from mattergen.common.tests.testutils import get_mp_20_debug_batch
+from mattergen.common.utils.data_utils import lattice_params_to_matrix_torch
+from mattergen.common.utils.globals import MAX_ATOMIC_NUM, MODELS_PROJECT_ROOT
+from mattergen.denoiser import GemNetTDenoiser, mask_disallowed_elements
+from mattergen.diffusion.inference_options import (
+    CompiledFunction,
+    InferenceCache,
+    InferenceOptions,
+    using_inference_options,
+)
 from mattergen.property_embeddings import (
     ChemicalSystemMultiHotEmbedding,
     SetConditionalEmbeddingType,
@@ -251,3 +261,129 @@ def test_mask_disallowed_elements(zero_based_predictions: bool):
             assert set(sampled_types).difference(set(chemsys)) == set()
         else:
             assert set(sampled_types).difference(set(chemsys)) != set()
+
+
+def _get_denoiser_and_batch(
+    num_structures: int | None = None,
+) -> tuple[GemNetTDenoiser, ChemGraph]:
+    torch.manual_seed(0)
+    hidden_dim = 64
+    gemnet = GemNetT(
+        atom_embedding=AtomEmbedding(emb_size=hidden_dim),
+        num_targets=1,
+        latent_dim=hidden_dim,
+        num_blocks=2,
+        emb_size_atom=hidden_dim,
+        emb_size_edge=hidden_dim,
+        emb_size_trip=hidden_dim // 2,
+        emb_size_bil_trip=hidden_dim // 2,
+        max_neighbors=20,
+        cutoff=5.0,
+        otf_graph=True,
+        regress_stress=True,
+        scale_file=f"{MODELS_PROJECT_ROOT}/common/gemnet/gemnet-dT.json",
+    )
+    denoiser = GemNetTDenoiser(gemnet=gemnet, hidden_dim=hidden_dim).eval()
+    debug_batch = get_mp_20_debug_batch()
+    batch = collate(
+        [
+            ChemGraph(
+                pos=frac_coords,
+                cell=cell[None],
+                atomic_numbers=atomic_numbers,
+                num_atoms=num_atoms,
+            )
+            for frac_coords, cell, atomic_numbers, num_atoms in list(
+                zip(
+                    debug_batch.frac_coords.split(debug_batch.num_atoms.tolist()),
+                    lattice_params_to_matrix_torch(debug_batch.lengths, debug_batch.angles),
+                    debug_batch.atom_types.split(debug_batch.num_atoms.tolist()),
+                    debug_batch.num_atoms,
+                )
+            )[:num_structures]
+        ]
+    )
+    return denoiser, batch
+
+
+def test_mixed_precision_scores_match_full_precision():
+    denoiser, batch = _get_denoiser_and_batch()
+    t = torch.rand(batch.get_batch_size())
+    with torch.inference_mode():
+        reference = denoiser(batch, t)
+        with using_inference_options(InferenceOptions(precision="32")):
+            full_precision = denoiser(batch, t)
+        with using_inference_options(InferenceOptions(precision="bf16-mixed")):
+            mixed_precision = denoiser(batch, t)
+
+    for field in ["pos", "cell", "atomic_numbers"]:
+        assert torch.equal(full_precision[field], reference[field])
+        assert mixed_precision[field].dtype == torch.float32
+        relative_error = (mixed_precision[field] - reference[field]).norm() / reference[
+            field
+        ].norm()
+        assert relative_error < 0.05
+
+
+def test_compiled_scores_match_eager():
+    torch._dynamo.reset()
+    # Not 64 structures: sizes that equal a static size, here the hidden dimension, are specialized on.
+    denoiser, batch = _get_denoiser_and_batch(num_structures=40)
+    _, smaller_batch = _get_denoiser_and_batch(num_structures=10)
+    num_graphs = 0
+
+    def counting_backend(graph_module: torch.fx.GraphModule, example_inputs):
+        nonlocal num_graphs
+        num_graphs += 1
+        return graph_module.forward
+
+    # Compiling with the default backend takes minutes, tracing is what may break with dynamic sizes.
+    gemnet = denoiser.gemnet
+    gemnet._compiled_interaction_blocks = CompiledFunction(
+        gemnet._interaction_blocks, backend=counting_backend
+    )
+    for b in [batch, smaller_batch]:
+        t = torch.rand(b.get_batch_size())
+        with torch.inference_mode():
+            eager = denoiser(b, t)
+            with using_inference_options(InferenceOptions(compile_model=True)):
+                compiled = denoiser(b, t)
+        for field in ["pos", "cell", "atomic_numbers"]:
+            torch.testing.assert_close(compiled[field], eager[field])
+
+    # Batches with different numbers of atoms, edges and triplets share a single graph.
+    assert num_graphs == 1
+    assert not gemnet._compiled_interaction_blocks._failed
+
+
+def test_cached_conditioning_matches_uncached():
+    denoiser, batch = _get_denoiser_and_batch(num_structures=10)
+    batch = batch.replace(chemical_system=["Li-O"] * 5 + ["Na-Cl"] * 5)
+    conditional = replace_use_unconditional_embedding(
+        batch=batch, use_unconditional_embedding={"chemical_system": torch.zeros(10, 1, dtype=torch.bool)}  # type: ignore
+    )
+    unconditional = replace_use_unconditional_embedding(
+        batch=batch, use_unconditional_embedding={"chemical_system": torch.ones(10, 1, dtype=torch.bool)}  # type: ignore
+    )
+    logits = torch.randn(batch["pos"].shape[0], MAX_ATOMIC_NUM)
+    batch_idx = batch.get_batch_idx("pos")
+    cache = InferenceCache()
+    for x in [conditional, unconditional]:
+        t = torch.rand(batch.get_batch_size())
+        with torch.inference_mode():
+            uncached_scores = denoiser(x, t)
+            uncached_logits = mask_disallowed_elements(logits, x=x, batch_idx=batch_idx)
+            with using_inference_options(InferenceOptions(), cache):
+                # Steps of the same batch reuse the cached values.
+                for _ in range(2):
+                    scores = denoiser(x.replace(pos=x["pos"]), t)
+                    masked_logits = mask_disallowed_elements(logits, x=x, batch_idx=batch_idx)
+                    for field in ["pos", "cell", "atomic_numbers"]:
+                        assert torch.equal(scores[field], uncached_scores[field])
+                    assert torch.equal(masked_logits, uncached_logits)
+
+    # The conditional and unconditional batches each have their own element masks. The denoiser has
+    # no property embeddings, which therefore do not depend on the chemical system.
+    assert cache.num_conditioning_entries == 3
+    cache.clear()
+    assert cache.num_conditioning_entries == 0